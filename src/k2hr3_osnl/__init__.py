@@ -22,6 +22,7 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 __all__ = [
+    'K2hr3BatchNotificationEndpoint',
     'K2hr3Conf',
     'K2hr3ConfError',
     'K2hr3NotificationEndpoint',
@@ -38,17 +39,37 @@ import logging
 from logging.handlers import TimedRotatingFileHandler
 from logging import StreamHandler
 from pathlib import Path
+import queue
+import signal
 import sys
+import threading
 import time
+from typing import Any, List, Tuple  # noqa
 
 import oslo_config  # type: ignore
 import oslo_messaging  # type: ignore
 
+from k2hr3_osnl.breaker import _circuit_breakers, _update_circuit_breakers
 from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.checkpoint import _checkpoint_retries, _replay_retries
 from k2hr3_osnl.exceptions import K2hr3Error
 from k2hr3_osnl.exceptions import K2hr3ConfError
 from k2hr3_osnl.exceptions import K2hr3NotificationEndpointError
+from k2hr3_osnl.dispatcher import _get_batch_notification_listener
+from k2hr3_osnl.dispatcher import _K2hr3NotificationListeners
+from k2hr3_osnl.engine import _stop_delivery_engine
+from k2hr3_osnl.endpoint import K2hr3BatchNotificationEndpoint
 from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.metrics import _get_metrics, _merge_families, _start_metrics_server, _stop_metrics_server  # noqa
+from k2hr3_osnl.prefilter import _get_prefilter, _update_prefilter
+from k2hr3_osnl.resolver import _get_resolver
+from k2hr3_osnl.retry import _get_retry_scheduler
+from k2hr3_osnl.shard import _stop_shard_dispatcher
+from k2hr3_osnl.spool import _get_spool, _stop_spool
+from k2hr3_osnl.supervisor import _K2hr3Supervisor
+from k2hr3_osnl.throttle import _get_throttle, _update_throttle
+from k2hr3_osnl.tls import _reset_ssl_contexts
+from k2hr3_osnl.useragent import _replay_spooled
 
 LOG = logging.getLogger(__name__)
 
@@ -96,13 +117,40 @@ def main() -> int:
     parser.add_argument('-v',
                         action='version',
                         version='%(prog)s ' + __version__)
+    parser.add_argument(
+        '-w',
+        '--workers',
+        dest='workers',
+        type=int,
+        default=0,
+        help='number of listener processes. default: 0 runs a listener in'
+        ' this process')
     args = parser.parse_args()
 
     try:
         conf = K2hr3Conf(Path(args.config_file))
         _configure_logger(args, conf)  # logger configured by args and conf.
-        endpoints = [K2hr3NotificationEndpoint(conf)]
-        sys.exit(listen(endpoints))
+        endpoints = _build_endpoints(conf)
+        if args.workers > 0:
+            # workers inherit the endpoints and listen in the same pool.
+            supervisor = _K2hr3Supervisor(
+                args.workers,
+                lambda: listen(endpoints),
+                stats=lambda: _worker_stats(endpoints),
+                shutdown_timeout=conf.k2hr3.drain_timeout_seconds + 10)
+            # serves the metrics the workers report.
+            _start_metrics_server(
+                conf, lambda: _get_metrics().render(
+                    _merge_families(supervisor.metrics)))
+            try:
+                sys.exit(supervisor.run())
+            finally:
+                _stop_metrics_server()
+        _start_metrics_server(conf)
+        try:
+            sys.exit(listen(endpoints))
+        finally:
+            _stop_metrics_server()
     except K2hr3Error as error:
         LOG.error('K2hr3Error error, %s', error)
         raise K2hr3Error("K2hr3 RuntimeError") from error
@@ -111,6 +159,141 @@ def main() -> int:
         raise RuntimeError("Unknown RuntimeError") from error
 
 
+def _build_endpoints(conf: K2hr3Conf) -> list[K2hr3NotificationEndpoint]:
+    """Build endpoints by the configuration.
+
+    :param conf: configuration
+    :type conf: K2hr3Conf
+    :returns: an endpoint per subscription, or an endpoint if no subscription
+    :rtype: list
+    """
+    endpoint_class = K2hr3NotificationEndpoint
+    if conf.oslo_messaging_notifications.batch_size > 0:
+        endpoint_class = K2hr3BatchNotificationEndpoint
+    subscriptions = conf.oslo_messaging_notifications.subscriptions
+    if subscriptions:
+        # a listener per target serves the endpoints of the target.
+        return [endpoint_class(conf, name) for name in subscriptions]
+    return [endpoint_class(conf)]
+
+
+def _worker_stats(
+        endpoints: list[K2hr3NotificationEndpoint]) -> dict[str, object]:
+    """Return stats of the process reported to the supervisor.
+
+    :param endpoints: endpoints of the process
+    :type endpoints: list
+    :returns: stats of the dedup caches, the retries, the resolver, the
+              spool and the metrics
+    :rtype: dict
+    """
+    conf = endpoints[0].conf
+    spool = _get_spool(conf)
+    return {
+        'dedup': [endpoint.dedup.stats for endpoint in endpoints],
+        'retry': _get_retry_scheduler(conf).stats,
+        'resolver': _get_resolver().stats,
+        'shards': endpoints[0].shards.stats if endpoints[0].shards else {},
+        'spool': spool.stats if spool else {},
+        'metrics': _get_metrics().collect(),
+    }
+
+
+def _register_metrics(endpoints: list[K2hr3NotificationEndpoint]) -> None:
+    """Register the metrics read from the endpoints when collected.
+
+    The configuration is read from the endpoints every time, so that the
+    metrics follow a reload.
+
+    :param endpoints: endpoints of the process
+    :type endpoints: list
+    """
+    metrics = _get_metrics()
+
+    def retries() -> dict[tuple[str, ...], float]:
+        stats = _get_retry_scheduler(endpoints[0].conf).stats
+        return {(outcome, ): value for outcome, value in stats.items()}
+
+    def inflight() -> dict[tuple[str, ...], float]:
+        return {(): _get_retry_scheduler(endpoints[0].conf).inflight}
+
+    def depths() -> dict[tuple[str, ...], float]:
+        shards = endpoints[0].shards
+        if shards is None:
+            return {}
+        return {(str(index), ): depth
+                for index, depth in enumerate(shards.depths)}
+
+    def duplicates() -> dict[tuple[str, ...], float]:
+        return {(): sum(endpoint.dedup.stats['hits']
+                        for endpoint in endpoints)}
+
+    def spooled() -> dict[tuple[str, ...], float]:
+        spool = _get_spool(endpoints[0].conf)
+        if spool is None:
+            return {}
+        return {(outcome, ): value for outcome, value in spool.stats.items()}
+
+    def spool_bytes() -> dict[tuple[str, ...], float]:
+        spool = _get_spool(endpoints[0].conf)
+        return {(): spool.size} if spool else {}
+
+    def circuits() -> dict[tuple[str, ...], float]:
+        return {(url, state): float(breaker.state == state)
+                for url, breaker in _circuit_breakers().items()
+                for state in ('closed', 'open', 'half-open')}
+
+    def requests_inflight() -> dict[tuple[str, ...], float]:
+        throttle = _get_throttle(endpoints[0].conf)
+        return {(): throttle.inflight} if throttle else {}
+
+    def rejected() -> dict[tuple[str, ...], float]:
+        return {(url, ): breaker.stats['rejected']
+                for url, breaker in _circuit_breakers().items()}
+
+    def lookups() -> dict[tuple[str, ...], float]:
+        return {(outcome, ): value
+                for outcome, value in _get_resolver().stats.items()}
+
+    def prefiltered() -> dict[tuple[str, ...], float]:
+        prefilter = _get_prefilter()
+        if prefilter is None:
+            return {}
+        return {(outcome, ): value
+                for outcome, value in prefilter.stats.items()}
+
+    metrics.collector('k2hr3_osnl_retries_total', 'counter',
+                      'Retries of api requests by the outcome.', retries,
+                      ('outcome', ))
+    metrics.collector('k2hr3_osnl_retries_inflight', 'gauge',
+                      'Retries waiting or running.', inflight)
+    metrics.collector('k2hr3_osnl_shard_queue_depth', 'gauge',
+                      'Messages waiting or running in each shard.', depths,
+                      ('shard', ))
+    metrics.collector('k2hr3_osnl_duplicates_skipped_total', 'counter',
+                      'Messages of members removed recently.', duplicates)
+    metrics.collector('k2hr3_osnl_spool_records_total', 'counter',
+                      'Spooled requests by the outcome.', spooled,
+                      ('outcome', ))
+    metrics.collector('k2hr3_osnl_spool_bytes', 'gauge',
+                      'Bytes of the spool segments.', spool_bytes)
+    metrics.collector('k2hr3_osnl_circuit_state', 'gauge',
+                      '1 for the current state of the circuit of an api.',
+                      circuits, ('url', 'state'))
+    metrics.collector('k2hr3_osnl_circuit_rejected_total', 'counter',
+                      'Requests not sent because the circuit is open.',
+                      rejected, ('url', ))
+    metrics.collector('k2hr3_osnl_requests_inflight', 'gauge',
+                      'Requests to the k2hr3 api in flight.',
+                      requests_inflight)
+    metrics.collector('k2hr3_osnl_prefilter_messages_total', 'counter',
+                      'Messages screened before decoding by the outcome.',
+                      prefiltered, ('outcome', ))
+    metrics.collector('k2hr3_osnl_resolver_lookups_total', 'counter',
+                      'Name lookups of the api hosts by the outcome.',
+                      lookups, ('outcome', ))
+
+
 _nametolevel = {
     'error': logging.ERROR,
     'warn': logging.WARNING,
@@ -128,21 +311,12 @@ def _configure_logger(args, conf) -> bool:  # noqa  # pylint: disable=missing-ty
     :returns: True if success, otherwise False
     :rtype: bool
     """
-    # We prefer args than configuration file.
-    # 1. debug_level
-    debug_level = logging.WARNING
-    if args.debug_level is not None:
-        debug_level = _nametolevel.get(args.debug_level, logging.WARNING)
-    else:
-        debug_level = _nametolevel.get(conf.debug_level, logging.WARNING)
-    LOG.setLevel(debug_level)
-
-    # 2. formatter
+    # 1. formatter
     formatter = logging.Formatter(
         '%(asctime)-15s %(levelname)s %(name)s:%(lineno)d %(message)s'
     )  # hardcoding
 
-    # 3. log_file
+    # 2. log_file
     if args.log_file is not None:
         # check the permission of the destination file.
         # if unable to open it, use default(stderr).
@@ -168,9 +342,37 @@ def _configure_logger(args, conf) -> bool:  # noqa  # pylint: disable=missing-ty
             handler.setFormatter(formatter)
             LOG.addHandler(handler)
 
-    # 3. libs_debug_level
+    # 3. debug_level and libs_debug_level
+    _set_log_levels(args, conf)
+    return True
+
+
+_LOG_ARGS = None  # command line args preferred on reload too.
+
+
+def _set_log_levels(args, conf) -> None:  # noqa  # pylint: disable=missing-type-doc
+    """Set log levels by args and conf.
+
+    :param args: command line args. The last args are used if None.
+    :param conf: configuration
+    """
+    global _LOG_ARGS  # pylint: disable=global-statement
+    if args is None:
+        args = _LOG_ARGS
+    _LOG_ARGS = args
+
+    # We prefer args than configuration file.
+    # 1. debug_level
+    debug_level = logging.WARNING
+    if args is not None and args.debug_level is not None:
+        debug_level = _nametolevel.get(args.debug_level, logging.WARNING)
+    else:
+        debug_level = _nametolevel.get(conf.debug_level, logging.WARNING)
+    LOG.setLevel(debug_level)
+
+    # 2. libs_debug_level
     libs_debug_level = logging.WARNING
-    if args.libs_debug_level is not None:
+    if args is not None and args.libs_debug_level is not None:
         libs_debug_level = _nametolevel.get(args.libs_debug_level,
                                             logging.WARNING)
     else:
@@ -183,8 +385,6 @@ def _configure_logger(args, conf) -> bool:  # noqa  # pylint: disable=missing-ty
     for i in libs:
         logging.getLogger(i).setLevel(libs_debug_level)
 
-    return True
-
 
 def listen(endpoints: list[K2hr3NotificationEndpoint]) -> int:
     """Run a oslo_messaging notification listener for k2hr3.
@@ -216,31 +416,35 @@ def listen(endpoints: list[K2hr3NotificationEndpoint]) -> int:
     conf = my_endpoint.conf
     assert isinstance(conf, K2hr3Conf)
 
+    # 3. batch endpoints receive a list of messages.
+    batch_size = conf.oslo_messaging_notifications.batch_size
+    if batch_size > 0 and not all(
+            isinstance(e, K2hr3BatchNotificationEndpoint) for e in endpoints):
+        LOG.error('batch_size requires K2hr3BatchNotificationEndpoint, %s',
+                  endpoints)
+        return 1
+
     try:
-        # transport, targets
-        transport = oslo_messaging.get_notification_transport(
-            oslo_config.cfg.CONF,
-            url=conf.oslo_messaging_notifications.transport_url)
-        targets = [
-            oslo_messaging.Target(
-                topic=conf.oslo_messaging_notifications.topic,
-                exchange=conf.oslo_messaging_notifications.exchange)
-        ]
-        listener = oslo_messaging.get_notification_listener(
-            transport,
-            targets,
-            endpoints,
-            pool=conf.oslo_messaging_notifications.pool,
-            executor=conf.oslo_messaging_notifications.executor,
-            allow_requeue=conf.oslo_messaging_notifications.allow_requeue)
-        listener.start()
-        LOG.info('Starting')
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        LOG.info('Stopping')
-        listener.stop()
-        listener.wait()
+        _register_metrics(endpoints)
+        _update_prefilter(conf, [e.prefilter_rule for e in endpoints])
+        listener = _get_listener(endpoints, conf)
+        _replay_retries(conf)
+        spool = _get_spool(conf)
+        if spool is not None:
+            spool.start(_replay_spooled)
+        signals = queue.SimpleQueue()  # type: queue.SimpleQueue[int]
+        previous = _set_signal_handlers(signals)
+        try:
+            listener.start()
+            LOG.info('Starting')
+            # SIGHUP reloads the configuration, the others stop.
+            while _wait_for_signal(signals) == signal.SIGHUP:
+                listener, conf = _reload(endpoints, listener, conf)
+            LOG.info('Stopping')
+            _drain(listener, conf)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
     except NotImplementedError:
         LOG.error('allow_requeue is not supported by driver')
         return 1
@@ -250,6 +454,251 @@ def listen(endpoints: list[K2hr3NotificationEndpoint]) -> int:
     return 0
 
 
+def _get_listener(endpoints: list[K2hr3NotificationEndpoint],
+                  conf: K2hr3Conf) -> Any:
+    """Build notification listeners of the endpoints.
+
+    A listener is built per target, so that an endpoint receives the
+    messages of its own target only. The listeners share a transport.
+
+    :param endpoints: endpoints to be called by the dispatcher
+    :type endpoints: list
+    :param conf: configuration
+    :type conf: K2hr3Conf
+    :returns: the notification listeners, not started yet
+    :rtype: _K2hr3NotificationListeners
+    """
+    # transport, targets
+    transport = oslo_messaging.get_notification_transport(
+        oslo_config.cfg.CONF,
+        url=conf.oslo_messaging_notifications.transport_url)
+    # endpoints of subscriptions with the same target share a listener.
+    targets = []  # type: List[Tuple[Any, List[K2hr3NotificationEndpoint]]]
+    for endpoint in endpoints:
+        for target, target_endpoints in targets:
+            if target == endpoint.target:
+                target_endpoints.append(endpoint)
+                break
+        else:
+            targets.append((endpoint.target, [endpoint]))
+    LOG.debug('targets %s', [target for target, _ in targets])
+    batch_size = conf.oslo_messaging_notifications.batch_size
+    listeners = []
+    for target, target_endpoints in targets:
+        if batch_size > 0:
+            # acknowledges each message of a batch.
+            listener = _get_batch_notification_listener(
+                transport,
+                [target],
+                target_endpoints,
+                pool=conf.oslo_messaging_notifications.pool,
+                executor=conf.oslo_messaging_notifications.executor,
+                allow_requeue=conf.oslo_messaging_notifications.allow_requeue,
+                batch_size=batch_size,
+                batch_timeout=conf.oslo_messaging_notifications.batch_timeout)
+        else:
+            listener = oslo_messaging.get_notification_listener(
+                transport,
+                [target],
+                target_endpoints,
+                pool=conf.oslo_messaging_notifications.pool,
+                executor=conf.oslo_messaging_notifications.executor,
+                allow_requeue=conf.oslo_messaging_notifications.allow_requeue)
+        listeners.append(listener)
+    return _K2hr3NotificationListeners(transport, listeners)
+
+
+def _set_signal_handlers(signals: queue.SimpleQueue) -> dict[int, Any]:
+    """Put SIGTERM, SIGINT and SIGHUP to the queue when they arrive.
+
+    Signal handlers can be set in the main thread only. In the other
+    threads, no handler is set.
+
+    :param signals: a queue of signal numbers
+    :type signals: queue.SimpleQueue
+    :returns: the previous handlers
+    :rtype: dict
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return {}
+
+    def on_signal(signum, frame):  # pylint: disable=unused-argument
+        # SimpleQueue.put is reentrant, so it is safe in a signal handler.
+        signals.put(signum)
+
+    return {
+        signum: signal.signal(signum, on_signal)
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+    }
+
+
+def _wait_for_signal(signals: queue.SimpleQueue) -> int:
+    """Block until a signal arrives.
+
+    :param signals: a queue of signal numbers
+    :type signals: queue.SimpleQueue
+    :returns: the signal number. SIGINT on KeyboardInterrupt.
+    :rtype: int
+    """
+    try:
+        while True:
+            try:
+                # waits with a timeout, so that signal handlers run in time.
+                signum = signals.get(timeout=1)
+            except queue.Empty:
+                continue
+            LOG.info('signal %s received', signum)
+            return signum
+    except KeyboardInterrupt:
+        return signal.SIGINT
+
+
+def _transport_settings(endpoints: list[K2hr3NotificationEndpoint],
+                        conf: K2hr3Conf) -> tuple[Any, ...]:
+    """Return the settings the listener is built with.
+
+    :param endpoints: endpoints of the listener
+    :type endpoints: list
+    :param conf: configuration
+    :type conf: K2hr3Conf
+    :returns: the settings which require a new listener if changed
+    :rtype: tuple
+    """
+    oslo = conf.oslo_messaging_notifications
+    return (oslo.transport_url, oslo.pool, oslo.executor, oslo.allow_requeue,
+            oslo.batch_size, oslo.batch_timeout,
+            tuple((endpoint.target.topic, endpoint.target.exchange)
+                  for endpoint in endpoints))
+
+
+def _reload(endpoints: list[K2hr3NotificationEndpoint], listener: Any,
+            conf: K2hr3Conf) -> tuple[Any, K2hr3Conf]:
+    """Re-read the configuration file and apply it.
+
+    The settings read on every message (the api url, the timeouts, the
+    retry policy, the TLS files, the filters and the log levels) are
+    swapped in the endpoints without stopping the listener. The listener is
+    rebuilt only if the transport settings or the targets changed. If the
+    new configuration is invalid, the current one is kept.
+
+    :param endpoints: endpoints of the listener
+    :type endpoints: list
+    :param listener: the running listener
+    :type listener: _K2hr3NotificationListeners
+    :param conf: the current configuration
+    :type conf: K2hr3Conf
+    :returns: the listener and the configuration in use
+    :rtype: tuple
+    """
+    LOG.info('reloading %s', conf.path)
+    try:
+        new_conf = K2hr3Conf(conf.path)
+        new_conf.validate()
+    except K2hr3ConfError as error:
+        LOG.error('reload failed, keeps the current configuration. %s', error)
+        return listener, conf
+    old, new = conf.oslo_messaging_notifications, \
+        new_conf.oslo_messaging_notifications
+    if (old.batch_size > 0) != (new.batch_size > 0) or \
+            old.subscriptions != new.subscriptions:
+        # the endpoints would have to be rebuilt.
+        LOG.error('reload rejected, changing the subscriptions or enabling'
+                  ' batch_size requires a restart.')
+        return listener, conf
+
+    settings = _transport_settings(endpoints, conf)
+    reloaded = []  # type: List[K2hr3NotificationEndpoint]
+    try:
+        for endpoint in endpoints:
+            endpoint.reload(new_conf)
+            reloaded.append(endpoint)
+        if _transport_settings(endpoints, new_conf) != settings:
+            listener = _restart_listener(endpoints, listener, new_conf)
+    except (K2hr3NotificationEndpointError, oslo_messaging.MessagingException,
+            NotImplementedError) as error:
+        LOG.error('reload failed, keeps the current configuration. %s', error)
+        for endpoint in reloaded:
+            endpoint.reload(conf)  # the current one is known to be valid.
+        return listener, conf
+    _reset_ssl_contexts()  # reads renewed certificates.
+    _get_retry_scheduler(new_conf)  # updates max_inflight_retries.
+    _update_circuit_breakers(new_conf)
+    _update_throttle(new_conf)
+    _update_prefilter(new_conf, [e.prefilter_rule for e in endpoints])
+    spool = _get_spool(new_conf)  # replays with the new api url.
+    if spool is not None:
+        spool.start(_replay_spooled)
+    _set_log_levels(None, new_conf)
+    LOG.info('reloaded %s', conf.path)
+    return listener, new_conf
+
+
+def _restart_listener(endpoints: list[K2hr3NotificationEndpoint],
+                      listener: Any, conf: K2hr3Conf) -> Any:
+    """Replace the listener with a listener built by the configuration.
+
+    Messages in flight are finished by the current listener before the new
+    one starts. If the new listener fails to start, the current one is
+    started again.
+
+    :param endpoints: endpoints of the listener
+    :type endpoints: list
+    :param listener: the running listener
+    :type listener: _K2hr3NotificationListeners
+    :param conf: the new configuration
+    :type conf: K2hr3Conf
+    :returns: the new listener
+    :rtype: _K2hr3NotificationListeners
+    :raises oslo_messaging.MessagingException: if failed to build or start.
+    """
+    # builds the new one first, so that an invalid transport_url raises here.
+    new_listener = _get_listener(endpoints, conf)
+    LOG.info('transport settings changed, restarting the listener.')
+    listener.stop()
+    listener.wait()
+    try:
+        new_listener.start()
+    except oslo_messaging.MessagingException:
+        listener.start()
+        raise
+    listener.transport.cleanup()
+    return new_listener
+
+
+def _drain(listener: Any, conf: K2hr3Conf) -> None:
+    """Stop consuming messages and finish in-flight deliveries.
+
+    In-flight messages are given drain_timeout_seconds to finish. A message
+    not finished in time is not acknowledged and the message queue server
+    redelivers it. The deliveries of such messages queued in the shards or
+    sent in the asyncio engine are cancelled, so that no thread keeps the
+    process alive. Retries of acknowledged messages not started yet are
+    saved to retry_checkpoint_file and replayed on the next start. The
+    spool is stopped last because the deliveries stopped before may spool
+    their requests. It is replayed on the next start too.
+
+    :param listener: the notification listener
+    :type listener: _K2hr3NotificationListeners
+    :param conf: configuration
+    :type conf: K2hr3Conf
+    """
+    deadline = time.monotonic() + conf.k2hr3.drain_timeout_seconds
+    listener.stop()
+    waiter = threading.Thread(target=listener.wait, name='k2hr3-drain')
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(max(0, deadline - time.monotonic()))
+    drained = not waiter.is_alive()
+    if not drained:
+        LOG.warning('in-flight messages did not finish in %ss, the message'
+                    ' queue server redelivers them.',
+                    conf.k2hr3.drain_timeout_seconds)
+    _checkpoint_retries(conf, _get_retry_scheduler(conf).stop())
+    _stop_shard_dispatcher(wait=drained)
+    _stop_delivery_engine(wait=drained)
+    _stop_spool()
+
+
 if __name__ == "__main__":
     sys.exit(main())
 
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Stop sending requests to an unhealthy k2hr3 api for a while."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+from collections import deque
+import logging
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+
+LOG = logging.getLogger(__name__)
+
+_CLOSED = 'closed'
+_OPEN = 'open'
+_HALF_OPEN = 'half-open'
+# number of the last requests to compute the error ratio.
+_WINDOW = 20
+
+
+class _K2hr3CircuitBreaker:
+    """A circuit breaker of an api url.
+
+    The circuit opens when the errors of the last requests reach
+    breaker_error_ratio, or when breaker_consecutive_timeouts requests
+    time out in a row. While open, requests are rejected without
+    connecting. After breaker_open_seconds, a request is let through as a
+    probe. The circuit closes if the probe succeeds, otherwise opens again.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.breaker import _K2hr3CircuitBreaker
+    >>> breaker = _K2hr3CircuitBreaker('http://127.0.0.1/v1/role', 0.5, 3, 30)
+    >>> for _ in range(3):
+    ...     breaker.record(False, timeout=True)
+    >>> breaker.state
+    'open'
+    >>> breaker.allow()
+    False
+    """
+
+    def __init__(self, url: str, error_ratio: float,
+                 consecutive_timeouts: int, open_seconds: float,
+                 window: int = _WINDOW) -> None:
+        """Initialize attributes.
+
+        :param url: api url
+        :type url: str
+        :param error_ratio: ratio of errors to open. 0 disables it.
+        :type error_ratio: float
+        :param consecutive_timeouts: timeouts in a row to open. 0 disables
+                                     it.
+        :type consecutive_timeouts: int
+        :param open_seconds: seconds to reject requests before a probe
+        :type open_seconds: float
+        :param window: number of the last requests to compute the ratio
+        :type window: int
+        """
+        self._url = url
+        self._error_ratio = error_ratio
+        self._consecutive_timeouts = consecutive_timeouts
+        self._open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._results = deque(maxlen=window)  # type: deque[bool]
+        self._timeouts = 0
+        self._state = _CLOSED
+        self._until = 0.0  # the time to probe if open, or to probe again.
+        self._stats = {'opened': 0, 'rejected': 0}
+
+    @property
+    def state(self) -> str:
+        """Returns the state of the circuit.
+
+        :returns: 'closed', 'open' or 'half-open'
+        :rtype: str
+        """
+        return self._state
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Returns counters of the circuit.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def update(self, error_ratio: float, consecutive_timeouts: int,
+               open_seconds: float) -> None:
+        """Apply new thresholds.
+
+        :param error_ratio: ratio of errors to open. 0 disables it.
+        :type error_ratio: float
+        :param consecutive_timeouts: timeouts in a row to open. 0 disables
+                                     it.
+        :type consecutive_timeouts: int
+        :param open_seconds: seconds to reject requests before a probe
+        :type open_seconds: float
+        """
+        with self._lock:
+            self._error_ratio = error_ratio
+            self._consecutive_timeouts = consecutive_timeouts
+            self._open_seconds = open_seconds
+
+    def allow(self) -> bool:
+        """Returns True if a request can be sent.
+
+        :returns: False if the circuit is open or a probe is in flight
+        :rtype: bool
+        """
+        if self._state == _CLOSED:  # reads without the lock on the hot path.
+            return True
+        with self._lock:
+            if self._state == _CLOSED:
+                return True
+            now = time.monotonic()
+            if now < self._until:
+                self._stats['rejected'] += 1
+                return False
+            # probes again if the last probe did not report in time.
+            self._state = _HALF_OPEN
+            self._until = now + self._open_seconds
+            LOG.warning('circuit half-open, probing %s', self._url)
+            return True
+
+    def record(self, success: bool, timeout: bool = False) -> None:
+        """Record the result of a request.
+
+        :param success: True if the api responded without a server error
+        :type success: bool
+        :param timeout: True if the request timed out
+        :type timeout: bool
+        """
+        with self._lock:
+            if self._state == _HALF_OPEN:
+                if success:
+                    self._close()
+                else:
+                    self._open('the probe failed')
+                return
+            if self._state == _OPEN:
+                return  # sent before the circuit opened.
+            self._results.append(success)
+            self._timeouts = self._timeouts + 1 if timeout else 0
+            if 0 < self._consecutive_timeouts <= self._timeouts:
+                self._open(f'{self._timeouts} timeouts in a row')
+                return
+            errors = self._results.count(False)
+            if self._error_ratio > 0 and \
+                    len(self._results) == self._results.maxlen and \
+                    errors >= self._error_ratio * len(self._results):
+                self._open(f'{errors} errors in {len(self._results)}'
+                           ' requests')
+
+    def _open(self, reason: str) -> None:
+        """Open the circuit. The caller must hold the lock."""
+        self._state = _OPEN
+        self._until = time.monotonic() + self._open_seconds
+        self._stats['opened'] += 1
+        LOG.error('circuit open for %ss, %s. %s', self._open_seconds, reason,
+                  self._url)
+
+    def _close(self) -> None:
+        """Close the circuit. The caller must hold the lock."""
+        self._state = _CLOSED
+        self._results.clear()
+        self._timeouts = 0
+        LOG.warning('circuit closed, %s recovered', self._url)
+
+
+# api url => circuit breaker
+_BREAKERS = {}  # type: Dict[str, _K2hr3CircuitBreaker]
+_BREAKERS_LOCK = threading.Lock()
+
+
+def _get_circuit_breaker(conf: K2hr3Conf,
+                         url: str) -> _K2hr3CircuitBreaker | None:
+    """Return the circuit breaker of the api url.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param url: api url
+    :type url: str
+    :returns: the circuit breaker or None if circuit_breaker is False
+    :rtype: _K2hr3CircuitBreaker
+    """
+    if not conf.k2hr3.circuit_breaker:
+        return None
+    breaker = _BREAKERS.get(url, None)
+    if breaker is not None:
+        return breaker
+    with _BREAKERS_LOCK:
+        if url not in _BREAKERS:
+            _BREAKERS[url] = _K2hr3CircuitBreaker(
+                url, conf.k2hr3.breaker_error_ratio,
+                conf.k2hr3.breaker_consecutive_timeouts,
+                conf.k2hr3.breaker_open_seconds)
+        return _BREAKERS[url]
+
+
+def _update_circuit_breakers(conf: K2hr3Conf) -> None:
+    """Apply the thresholds of the configuration to the circuit breakers.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    """
+    with _BREAKERS_LOCK:
+        breakers = list(_BREAKERS.values())
+    for breaker in breakers:
+        breaker.update(conf.k2hr3.breaker_error_ratio,
+                       conf.k2hr3.breaker_consecutive_timeouts,
+                       conf.k2hr3.breaker_open_seconds)
+
+
+def _circuit_breakers() -> dict[str, _K2hr3CircuitBreaker]:
+    """Returns the circuit breakers by the api url.
+
+    :returns: a copy of the circuit breakers
+    :rtype: dict
+    """
+    with _BREAKERS_LOCK:
+        return dict(_BREAKERS)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -21,6 +21,7 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+from collections.abc import Mapping
 import logging
 from pathlib import Path
 from typing import List, Set, Dict, Tuple, Optional  # noqa: pylint: disable=unused-import
@@ -30,6 +31,9 @@ from k2hr3_osnl.exceptions import K2hr3ConfError
 
 LOG = logging.getLogger(__name__)
 
+# A subscription named <name> is configured in the [subscription:<name>].
+_SUBSCRIPTION_PREFIX = 'subscription:'
+
 
 class K2hr3Conf(cfg.ConfigOpts):  # public class instantiated in __main__
     r"""Parses and stores configurations.
@@ -121,7 +125,24 @@ class K2hr3Conf(cfg.ConfigOpts):  # public class instantiated in __main__
             cfg.BoolOpt(
                 'allow_requeue',
                 default=True,
-                help='requeue if listener fails to process a msg properly')
+                help='requeue if listener fails to process a msg properly'),
+            cfg.IntOpt('batch_size',
+                       default=0,
+                       min=0,
+                       help='number of messages to process at once. '
+                       '0 disables the batch mode'),
+            cfg.IntOpt('batch_timeout',
+                       default=1,
+                       min=1,
+                       help='seconds to wait until batch_size messages'),
+            cfg.ListOpt('subscriptions',
+                        default=[],
+                        help='names of [subscription:<name>] sections to '
+                        'listen to in a listener'),
+            cfg.BoolOpt('prefilter',
+                        default=False,
+                        help='skips decoding the bodies of messages which '
+                        'publisher_id and event_type match no filter'),
         ]
         self.register_opts(oslo_opts, group=oslo)
 
@@ -144,7 +165,139 @@ class K2hr3Conf(cfg.ConfigOpts):  # public class instantiated in __main__
             cfg.BoolOpt(
                 'requeue_on_error',
                 default=False,
-                help='requeue messages or not in case of errors in listener')
+                help='requeue messages or not in case of errors in listener'),
+            cfg.IntOpt('max_connections',
+                       default=10,
+                       min=1,
+                       help='max number of keep-alive connections to api'),
+            cfg.IntOpt('connection_idle_timeout_seconds',
+                       default=60,
+                       min=0,
+                       help='seconds to keep an unused connection open'),
+            cfg.IntOpt('dns_cache_ttl_seconds',
+                       default=300,
+                       min=0,
+                       help='seconds to cache the address of the api host'),
+            cfg.StrOpt('ca_file',
+                       default='',
+                       help='CA certificates file to verify the api server'),
+            cfg.StrOpt('cert_file',
+                       default='',
+                       help='client certificate file'),
+            cfg.StrOpt('key_file',
+                       default='',
+                       help='private key file of the client certificate'),
+            cfg.BoolOpt('tls_session_resumption',
+                        default=True,
+                        help='resume TLS sessions to the api server'),
+            cfg.IntOpt('retry_max_interval_seconds',
+                       default=600,
+                       min=0,
+                       help='max interval seconds of the retry backoff'),
+            cfg.BoolOpt('retry_jitter',
+                        default=True,
+                        help='randomize retry intervals'),
+            cfg.IntOpt('max_inflight_retries',
+                       default=1000,
+                       min=1,
+                       help='max number of requests waiting for retries'),
+            cfg.IntOpt('retry_workers',
+                       default=4,
+                       min=1,
+                       help='number of threads to retry requests'),
+            cfg.BoolOpt('bulk_delete',
+                        default=True,
+                        help='remove members of a batch in a request if '
+                        'the api supports'),
+            cfg.IntOpt('bulk_max_items',
+                       default=100,
+                       min=1,
+                       help='max number of members in a bulk request'),
+            cfg.StrOpt('delivery_engine',
+                       default='sync',
+                       choices=('sync', 'asyncio'),
+                       help='sync sends requests in the executor threads. '
+                       'asyncio sends them in an event loop thread'),
+            cfg.MultiStrOpt('extractors',
+                            default=[],
+                            help='"<event_type regex> [<publisher_id regex>] '
+                            '<module>:<function>" to extract params from '
+                            'payloads'),
+            cfg.IntOpt('dedup_window_seconds',
+                       default=60,
+                       min=0,
+                       help='seconds to skip notifications of the members '
+                       'already removed. 0 disables'),
+            cfg.IntOpt('dedup_max_entries',
+                       default=10000,
+                       min=1,
+                       help='max number of removed members to remember'),
+            cfg.IntOpt('shards',
+                       default=0,
+                       min=0,
+                       help='number of threads to deliver messages. messages'
+                       ' of an instance are delivered in a thread one by '
+                       'one. 0 disables'),
+            cfg.IntOpt('drain_timeout_seconds',
+                       default=30,
+                       min=0,
+                       help='seconds to wait for in-flight messages on '
+                       'shutdown'),
+            cfg.StrOpt('retry_checkpoint_file',
+                       default='',
+                       help='file to save pending retries on shutdown and '
+                       'replay them on start'),
+            cfg.PortOpt('metrics_port',
+                        default=0,
+                        help='port to serve metrics at /metrics. 0 disables'
+                        ' the metrics server'),
+            cfg.StrOpt('metrics_host',
+                       default='127.0.0.1',
+                       help='address to serve metrics'),
+            cfg.FloatOpt('slow_message_seconds',
+                         default=0,
+                         min=0,
+                         help='log the time of each stage of a message which'
+                         ' takes longer. 0 disables the log'),
+            cfg.StrOpt('spool_dir',
+                       default='',
+                       help='directory to spool requests which failed after'
+                       ' retries and replay them'),
+            cfg.BoolOpt('circuit_breaker',
+                        default=False,
+                        help='stop sending requests to an unhealthy api for'
+                        ' a while'),
+            cfg.FloatOpt('breaker_error_ratio',
+                         default=0.5,
+                         min=0,
+                         max=1,
+                         help='ratio of errors in the last 20 requests to'
+                         ' open the circuit. 0 disables it'),
+            cfg.IntOpt('breaker_consecutive_timeouts',
+                       default=3,
+                       min=0,
+                       help='timeouts in a row to open the circuit. 0'
+                       ' disables it'),
+            cfg.IntOpt('breaker_open_seconds',
+                       default=30,
+                       min=1,
+                       help='seconds to keep the circuit open before a'
+                       ' probe request'),
+            cfg.FloatOpt('rate_limit',
+                         default=0,
+                         min=0,
+                         help='max number of requests to api per second. 0'
+                         ' disables the limit'),
+            cfg.IntOpt('rate_limit_burst',
+                       default=10,
+                       min=1,
+                       help='max number of requests sent at once under the'
+                       ' rate limit'),
+            cfg.IntOpt('max_inflight_requests',
+                       default=0,
+                       min=0,
+                       help='max number of requests to api in flight. 0'
+                       ' disables the cap'),
         ]
         self.register_opts(k2hr3_opts, group=k2hr3)
 
@@ -169,8 +322,96 @@ class K2hr3Conf(cfg.ConfigOpts):  # public class instantiated in __main__
         except (cfg.ConfigFileParseError, cfg.ConfigFileValueError) as error:
             raise K2hr3ConfError(f'parse error, {error}') from error
 
+        self._register_subscriptions()
         return True
 
+    def _register_subscriptions(self) -> None:
+        """Register the options of each subscription section.
+
+        A subscription has its own topic, exchange, filters and extractors.
+        Options not in the section default to the values in the
+        oslo_messaging_notifications group.
+
+        :raises K2hr3ConfError: if a section is missing or invalid.
+        """
+        oslo = self.oslo_messaging_notifications
+        names = oslo.subscriptions or []
+        if len(set(names)) != len(names):
+            raise K2hr3ConfError(f'duplicated subscriptions, {names}')
+        sections = self.list_all_sections()
+        for name in names:
+            group_name = _SUBSCRIPTION_PREFIX + name
+            if group_name not in sections:
+                raise K2hr3ConfError(
+                    f'no [{group_name}] section for the subscription {name}')
+            group = cfg.OptGroup(name=group_name,
+                                 title=f'Subscription{name}Settings')
+            self.register_group(group)
+            self.register_opts([
+                cfg.StrOpt('event_type',
+                           default=oslo.event_type,
+                           help='event_type'),
+                cfg.StrOpt('publisher_id',
+                           default=oslo.publisher_id,
+                           help='publisher_id'),
+                cfg.DictOpt('context', default=oslo.context, help='context'),
+                cfg.DictOpt('metadata',
+                            default=oslo.metadata,
+                            help='metadata'),
+                cfg.DictOpt('payload', default=oslo.payload, help='payload'),
+                cfg.StrOpt('topic', default=oslo.topic, help='topic'),
+                cfg.StrOpt('exchange', default=oslo.exchange, help='exchange'),
+                cfg.MultiStrOpt('extractors',
+                                default=[],
+                                help='extractors of the subscription')
+            ], group=group)
+            try:
+                # values in a newly registered group are parsed lazily.
+                for opt in self[group_name]:
+                    getattr(self[group_name], opt)
+            except ValueError as error:  # ConfigFileValueError too
+                raise K2hr3ConfError(
+                    f'parse error in [{group_name}], {error}') from error
+
+    @property
+    def path(self) -> Path:
+        """Returns the configuration file path.
+
+        :returns: configuration file path
+        :rtype: Path
+        """
+        return self._path
+
+    def validate(self) -> None:
+        """Read all options to check their values.
+
+        oslo_config converts a value when it is read first. This method
+        raises the errors of all options at once, for instance before a
+        reloaded configuration is applied.
+
+        :raises K2hr3ConfError: if an invalid value is found.
+        """
+        try:
+            for value in self.values():
+                if isinstance(value, Mapping):
+                    dict(value)  # reads the options of the group.
+        except ValueError as error:
+            raise K2hr3ConfError(f'invalid value, {error}') from error
+
+    def subscription(self, name: str) -> cfg.ConfigOpts.GroupAttr:
+        """Returns the options of a subscription.
+
+        :param name: a name in the subscriptions option
+        :type name: str
+        :returns: the options in the [subscription:<name>] section
+        :rtype: oslo_config.cfg.ConfigOpts.GroupAttr
+        :raises K2hr3ConfError: if no such subscription.
+        """
+        if name not in (self.oslo_messaging_notifications.subscriptions
+                        or []):
+            raise K2hr3ConfError(f'no such subscription, {name}')
+        return self[_SUBSCRIPTION_PREFIX + name]
+
 
 #
 # EOF
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Save pending retries on shutdown and replay them on start."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections.abc import Callable
+import fcntl
+import json
+import logging
+import os
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.retry import _get_retry_scheduler
+from k2hr3_osnl.useragent import _K2hr3RetryTask
+
+LOG = logging.getLogger(__name__)
+
+
+def _checkpoint_files(path: str) -> list[str]:
+    """Return the checkpoint files of all processes.
+
+    :param path: retry_checkpoint_file
+    :type path: str
+    :returns: the file saved by a process and the path itself if any
+    :rtype: list
+    """
+    directory, base = os.path.split(path)
+    try:
+        names = os.listdir(directory or '.')
+    except OSError as error:
+        LOG.error('failed to list %s, %s', directory, error)
+        return []
+    return sorted(
+        os.path.join(directory, name) for name in names
+        if name == base or (name.startswith(f'{base}.') and
+                            name[len(base) + 1:].isdigit()))
+
+
+def _checkpoint_retries(conf: K2hr3Conf,
+                        tasks: list[Callable[[], None]]) -> int:
+    """Save the retries which have not started yet.
+
+    The messages of the retries have been acknowledged already, so they
+    would be lost without the checkpoint. Each process saves them to its own
+    file, retry_checkpoint_file suffixed with the pid, because the workers
+    share the configuration. The file is replaced atomically.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param tasks: tasks returned by _K2hr3RetryScheduler.stop
+    :type tasks: list
+    :returns: number of saved retries
+    :rtype: int
+    """
+    retries = [task for task in tasks if isinstance(task, _K2hr3RetryTask)]
+    path = conf.k2hr3.retry_checkpoint_file
+    if not path:
+        for task in retries:
+            LOG.error('gave up the retry of %s on shutdown',
+                      task.params.get('cuk', None))
+        return 0
+    if not retries:
+        return 0
+    path = f'{path}.{os.getpid()}'
+    temp = f'{path}.tmp'
+    try:
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump([task.to_dict() for task in retries], f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+    except OSError as error:
+        LOG.error('failed to save %s retries to %s, %s', len(retries), path,
+                  error)
+        return 0
+    LOG.info('saved %s retries to %s', len(retries), path)
+    return len(retries)
+
+
+def _replay_retries(conf: K2hr3Conf) -> int:
+    """Schedule the retries saved by the last shutdown.
+
+    The files saved by all processes are replayed. A process takes a file
+    with flock, so that the workers starting together replay each file once.
+    The file is removed once the retries are scheduled. A broken file is
+    left for an operator.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: number of scheduled retries
+    :rtype: int
+    """
+    path = conf.k2hr3.retry_checkpoint_file
+    if not path:
+        return 0
+    return sum(
+        _replay_checkpoint(conf, file) for file in _checkpoint_files(path))
+
+
+def _replay_checkpoint(conf: K2hr3Conf, path: str) -> int:
+    """Schedule the retries in a checkpoint file unless taken by others.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param path: a checkpoint file
+    :type path: str
+    :returns: number of scheduled retries
+    :rtype: int
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:  # replayed by another process
+        return 0
+    except OSError as error:
+        LOG.error('failed to load retries from %s, %s', path, error)
+        return 0
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:  # being replayed by another process
+            return 0
+        if os.fstat(fd).st_nlink == 0:  # replayed in the meantime
+            return 0
+        with os.fdopen(os.dup(fd), encoding='utf-8') as f:
+            retries = [
+                _K2hr3RetryTask.from_dict(conf, data) for data in json.load(f)
+            ]
+        return _schedule_retries(conf, path, retries)
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        LOG.error('failed to load retries from %s, %s', path, error)
+        return 0
+    finally:
+        os.close(fd)
+
+
+def _schedule_retries(conf: K2hr3Conf, path: str,
+                      retries: list[_K2hr3RetryTask]) -> int:
+    """Schedule the retries loaded from the file and remove it.
+
+    The caller must hold the lock of the file.
+    """
+    scheduler = _get_retry_scheduler(conf)
+    scheduled = 0
+    for task in retries:
+        if scheduler.schedule(0, task):
+            scheduled += 1
+        else:
+            LOG.error('gave up the retry of %s on start',
+                      task.params.get('cuk', None))
+    try:
+        os.remove(path)
+    except OSError as error:
+        LOG.error('failed to remove %s, %s', path, error)
+    LOG.info('replayed %s retries from %s', scheduled, path)
+    return scheduled
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Encode and decode json by the fastest library installed."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import json
+import logging
+
+from typing import List, Set, Dict, Tuple, Optional, Union, Any  # noqa: pylint: disable=unused-import
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore
+try:
+    import ujson  # type: ignore
+except ImportError:
+    ujson = None
+
+LOG = logging.getLogger(__name__)
+
+
+def _double_indent(text: str) -> str:
+    """Double the indentation of a json indented by two spaces.
+
+    orjson indents by two spaces only. Two spaces are added level by level
+    by str.replace which is much faster than a regular expression. This is
+    safe because newlines in strings are escaped. After the n-th pass, a
+    line nested deeper than n has 4n+2 or more spaces and the rest have 4n
+    or less.
+
+    :param text: json indented by two spaces
+    :type text: str
+    :returns: json indented by four spaces
+    :rtype: str
+    """
+    depth = 1
+    while True:
+        old = '\n' + ' ' * (4 * depth - 2)
+        if old not in text:
+            return text
+        text = text.replace(old, '\n' + ' ' * (4 * depth))
+        depth += 1
+
+
+class _K2hr3JsonCodec:
+    """Encodes and decodes json by the json module of the stdlib.
+
+    Subclasses use a faster library and fall back to this class if the
+    library can not serialize an object, e.g. a dict with non-str keys.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.codec import _K2hr3JsonCodec
+    >>> codec = _K2hr3JsonCodec()
+    >>> codec.dumps(['127.0.0.1', '::1'])
+    '["127.0.0.1","::1"]'
+    >>> codec.loads(b'{"code": 204}')
+    {'code': 204}
+    """
+
+    name = 'json'
+
+    def dumps(self, obj: Any) -> str:
+        """Serialize an object into a compact json string.
+
+        :param obj: a json serializable object
+        :type obj: object
+        :returns: json string
+        :rtype: str
+        """
+        return json.dumps(obj, separators=(',', ':'))
+
+    def dumpb(self, obj: Any) -> bytes:
+        """Serialize an object into a compact utf-8 encoded json.
+
+        :param obj: a json serializable object
+        :type obj: object
+        :returns: json bytes
+        :rtype: bytes
+        """
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def dumps_pretty(self, obj: Any) -> str:
+        """Serialize an object into a json indented by four spaces.
+
+        :param obj: a json serializable object
+        :type obj: object
+        :returns: json string with sorted keys
+        :rtype: str
+        """
+        return json.dumps(obj, indent=4, sort_keys=True)
+
+    def loads(self, data: str | bytes) -> Any:
+        """Deserialize a json.
+
+        :param data: json string or utf-8 encoded json bytes
+        :type data: str or bytes
+        :returns: deserialized object
+        :rtype: object
+        :raises ValueError: if data is not a valid json
+        """
+        return json.loads(data)
+
+
+class _K2hr3OrjsonCodec(_K2hr3JsonCodec):
+    """Encodes and decodes json by orjson."""
+
+    name = 'orjson'
+
+    def dumps(self, obj: Any) -> str:
+        """Serialize an object into a compact json string."""
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            return super().dumps(obj)
+
+    def dumpb(self, obj: Any) -> bytes:
+        """Serialize an object into a compact utf-8 encoded json."""
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return super().dumpb(obj)
+
+    def dumps_pretty(self, obj: Any) -> str:
+        """Serialize an object into a json indented by four spaces."""
+        try:
+            data = orjson.dumps(
+                obj, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+        except TypeError:
+            return super().dumps_pretty(obj)
+        return _double_indent(data.decode('utf-8'))
+
+    def loads(self, data: str | bytes) -> Any:
+        """Deserialize a json."""
+        return orjson.loads(data)
+
+
+class _K2hr3UjsonCodec(_K2hr3JsonCodec):
+    """Encodes and decodes json by ujson."""
+
+    name = 'ujson'
+
+    def dumps(self, obj: Any) -> str:
+        """Serialize an object into a compact json string."""
+        try:
+            return ujson.dumps(obj, escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return super().dumps(obj)
+
+    def dumpb(self, obj: Any) -> bytes:
+        """Serialize an object into a compact utf-8 encoded json."""
+        return self.dumps(obj).encode('utf-8')
+
+    def dumps_pretty(self, obj: Any) -> str:
+        """Serialize an object into a json indented by four spaces."""
+        try:
+            return ujson.dumps(obj, indent=4, sort_keys=True,
+                               escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return super().dumps_pretty(obj)
+
+    def loads(self, data: str | bytes) -> Any:
+        """Deserialize a json."""
+        return ujson.loads(data)
+
+
+def _available_codecs() -> dict[str, _K2hr3JsonCodec]:
+    """Return the codecs of the installed libraries, the fastest first.
+
+    :returns: codecs by the library names
+    :rtype: dict
+    """
+    codecs = {}  # type: Dict[str, _K2hr3JsonCodec]
+    if orjson is not None:
+        codecs['orjson'] = _K2hr3OrjsonCodec()
+    if ujson is not None:
+        codecs['ujson'] = _K2hr3UjsonCodec()
+    codecs['json'] = _K2hr3JsonCodec()
+    return codecs
+
+
+_CODECS = _available_codecs()
+_CODEC = next(iter(_CODECS.values()))
+
+
+def _get_codec() -> _K2hr3JsonCodec:
+    """Return the codec of the fastest library installed.
+
+    :returns: the json codec
+    :rtype: _K2hr3JsonCodec
+    """
+    return _CODEC
+
+
+def _dumps(obj: Any) -> str:
+    """Serialize an object into a compact json string.
+
+    :param obj: a json serializable object
+    :type obj: object
+    :returns: json string
+    :rtype: str
+    """
+    return _CODEC.dumps(obj)
+
+
+def _dumpb(obj: Any) -> bytes:
+    """Serialize an object into a compact utf-8 encoded json.
+
+    :param obj: a json serializable object
+    :type obj: object
+    :returns: json bytes
+    :rtype: bytes
+    """
+    return _CODEC.dumpb(obj)
+
+
+def _dumps_pretty(obj: Any) -> str:
+    """Serialize an object into a json indented by four spaces for logs.
+
+    :param obj: a json serializable object
+    :type obj: object
+    :returns: json string with sorted keys
+    :rtype: str
+    """
+    return _CODEC.dumps_pretty(obj)
+
+
+def _loads(data: str | bytes) -> Any:
+    """Deserialize a json.
+
+    :param data: json string or utf-8 encoded json bytes
+    :type data: str or bytes
+    :returns: deserialized object
+    :rtype: object
+    :raises ValueError: if data is not a valid json
+    """
+    return _CODEC.loads(data)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Remember recently handled instances to skip duplicate notifications."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+LOG = logging.getLogger(__name__)
+
+# (cuk, ips)
+_Key = Tuple[str, frozenset]
+
+
+class _K2hr3DedupCache:
+    """An LRU cache of the recently handled (cuk, ips) pairs.
+
+    Neutron sends a port.delete.end per port of an instance and nova may
+    send both of the legacy and versioned notifications of an instance.
+    The cache remembers the members handled in the last window seconds so
+    that the endpoint does not call the api for the same members again.
+    At most max_entries pairs are kept and the least recently used pair
+    is evicted first.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.dedup import _K2hr3DedupCache
+    >>> cache = _K2hr3DedupCache(window=60, max_entries=1000)
+    >>> params = {'cuk': 'instance_id', 'ips': ['127.0.0.1']}
+    >>> cache.seen(params)
+    False
+    >>> cache.add(params)
+    >>> cache.seen(params)
+    True
+    """
+
+    def __init__(self, window: float = 60, max_entries: int = 10000) -> None:
+        """Initialize attributes.
+
+        :param window: seconds to remember a pair. 0 disables the cache.
+        :type window: float
+        :param max_entries: max number of pairs to remember
+        :type max_entries: int
+        """
+        self._window = window
+        self._max_entries = max_entries
+        # (cuk, ips) => expires
+        self._entries = OrderedDict()  # type: OrderedDict[_Key, float]
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    @property
+    def window(self) -> float:
+        """Returns seconds to remember a pair.
+
+        :returns: window
+        :rtype: float
+        """
+        return self._window
+
+    @property
+    def max_entries(self) -> int:
+        """Returns the max number of pairs to remember.
+
+        :returns: max_entries
+        :rtype: int
+        """
+        return self._max_entries
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Returns counters of lookups.
+
+        hits counts the duplicates, misses counts the other lookups and
+        evictions counts the pairs evicted before they expired.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            return stats
+
+    def __len__(self) -> int:
+        """Returns the number of remembered pairs."""
+        return len(self._entries)
+
+    @staticmethod
+    def key(params: dict[str, Any]) -> _Key:
+        """Returns the key of the params.
+
+        :param params: params which have the cuk and the ips
+        :type params: dict
+        :returns: a pair of the cuk and the set of ips
+        :rtype: tuple
+        """
+        return (str(params.get('cuk', '')),
+                frozenset(params.get('ips', None) or ()))
+
+    def seen(self, params: dict[str, Any]) -> bool:
+        """Returns True if the params were handled in the window.
+
+        :param params: params which have the cuk and the ips
+        :type params: dict
+        :returns: True if the params are a duplicate
+        :rtype: bool
+        """
+        if self._window <= 0:
+            return False
+        key = self.key(params)
+        now = time.monotonic()
+        with self._lock:
+            expires = self._entries.get(key, None)
+            if expires is not None and expires > now:
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                return True
+            if expires is not None:
+                del self._entries[key]
+            self._stats['misses'] += 1
+            return False
+
+    def add(self, params: dict[str, Any]) -> None:
+        """Remember the params were handled.
+
+        The window starts when the params are added first. A duplicate
+        does not extend it.
+
+        :param params: params which have the cuk and the ips
+        :type params: dict
+        """
+        if self._window <= 0:
+            return
+        key = self.key(params)
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries and self._entries[key] > now:
+                return
+            self._entries[key] = now + self._window
+            self._entries.move_to_end(key)
+            self._expire(now)
+
+    def _expire(self, now: float) -> None:
+        """Drop expired pairs and evict pairs over max_entries.
+
+        The caller must hold the lock.
+        """
+        entries = self._entries
+        # the oldest pairs are at the front unless they were hit.
+        while entries:
+            key, expires = next(iter(entries.items()))
+            if expires > now:
+                break
+            del entries[key]
+        while len(entries) > self._max_entries:
+            entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def clear(self) -> None:
+        """Forget all pairs."""
+        with self._lock:
+            self._entries.clear()
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
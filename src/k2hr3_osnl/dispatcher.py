@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Dispatch batches of notification messages with per-message results."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import itertools
+import logging
+import operator
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from oslo_messaging import NotificationResult  # type: ignore
+from oslo_messaging.notify.dispatcher import BatchNotificationDispatcher  # type: ignore  # noqa
+from oslo_messaging.notify.dispatcher import PRIORITIES  # type: ignore
+from oslo_messaging.notify.listener import BatchNotificationServer  # type: ignore  # noqa
+
+LOG = logging.getLogger(__name__)
+
+
+class _K2hr3BatchNotificationDispatcher(BatchNotificationDispatcher):  # type: ignore  # noqa
+    """A batch dispatcher which acknowledges messages one by one.
+
+    The oslo_messaging's BatchNotificationDispatcher requeues all messages
+    of a batch if an endpoint returns NotificationResult.REQUEUE. Our batch
+    endpoint returns a list of results in the order of the messages, so only
+    the failed messages are requeued.
+
+    Reference:
+    - https://github.com/openstack/oslo.messaging/blob/master/oslo_messaging/notify/dispatcher.py#L115
+    """  # noqa: E501
+
+    def dispatch(self, incoming: list[Any]) -> set[Any]:
+        """Dispatch notification messages to the endpoint methods.
+
+        :param incoming: messages received from the transport
+        :type incoming: list
+        :returns: messages to be requeued
+        :rtype: set
+        """
+        extracted = sorted((self._extract_user_message(m) for m in incoming),
+                           key=operator.itemgetter(0))
+        requeues = set()  # type: Set[Any]
+        for priority, group in itertools.groupby(extracted,
+                                                 operator.itemgetter(0)):
+            _, raw_messages, messages = zip(*group)
+            if priority not in PRIORITIES:
+                LOG.warning('Unknown priority "%s"', priority)
+                continue
+            for screen, callback in self._callbacks_by_priority.get(
+                    priority, []):
+                pairs = [(raw, message)
+                         for raw, message in zip(raw_messages, messages)
+                         if not screen or screen.match(
+                             message['ctxt'], message['publisher_id'],
+                             message['event_type'], message['metadata'],
+                             message['payload'])]
+                if not pairs:
+                    continue
+                ret = self._exec_callback(callback,
+                                          [message for _, message in pairs])
+                if isinstance(ret, (list, tuple)):
+                    # a result per message.
+                    for (raw, _), result in zip(pairs, ret):
+                        if result == NotificationResult.REQUEUE:
+                            requeues.add(raw)
+                elif ret == NotificationResult.REQUEUE:
+                    requeues.update(raw for raw, _ in pairs)
+        return requeues
+
+
+class _K2hr3NotificationListeners:
+    """Listeners of the targets which run as a listener.
+
+    oslo_messaging dispatches a message of any target to all endpoints of a
+    listener. A listener per target lets the endpoints of a subscription
+    receive the messages of the subscription's target only. The listeners
+    share a transport.
+    """
+
+    def __init__(self, transport: Any, listeners: list[Any]) -> None:
+        """Initialize attributes.
+
+        :param transport: the messaging transport shared by the listeners
+        :type transport: Transport
+        :param listeners: a listener per target
+        :type listeners: list of NotificationServer
+        """
+        self.transport = transport
+        self.listeners = listeners
+
+    def start(self) -> None:
+        """Start the listeners.
+
+        If a listener fails to start, the listeners started before it are
+        stopped, so that no listener consumes messages alone.
+        """
+        started = []  # type: List[Any]
+        try:
+            for listener in self.listeners:
+                listener.start()
+                started.append(listener)
+        except Exception:
+            for listener in started:
+                listener.stop()
+                listener.wait()
+            raise
+
+    def stop(self) -> None:
+        """Stop consuming messages of all targets."""
+        for listener in self.listeners:
+            listener.stop()
+
+    def wait(self) -> None:
+        """Wait for the in-flight messages of all targets to finish."""
+        for listener in self.listeners:
+            listener.wait()
+
+
+def _get_batch_notification_listener(  # pylint: disable=too-many-positional-arguments  # noqa
+        transport: Any,
+        targets: list[Any],
+        endpoints: list[Any],
+        executor: str | None = None,
+        allow_requeue: bool = False,
+        pool: str | None = None,
+        batch_size: int | None = None,
+        batch_timeout: int | None = None) -> BatchNotificationServer:
+    """Construct a batch notification listener.
+
+    This is the oslo_messaging.get_batch_notification_listener with our
+    dispatcher.
+
+    :param transport: the messaging transport
+    :type transport: Transport
+    :param targets: the exchanges and topics to listen on
+    :type targets: list of Target
+    :param endpoints: a list of endpoint objects
+    :type endpoints: list
+    :param executor: name of message executor
+    :type executor: str
+    :param allow_requeue: whether NotificationResult.REQUEUE support is needed
+    :type allow_requeue: bool
+    :param pool: the pool name
+    :type pool: str
+    :param batch_size: number of messages to wait before calling endpoints
+    :type batch_size: int
+    :param batch_timeout: seconds to wait before calling endpoints
+    :type batch_timeout: int
+    :returns: a batch notification listener
+    :rtype: BatchNotificationServer
+    """
+    dispatcher = _K2hr3BatchNotificationDispatcher(endpoints, None)
+    return BatchNotificationServer(transport, targets, dispatcher, executor,
+                                   allow_requeue, pool, batch_size,
+                                   batch_timeout)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -18,25 +18,106 @@
 # REVISION:
 #
 """An endpoint for the oslo_messaging notification message listener."""
-from __future__ import (absolute_import, division, print_function,
-                        unicode_literals)
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
 
-import json
+import concurrent.futures
+import functools
 import logging
+import re
 import sys
 import traceback
 from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
 
-from oslo_messaging import NotificationFilter, NotificationResult  # type: ignore  # noqa
+from oslo_messaging import NotificationFilter, NotificationResult, Target  # type: ignore  # noqa
 
 from k2hr3_osnl.cfg import K2hr3Conf
-from k2hr3_osnl.useragent import _K2hr3UserAgent
+from k2hr3_osnl.dedup import _K2hr3DedupCache
+from k2hr3_osnl.useragent import _K2hr3UserAgent, _get_agent
+from k2hr3_osnl.exceptions import K2hr3ConfError
 from k2hr3_osnl.exceptions import K2hr3NotificationEndpointError
+from k2hr3_osnl.extractor import _K2hr3ExtractorRegistry
 from k2hr3_osnl.exceptions import _K2hr3UserAgentError
+from k2hr3_osnl.lazylog import _LazyJson
+from k2hr3_osnl.metrics import _FILTERED, _HANDLED, _PAYLOAD_ERRORS, _RECEIVED, _REQUEUED  # noqa
+from k2hr3_osnl.resolver import _get_resolver
+from k2hr3_osnl.shard import _K2hr3ShardDispatcher, _get_shard_dispatcher
+from k2hr3_osnl.timing import (_annotate, _broker_seconds, _current_trace,
+                               _finish_trace, _mark, _set_trace, _start_trace)
 
 LOG = logging.getLogger(__name__)
 
 
+class _K2hr3NotificationFilter(NotificationFilter):
+    """A NotificationFilter whose regexes can be replaced.
+
+    The oslo_messaging dispatcher keeps the filter_rule of an endpoint when
+    the listener is built. This filter delegates to an inner filter, so that
+    the regexes are replaced by update() without rebuilding the listener.
+    The received and the dropped messages are counted per event type. The
+    trace of a matched message starts here.
+
+    Simple usage:
+
+    >>> from oslo_messaging import NotificationFilter
+    >>> from k2hr3_osnl.endpoint import _K2hr3NotificationFilter
+    >>> rule = _K2hr3NotificationFilter(
+    ...     NotificationFilter(event_type=r'^port\\.delete\\.end$'))
+    >>> rule.match({}, 'network.host1', 'port.delete.end', {}, {})
+    True
+    >>> rule.update(
+    ...     NotificationFilter(event_type=r'^instance\\.delete\\.end$'))
+    >>> rule.match({}, 'network.host1', 'port.delete.end', {}, {})
+    False
+    """
+
+    def __init__(self, rule: NotificationFilter) -> None:
+        """Initialize attributes.
+
+        :param rule: the filter to delegate to
+        :type rule: NotificationFilter
+        """
+        super().__init__()
+        self._filter = rule
+
+    def update(self, rule: NotificationFilter) -> None:
+        """Replace the filter to delegate to.
+
+        :param rule: the new filter
+        :type rule: NotificationFilter
+        """
+        self._filter = rule
+
+    def match(self, context: dict[str, Any], publisher_id: str,  # noqa
+              event_type: str, metadata: dict[str, Any],
+              payload: Any) -> bool:
+        """Returns True if the notification matches the regexes.
+
+        :param context: Context of a notification
+        :type context: dict
+        :param publisher_id: Publisher_id of a notification
+        :type publisher_id: str
+        :param event_type: Event_type of a notification
+        :type event_type: str
+        :param metadata: Metadata of a notification
+        :type metadata: dict
+        :param payload: Payload of a notification
+        :type payload: dict
+        :returns: True if matched
+        :rtype: bool
+        """
+        trace = _start_trace()
+        matched = self._filter.match(context, publisher_id, event_type,
+                                     metadata, payload)
+        _RECEIVED.inc(str(event_type))
+        if not matched:
+            _FILTERED.inc(str(event_type))
+            _set_trace(None)
+            return False
+        trace.mark('filter')
+        return True
+
+
 class K2hr3NotificationEndpoint:  # public class instantiated in main
     """An endpoint called by a OpenStack dispatcher.
 
@@ -57,7 +138,9 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
     ...     print(error)
     """
 
-    def __init__(self, conf: K2hr3Conf) -> None:  # public called in __main__
+    def __init__(self,
+                 conf: K2hr3Conf,
+                 subscription: str | None = None) -> None:  # public called in __main__  # noqa
         """Initialize attribute.
 
         We instantiate the NotificationFilter instance as the 'filter_rule'
@@ -71,55 +154,215 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
 
         :param conf: K2hr3Conf object
         :type conf: K2hr3Conf
+        :param subscription: a name in the subscriptions option. The filter
+                             and the target are read from the section of the
+                             subscription if given.
+        :type subscription: str
         :raises K2hr3NotificationEndpointError: if invalid augment.
         """
         if isinstance(conf, K2hr3Conf) is False:
             raise K2hr3NotificationEndpointError(
                 f'conf is a K2hr3Conf instance, not {type(conf)}')
 
-        context = conf.oslo_messaging_notifications.context
-        metadata = conf.oslo_messaging_notifications.metadata
-        payload = conf.oslo_messaging_notifications.payload
-        publisher_id = conf.oslo_messaging_notifications.publisher_id
-        event_type = conf.oslo_messaging_notifications.event_type
+        self._subscription = subscription
+        state = self._load(conf)
+        self.filter_rule = _K2hr3NotificationFilter(state['filter'])
+        self._prefilter_rule = state['prefilter_rule']
+        self._conf = conf
+        self._target = state['target']
+        self._extractors = state['extractors']
+        # Notifications of the members removed recently are skipped.
+        self._dedup = state['dedup']
+        # Deliveries of an instance are serialized in a shard if enabled.
+        self._shards = _get_shard_dispatcher(conf)
+        _get_resolver().ttl = conf.k2hr3.dns_cache_ttl_seconds
+        LOG.debug('endpoint initialized')
+
+    def _load(self, conf: K2hr3Conf) -> dict[str, Any]:
+        """Build the settings of the endpoint from the configuration.
+
+        Nothing of the endpoint is changed here, so that a configuration
+        is applied entirely or not at all.
+
+        :param conf: K2hr3Conf object
+        :type conf: K2hr3Conf
+        :returns: the settings
+        :rtype: dict
+        :raises K2hr3NotificationEndpointError: if invalid configuration.
+        """
+        group = conf.oslo_messaging_notifications
+        extractors = None
+        if self._subscription is not None:
+            try:
+                group = conf.subscription(self._subscription)
+            except K2hr3ConfError as error:
+                raise K2hr3NotificationEndpointError(
+                    f'invalid subscription, {error}') from error
+            extractors = group.extractors
 
         # publisher_id and event_type are must
         assert [
-            isinstance(publisher_id, str),
-            isinstance(event_type, str),
+            isinstance(group.publisher_id, str),
+            isinstance(group.event_type, str),
         ]
+        try:
+            rule = NotificationFilter(
+                context=group.context,
+                # publiser_id
+                # ex) compute.hostname.domain_name
+                # ex) nova-compute:hostname.domain_name
+                # ex) network.hostname.domain_name
+                publisher_id=group.publisher_id,
+                # event_type
+                # ex) port.delete.end
+                # ex) instance.delete.end
+                # ex) compute.instance.delete.end
+                event_type=group.event_type,
+                metadata=group.metadata,
+                # payload contains the virtual machine instance id and the
+                # ips.
+                # ex) payload by neutron's port.delete.end event.
+                # "port": {
+                #    ...
+                #    "device_id": "deviceid-ffff-ffff-ffff-ffffffffffff",
+                #    "fixed_ips": [
+                #        {
+                #            "ip_address": "172.16.0.1",
+                #    ...
+                payload=group.payload)
+            # screens serialized messages before they are decoded.
+            prefilter_rule = tuple(
+                re.compile(regex) if regex is not None else None
+                for regex in (group.publisher_id, group.event_type))
+        except re.error as error:
+            raise K2hr3NotificationEndpointError(
+                f'invalid filter, {error}') from error
+        state = {
+            'filter': rule,
+            'prefilter_rule': prefilter_rule,
+            'target': (group.topic, group.exchange),
+            'extractors': None,
+        }  # type: Dict[str, Any]
+
+        # The api url is parsed and its host is resolved once here.
+        # _K2hr3UserAgent reuses the cached results on every message.
+        try:
+            _K2hr3UserAgent.parse_url(conf.k2hr3.api_url)
+        except _K2hr3UserAgentError as error:
+            raise K2hr3NotificationEndpointError(
+                f'a valid url is expected, not {conf.k2hr3.api_url}'
+            ) from error
+        # An extractor is selected by the event type of each message. A
+        # derived class which overrides _payload_to_params keeps its own.
+        if type(self)._payload_to_params is \
+                K2hr3NotificationEndpoint._payload_to_params:
+            state['extractors'] = _K2hr3ExtractorRegistry.from_conf(
+                conf, extractors)
+        dedup = getattr(self, '_dedup', None)
+        if dedup is None or (dedup.window, dedup.max_entries) != (
+                conf.k2hr3.dedup_window_seconds,
+                conf.k2hr3.dedup_max_entries):
+            dedup = _K2hr3DedupCache(window=conf.k2hr3.dedup_window_seconds,
+                                     max_entries=conf.k2hr3.dedup_max_entries)
+        state['dedup'] = dedup
+        try:
+            _K2hr3UserAgent.validate_url(conf.k2hr3.api_url)
+        except _K2hr3UserAgentError as error:
+            # The resolver counts the failure and retries it later.
+            LOG.warning('%s', error)
+        return state
 
-        self.filter_rule = NotificationFilter(
-            context=context,
-            # publiser_id
-            # ex) compute.hostname.domain_name
-            # ex) nova-compute:hostname.domain_name
-            # ex) network.hostname.domain_name
-            publisher_id=publisher_id,
-            # event_type
-            # ex) port.delete.end
-            # ex) instance.delete.end
-            # ex) compute.instance.delete.end
-            event_type=event_type,
-            metadata=metadata,
-            # payload contains the virtual machine instance id and the ips.
-            # ex) payload by neutron's port.delete.end event.
-            # "port": {
-            #    ...
-            #    "device_id": "deviceid-ffff-ffff-ffff-ffffffffffff",
-            #    "fixed_ips": [
-            #        {
-            #            "ip_address": "172.16.0.1",
-            #    ...
-            payload=payload)
+    def reload(self, conf: K2hr3Conf) -> None:
+        """Apply a new configuration without stopping the listener.
+
+        The filters, the extractors, the dedup cache and the configuration
+        read by every delivery (the api url, the timeouts and the retry
+        policy) are swapped. A message being handled completes with the
+        previous settings. The target is updated too, but the listener has
+        to be restarted to listen to it.
+
+        :param conf: K2hr3Conf object
+        :type conf: K2hr3Conf
+        :raises K2hr3NotificationEndpointError: if invalid configuration. The
+                                                endpoint is unchanged then.
+        """
+        if isinstance(conf, K2hr3Conf) is False:
+            raise K2hr3NotificationEndpointError(
+                f'conf is a K2hr3Conf instance, not {type(conf)}')
+        state = self._load(conf)
+        self.filter_rule.update(state['filter'])
+        self._prefilter_rule = state['prefilter_rule']
+        self._target = state['target']
+        self._extractors = state['extractors']
+        self._dedup = state['dedup']
+        self._shards = _get_shard_dispatcher(conf)
+        _get_resolver().ttl = conf.k2hr3.dns_cache_ttl_seconds
         self._conf = conf
-        LOG.debug('endpoint initialized')
+        LOG.debug('endpoint reloaded')
 
     @property
     def conf(self) -> K2hr3Conf:
         """Returns the K2hr3Conf object."""
         return self._conf
 
+    @property
+    def subscription(self) -> str | None:
+        """Returns the name of the subscription if given."""
+        return self._subscription
+
+    @property
+    def prefilter_rule(self) -> tuple[Any, Any]:
+        """Returns the publisher_id and the event_type regexes."""
+        return self._prefilter_rule
+
+    @property
+    def target(self) -> Target:
+        """Returns the target the endpoint listens to."""
+        topic, exchange = self._target
+        return Target(topic=topic, exchange=exchange)
+
+    @property
+    def dedup(self) -> _K2hr3DedupCache:
+        """Returns the cache of the recently removed members."""
+        return self._dedup
+
+    @property
+    def shards(self) -> _K2hr3ShardDispatcher | None:
+        """Returns the shard dispatcher if the shards option is enabled."""
+        return self._shards
+
+    def _extract_params(self, event_type: str, payload: Any,
+                        publisher_id: str | None = None
+                        ) -> dict[str, object]:
+        """Extract params by the extractor for the event type.
+
+        If no extractor is registered for the event type and the publisher id
+        or the payload is unexpected, _payload_to_params probes the payload.
+
+        :param event_type: event type of the notification
+        :type event_type: str
+        :param payload: payload of the notification
+        :type payload: dict
+        :param publisher_id: publisher id of the notification
+        :type publisher_id: str
+        :returns: params which have the cuk and the ips
+        :rtype: dict
+        :raises K2hr3NotificationEndpointError: if the payload does not
+        contain enough data.
+        """
+        extractor = None
+        if self._extractors is not None:
+            extractor = self._extractors.lookup(event_type, publisher_id)
+        if extractor is not None:
+            try:
+                params = extractor(payload)
+                if params.get('cuk', None):
+                    return params
+            except (KeyError, TypeError, AttributeError, ValueError) as error:
+                LOG.debug('unexpected payload for %s, %s', event_type,
+                          error)
+        return self._payload_to_params(payload)
+
     def _payload_to_params(self, payload: Any) -> dict[str, object]:
         """Parse a payload data.
 
@@ -188,7 +431,7 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
             LOG.error('cuk is empty')
             raise K2hr3NotificationEndpointError(f'no cuk in params, {params}')
 
-        LOG.debug(json.dumps(params, indent=4, sort_keys=True))
+        LOG.debug('params %s', _LazyJson(params))
         return params
 
     def __call_r3api(self, params: dict[str, Any]) -> str:
@@ -204,11 +447,17 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
         ]
 
         try:
-            agent = _K2hr3UserAgent(self._conf)
+            agent = _get_agent(self._conf)
             agent.instance_id = params.get('cuk', None)
             if params.get('ips', None):
                 agent.ips = params.get('ips', None)
+            _mark('prepare')
             if agent.send():
+                if agent.deferred:
+                    # not remembered because the retry may fail.
+                    LOG.warning('retry scheduled. %s', agent.instance_id)
+                    return NotificationResult.HANDLED  # type: ignore
+                self._dedup.add(params)
                 LOG.debug('ok sent. %s code, %s', agent.instance_id,
                           agent.code)
                 return NotificationResult.HANDLED  # type: ignore
@@ -233,10 +482,54 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
                       error)
             raise
 
+    def _call_r3api(self, params: dict[str, Any]) -> str:
+        """Call the r3api from derived classes.
+
+        :returns: NotificationResult.REQUEUE if failed to call the r3api.
+                  Otherwise NotificationResult.HANDLED.
+        :rtype: str
+        """
+        return self.__call_r3api(params)
+
+    def _deliver(self, params: dict[str, Any]) -> str:
+        """Call the r3api unless the params were handled recently.
+
+        If the shards option is enabled, the r3api is called in the shard of
+        the cuk after the messages of the instance received before, so that
+        a duplicate waiting for them is skipped. If the delivery is cancelled
+        because the drain timed out, the message is requeued.
+
+        :returns: NotificationResult.REQUEUE if failed to call the r3api.
+                  Otherwise NotificationResult.HANDLED.
+        :rtype: str
+        """
+        trace = _current_trace()
+
+        def deliver() -> str:
+            # the trace follows the message into the thread of the shard.
+            previous = _set_trace(trace)
+            try:
+                _mark('queue')
+                if self._dedup.seen(params):
+                    LOG.info('NotificationResult.HANDLED %s duplicated',
+                             params.get('cuk'))
+                    return NotificationResult.HANDLED  # type: ignore
+                return self.__call_r3api(params)
+            finally:
+                _set_trace(previous)
+
+        try:
+            if self._shards is None:
+                return deliver()
+            return self._shards.run(str(params.get('cuk')), deliver)
+        except concurrent.futures.CancelledError:
+            LOG.warning('delivery cancelled. requeuing %s', params.get('cuk'))
+            return NotificationResult.REQUEUE  # type: ignore
+
     # yapf: disable
     def info(self, context: dict[str, object],  # pylint: disable=unused-argument,too-many-positional-arguments  # noqa
              publisher_id: str, event_type: str,
-             payload: dict[str, object], metadata: dict[str, object]):  # pylint: disable=unused-argument  # noqa
+             payload: dict[str, object], metadata: dict[str, object]):  # noqa
         """Notification endpoint in info priority.
 
         Notification messages that match the filter’s rules will be passed
@@ -270,16 +563,46 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
             isinstance(payload, dict),  # We are interested in payload only.
         ]
 
+        # the filter started the trace unless called directly.
+        trace = _current_trace() or _start_trace()
+        result = self._handle(publisher_id, event_type, payload)
+        if result == NotificationResult.HANDLED:
+            _HANDLED.inc(str(event_type))
+        else:
+            _REQUEUED.inc(str(event_type))
+        _mark('result')
+        trace.fields['event_type'] = event_type
+        trace.fields['result'] = result
+        _finish_trace(trace, self._conf.k2hr3.slow_message_seconds,
+                      _broker_seconds(metadata))
+        return result
+
+    def _handle(self, publisher_id: str, event_type: str,
+                payload: dict[str, object]) -> str:
+        """Parse the payload and call the r3api.
+
+        :param publisher_id: Publisher_id of a notification
+        :type publisher_id: str
+        :param event_type: Event_type of a notification
+        :type event_type: str
+        :param payload: Payload of a notification
+        :type payload: dict
+        :returns: NotificationResult.HANDLED or NotificationResult.REQUEUE
+        :rtype: str
+        """
         try:
             LOG.debug('publisher_id %s event_type %s  payload %s',
-                      publisher_id, event_type,
-                      json.dumps(payload, indent=4, sort_keys=True))
-            params = self._payload_to_params(payload)
+                      publisher_id, event_type, _LazyJson(payload))
+            params = self._extract_params(event_type, payload,
+                                          publisher_id)
+            _mark('parse')
+            _annotate(cuk=params.get('cuk'))
         except K2hr3NotificationEndpointError as error:
             # K2hr3NotificationEndpointError is a hard error.
             # We don't raise an exception again since we should avoid infinite
             # message parsing loop.
             LOG.error('invalid payload %s', error)
+            _PAYLOAD_ERRORS.inc(str(event_type))
             return NotificationResult.HANDLED
         except Exception:  # noqa: pylint: disable=broad-exception-caught
             # Unknown exception should be treat as a hard error.
@@ -289,11 +612,12 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
             # Too much? https://docs.python.org/3/library/traceback.html
             LOG.error('exec_type %s exec_value %s traceback %s', exc_type,
                       exc_value, repr(traceback.extract_tb(exc_traceback)))
+            _PAYLOAD_ERRORS.inc(str(event_type))
             return NotificationResult.HANDLED
 
         try:
             # We calls the r3api.
-            if self.__call_r3api(params) == NotificationResult.HANDLED:
+            if self._deliver(params) == NotificationResult.HANDLED:
                 LOG.info('NotificationResult.HANDLED %s', params.get('cuk'))
                 return NotificationResult.HANDLED
             LOG.info('NotificationResult.REQUEUE %s', params.get('cuk'))
@@ -311,6 +635,214 @@ class K2hr3NotificationEndpoint:  # public class instantiated in main
         return NotificationResult.HANDLED
 
 
+class K2hr3BatchNotificationEndpoint(K2hr3NotificationEndpoint):
+    """An endpoint called by a OpenStack batch dispatcher.
+
+    The endpoint receives a list of notification messages when batch_size
+    messages arrive or batch_timeout seconds passed, and returns a result
+    per message.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.cfg import K2hr3Conf
+    >>> from k2hr3_osnl.endpoint import K2hr3BatchNotificationEndpoint
+    >>> import k2hr3_osnl
+    >>> from pathlib import Path
+    >>> conf = K2hr3Conf(Path('etc/k2hr3_osnl.conf'))
+    >>> endpoints = [K2hr3BatchNotificationEndpoint(conf)]
+    >>> k2hr3_osnl.listen(endpoints)
+    """
+
+    def _messages_to_params(
+            self, messages: list[dict[str, Any]]) -> list[tuple[int, Any]]:
+        """Parse payloads of a batch in one pass.
+
+        :param messages: notification messages
+        :type messages: list
+        :returns: pairs of the index of a message and its params. Messages
+                  without enough data are skipped.
+        :rtype: list
+        """
+        params_list = []
+        for index, message in enumerate(messages):
+            try:
+                params_list.append((index,
+                                    self._extract_params(
+                                        message['event_type'],
+                                        message['payload'],
+                                        message.get('publisher_id'))))
+            except K2hr3NotificationEndpointError as error:
+                # K2hr3NotificationEndpointError is a hard error.
+                LOG.error('invalid payload %s', error)
+                _PAYLOAD_ERRORS.inc(str(message.get('event_type')))
+            except Exception:  # noqa: pylint: disable=broad-exception-caught
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                LOG.error('exec_type %s exec_value %s traceback %s', exc_type,
+                          exc_value, repr(traceback.extract_tb(exc_traceback)))
+                _PAYLOAD_ERRORS.inc(str(message.get('event_type')))
+        return params_list
+
+    def _skip_duplicates(
+        self, params_list: list[tuple[int, Any]]
+    ) -> tuple[list[tuple[int, Any]], list[tuple[int, int]]]:
+        """Drop the params removed recently or appearing twice in a batch.
+
+        :param params_list: pairs of the index of a message and its params
+        :type params_list: list
+        :returns: the params to send and pairs of the index of a duplicate
+                  in the batch and the index of the message sent instead.
+        :rtype: tuple
+        """
+        unique = []  # type: List[Tuple[int, Any]]
+        duplicates = []  # type: List[Tuple[int, int]]
+        first = {}  # type: Dict[Tuple[str, frozenset], int]
+        for index, params in params_list:
+            key = _K2hr3DedupCache.key(params)
+            if key in first:
+                duplicates.append((index, first[key]))
+            elif self._dedup.seen(params):
+                LOG.debug('%s duplicated', params.get('cuk'))
+            else:
+                first[key] = index
+                unique.append((index, params))
+        return unique, duplicates
+
+    def _call_r3api_bulk(self, params_list: list[tuple[int, Any]],
+                         results: list[str]) -> None:
+        """Call the r3api with the members of a batch in bulk.
+
+        If the api does not support the bulk removal, the requests are sent
+        concurrently in the asyncio engine or one by one.
+
+        :param params_list: pairs of the index of a message and its params
+        :type params_list: list
+        :param results: results of messages updated in place
+        :type results: list
+        """
+        on_error = NotificationResult.HANDLED
+        if self._conf.k2hr3.requeue_on_error is True:
+            on_error = NotificationResult.REQUEUE
+        agents = []  # type: List[Tuple[int, Any, _K2hr3UserAgent]]
+        for index, params in params_list:
+            try:
+                agent = _K2hr3UserAgent(self._conf)
+                agent.instance_id = params.get('cuk', None)
+                if params.get('ips', None):
+                    agent.ips = params.get('ips', None)
+                agents.append((index, params, agent))
+            except _K2hr3UserAgentError as error:
+                LOG.error('k2hr3 exception %s', error)
+                results[index] = on_error
+        if not agents:
+            return
+        sent = _K2hr3UserAgent.send_bulk([agent for _, _, agent in agents])
+        for (index, params, agent), success in zip(agents, sent):
+            if success:
+                if not agent.deferred:
+                    self._dedup.add(params)
+                LOG.debug('ok sent. %s code, %s', agent.instance_id,
+                          agent.code)
+                continue
+            LOG.error('no sent. %s error %s', agent.instance_id, agent.error)
+            results[index] = on_error
+
+    def _call_r3api_batch(self, params_list: list[tuple[int, Any]],
+                          results: list[str]) -> None:
+        """Call the r3api for each params and store the results.
+
+        Messages of the deliveries cancelled because the drain timed out are
+        requeued.
+
+        :param params_list: pairs of the index of a message and its params
+        :type params_list: list
+        :param results: results of messages updated in place
+        :type results: list
+        """
+        # The bulk request and the asyncio engine handle a whole batch.
+        if len(params_list) > 1 and (
+                self._conf.k2hr3.bulk_delete
+                or self._conf.k2hr3.delivery_engine == 'asyncio'):
+            try:
+                self._call_r3api_bulk(params_list, results)
+            except concurrent.futures.CancelledError:
+                LOG.warning('bulk delivery cancelled. requeuing %s messages',
+                            len(params_list))
+                for index, _ in params_list:
+                    results[index] = NotificationResult.REQUEUE
+            except Exception:  # noqa: pylint: disable=broad-exception-caught
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                LOG.error('exec_type %s exec_value %s traceback %s', exc_type,
+                          exc_value, repr(traceback.extract_tb(exc_traceback)))
+            return
+        if self._shards is not None:
+            # instances of a batch are delivered in parallel.
+            futures = [(index, params,
+                        self._shards.submit(str(params.get('cuk')),
+                                            functools.partial(
+                                                self._call_r3api, params)))
+                       for index, params in params_list]
+            for index, params, future in futures:
+                try:
+                    results[index] = future.result()
+                except concurrent.futures.CancelledError:
+                    LOG.warning('delivery cancelled. requeuing %s',
+                                params.get('cuk'))
+                    results[index] = NotificationResult.REQUEUE
+                except Exception:  # noqa: pylint: disable=broad-exception-caught
+                    exc_type, exc_value, exc_traceback = sys.exc_info()
+                    LOG.error('exec_type %s exec_value %s traceback %s',
+                              exc_type, exc_value,
+                              repr(traceback.extract_tb(exc_traceback)))
+            return
+        for index, params in params_list:
+            try:
+                results[index] = self._call_r3api(params)
+            except concurrent.futures.CancelledError:
+                LOG.warning('delivery cancelled. requeuing %s',
+                            params.get('cuk'))
+                results[index] = NotificationResult.REQUEUE
+            except Exception:  # noqa: pylint: disable=broad-exception-caught
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                LOG.error('exec_type %s exec_value %s traceback %s', exc_type,
+                          exc_value, repr(traceback.extract_tb(exc_traceback)))
+
+    def info(self, messages: list[dict[str, Any]]) -> list[str]:  # type: ignore  # pylint: disable=arguments-differ  # noqa
+        """Notification endpoint in info priority for a batch.
+
+        Like K2hr3NotificationEndpoint.info, this function catches all
+        exceptions and handles the invalid messages to avoid an infinite
+        loop.
+
+        :param messages: notification messages which have the ctxt,
+                         publisher_id, event_type, payload and metadata keys.
+        :type messages: list
+        :returns: NotificationResult.HANDLED or NotificationResult.REQUEUE
+                  for each message in the same order.
+        :rtype: list
+        """
+        # a trace covers the whole batch.
+        trace = _start_trace()
+        results = [NotificationResult.HANDLED] * len(messages)
+        params_list, duplicates = self._skip_duplicates(
+            self._messages_to_params(messages))
+        _mark('parse')
+        self._call_r3api_batch(params_list, results)
+        _mark('deliver')
+        for index, first in duplicates:
+            results[index] = results[first]
+        for message, result in zip(messages, results):
+            if result == NotificationResult.HANDLED:
+                _HANDLED.inc(str(message.get('event_type')))
+            else:
+                _REQUEUED.inc(str(message.get('event_type')))
+        LOG.info('batch handled %s requeued %s of %s messages',
+                 results.count(NotificationResult.HANDLED),
+                 results.count(NotificationResult.REQUEUE), len(messages))
+        trace.fields['messages'] = len(messages)
+        _finish_trace(trace, self._conf.k2hr3.slow_message_seconds)
+        return results
+
+
 #
 # Local variables:
 # tab-width: 4
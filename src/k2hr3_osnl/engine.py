@@ -0,0 +1,702 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Deliver requests to the k2hr3 api in an asyncio event loop thread."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import asyncio
+import collections
+from collections.abc import Mapping
+import http.client
+import io
+import logging
+import socket
+import ssl
+import threading
+import time
+import urllib.parse
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.exceptions import _K2hr3UserAgentError
+from k2hr3_osnl.metrics import _API_REQUEST_SECONDS
+from k2hr3_osnl.resolver import _get_resolver
+
+LOG = logging.getLogger(__name__)
+
+_MAX_LINE = 65536  # same as http.client
+_MAX_HEADERS = 100  # same as http.client
+
+
+class _K2hr3AsyncResponse:
+    """A http response read from an asyncio stream.
+
+    The attributes are the subset of http.client.HTTPResponse we use.
+    """
+
+    def __init__(self, version: str, status: int, reason: str,
+                 msg: http.client.HTTPMessage) -> None:
+        """Initialize attributes.
+
+        :param version: http version string like HTTP/1.1
+        :type version: str
+        :param status: http status code
+        :type status: int
+        :param reason: reason phrase
+        :type reason: str
+        :param msg: response headers
+        :type msg: http.client.HTTPMessage
+        """
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        conn = msg.get('Connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.will_close = 'keep-alive' not in conn
+        else:
+            self.will_close = 'close' in conn
+
+    def getheader(self, name: str, default: str | None = None) -> Any:
+        """Returns the value of a header.
+
+        :param name: header name
+        :type name: str
+        :param default: value if the header is missing
+        :type default: str
+        :returns: header value
+        :rtype: str
+        """
+        return self.msg.get(name, default)
+
+
+async def _read_line(reader: asyncio.StreamReader) -> bytes:
+    """Read a CRLF terminated line."""
+    try:
+        line = await reader.readline()
+    except ValueError as error:  # longer than the limit of the reader.
+        raise http.client.LineTooLong('header line') from error
+    if len(line) > _MAX_LINE:
+        raise http.client.LineTooLong('header line')
+    return line
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    """Read a body in the chunked transfer coding."""
+    chunks = []  # type: List[bytes]
+    while True:
+        line = await _read_line(reader)
+        try:
+            size = int(line.split(b';', 1)[0], 16)
+        except ValueError as error:
+            raise http.client.IncompleteRead(b''.join(chunks)) from error
+        if size < 0:
+            raise http.client.IncompleteRead(b''.join(chunks))
+        if size == 0:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)  # CRLF
+    while True:  # trailers
+        line = await _read_line(reader)
+        if line in {b'\r\n', b'\n', b''}:
+            break
+    return b''.join(chunks)
+
+
+async def _read_response(
+        reader: asyncio.StreamReader,
+        method: str) -> tuple[_K2hr3AsyncResponse, bytes]:
+    """Read a http response.
+
+    :raises http.client.HTTPException: if the response is malformed.
+    """
+    line = await _read_line(reader)
+    if not line:
+        raise http.client.RemoteDisconnected(
+            'Remote end closed connection without response')
+    try:
+        version, status, *rest = line.decode('iso-8859-1').split(None, 2)
+        code = int(status)
+    except ValueError as error:
+        raise http.client.BadStatusLine(str(line)) from error
+    if not version.startswith('HTTP/') or not 100 <= code <= 999:
+        raise http.client.BadStatusLine(str(line))
+    lines = []
+    while True:
+        line = await _read_line(reader)
+        if line in {b'\r\n', b'\n', b''}:
+            break
+        lines.append(line)
+        if len(lines) > _MAX_HEADERS:
+            raise http.client.HTTPException(
+                f'got more than {_MAX_HEADERS} headers')
+    msg = http.client.parse_headers(io.BytesIO(b''.join(lines) + b'\r\n'))
+    res = _K2hr3AsyncResponse(version, code,
+                              rest[0].strip() if rest else '', msg)
+    if method == 'HEAD' or code in {204, 304} or 100 <= code < 200:
+        return res, b''
+    length = msg.get('Content-Length', None)
+    try:
+        if 'chunked' in msg.get('Transfer-Encoding', '').lower():
+            return res, await _read_chunked(reader)
+        if length is not None:
+            return res, await reader.readexactly(int(length))
+    except asyncio.IncompleteReadError as error:
+        raise http.client.IncompleteRead(error.partial) from error
+    except ValueError as error:
+        raise http.client.HTTPException(
+            f'invalid Content-Length {length}') from error
+    # The body ends with the connection.
+    res.will_close = True
+    return res, await reader.read()
+
+
+class _K2hr3AsyncConnectionPool:
+    """Keeps asyncio stream connections to the k2hr3 api alive.
+
+    All methods must be called in the event loop thread.
+    """
+
+    def __init__(self,  # pylint: disable=too-many-positional-arguments
+                 scheme: str,
+                 host: str,
+                 port: int | None = None,
+                 maxsize: int = 10,
+                 idle_timeout: float = 60,
+                 context: ssl.SSLContext | None = None) -> None:
+        """Initialize attributes.
+
+        :param scheme: http or https
+        :type scheme: str
+        :param host: api host
+        :type host: str
+        :param port: api port. the default port of the scheme if None
+        :type port: int
+        :param maxsize: max number of connections
+        :type maxsize: int
+        :param idle_timeout: seconds to keep an unused connection open
+        :type idle_timeout: float
+        :param context: TLS context for https
+        :type context: ssl.SSLContext
+        :raises _K2hr3UserAgentError: if invalid arguments.
+        """
+        if scheme not in ('http', 'https'):
+            raise _K2hr3UserAgentError(
+                f'scheme should be http or https, not {scheme}')
+        if maxsize < 1:
+            raise _K2hr3UserAgentError(
+                f'maxsize should be positive, not {maxsize}')
+        self._scheme = scheme
+        self._host = host
+        self._port = port or (443 if scheme == 'https' else 80)
+        # the port is omitted if default like http.client does.
+        netloc = f'[{host}]' if ':' in host else host
+        if self._port != (443 if scheme == 'https' else 80):
+            netloc = f'{netloc}:{self._port}'
+        self._netloc = netloc
+        self._maxsize = maxsize
+        self._idle_timeout = idle_timeout
+        self._context = context
+        self._slots = asyncio.Semaphore(maxsize)
+        # (reader, writer, last used time). the last is the newest.
+        self._idle = collections.deque(
+        )  # type: collections.deque[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]]  # noqa
+        self._created = 0
+        self._closed = False
+
+    @property
+    def context(self) -> ssl.SSLContext | None:
+        """Returns the TLS context.
+
+        :returns: TLS context
+        :rtype: ssl.SSLContext
+        """
+        return self._context
+
+    @context.setter
+    def context(self, value: ssl.SSLContext | None) -> None:
+        """Replace the TLS context.
+
+        Idle connections made with the old context are closed. Borrowed
+        ones are closed when they are released.
+
+        :param value: TLS context
+        :type value: ssl.SSLContext
+        """
+        if value is self._context:
+            return
+        self._context = value
+        self._close_idle()
+        LOG.debug('tls context replaced. %s', self)
+
+    @property
+    def size(self) -> int:
+        """Returns the number of open connections.
+
+        :returns: number of idle and borrowed connections
+        :rtype: int
+        """
+        return self._created
+
+    @property
+    def idle(self) -> int:
+        """Returns the number of idle connections.
+
+        :returns: number of idle connections
+        :rtype: int
+        """
+        return len(self._idle)
+
+    def _evict_idle(self) -> None:
+        """Close connections unused for more than idle_timeout seconds."""
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][2] > self._idle_timeout:
+            _, writer, _ = self._idle.popleft()
+            self._created -= 1
+            writer.close()
+
+    async def _acquire(
+        self
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        """Borrow a connection. The caller must hold a slot."""
+        self._evict_idle()
+        if self._idle:
+            reader, writer, _ = self._idle.pop()
+            return reader, writer, True
+        # connects to the address cached by the resolver. a cache miss
+        # blocks, so the lookup runs in the default executor.
+        address = await asyncio.get_running_loop().run_in_executor(
+            None, _get_resolver().resolve, self._host)
+        reader, writer = await asyncio.open_connection(
+            address,
+            self._port,
+            ssl=self._context if self._scheme == 'https' else None,
+            server_hostname=self._host if self._scheme == 'https' else None)
+        self._created += 1
+        return reader, writer, False
+
+    def _release(self, reader: asyncio.StreamReader,
+                 writer: asyncio.StreamWriter,
+                 context: ssl.SSLContext | None) -> None:
+        """Give a connection made with the context back to the pool.
+
+        The connection is closed if the pool has been closed or the context
+        has been replaced while it was borrowed.
+        """
+        if self._closed or context is not self._context:
+            self._discard(writer)
+            return
+        self._idle.append((reader, writer, time.monotonic()))
+
+    def _discard(self, writer: asyncio.StreamWriter) -> None:
+        """Close a broken or non-reusable connection."""
+        self._created -= 1
+        writer.close()
+
+    async def request(
+            self,
+            method: str,
+            path: str,
+            headers: Mapping[str, str],
+            timeout: float,
+            body: bytes | None = None
+    ) -> tuple[_K2hr3AsyncResponse, bytes]:
+        """Send a http request over a pooled connection.
+
+        If the server has closed an idle keep-alive connection, the request
+        is sent again once over a new connection.
+
+        :param method: http request method
+        :type method: str
+        :param path: path and query string
+        :type path: str
+        :param headers: request headers
+        :type headers: Mapping
+        :param timeout: seconds to wait for the whole response
+        :type timeout: float
+        :param body: request body
+        :type body: bytes
+        :returns: the response and the whole response body
+        :rtype: tuple
+        :raises socket.timeout: if no response in timeout.
+        :raises BaseException: if a network or protocol error occurs.
+        """
+        started = time.monotonic()
+        code = 'error'
+        try:
+            res, res_body = await asyncio.wait_for(
+                self._request(method, path, headers, body), timeout)
+            code = str(res.status)
+            return res, res_body
+        except asyncio.TimeoutError as error:
+            raise socket.timeout(
+                f'no response from {self._host} in {timeout}s') from error
+        finally:
+            _API_REQUEST_SECONDS.observe(time.monotonic() - started, method,
+                                         code)
+
+    async def _request(
+            self, method: str, path: str, headers: Mapping[str, str],
+            body: bytes | None) -> tuple[_K2hr3AsyncResponse, bytes]:
+        """Send a http request without the timeout."""
+        lines = [f'{method} {path} HTTP/1.1']
+        names = {name.lower() for name in headers}
+        if 'host' not in names:
+            lines.append(f'Host: {self._netloc}')
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        if body is not None or method in {'POST', 'PUT', 'PATCH'}:
+            lines.append(f'Content-Length: {len(body or b"")}')
+        data = ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1')
+        if body:
+            data += body
+        async with self._slots:
+            while True:
+                context = self._context
+                reader, writer, reused = await self._acquire()
+                try:
+                    writer.write(data)
+                    await writer.drain()
+                    res, res_body = await _read_response(reader, method)
+                except (ConnectionResetError, BrokenPipeError,
+                        http.client.BadStatusLine,
+                        asyncio.IncompleteReadError) as error:
+                    self._discard(writer)
+                    if reused:
+                        LOG.debug('reconnecting to %s, %s', self._host, error)
+                        continue
+                    raise
+                except BaseException:
+                    self._discard(writer)
+                    raise
+                if res.will_close:
+                    self._discard(writer)
+                else:
+                    self._release(reader, writer, context)
+                return res, res_body
+
+    def close(self) -> None:
+        """Close all idle connections and borrowed ones when released."""
+        self._closed = True
+        self._close_idle()
+
+    def _close_idle(self) -> None:
+        """Close all idle connections."""
+        while self._idle:
+            _, writer, _ = self._idle.popleft()
+            self._created -= 1
+            writer.close()
+
+    def __repr__(self):
+        return (f'<_K2hr3AsyncConnectionPool {self._scheme}://{self._host}:'
+                f'{self._port} size={self._created} maxsize={self._maxsize}>')
+
+
+class _K2hr3DeliveryEngine:
+    """Runs asyncio connection pools in a dedicated event loop thread.
+
+    Threads of the oslo_messaging executor hand requests over to the loop
+    and wait for the results, so that hundreds of requests share a few
+    connections.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.engine import _K2hr3DeliveryEngine
+    >>> engine = _K2hr3DeliveryEngine(maxsize=10)
+    >>> res, body = engine.request('http://127.0.0.1/v1/role', 'DELETE',
+    ...                            '/v1/role?cuk=x', {}, 30)
+    >>> engine.stop()
+    """
+
+    def __init__(self, maxsize: int = 10, idle_timeout: float = 60) -> None:
+        """Initialize attributes.
+
+        :param maxsize: max number of connections to a host
+        :type maxsize: int
+        :param idle_timeout: seconds to keep an unused connection open
+        :type idle_timeout: float
+        """
+        self._maxsize = maxsize
+        self._idle_timeout = idle_timeout
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._thread = None  # type: Optional[threading.Thread]
+        self._lock = threading.Lock()
+        # pools are touched only in the loop thread.
+        self._pools = {
+        }  # type: Dict[Tuple[str, str, Optional[int]], _K2hr3AsyncConnectionPool]  # noqa
+
+    @property
+    def running(self) -> bool:
+        """Returns True if the event loop thread is running.
+
+        :returns: True if running
+        :rtype: bool
+        """
+        return self._thread is not None and self._thread.is_alive()
+
+    def _start(self) -> asyncio.AbstractEventLoop:
+        """Start the event loop thread if not running."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._run,
+                                          args=(loop, ),
+                                          name='k2hr3-delivery')
+                thread.daemon = True
+                thread.start()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop) -> None:
+        """Run the event loop. Runs in the loop thread."""
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    def _get_pool(
+            self, url: str,
+            context: ssl.SSLContext | None) -> _K2hr3AsyncConnectionPool:
+        """Return the pool for the url. Runs in the loop thread."""
+        parts = urllib.parse.urlsplit(url)
+        if parts.hostname is None:
+            raise _K2hr3UserAgentError(f'url contains no host, {url}')
+        key = (parts.scheme, parts.hostname, parts.port)
+        pool = self._pools.get(key, None)
+        if pool is None:
+            pool = _K2hr3AsyncConnectionPool(parts.scheme,
+                                             parts.hostname,
+                                             parts.port,
+                                             maxsize=self._maxsize,
+                                             idle_timeout=self._idle_timeout,
+                                             context=context)
+            self._pools[key] = pool
+        elif context is not None:
+            # replaced in place because requests may borrow connections.
+            pool.context = context
+        return pool
+
+    async def _request(  # pylint: disable=too-many-positional-arguments
+            self,
+            url: str,
+            method: str,
+            path: str,
+            headers: Mapping[str, str],
+            timeout: float,
+            body: bytes | None = None,
+            context: ssl.SSLContext | None = None
+    ) -> tuple[_K2hr3AsyncResponse, bytes]:
+        """Send a request in the loop thread."""
+        pool = self._get_pool(url, context)
+        return await pool.request(method, path, headers, timeout, body)
+
+    def request(  # pylint: disable=too-many-positional-arguments
+            self,
+            url: str,
+            method: str,
+            path: str,
+            headers: Mapping[str, str],
+            timeout: float,
+            body: bytes | None = None,
+            context: ssl.SSLContext | None = None
+    ) -> tuple[_K2hr3AsyncResponse, bytes]:
+        """Send a request in the loop thread and wait for the response.
+
+        :param url: api url to choose the pool
+        :type url: str
+        :param method: http request method
+        :type method: str
+        :param path: path and query string
+        :type path: str
+        :param headers: request headers
+        :type headers: Mapping
+        :param timeout: seconds to wait for the whole response
+        :type timeout: float
+        :param body: request body
+        :type body: bytes
+        :param context: TLS context for https
+        :type context: ssl.SSLContext
+        :returns: the response and the whole response body
+        :rtype: tuple
+        :raises BaseException: if a network or protocol error occurs.
+        """
+        loop = self._start()
+        future = asyncio.run_coroutine_threadsafe(
+            self._request(url, method, path, headers, timeout, body, context),
+            loop)
+        return future.result()
+
+    def request_all(self, requests: list[tuple[Any, ...]]) -> list[Any]:
+        """Send requests concurrently and wait for all responses.
+
+        :param requests: arguments of request() for each request
+        :type requests: list
+        :returns: the response and body, or the exception for each request
+        :rtype: list
+        """
+
+        async def gather():
+            return await asyncio.gather(
+                *(self._request(*args) for args in requests),
+                return_exceptions=True)
+
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(gather(), loop).result()
+
+    def stop(self, wait: bool = True) -> None:
+        """Close all connections and stop the event loop thread.
+
+        :param wait: True to wait for the requests in flight. False to
+                     cancel them, and their callers get CancelledError.
+        :type wait: bool
+        """
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop, self._thread = None, None
+        if loop is None or thread is None:
+            return
+
+        async def close():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            if not wait:
+                for task in tasks:
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+        asyncio.run_coroutine_threadsafe(close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
+class _K2hr3EnginePool:
+    """Adapts the delivery engine to the connection pool interface.
+
+    _K2hr3UserAgent sends requests through this object like the
+    _K2hr3ConnectionPool, and the calling thread waits for the result.
+    """
+
+    def __init__(self, engine: _K2hr3DeliveryEngine, url: str,
+                 context: ssl.SSLContext | None) -> None:
+        """Initialize attributes.
+
+        :param engine: delivery engine
+        :type engine: _K2hr3DeliveryEngine
+        :param url: api url
+        :type url: str
+        :param context: TLS context for https
+        :type context: ssl.SSLContext
+        """
+        self._engine = engine
+        self._url = url
+        self._context = context
+
+    @property
+    def engine(self) -> _K2hr3DeliveryEngine:
+        """Returns the delivery engine.
+
+        :returns: delivery engine
+        :rtype: _K2hr3DeliveryEngine
+        """
+        return self._engine
+
+    def args(
+            self,
+            method: str,
+            path: str,
+            headers: Mapping[str, str],
+            timeout: float,
+            body: bytes | None = None) -> tuple[Any, ...]:
+        """Returns the arguments of a request for request_all().
+
+        :returns: arguments
+        :rtype: tuple
+        """
+        return (self._url, method, path, headers, timeout, body,
+                self._context)
+
+    def request(
+            self,
+            method: str,
+            path: str,
+            headers: Mapping[str, str],
+            timeout: float,
+            body: bytes | None = None
+    ) -> tuple[_K2hr3AsyncResponse, bytes]:
+        """Send a http request in the engine and wait for the response.
+
+        :returns: the response and the whole response body
+        :rtype: tuple
+        :raises BaseException: if a network or protocol error occurs.
+        """
+        return self._engine.request(
+            *self.args(method, path, headers, timeout, body))
+
+
+_ENGINE = None  # type: Optional[_K2hr3DeliveryEngine]
+_ENGINE_LOCK = threading.Lock()
+
+
+def _get_delivery_engine(conf: K2hr3Conf) -> _K2hr3DeliveryEngine:
+    """Return the process wide delivery engine.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: the delivery engine
+    :rtype: _K2hr3DeliveryEngine
+    """
+    global _ENGINE  # pylint: disable=global-statement
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = _K2hr3DeliveryEngine(
+                maxsize=conf.k2hr3.max_connections,
+                idle_timeout=conf.k2hr3.connection_idle_timeout_seconds)
+        return _ENGINE
+
+
+def _stop_delivery_engine(wait: bool = True) -> None:
+    """Stop the process wide delivery engine if started.
+
+    :param wait: False to cancel the requests in flight
+    :type wait: bool
+    """
+    global _ENGINE  # pylint: disable=global-statement
+    with _ENGINE_LOCK:
+        engine, _ENGINE = _ENGINE, None
+    if engine is not None:
+        engine.stop(wait)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Extract the k2hr3 api params from notification payloads."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+from collections.abc import Callable
+import importlib
+from importlib import metadata
+import logging
+import re
+import threading
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.exceptions import K2hr3NotificationEndpointError
+
+LOG = logging.getLogger(__name__)
+
+# An extractor takes a payload and returns params which have the 'cuk' and
+# optionally the 'ips'. It may raise KeyError, TypeError, AttributeError or
+# ValueError if the payload is unexpected.
+_Extractor = Callable[[Dict[str, Any]], Dict[str, Any]]
+
+# entry points of extractors. a loaded extractor must have the event_type
+# attribute which is a regular expression of event types. It may have the
+# publisher_id attribute which is a regular expression of publisher ids.
+ENTRY_POINT_GROUP = 'k2hr3_osnl.extractors'
+
+_MAX_CACHED_EVENT_TYPES = 1024
+
+
+def _extract_neutron_port(payload: dict[str, Any]) -> dict[str, Any]:
+    """Extract params from a neutron port notification.
+
+    ex) port.delete.end
+    """
+    port = payload['port']
+    params = {'cuk': port['device_id']}  # type: Dict[str, Any]
+    ips = [
+        v['ip_address'] for v in port.get('fixed_ips') or ()
+        if v.get('ip_address', None)
+    ]
+    if ips:
+        params['ips'] = ips
+    return params
+
+
+def _extract_nova_versioned(payload: dict[str, Any]) -> dict[str, Any]:
+    """Extract params from a nova versioned notification.
+
+    ex) instance.delete.end
+    """
+    return {'cuk': payload['nova_object.data']['uuid']}
+
+
+def _extract_nova_legacy(payload: dict[str, Any]) -> dict[str, Any]:
+    """Extract params from a nova legacy notification.
+
+    ex) compute.instance.delete.end
+    """
+    return {'cuk': payload['instance_id']}
+
+
+_BUILTIN_EXTRACTORS = [
+    (r'^port\.', _extract_neutron_port),
+    (r'^instance\.', _extract_nova_versioned),
+    (r'^compute\.instance\.', _extract_nova_legacy),
+]  # type: List[Tuple[str, _Extractor]]
+
+
+def _load_extractor(path: str) -> _Extractor:
+    """Import an extractor function.
+
+    :param path: module and function like 'package.module:function'
+    :type path: str
+    :returns: the function
+    :rtype: callable
+    :raises K2hr3NotificationEndpointError: if failed to import.
+    """
+    module_name, sep, attr = path.partition(':')
+    if not sep:
+        module_name, _, attr = path.rpartition('.')
+    try:
+        func = getattr(importlib.import_module(module_name), attr)
+    except (ImportError, AttributeError, ValueError) as error:
+        raise K2hr3NotificationEndpointError(
+            f'failed to load the extractor {path}, {error}') from error
+    if not callable(func):
+        raise K2hr3NotificationEndpointError(
+            f'extractor should be callable, not {path}')
+    return func
+
+
+def _iter_entry_points() -> list[Any]:
+    """Return the entry points of extractors installed."""
+    eps = metadata.entry_points()
+    if hasattr(eps, 'select'):
+        return list(eps.select(group=ENTRY_POINT_GROUP))
+    return list(eps.get(ENTRY_POINT_GROUP, ()))  # python3.9
+
+
+class _K2hr3ExtractorRegistry:
+    """Selects an extractor by the event type and the publisher id.
+
+    Rules are regular expressions of event types and optionally of publisher
+    ids paired with extractors. The first matching rule wins. The selection
+    is cached per event type and publisher id, so each message costs a dict
+    lookup.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.extractor import _K2hr3ExtractorRegistry
+    >>> registry = _K2hr3ExtractorRegistry()
+    >>> registry.lookup('port.delete.end')(payload)
+    {'cuk': '...', 'ips': ['...']}
+    """
+
+    def __init__(self) -> None:
+        """Initialize attributes with the builtin extractors."""
+        # (event_type pattern, publisher_id pattern or None, extractor)
+        self._rules = [
+            (re.compile(pattern), None, extractor)
+            for pattern, extractor in _BUILTIN_EXTRACTORS
+        ]  # type: List[Tuple[re.Pattern, Optional[re.Pattern], _Extractor]]
+        self._cache = {}  # type: Dict[Tuple[str, Optional[str]], Optional[_Extractor]]  # noqa
+        self._lock = threading.Lock()
+
+    def register(self, event_type: str, extractor: _Extractor,
+                 publisher_id: str | None = None) -> None:
+        """Register an extractor prior to the others.
+
+        :param event_type: a regular expression of event types
+        :type event_type: str
+        :param extractor: a function to extract params from a payload
+        :type extractor: callable
+        :param publisher_id: a regular expression of publisher ids. None
+                             matches any publisher.
+        :type publisher_id: str
+        :raises K2hr3NotificationEndpointError: if invalid arguments.
+        """
+        try:
+            pattern = re.compile(event_type)
+        except (re.error, TypeError) as error:
+            raise K2hr3NotificationEndpointError(
+                f'invalid event_type pattern {event_type}, {error}'
+            ) from error
+        publisher = None
+        if publisher_id is not None:
+            try:
+                publisher = re.compile(publisher_id)
+            except (re.error, TypeError) as error:
+                raise K2hr3NotificationEndpointError(
+                    f'invalid publisher_id pattern {publisher_id}, {error}'
+                ) from error
+        if not callable(extractor):
+            raise K2hr3NotificationEndpointError(
+                f'extractor should be callable, not {extractor}')
+        with self._lock:
+            self._rules.insert(0, (pattern, publisher, extractor))
+            self._cache.clear()
+        LOG.info('extractor %s registered for %s of %s', extractor,
+                 event_type, publisher_id or 'any publisher')
+
+    def lookup(self, event_type: str,
+               publisher_id: str | None = None) -> _Extractor | None:
+        """Return the extractor for the event type and the publisher id.
+
+        :param event_type: event type of a notification
+        :type event_type: str
+        :param publisher_id: publisher id of a notification. None matches
+                             only the rules for any publisher.
+        :type publisher_id: str
+        :returns: an extractor, or None if no rule matches.
+        :rtype: callable
+        """
+        key = (event_type, publisher_id)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        extractor = None
+        for pattern, publisher, candidate in self._rules:
+            if not pattern.search(event_type or ''):
+                continue
+            if publisher is not None and (
+                    publisher_id is None or
+                    not publisher.search(publisher_id)):
+                continue
+            extractor = candidate
+            break
+        with self._lock:
+            if len(self._cache) >= _MAX_CACHED_EVENT_TYPES:
+                self._cache.clear()
+            self._cache[key] = extractor
+        return extractor
+
+    def load_entry_points(self) -> None:
+        """Register extractors installed as the entry points."""
+        for entry_point in _iter_entry_points():
+            try:
+                extractor = entry_point.load()
+                self.register(getattr(extractor, 'event_type'), extractor,
+                              getattr(extractor, 'publisher_id', None))
+            except (ImportError, AttributeError,
+                    K2hr3NotificationEndpointError) as error:
+                LOG.error('failed to load the extractor %s, %s',
+                          entry_point.name, error)
+
+    @classmethod
+    def from_conf(
+            cls,
+            conf: K2hr3Conf,
+            extractors: list[str] | None = None
+    ) -> '_K2hr3ExtractorRegistry':
+        """Build a registry from the builtins, entry points and the conf.
+
+        Each extractors option is '<event_type regex> [<publisher_id regex>]
+        <module>:<function>'. Extractors in the conf have priority over the
+        entry points.
+
+        :param conf: K2hr3Conf object
+        :type conf: K2hr3Conf
+        :param extractors: extractors of a subscription which have priority
+                           over the extractors in the k2hr3 group.
+        :type extractors: list
+        :returns: a registry
+        :rtype: _K2hr3ExtractorRegistry
+        :raises K2hr3NotificationEndpointError: if invalid extractors.
+        """
+        registry = cls()
+        registry.load_entry_points()
+        values = list(extractors or []) + list(conf.k2hr3.extractors or [])
+        for value in reversed(values):
+            fields = value.split()
+            if len(fields) not in (2, 3):
+                raise K2hr3NotificationEndpointError(
+                    f'extractors should be "<event_type> [<publisher_id>] '
+                    f'<module>:<function>", not {value}')
+            publisher_id = fields[1] if len(fields) == 3 else None
+            registry.register(fields[0], _load_extractor(fields[-1]),
+                              publisher_id)
+        return registry
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -32,10 +32,17 @@ LOG = logging.getLogger(__name__)
 
 class _K2hr3HttpResponse:
 
+    __slots__ = ('_code', '_error')
+
     def __init__(self):
         self._code = -1  # http status code from api server
         self._error = ''
 
+    def reset(self) -> None:  # public.
+        """Clear the code and the error to reuse the response."""
+        self._code = -1
+        self._error = ''
+
     @property
     def code(self) -> int:  # public.
         """Returns the HTTP status code.
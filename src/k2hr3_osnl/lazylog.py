@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Format log arguments only when the record is emitted."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections.abc import Callable
+import logging
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.codec import _dumps_pretty
+
+LOG = logging.getLogger(__name__)
+
+
+class _LazyCall:  # pylint: disable=too-few-public-methods
+    """Calls a function when the log message is formatted.
+
+    The logging module formats the arguments only if a handler emits the
+    record, so passing this object instead of the result skips the call
+    when the level is disabled.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.lazylog import _LazyCall
+    >>> LOG.debug('payload %s', _LazyCall(json.dumps, payload))
+    """
+
+    __slots__ = ('_func', '_args', '_kwargs')
+
+    def __init__(self, func: Callable[..., Any], *args: Any,
+                 **kwargs: Any) -> None:
+        """Initialize attributes.
+
+        :param func: a function returning the value to be logged
+        :type func: callable
+        :param args: positional arguments of the function
+        :type args: tuple
+        :param kwargs: keyword arguments of the function
+        :type kwargs: dict
+        """
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+
+    def __str__(self) -> str:
+        return str(self._func(*self._args, **self._kwargs))
+
+    __repr__ = __str__
+
+
+class _LazyJson(_LazyCall):  # pylint: disable=too-few-public-methods
+    """Serializes an object into an indented json when logged.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.lazylog import _LazyJson
+    >>> LOG.debug('payload %s', _LazyJson(payload))
+    """
+
+    __slots__ = ()
+
+    def __init__(self, obj: Any) -> None:
+        """Initialize attributes.
+
+        :param obj: a json serializable object
+        :type obj: object
+        """
+        super().__init__(_dumps_pretty, obj)
+
+
+def _decode_body(body: bytes, limit: int = 1024) -> str:
+    """Decode the head of a response body for logging.
+
+    :param body: response body
+    :type body: bytes
+    :param limit: max number of bytes to decode
+    :type limit: int
+    :returns: decoded string
+    :rtype: str
+    """
+    text = body[:limit].decode('utf-8', errors='replace')
+    if len(body) > limit:
+        text += f'...({len(body)} bytes)'
+    return text
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Collect metrics and expose them in the Prometheus text format."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import bisect
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import os
+import resource
+import threading
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+
+LOG = logging.getLogger(__name__)
+
+# seconds of an api request, from 5ms to 30s.
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0, 30.0)
+# seconds of a stage, from 100us.
+_STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                  0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# A family is a JSON serializable dict, so that a worker process reports it
+# to the supervisor.
+# {'name': str, 'type': str, 'help': str,
+#  'samples': [[name, {label: value}, value], ...]}
+_Family = Dict[str, Any]
+
+
+class _K2hr3Counter:
+    """A counter per label values.
+
+    Each thread increments its own dict, so that no lock is taken on the
+    hot path. The dicts are summed up when the metrics are collected.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.metrics import _K2hr3Counter
+    >>> counter = _K2hr3Counter('requests_total', 'requests', ('code',))
+    >>> counter.inc('204')
+    >>> counter.value('204')
+    1
+    """
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = ()) -> None:
+        """Initialize attributes.
+
+        :param name: metric name
+        :type name: str
+        :param documentation: help text
+        :type documentation: str
+        :param labelnames: label names
+        :type labelnames: tuple
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards = []  # type: List[Dict[Tuple[str, ...], Any]]
+        self._lock = threading.Lock()  # taken once in a thread.
+
+    def _values(self) -> dict[tuple[str, ...], Any]:
+        """Returns the dict of the current thread."""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = {}  # type: Dict[Tuple[str, ...], Any]
+            with self._lock:
+                self._shards.append(values)
+            self._local.values = values
+            return values
+
+    def _snapshots(self) -> list[list[tuple[tuple[str, ...], Any]]]:
+        """Returns copies of the dicts of all threads."""
+        with self._lock:
+            shards = list(self._shards)
+        # list(dict.items()) does not release the GIL.
+        return [list(values.items()) for values in shards]
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        """Increment the counter of the label values.
+
+        :param labelvalues: values in the order of labelnames
+        :type labelvalues: str
+        :param amount: amount to add
+        :type amount: float
+        """
+        values = self._values()
+        values[labelvalues] = values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        """Returns the sum of all threads.
+
+        :param labelvalues: values in the order of labelnames
+        :type labelvalues: str
+        :returns: the value
+        :rtype: float
+        """
+        return sum(
+            value for items in self._snapshots() for key, value in items
+            if key == labelvalues)
+
+    def collect(self) -> _Family:
+        """Returns the samples of the counter.
+
+        :returns: the metric family
+        :rtype: dict
+        """
+        totals = {}  # type: Dict[Tuple[str, ...], float]
+        for items in self._snapshots():
+            for key, value in items:
+                totals[key] = totals.get(key, 0) + value
+        return {
+            'name': self.name,
+            'type': self.type,
+            'help': self.documentation,
+            'samples': [[self.name,
+                         dict(zip(self.labelnames, key)), value]
+                        for key, value in sorted(totals.items())],
+        }
+
+
+class _K2hr3Histogram(_K2hr3Counter):
+    """A histogram per label values.
+
+    Like _K2hr3Counter, each thread updates its own buckets.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.metrics import _K2hr3Histogram
+    >>> histogram = _K2hr3Histogram('seconds', 'latency', ('code',),
+    ...                             buckets=(0.1, 1.0))
+    >>> histogram.observe(0.05, '204')
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = _LATENCY_BUCKETS) -> None:
+        """Initialize attributes.
+
+        :param name: metric name
+        :type name: str
+        :param documentation: help text
+        :type documentation: str
+        :param labelnames: label names
+        :type labelnames: tuple
+        :param buckets: upper bounds of the buckets in the ascending order
+        :type buckets: tuple
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, amount: float, *labelvalues: str) -> None:
+        """Observe a value.
+
+        :param amount: observed value
+        :type amount: float
+        :param labelvalues: values in the order of labelnames
+        :type labelvalues: str
+        """
+        values = self._values()
+        data = values.get(labelvalues, None)
+        if data is None:
+            # counts of the buckets and +Inf, and the sum.
+            data = [0] * (len(self.buckets) + 1) + [0.0]
+            values[labelvalues] = data
+        data[bisect.bisect_left(self.buckets, amount)] += 1
+        data[-1] += amount
+
+    def collect(self) -> _Family:
+        """Returns the samples of the histogram.
+
+        :returns: the metric family
+        :rtype: dict
+        """
+        totals = {}  # type: Dict[Tuple[str, ...], List[float]]
+        for items in self._snapshots():
+            for key, data in items:
+                total = totals.setdefault(key, [0] * len(data))
+                for index, value in enumerate(data):
+                    total[index] += value
+        samples = []  # type: List[List[Any]]
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        for key, data in sorted(totals.items()):
+            labels = dict(zip(self.labelnames, key))
+            count = 0.0
+            for bound, value in zip(bounds, data):
+                count += value
+                samples.append([self.name + '_bucket',
+                                dict(labels, le=bound), count])
+            samples.append([self.name + '_sum', labels, data[-1]])
+            samples.append([self.name + '_count', labels, count])
+        return {
+            'name': self.name,
+            'type': self.type,
+            'help': self.documentation,
+            'samples': samples,
+        }
+
+
+class _K2hr3Collector:
+    """Metrics read from a callback when they are collected.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.metrics import _K2hr3Collector
+    >>> collector = _K2hr3Collector('depth', 'gauge', 'queue depth',
+    ...                             lambda: {(): 0})
+    """
+
+    def __init__(self, name: str, metric_type: str, documentation: str,
+                 callback: Callable[[], dict[tuple[str, ...], float]],
+                 labelnames: tuple[str, ...] = ()) -> None:
+        """Initialize attributes.
+
+        :param name: metric name
+        :type name: str
+        :param metric_type: counter or gauge
+        :type metric_type: str
+        :param documentation: help text
+        :type documentation: str
+        :param callback: returns label values => value
+        :type callback: callable
+        :param labelnames: label names
+        :type labelnames: tuple
+        """
+        self.name = name
+        self.type = metric_type
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = labelnames
+
+    def collect(self) -> _Family:
+        """Returns the samples of the callback.
+
+        :returns: the metric family
+        :rtype: dict
+        """
+        return {
+            'name': self.name,
+            'type': self.type,
+            'help': self.documentation,
+            'samples': [[self.name,
+                         dict(zip(self.labelnames, key)), value]
+                        for key, value in sorted(self.callback().items())],
+        }
+
+
+class _K2hr3Metrics:
+    """A registry of metrics.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.metrics import _K2hr3Metrics
+    >>> metrics = _K2hr3Metrics()
+    >>> counter = metrics.counter('requests_total', 'requests')
+    >>> counter.inc()
+    >>> print(metrics.render(), end='')
+    # HELP requests_total requests
+    # TYPE requests_total counter
+    requests_total 1
+    """
+
+    def __init__(self) -> None:
+        """Initialize attributes."""
+        self._metrics = {}  # type: Dict[str, Any]
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Any) -> Any:
+        """Register a metric unless the name is registered."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str,
+                labelnames: tuple[str, ...] = ()) -> _K2hr3Counter:
+        """Returns the counter of the name.
+
+        :param name: metric name
+        :type name: str
+        :param documentation: help text
+        :type documentation: str
+        :param labelnames: label names
+        :type labelnames: tuple
+        :returns: the counter
+        :rtype: _K2hr3Counter
+        """
+        return self._register(_K2hr3Counter(name, documentation, labelnames))
+
+    def histogram(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = _LATENCY_BUCKETS) -> _K2hr3Histogram:
+        """Returns the histogram of the name.
+
+        :param name: metric name
+        :type name: str
+        :param documentation: help text
+        :type documentation: str
+        :param labelnames: label names
+        :type labelnames: tuple
+        :param buckets: upper bounds of the buckets
+        :type buckets: tuple
+        :returns: the histogram
+        :rtype: _K2hr3Histogram
+        """
+        return self._register(
+            _K2hr3Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self,
+                  name: str,
+                  metric_type: str,
+                  documentation: str,
+                  callback: Callable[[], dict[tuple[str, ...], float]],
+                  labelnames: tuple[str, ...] = ()) -> None:
+        """Register a callback collector. A collector of the same name is
+        replaced.
+
+        :param name: metric name
+        :type name: str
+        :param metric_type: counter or gauge
+        :type metric_type: str
+        :param documentation: help text
+        :type documentation: str
+        :param callback: returns label values => value
+        :type callback: callable
+        :param labelnames: label names
+        :type labelnames: tuple
+        """
+        with self._lock:
+            self._metrics[name] = _K2hr3Collector(name, metric_type,
+                                                  documentation, callback,
+                                                  labelnames)
+
+    def collect(self) -> list[_Family]:
+        """Returns the families of all metrics.
+
+        :returns: the metric families
+        :rtype: list
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        families = []
+        for metric in metrics:
+            try:
+                families.append(metric.collect())
+            except Exception as error:  # noqa: pylint: disable=broad-exception-caught
+                LOG.warning('failed to collect %s, %s', metric.name, error)
+        return families
+
+    def render(self, families: list[_Family] | None = None) -> str:
+        """Returns the metrics in the Prometheus text format.
+
+        :param families: families to render. the families of the registry
+                         if None.
+        :type families: list
+        :returns: the text
+        :rtype: str
+        """
+        if families is None:
+            families = self.collect()
+        lines = []
+        for family in families:
+            lines.append(f"# HELP {family['name']} {family['help']}")
+            lines.append(f"# TYPE {family['name']} {family['type']}")
+            for name, labels, value in family['samples']:
+                lines.append(f'{name}{_format_labels(labels)} '
+                             f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    """Returns the labels in the Prometheus text format."""
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"'
+                     for name, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _escape(value: Any) -> str:
+    """Returns the label value escaped in the Prometheus text format."""
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _format_value(value: float) -> str:
+    """Returns the value in the Prometheus text format."""
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _merge_families(reports: dict[Any, list[_Family]]) -> list[_Family]:
+    """Merge the families of processes with the worker label.
+
+    :param reports: worker => the families the worker reported
+    :type reports: dict
+    :returns: the metric families
+    :rtype: list
+    """
+    merged = {}  # type: Dict[str, _Family]
+    for worker, families in sorted(reports.items()):
+        for family in families:
+            target = merged.setdefault(family['name'], dict(family,
+                                                            samples=[]))
+            target['samples'].extend(
+                [name, dict(labels, worker=str(worker)), value]
+                for name, labels, value in family['samples'])
+    return list(merged.values())
+
+
+def _resident_memory() -> dict[tuple[str, ...], float]:
+    """Returns the resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm', encoding='ascii') as f:
+            pages = int(f.read().split()[1])
+        return {(): float(pages * os.sysconf('SC_PAGE_SIZE'))}
+    except (OSError, ValueError, IndexError):
+        # the max resident set size in kilobytes if no procfs.
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {(): float(usage.ru_maxrss * 1024)}
+
+
+_METRICS = _K2hr3Metrics()
+_METRICS.collector('process_resident_memory_bytes', 'gauge',
+                   'Resident memory size in bytes.', _resident_memory)
+
+_RECEIVED = _METRICS.counter(
+    'k2hr3_osnl_messages_received_total',
+    'Messages checked by the filter of an endpoint.', ('event_type',))
+_FILTERED = _METRICS.counter(
+    'k2hr3_osnl_messages_filtered_total',
+    'Messages dropped by the filter of an endpoint.', ('event_type',))
+_HANDLED = _METRICS.counter('k2hr3_osnl_messages_handled_total',
+                            'Messages acknowledged.', ('event_type',))
+_REQUEUED = _METRICS.counter('k2hr3_osnl_messages_requeued_total',
+                             'Messages requeued.', ('event_type',))
+_PAYLOAD_ERRORS = _METRICS.counter(
+    'k2hr3_osnl_payload_errors_total',
+    'Messages without the instance id or with an unexpected payload.',
+    ('event_type',))
+_API_REQUEST_SECONDS = _METRICS.histogram(
+    'k2hr3_osnl_api_request_duration_seconds',
+    'Seconds to send a request to the k2hr3 api and read the response.',
+    ('method', 'code'))
+
+_STAGE_SECONDS = _METRICS.histogram(
+    'k2hr3_osnl_stage_duration_seconds',
+    'Seconds each stage of a message took. broker is the time since the'
+    ' notifier sent the message.', ('stage', ), _STAGE_BUCKETS)
+_MESSAGE_SECONDS = _METRICS.histogram(
+    'k2hr3_osnl_message_duration_seconds',
+    'Seconds from the filter to the result of a message or a batch.', (),
+    _STAGE_BUCKETS)
+_THROTTLE_SECONDS = _METRICS.histogram(
+    'k2hr3_osnl_throttle_wait_seconds',
+    'Seconds a request to the k2hr3 api waited for the rate limit and the'
+    ' in-flight cap.', (), _STAGE_BUCKETS)
+
+
+def _get_metrics() -> _K2hr3Metrics:
+    """Return the process wide registry of metrics.
+
+    :returns: the registry
+    :rtype: _K2hr3Metrics
+    """
+    return _METRICS
+
+
+class _K2hr3MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the metrics at /metrics."""
+
+    server: '_K2hr3MetricsHTTPServer'
+
+    def do_GET(self):  # noqa: N802 pylint: disable=invalid-name
+        """Handles a GET request."""
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        try:
+            body = self.server.render().encode('utf-8')
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            LOG.error('failed to render metrics, %s', error)
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', _CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Logs an access in the debug level."""
+        LOG.debug('%s %s', self.address_string(), format % args)
+
+
+class _K2hr3MetricsHTTPServer(ThreadingHTTPServer):
+    """A http server which renders the metrics by a callback."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int],
+                 render: Callable[[], str]) -> None:
+        """Initialize attributes.
+
+        :param address: host and port to listen
+        :type address: tuple
+        :param render: returns the metrics in the Prometheus text format
+        :type render: callable
+        """
+        super().__init__(address, _K2hr3MetricsHandler)
+        self.render = render
+
+
+_SERVER = None  # type: Optional[_K2hr3MetricsHTTPServer]
+_SERVER_LOCK = threading.Lock()
+
+
+def _start_metrics_server(
+        conf: K2hr3Conf,
+        render: Callable[[], str] = _METRICS.render
+) -> _K2hr3MetricsHTTPServer | None:
+    """Start the process wide metrics server in a thread.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param render: returns the metrics in the Prometheus text format
+    :type render: callable
+    :returns: the server, or None if the metrics_port option is 0.
+    :rtype: _K2hr3MetricsHTTPServer
+    :raises OSError: if failed to listen.
+    """
+    global _SERVER  # pylint: disable=global-statement
+    if conf.k2hr3.metrics_port <= 0:
+        return None
+    with _SERVER_LOCK:
+        if _SERVER is None:
+            _SERVER = _K2hr3MetricsHTTPServer(
+                (conf.k2hr3.metrics_host, conf.k2hr3.metrics_port), render)
+            thread = threading.Thread(target=_SERVER.serve_forever,
+                                      name='k2hr3-metrics')
+            thread.daemon = True
+            thread.start()
+            LOG.info('metrics served at %s:%s', *_SERVER.server_address[:2])
+        return _SERVER
+
+
+def _stop_metrics_server() -> None:
+    """Stop the process wide metrics server if started."""
+    global _SERVER  # pylint: disable=global-statement
+    with _SERVER_LOCK:
+        server, _SERVER = _SERVER, None
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
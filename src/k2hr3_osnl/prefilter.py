@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Skip irrelevant notifications before decoding their bodies."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import logging
+import re
+import threading
+import types
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from oslo_messaging._drivers import common as _driver_common  # type: ignore
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.codec import _loads
+
+LOG = logging.getLogger(__name__)
+
+# keys of the envelope of a serialized message.
+_VERSION_KEY = 'oslo.version'
+_MESSAGE_KEY = 'oslo.message'
+_ENVELOPE_VERSION = '2.0'
+# keys of a notification read by the prefilter and the string value
+# following a key.
+_REQUIRED_KEYS = ('publisher_id', 'event_type', 'priority')
+_KEY = re.compile('"(' + '|'.join(_REQUIRED_KEYS + ('_unique_id', )) + ')"')
+_VALUE = re.compile(r'\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+# publisher_id regex and event_type regex. None matches everything.
+_Rule = Tuple[Optional[re.Pattern], Optional[re.Pattern]]
+# regexes matching everything.
+_MATCH_ALL = frozenset(('', '.*', '^.*', '.*$', '^.*$'))
+
+
+def _scan_message(body: str) -> dict[str, Any] | None:
+    """Build a message without the payload from a serialized body.
+
+    The body is scanned once for the keys. A key found twice, for instance
+    in the payload too, can not be told from the one of the notification,
+    so the body has to be decoded then.
+
+    :param body: the serialized body of a notification
+    :type body: str
+    :returns: the publisher_id, the event_type, the priority and the unique
+              id of the message with an empty payload, or None if they can
+              not be found safely.
+    :rtype: dict
+    """
+    message = {'payload': {}}  # type: Dict[str, Any]
+    for found in _KEY.finditer(body):
+        key = found.group(1)
+        if key in message:
+            return None
+        matched = _VALUE.match(body, found.end())
+        if matched is None:
+            return None
+        value = matched.group(1)
+        if '\\' in value:
+            value = _loads(f'"{value}"')
+        message[key] = value
+    if any(key not in message for key in _REQUIRED_KEYS):
+        return None
+    return message
+
+
+class _K2hr3Prefilter:
+    """Screens serialized notifications by the publisher_id and event_type.
+
+    The message queue driver decodes the whole body of a message before the
+    dispatcher filters it. The prefilter scans the serialized body for the
+    publisher_id and the event_type first. If no endpoint matches them, the
+    body is not decoded and the message is passed on with an empty payload
+    and context, so that the dispatcher filters it out and acknowledges it
+    as usual. The other messages, and bodies which can not be scanned
+    safely, are decoded as usual.
+
+    Simple usage:
+
+    >>> import re
+    >>> from k2hr3_osnl.prefilter import _K2hr3Prefilter
+    >>> prefilter = _K2hr3Prefilter(
+    ...     [(re.compile('^network.*$'), re.compile('^port.delete.end$'))])
+    >>> body = ('{"publisher_id": "network.host1",'
+    ...         ' "event_type": "port.update.end", "priority": "INFO",'
+    ...         ' "payload": {"port": {}}}')
+    >>> message = prefilter.screen({'oslo.version': '2.0',
+    ...                             'oslo.message': body})
+    >>> message['event_type'], message['payload']
+    ('port.update.end', {})
+    """
+
+    def __init__(self, rules: list[_Rule]) -> None:
+        """Initialize attributes.
+
+        :param rules: pairs of the publisher_id and the event_type regexes
+                      of the endpoints
+        :type rules: list
+        """
+        self._rules = list(rules)
+        self._match_all = self._rules_match_all(self._rules)
+        self._lock = threading.Lock()
+        self._stats = {'skipped': 0, 'decoded': 0}
+
+    @staticmethod
+    def _rules_match_all(rules: list[_Rule]) -> bool:
+        """Returns True if a rule matches every message.
+
+        :param rules: pairs of the publisher_id and the event_type regexes
+        :type rules: list
+        :returns: True if no message can be skipped
+        :rtype: bool
+        """
+        return any(
+            all(regex is None or regex.pattern in _MATCH_ALL
+                for regex in rule) for rule in rules)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Returns counters of screened messages.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def update(self, rules: list[_Rule]) -> None:
+        """Replace the rules.
+
+        :param rules: pairs of the publisher_id and the event_type regexes
+                      of the endpoints
+        :type rules: list
+        """
+        self._rules = list(rules)
+        self._match_all = self._rules_match_all(self._rules)
+
+    def _matches(self, publisher_id: str, event_type: str) -> bool:
+        """Returns True if any rule matches the publisher_id and event_type.
+
+        :param publisher_id: publisher_id of a notification
+        :type publisher_id: str
+        :param event_type: event_type of a notification
+        :type event_type: str
+        :returns: True if matched
+        :rtype: bool
+        """
+        for publisher_id_regex, event_type_regex in self._rules:
+            if publisher_id_regex is not None and \
+                    not publisher_id_regex.match(publisher_id):
+                continue
+            if event_type_regex is not None and \
+                    not event_type_regex.match(event_type):
+                continue
+            return True
+        return False
+
+    def screen(self, msg: Any) -> dict[str, Any] | None:
+        """Returns a message without the payload if no rule matches.
+
+        If a rule matches every message, the body is not scanned.
+
+        :param msg: the envelope of a message from the driver
+        :type msg: dict
+        :returns: a message to pass on instead of decoding the body, or
+                  None if the body should be decoded.
+        :rtype: dict
+        """
+        if self._match_all:
+            with self._lock:
+                self._stats['decoded'] += 1
+            return None
+        if not isinstance(msg, dict) or \
+                msg.get(_VERSION_KEY, None) != _ENVELOPE_VERSION:
+            return None
+        body = msg.get(_MESSAGE_KEY, None)
+        if not isinstance(body, str):
+            return None
+        message = _scan_message(body)
+        if message is None or self._matches(message['publisher_id'],
+                                            message['event_type']):
+            with self._lock:
+                self._stats['decoded'] += 1
+            return None
+        with self._lock:
+            self._stats['skipped'] += 1
+        return message
+
+
+_PREFILTER = None  # type: Optional[_K2hr3Prefilter]
+_PREFILTER_LOCK = threading.Lock()
+# the function of the driver decoding a message. it is a private function of
+# oslo.messaging, so it may be missing in a future version.
+_DESERIALIZE_MSG = getattr(_driver_common, 'deserialize_msg', None)
+# the envelope answered by the hook only to check if the driver calls it.
+_PROBE = types.MappingProxyType({_VERSION_KEY: 'k2hr3_osnl.prefilter'})
+_PROBE_KEY = 'k2hr3_osnl.prefilter'
+
+
+def _deserialize_msg(msg: Any) -> Any:
+    """Decode a message from the driver unless the prefilter skips it.
+
+    :param msg: the envelope of a message
+    :type msg: dict
+    :returns: the message
+    :rtype: dict
+    """
+    if msg is _PROBE:
+        return {_PROBE_KEY: True}
+    prefilter = _PREFILTER
+    if prefilter is not None:
+        message = prefilter.screen(msg)
+        if message is not None:
+            return message
+    return _DESERIALIZE_MSG(msg)  # type: ignore
+
+
+def _hook_reached() -> bool:
+    """Returns True if the rabbit driver decodes messages by the hook.
+
+    The driver is expected to look up deserialize_msg in the common module
+    for each message. This decodes the probe by the message class of the
+    driver to make sure of it.
+
+    :returns: True if the hook is called
+    :rtype: bool
+    """
+    try:
+        from oslo_messaging._drivers import impl_rabbit  # type: ignore  # noqa: pylint: disable=import-outside-toplevel
+        message = impl_rabbit.RabbitMessage(
+            types.SimpleNamespace(payload=_PROBE))
+    except Exception as error:  # noqa: pylint: disable=broad-exception-caught
+        LOG.error('failed to decode the probe by the rabbit driver, %s',
+                  error)
+        return False
+    return message.get(_PROBE_KEY, False) is True
+
+
+def _get_prefilter() -> _K2hr3Prefilter | None:
+    """Return the prefilter if enabled.
+
+    :returns: the prefilter or None
+    :rtype: _K2hr3Prefilter
+    """
+    return _PREFILTER
+
+
+def _update_prefilter(conf: K2hr3Conf,
+                      rules: list[_Rule]) -> _K2hr3Prefilter | None:
+    """Enable, update or disable the prefilter by the configuration.
+
+    The prefilter replaces the function of the driver decoding messages.
+    It supports the rabbit driver only, which envelopes a notification in
+    the same format as it dispatches it. If the driver does not call the
+    replaced function, the prefilter is disabled with an error log.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param rules: pairs of the publisher_id and the event_type regexes of
+                  the endpoints
+    :type rules: list
+    :returns: the prefilter or None if disabled
+    :rtype: _K2hr3Prefilter
+    """
+    global _PREFILTER  # pylint: disable=global-statement
+    group = conf.oslo_messaging_notifications
+    with _PREFILTER_LOCK:
+        if not group.prefilter:
+            _PREFILTER = None
+            return None
+        if not group.transport_url.startswith('rabbit://'):
+            LOG.warning('prefilter supports rabbit:// only, not %s',
+                        group.transport_url.split('://')[0])
+            _PREFILTER = None
+            return None
+        if _DESERIALIZE_MSG is None:
+            LOG.error('prefilter disabled. oslo.messaging has no '
+                      'deserialize_msg to replace')
+            _PREFILTER = None
+            return None
+        if _driver_common.deserialize_msg is not _deserialize_msg:
+            _driver_common.deserialize_msg = _deserialize_msg
+            if not _hook_reached():
+                LOG.error('prefilter disabled. the rabbit driver does not '
+                          'decode messages by deserialize_msg of %s',
+                          _driver_common.__name__)
+                _driver_common.deserialize_msg = _DESERIALIZE_MSG
+                _PREFILTER = None
+                return None
+        if _PREFILTER is None:
+            _PREFILTER = _K2hr3Prefilter(rules)
+        else:
+            _PREFILTER.update(rules)
+        return _PREFILTER
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Resolve and cache the address of the k2hr3 api host."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import ipaddress
+import logging
+import socket
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional  # noqa: pylint: disable=unused-import
+
+LOG = logging.getLogger(__name__)
+
+# Seconds to remember a failed lookup at most.
+_NEGATIVE_TTL_SECONDS = 30
+
+
+class _K2hr3Resolver:
+    """Caches resolved addresses for ttl seconds.
+
+    Only the first lookup of a host blocks the caller. When a cached entry
+    expires, the caller gets the stale entry and a background thread
+    refreshes it. A failed lookup is cached too, so that a broken resolver
+    is not queried on every message.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.resolver import _K2hr3Resolver
+    >>> resolver = _K2hr3Resolver(ttl=300)
+    >>> resolver.resolve('localhost')
+    '127.0.0.1'
+    """
+
+    def __init__(self, ttl: float = 300) -> None:
+        """Initialize attributes.
+
+        :param ttl: seconds to cache an address. 0 disables caching.
+        :type ttl: float
+        """
+        self._ttl = ttl
+        # host => (address, error, expires)
+        self._cache = {}  # type: Dict[str, Tuple[Optional[str], Optional[OSError], float]]  # noqa
+        self._refreshing = set()  # type: Set[str]
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'failures': 0, 'refreshes': 0}
+
+    @property
+    def ttl(self) -> float:
+        """Returns seconds to cache an address.
+
+        :returns: ttl
+        :rtype: float
+        """
+        return self._ttl
+
+    @ttl.setter
+    def ttl(self, value: float) -> None:
+        """Set seconds to cache an address.
+
+        :param value: ttl
+        :type value: float
+        """
+        self._ttl = value
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Returns counters of lookups.
+
+        hits and misses count the cache lookups, failures counts the failed
+        name resolutions and refreshes counts the background refreshes.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def resolve(self, host: str) -> str:
+        """Return an address of the host.
+
+        :param host: host name
+        :type host: str
+        :returns: an ip address
+        :rtype: str
+        :raises OSError: if the name resolution failed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(host, None)
+            if entry is not None:
+                self._stats['hits'] += 1
+                if entry[2] <= now:
+                    self._refresh_in_background(host)
+            else:
+                self._stats['misses'] += 1
+        if entry is None:
+            return self._lookup(host)
+        address, error, _ = entry
+        if address is None:
+            # raises a copy not to grow the traceback of the cached one.
+            raise type(error)(*error.args)  # type: ignore
+        return address
+
+    def _lookup(self, host: str) -> str:
+        """Resolve the host and cache the result.
+
+        :raises OSError: if the name resolution failed.
+        """
+        try:
+            # an ip address is an address of itself.
+            address = str(ipaddress.ip_address(host))
+        except ValueError:
+            address = ''
+        try:
+            if not address:
+                # https://github.com/python/cpython/blob/master/Modules/socketmodule.c#L5729
+                address = socket.gethostbyname(host)
+        except OSError as error:
+            with self._lock:
+                self._stats['failures'] += 1
+                if self._ttl > 0:
+                    expires = time.monotonic() + min(self._ttl,
+                                                     _NEGATIVE_TTL_SECONDS)
+                    stale = self._cache.get(host, None)
+                    if stale is not None and stale[0] is not None:
+                        # keeps the last known address if we have.
+                        self._cache[host] = (stale[0], None, expires)
+                    else:
+                        self._cache[host] = (None, error, expires)
+            raise
+        with self._lock:
+            if self._ttl > 0:
+                self._cache[host] = (address, None,
+                                     time.monotonic() + self._ttl)
+        LOG.debug('%s resolved %s', host, address)
+        return address
+
+    def _refresh_in_background(self, host: str) -> None:
+        """Start a thread to refresh the entry.
+
+        The caller must hold the lock.
+        """
+        if host in self._refreshing:
+            return
+        self._refreshing.add(host)
+        self._stats['refreshes'] += 1
+        thread = threading.Thread(target=self._refresh,
+                                  args=(host, ),
+                                  name=f'k2hr3-resolver-{host}')
+        thread.daemon = True
+        thread.start()
+
+    def _refresh(self, host: str) -> None:
+        """Refresh the entry. Runs in a background thread."""
+        try:
+            self._lookup(host)
+        except OSError as error:
+            LOG.warning('failed to refresh the address of %s, %s', host,
+                        error)
+        finally:
+            with self._lock:
+                self._refreshing.discard(host)
+
+    def clear(self) -> None:
+        """Forget all cached entries."""
+        with self._lock:
+            self._cache.clear()
+
+
+_RESOLVER = _K2hr3Resolver()
+
+
+def _get_resolver() -> _K2hr3Resolver:
+    """Return the process wide resolver.
+
+    :returns: the resolver
+    :rtype: _K2hr3Resolver
+    """
+    return _RESOLVER
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
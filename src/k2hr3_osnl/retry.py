@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Schedule retries of failed requests to the k2hr3 api."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+
+LOG = logging.getLogger(__name__)
+
+
+def _backoff_delay(attempt: int, conf: K2hr3Conf) -> float:
+    """Return seconds to wait before the attempt.
+
+    The interval doubles on every attempt up to retry_max_interval_seconds.
+    If retry_jitter is True, the interval is randomized between the half
+    and the whole of it to spread retries of a burst.
+
+    :param attempt: retry count starting from 1
+    :type attempt: int
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: seconds to wait
+    :rtype: float
+    """
+    delay = min(conf.k2hr3.retry_max_interval_seconds,
+                conf.k2hr3.retry_interval_seconds * (2**(attempt - 1)))
+    if conf.k2hr3.retry_jitter:
+        delay = random.uniform(delay / 2, delay)  # nosec
+    return delay
+
+
+class _K2hr3RetryScheduler:
+    """Runs delayed tasks without blocking the caller.
+
+    Tasks are parked in a heap ordered by the time they are due. A timer
+    thread pops the due tasks and runs them in a small thread pool. The
+    number of tasks waiting or running is capped by max_inflight.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.retry import _K2hr3RetryScheduler
+    >>> scheduler = _K2hr3RetryScheduler(max_inflight=10)
+    >>> scheduler.schedule(1.0, lambda: print('retry'))
+    True
+    >>> scheduler.stop()
+    """
+
+    def __init__(self, max_inflight: int = 1000, workers: int = 4) -> None:
+        """Initialize attributes.
+
+        :param max_inflight: max number of waiting and running tasks
+        :type max_inflight: int
+        :param workers: number of threads to run tasks
+        :type workers: int
+        """
+        self._max_inflight = max_inflight
+        self._workers = workers
+        self._heap = []  # type: List[Tuple[float, int, Callable[[], None]]]
+        self._seq = itertools.count()  # keeps the order of the same due.
+        self._inflight = 0
+        self._cond = threading.Condition()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._running = False
+        self._stopping = False
+        self._stats = {'scheduled': 0, 'rejected': 0, 'executed': 0}
+
+    @property
+    def max_inflight(self) -> int:
+        """Returns the max number of waiting and running tasks.
+
+        :returns: max number of tasks
+        :rtype: int
+        """
+        return self._max_inflight
+
+    @max_inflight.setter
+    def max_inflight(self, value: int) -> None:
+        """Set the max number of waiting and running tasks.
+
+        :param value: max number of tasks
+        :type value: int
+        """
+        self._max_inflight = value
+
+    @property
+    def inflight(self) -> int:
+        """Returns the number of waiting and running tasks.
+
+        :returns: number of tasks
+        :rtype: int
+        """
+        return self._inflight
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Returns counters of tasks.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._cond:
+            return dict(self._stats)
+
+    def schedule(self, delay: float, task: Callable[[], None]) -> bool:
+        """Run the task after delay seconds.
+
+        :param delay: seconds to wait
+        :type delay: float
+        :param task: a callable without arguments
+        :type task: callable
+        :returns: True if scheduled, False if too many tasks are in flight.
+        :rtype: bool
+        """
+        with self._cond:
+            if self._inflight >= self._max_inflight:
+                self._stats['rejected'] += 1
+                LOG.warning('too many retries in flight, %s', self._inflight)
+                return False
+            heapq.heappush(self._heap,
+                           (time.monotonic() + delay, next(self._seq), task))
+            self._inflight += 1
+            self._stats['scheduled'] += 1
+            if not self._stopping:
+                self._start()
+            self._cond.notify()
+        return True
+
+    def _start(self) -> None:
+        """Start the timer thread if not running.
+
+        The caller must hold the lock.
+        """
+        if self._running:
+            return
+        self._running = True
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix='k2hr3-retry')
+        self._thread = threading.Thread(target=self._run,
+                                        name='k2hr3-retry-timer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self) -> None:
+        """Pop the due tasks. Runs in the timer thread."""
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                _, _, task = heapq.heappop(self._heap)
+                executor = self._executor
+            assert executor is not None
+            try:
+                executor.submit(self._execute, task)
+            except RuntimeError:  # stopped in the meantime
+                self._execute(task)
+
+    def _execute(self, task: Callable[[], None]) -> None:
+        """Run a task. Runs in the worker threads."""
+        try:
+            task()
+        except Exception:  # pylint: disable=broad-exception-caught
+            LOG.exception('retry task failed.')
+        finally:
+            with self._cond:
+                self._inflight -= 1
+                self._stats['executed'] += 1
+                self._cond.notify_all()
+
+    def stop(self) -> list[Callable[[], None]]:
+        """Stop the timer thread and return the tasks not started yet.
+
+        Running tasks are completed before this method returns. Tasks they
+        schedule in the meantime are returned too.
+
+        :returns: tasks which are not started
+        :rtype: list
+        """
+        with self._cond:
+            self._stopping = True
+            self._running = False
+            thread, self._thread = self._thread, None
+            executor, self._executor = self._executor, None
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        if executor is not None:
+            executor.shutdown(wait=True)
+        with self._cond:
+            pending = [task for _, _, task in sorted(self._heap)]
+            self._inflight -= len(self._heap)
+            self._heap.clear()
+            self._stopping = False
+        return pending
+
+
+_SCHEDULER = None  # type: Optional[_K2hr3RetryScheduler]
+_SCHEDULER_LOCK = threading.Lock()
+
+
+def _get_retry_scheduler(conf: K2hr3Conf) -> _K2hr3RetryScheduler:
+    """Return the process wide retry scheduler.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: the retry scheduler
+    :rtype: _K2hr3RetryScheduler
+    """
+    global _SCHEDULER  # pylint: disable=global-statement
+    with _SCHEDULER_LOCK:
+        if _SCHEDULER is None:
+            _SCHEDULER = _K2hr3RetryScheduler(
+                max_inflight=conf.k2hr3.max_inflight_retries,
+                workers=conf.k2hr3.retry_workers)
+        else:
+            _SCHEDULER.max_inflight = conf.k2hr3.max_inflight_retries
+        return _SCHEDULER
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
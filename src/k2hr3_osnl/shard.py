@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Serialize deliveries of an instance on shards chosen by a hash ring."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import bisect
+from collections.abc import Callable
+from concurrent.futures import Future, ThreadPoolExecutor
+import hashlib
+import logging
+import threading
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+
+LOG = logging.getLogger(__name__)
+
+# points of a shard on the hash ring.
+_REPLICAS = 64
+
+
+def _hash(key: str) -> int:
+    """Return a 64 bit hash of the key which is stable across processes.
+
+    :param key: a key
+    :type key: str
+    :returns: a hash value
+    :rtype: int
+    """
+    return int.from_bytes(
+        hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class _K2hr3ShardDispatcher:
+    """Runs tasks of a key one by one and tasks of different keys in parallel.
+
+    A key is mapped onto a shard by a consistent hash ring and each shard
+    runs its tasks in a thread in the submitted order. Changing the number
+    of shards moves only the keys of the added or removed shards.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.shard import _K2hr3ShardDispatcher
+    >>> shards = _K2hr3ShardDispatcher(4)
+    >>> shards.run('instance_id', lambda: 'handled')
+    'handled'
+    >>> shards.stop()
+    """
+
+    def __init__(self, shards: int, replicas: int = _REPLICAS) -> None:
+        """Initialize attributes.
+
+        :param shards: number of shards
+        :type shards: int
+        :param replicas: points of a shard on the hash ring
+        :type replicas: int
+        """
+        ring = sorted((_hash(f'{shard}-{replica}'), shard)
+                      for shard in range(shards)
+                      for replica in range(replicas))
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_shards = [shard for _, shard in ring]
+        self._executors = [None] * shards  # type: List[Optional[ThreadPoolExecutor]]  # noqa
+        self._depths = [0] * shards
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'completed': 0}
+
+    @property
+    def shards(self) -> int:
+        """Returns the number of shards.
+
+        :returns: number of shards
+        :rtype: int
+        """
+        return len(self._depths)
+
+    @property
+    def depths(self) -> list[int]:
+        """Returns the number of waiting and running tasks of each shard.
+
+        :returns: depths in the order of shards
+        :rtype: list
+        """
+        with self._lock:
+            return list(self._depths)
+
+    @property
+    def stats(self) -> dict[str, Any]:
+        """Returns counters of tasks and the depths of shards.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)  # type: Dict[str, Any]
+            stats['depths'] = list(self._depths)
+            return stats
+
+    def shard(self, key: str) -> int:
+        """Returns the shard of the key.
+
+        :param key: a key like an instance id
+        :type key: str
+        :returns: index of the shard
+        :rtype: int
+        """
+        index = bisect.bisect(self._ring_hashes, _hash(key))
+        return self._ring_shards[index % len(self._ring_shards)]
+
+    def submit(self, key: str, task: Callable[[], Any]) -> Future:
+        """Run the task after the tasks of the same shard.
+
+        :param key: a key like an instance id
+        :type key: str
+        :param task: a callable without arguments
+        :type task: callable
+        :returns: a future of the result of the task
+        :rtype: concurrent.futures.Future
+        """
+        shard = self.shard(key)
+        with self._lock:
+            executor = self._executors[shard]
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'k2hr3-shard-{shard}')
+                self._executors[shard] = executor
+            self._depths[shard] += 1
+            self._stats['submitted'] += 1
+        try:
+            return executor.submit(self._execute, shard, task)
+        except RuntimeError:  # stopped in the meantime
+            self._done(shard)
+            raise
+
+    def run(self, key: str, task: Callable[[], Any]) -> Any:
+        """Run the task in the shard of the key and wait for the result.
+
+        :param key: a key like an instance id
+        :type key: str
+        :param task: a callable without arguments
+        :type task: callable
+        :returns: the result of the task
+        :raises Exception: the exception the task raised.
+        """
+        return self.submit(key, task).result()
+
+    def _execute(self, shard: int, task: Callable[[], Any]) -> Any:
+        """Run a task. Runs in the thread of the shard."""
+        try:
+            return task()
+        finally:
+            self._done(shard)
+
+    def _done(self, shard: int) -> None:
+        """Count a finished task."""
+        with self._lock:
+            self._depths[shard] -= 1
+            self._stats['completed'] += 1
+
+    def stop(self, wait: bool = True) -> None:
+        """Stop the threads.
+
+        :param wait: True to wait for the submitted tasks. False to cancel
+                     the tasks not started yet and return at once.
+        :type wait: bool
+        """
+        with self._lock:
+            executors = list(self._executors)
+            self._executors = [None] * len(executors)
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+_SHARDS = None  # type: Optional[_K2hr3ShardDispatcher]
+_SHARDS_LOCK = threading.Lock()
+
+
+def _get_shard_dispatcher(conf: K2hr3Conf) -> _K2hr3ShardDispatcher | None:
+    """Return the process wide shard dispatcher.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: the shard dispatcher or None if the shards option is 0.
+    :rtype: _K2hr3ShardDispatcher
+    """
+    global _SHARDS  # pylint: disable=global-statement
+    if conf.k2hr3.shards <= 0:
+        return None
+    with _SHARDS_LOCK:
+        old, shards = None, _SHARDS
+        if shards is None or shards.shards != conf.k2hr3.shards:
+            old, shards = shards, _K2hr3ShardDispatcher(conf.k2hr3.shards)
+            _SHARDS = shards
+    # waits for the queued deliveries without blocking the other threads.
+    if old is not None:
+        old.stop()
+    return shards
+
+
+def _stop_shard_dispatcher(wait: bool = True) -> None:
+    """Stop the process wide shard dispatcher if started.
+
+    :param wait: False to cancel the tasks not started yet
+    :type wait: bool
+    """
+    global _SHARDS  # pylint: disable=global-statement
+    with _SHARDS_LOCK:
+        shards, _SHARDS = _SHARDS, None
+    if shards is not None:
+        shards.stop(wait)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Spool failed requests to the k2hr3 api on disk and replay them."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+from collections.abc import Callable, Iterator
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.codec import _dumpb, _loads
+from k2hr3_osnl.retry import _backoff_delay
+
+LOG = logging.getLogger(__name__)
+
+# A record is the length and the crc32 of the payload followed by the json.
+_HEADER = struct.Struct('>II')
+# A new segment is started when the current one exceeds the size.
+_SEGMENT_BYTES = 4 * 1024 * 1024
+_SEGMENT_SUFFIX = '.seg'
+# A segment with a broken record is renamed with the suffix for recovery.
+_CORRUPT_SUFFIX = '.corrupt'
+# seconds between scans of the directory if nothing to replay.
+_IDLE_SECONDS = 1.0
+
+
+def _read_records(data: bytes, path: str,
+                  broken: list[int] | None = None
+                  ) -> Iterator[dict[str, Any]]:
+    """Yield the records of a segment.
+
+    A torn record at the tail, which a crash in the middle of a write
+    leaves, ends the segment. So does a broken checksum, whose offset is
+    appended to broken.
+
+    :param data: content of a segment
+    :type data: bytes
+    :param path: segment path for logging
+    :type path: str
+    :param broken: offsets of broken records
+    :type broken: list
+    :returns: records
+    :rtype: iterator
+    """
+    offset = 0
+    while offset < len(data):
+        if offset + _HEADER.size > len(data):
+            LOG.warning('torn record at %s of %s', offset, path)
+            return
+        length, crc = _HEADER.unpack_from(data, offset)
+        payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+        if len(payload) < length:
+            LOG.warning('torn record at %s of %s', offset, path)
+            return
+        if zlib.crc32(payload) != crc:
+            LOG.error('broken record at %s of %s, skips %s bytes', offset,
+                      path, len(data) - offset)
+            if broken is not None:
+                broken.append(offset)
+            return
+        offset += _HEADER.size + length
+        try:
+            record = _loads(payload)
+        except ValueError as error:
+            LOG.error('invalid record at %s of %s, %s', offset, path, error)
+            continue
+        yield record
+
+
+def _fsync_dir(path: str) -> None:
+    """Persist the entries of a directory.
+
+    :param path: directory path
+    :type path: str
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _K2hr3Spool:  # pylint: disable=too-many-instance-attributes
+    """An append-only spool of failed requests.
+
+    Records are appended to a segment file, which the process locks while
+    it writes to it. Callers appending at the same time share a fsync, so
+    that a record is durable when append returns. The replayer thread
+    locks a segment no process writes to, sends its records in order and
+    removes it. While a record fails temporarily, the replayer backs off
+    like a retry. Processes can share the directory.
+
+    A record is sent at least once. A segment which a process stops in the
+    middle of is replayed from the start again.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.cfg import K2hr3Conf
+    >>> from k2hr3_osnl.spool import _K2hr3Spool
+    >>> from pathlib import Path
+    >>> conf = K2hr3Conf(Path('etc/k2hr3-osnl.conf'))
+    >>> spool = _K2hr3Spool('/var/spool/k2hr3_osnl', conf)
+    >>> spool.append({'url': 'http://127.0.0.1/v1/role'})
+    True
+    >>> spool.start(lambda conf, record: True)
+    >>> spool.stop()
+    """
+
+    def __init__(self, path: str, conf: K2hr3Conf) -> None:
+        """Initialize attributes.
+
+        :param path: directory of segments. It is created if not exists.
+        :type path: str
+        :param conf: K2hr3Conf object
+        :type conf: K2hr3Conf
+        :raises OSError: if failed to create the directory
+        """
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        self._path = path
+        self._conf = conf
+        self._cond = threading.Condition()
+        self._fd = None  # type: Optional[int]
+        self._segment = ''
+        self._size = 0
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._stopped = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._stats = {'spooled': 0, 'replayed': 0, 'dropped': 0}
+
+    @property
+    def path(self) -> str:
+        """Returns the directory of segments.
+
+        :returns: directory path
+        :rtype: str
+        """
+        return self._path
+
+    @property
+    def conf(self) -> K2hr3Conf:
+        """Returns the configuration to replay records.
+
+        :returns: K2hr3Conf object
+        :rtype: K2hr3Conf
+        """
+        return self._conf
+
+    @conf.setter
+    def conf(self, value: K2hr3Conf) -> None:
+        """Set the configuration to replay records.
+
+        :param value: K2hr3Conf object
+        :type value: K2hr3Conf
+        """
+        self._conf = value
+
+    @property
+    def stats(self) -> dict[str, int]:
+        """Returns counters of records.
+
+        :returns: a copy of counters
+        :rtype: dict
+        """
+        with self._cond:
+            return dict(self._stats)
+
+    @property
+    def size(self) -> int:
+        """Returns bytes of segments in the directory.
+
+        :returns: bytes
+        :rtype: int
+        """
+        size = 0
+        for name in self._segments():
+            try:
+                size += os.stat(os.path.join(self._path, name)).st_size
+            except OSError:  # replayed in the meantime
+                pass
+        return size
+
+    def _segments(self) -> list[str]:
+        """Returns segment names from the oldest."""
+        try:
+            names = os.listdir(self._path)
+        except OSError as error:
+            LOG.error('failed to list %s, %s', self._path, error)
+            return []
+        return sorted(name for name in names
+                      if name.endswith(_SEGMENT_SUFFIX))
+
+    def append(self, record: dict[str, Any]) -> bool:
+        """Write a record and wait until it is durable.
+
+        :param record: a json serializable dict
+        :type record: dict
+        :returns: True if the record is on disk, otherwise False
+        :rtype: bool
+        """
+        payload = _dumpb(record)
+        frame = _HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._cond:
+            try:
+                if self._fd is None or self._size >= _SEGMENT_BYTES:
+                    self._roll()
+                    self._open()
+                assert self._fd is not None
+                written = os.write(self._fd, frame)
+                if written != len(frame):
+                    # keeps the segment readable.
+                    os.ftruncate(self._fd, self._size)
+                    raise OSError(f'wrote {written} of {len(frame)} bytes')
+            except OSError as error:
+                LOG.error('failed to spool a record to %s, %s', self._path,
+                          error)
+                return False
+            self._size += len(frame)
+            self._written += 1
+            self._stats['spooled'] += 1
+            return self._sync(self._written)
+
+    def _sync(self, seq: int) -> bool:
+        """Wait until the record of seq is synced.
+
+        The first waiter calls fsync for the records written so far and
+        the others wait for it. The caller must hold the lock.
+        """
+        while self._synced < seq:
+            if self._syncing:
+                self._cond.wait()
+                continue
+            fd, target = self._fd, self._written
+            self._syncing = True
+            self._cond.release()
+            try:
+                os.fsync(fd)  # type: ignore
+            except OSError as error:
+                LOG.error('failed to sync %s, %s', self._segment, error)
+                return False
+            finally:
+                self._cond.acquire()
+                self._syncing = False
+                self._cond.notify_all()
+            self._synced = max(self._synced, target)
+        return True
+
+    def _open(self) -> None:
+        """Start a new segment. The caller must hold the lock."""
+        name = f'{time.time_ns():020d}-{os.getpid()}{_SEGMENT_SUFFIX}'
+        path = os.path.join(self._path, name)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND,
+                     0o600)
+        # tells the replayers the segment is being written.
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        _fsync_dir(self._path)
+        self._fd, self._segment, self._size = fd, path, 0
+
+    def _roll(self) -> None:
+        """Close the current segment. The caller must hold the lock."""
+        while self._syncing:
+            self._cond.wait()
+        if self._fd is None:
+            return
+        fd, self._fd = self._fd, None
+        try:
+            os.fsync(fd)
+        except OSError as error:
+            LOG.error('failed to sync %s, %s', self._segment, error)
+        os.close(fd)
+        self._synced = self._written
+
+    def start(self, replay: Callable[[K2hr3Conf, dict[str, Any]],
+                                     bool]) -> None:
+        """Start the replayer thread.
+
+        :param replay: a callable sending a record. It returns False if
+                       the record should be sent again later.
+        :type replay: callable
+        """
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, args=(replay, ),
+                                        name='k2hr3-spool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the replayer thread and close the current segment."""
+        self._stopped.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+        with self._cond:
+            self._roll()
+
+    def _run(self, replay: Callable[[K2hr3Conf, dict[str, Any]],
+                                    bool]) -> None:
+        """Replay segments. Runs in the replayer thread."""
+        while not self._stopped.is_set():
+            replayed = False
+            for name in self._segments():
+                if self._stopped.is_set():
+                    return
+                replayed = self._replay_segment(
+                    os.path.join(self._path, name), replay) or replayed
+            if replayed:
+                continue
+            with self._cond:
+                if self._size > 0 and self._fd is not None:
+                    self._roll()  # replays the current segment next.
+                    continue
+            self._stopped.wait(_IDLE_SECONDS)
+
+    def _replay_segment(
+            self, path: str,
+            replay: Callable[[K2hr3Conf, dict[str, Any]], bool]) -> bool:
+        """Replay a segment unless locked and remove it.
+
+        A segment with a broken record is renamed with the .corrupt suffix
+        instead, so that the records after the broken one can be recovered.
+
+        :returns: True if the segment is removed, otherwise False
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:  # replayed in the meantime
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:  # being written or replayed
+                return False
+            if not self._is_linked(fd, path):  # replayed in the meantime
+                return False
+            with os.fdopen(os.dup(fd), 'rb') as f:
+                data = f.read()
+            broken = []  # type: List[int]
+            for record in _read_records(data, path, broken):
+                if not self._replay_record(record, replay):
+                    return False
+            if broken:
+                os.rename(path, path + _CORRUPT_SUFFIX)
+                LOG.error('quarantined %s to %s%s', path, path,
+                          _CORRUPT_SUFFIX)
+                return True
+            os.remove(path)
+        except OSError as error:
+            LOG.error('failed to replay %s, %s', path, error)
+            return False
+        finally:
+            os.close(fd)
+        LOG.info('replayed %s', path)
+        return True
+
+    @staticmethod
+    def _is_linked(fd: int, path: str) -> bool:
+        """Returns True if the path still names the file opened as fd."""
+        try:
+            return os.path.samestat(os.fstat(fd), os.stat(path))
+        except FileNotFoundError:  # removed
+            return False
+
+    def _replay_record(
+            self, record: dict[str, Any],
+            replay: Callable[[K2hr3Conf, dict[str, Any]], bool]) -> bool:
+        """Send a record until it succeeds or fails permanently.
+
+        :returns: False if stopped, otherwise True
+        """
+        attempt = 0
+        while not self._stopped.is_set():
+            try:
+                done = replay(self._conf, record)
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOG.exception('dropped a spooled record %s', record)
+                with self._cond:
+                    self._stats['dropped'] += 1
+                return True
+            if done:
+                with self._cond:
+                    self._stats['replayed'] += 1
+                return True
+            attempt += 1
+            delay = _backoff_delay(attempt, self._conf)
+            LOG.warning('replaying the spool in %.1f seconds.', delay)
+            self._stopped.wait(delay)
+        return False
+
+
+_SPOOL = None  # type: Optional[_K2hr3Spool]
+_SPOOL_LOCK = threading.Lock()
+
+
+def _get_spool(conf: K2hr3Conf) -> _K2hr3Spool | None:
+    """Return the process wide spool.
+
+    The directory can not be changed without a restart.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: the spool or None if spool_dir is empty or unusable
+    :rtype: _K2hr3Spool
+    """
+    global _SPOOL  # pylint: disable=global-statement
+    with _SPOOL_LOCK:
+        if _SPOOL is None:
+            if not conf.k2hr3.spool_dir:
+                return None
+            try:
+                _SPOOL = _K2hr3Spool(conf.k2hr3.spool_dir, conf)
+            except OSError as error:
+                LOG.error('failed to create the spool, %s', error)
+                return None
+        elif _SPOOL.conf is not conf and \
+                _SPOOL.path != conf.k2hr3.spool_dir:
+            LOG.warning('spool_dir requires a restart, keeps %s', _SPOOL.path)
+        _SPOOL.conf = conf
+        return _SPOOL
+
+
+def _stop_spool() -> None:
+    """Stop the process wide spool."""
+    global _SPOOL  # pylint: disable=global-statement
+    with _SPOOL_LOCK:
+        spool, _SPOOL = _SPOOL, None
+    if spool is not None:
+        spool.stop()
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Run listeners in worker processes and supervise them."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from collections.abc import Callable
+import json
+import logging
+import math
+import os
+import resource
+import selectors
+import signal
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+LOG = logging.getLogger(__name__)
+
+# A worker running longer than this is regarded as healthy again.
+_STABLE_SECONDS = 60
+
+
+class _K2hr3Worker:
+    """A slot of a worker process in the supervisor."""
+
+    def __init__(self, slot: int) -> None:
+        """Initialize attributes.
+
+        :param slot: index of the slot
+        :type slot: int
+        """
+        self.slot = slot
+        self.pid = None  # type: Optional[int]
+        self.reader = None  # type: Optional[int]
+        self.buffer = b''
+        self.started = 0.0
+        self.next_start = 0.0
+        self.restarts = 0
+        self.failures = 0
+        self.exitcode = None  # type: Optional[int]
+        self.report = {}  # type: Dict[str, Any]
+
+    def stats(self) -> dict[str, Any]:
+        """Returns the stats of the slot.
+
+        :returns: stats of the slot and the last report of the worker
+        :rtype: dict
+        """
+        return {
+            'pid': self.pid,
+            'restarts': self.restarts,
+            'exitcode': self.exitcode,
+            'uptime': (time.monotonic() - self.started
+                       if self.pid is not None else 0),
+            # metrics are large, so that they are served separately.
+            'report': {
+                key: value
+                for key, value in self.report.items() if key != 'metrics'
+            },
+        }
+
+
+def _worker_usage() -> dict[str, Any]:
+    """Return the resource usage of the current process.
+
+    :returns: pid, cpu times and max rss
+    :rtype: dict
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'pid': os.getpid(),
+        'utime': usage.ru_utime,
+        'stime': usage.ru_stime,
+        'maxrss': usage.ru_maxrss,
+    }
+
+
+class _K2hr3Supervisor:
+    """Forks worker processes and restarts them if they exit.
+
+    Each worker runs the target, which is expected to run a listener.
+    Workers share the pool of the listener, so that the broker load
+    balances messages between them. A worker exited unexpectedly is
+    restarted after a delay which doubles on every consecutive failure.
+    SIGTERM and SIGINT stop the workers and the supervisor. SIGHUP is
+    forwarded to the workers. SIGUSR1 logs the stats of the workers.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.supervisor import _K2hr3Supervisor
+    >>> supervisor = _K2hr3Supervisor(4, lambda: listen(endpoints))
+    >>> supervisor.run()
+    0
+    """
+
+    def __init__(self,  # pylint: disable=too-many-positional-arguments
+                 workers: int,
+                 target: Callable[[], int],
+                 stats: Callable[[], dict[str, Any]] = dict,
+                 stats_interval: float = 10,
+                 restart_interval: float = 1,
+                 restart_max_interval: float = 60,
+                 shutdown_timeout: float = 30) -> None:
+        """Initialize attributes.
+
+        :param workers: number of worker processes
+        :type workers: int
+        :param target: a callable run in each worker which returns an exit
+                       code
+        :type target: callable
+        :param stats: a callable run in each worker which returns stats to
+                      report to the supervisor
+        :type stats: callable
+        :param stats_interval: seconds between reports of a worker
+        :type stats_interval: float
+        :param restart_interval: seconds to wait before the first restart
+        :type restart_interval: float
+        :param restart_max_interval: max seconds to wait before a restart
+        :type restart_max_interval: float
+        :param shutdown_timeout: seconds to wait for workers to exit before
+                                 killing them
+        :type shutdown_timeout: float
+        """
+        self._workers = [_K2hr3Worker(slot) for slot in range(workers)]
+        self._target = target
+        self._stats = stats
+        self._stats_interval = stats_interval
+        self._restart_interval = restart_interval
+        self._restart_max_interval = restart_max_interval
+        self._shutdown_timeout = shutdown_timeout
+        self._selector = selectors.DefaultSelector()
+        # signals wake up the selector by this pipe.
+        self._wakeup = None  # type: Optional[Tuple[int, int]]
+        self._stopping = False
+        self._signals = set()  # type: Set[int]
+
+    @property
+    def stats(self) -> dict[int, dict[str, Any]]:
+        """Returns the stats of each worker.
+
+        :returns: slot => stats of the worker
+        :rtype: dict
+        """
+        return {worker.slot: worker.stats() for worker in self._workers}
+
+    @property
+    def metrics(self) -> dict[int, list[dict[str, Any]]]:
+        """Returns the metric families each worker reported last.
+
+        :returns: slot => the metric families of the worker
+        :rtype: dict
+        """
+        return {
+            worker.slot: worker.report.get('metrics', [])
+            for worker in self._workers
+        }
+
+    def stop(self) -> None:
+        """Stop the workers and return from run."""
+        self._stopping = True
+        if self._wakeup is not None:
+            try:
+                os.write(self._wakeup[1], b'\0')
+            except OSError:
+                pass
+
+    def run(self) -> int:
+        """Run the workers until SIGTERM or SIGINT arrives.
+
+        :returns: 0
+        :rtype: int
+        """
+        handlers = {
+            signal.SIGTERM: self._on_stop,
+            signal.SIGINT: self._on_stop,
+            signal.SIGHUP: self._on_signal,
+            signal.SIGUSR1: self._on_signal,
+            signal.SIGCHLD: self._on_child,
+        }
+        reader, writer = os.pipe()
+        os.set_blocking(reader, False)
+        os.set_blocking(writer, False)
+        self._wakeup = (reader, writer)
+        self._selector.register(reader, selectors.EVENT_READ, None)
+        previous_wakeup = signal.set_wakeup_fd(writer)
+        previous = {
+            signum: signal.signal(signum, handler)
+            for signum, handler in handlers.items()
+        }
+        LOG.info('supervisor started with %s workers', len(self._workers))
+        try:
+            while not self._stopping:
+                now = time.monotonic()
+                timeout = 1.0
+                for worker in self._workers:
+                    if worker.pid is None and worker.next_start <= now:
+                        self._spawn(worker)
+                    elif worker.pid is None:
+                        timeout = min(timeout, worker.next_start - now)
+                self._poll(timeout)
+                self._reap()
+                if signal.SIGHUP in self._signals:
+                    self._signals.discard(signal.SIGHUP)
+                    self._kill(signal.SIGHUP)
+                if signal.SIGUSR1 in self._signals:
+                    self._signals.discard(signal.SIGUSR1)
+                    LOG.info('workers %s', self.stats)
+            self._shutdown()
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+            signal.set_wakeup_fd(previous_wakeup)
+            self._selector.unregister(reader)
+            self._wakeup = None
+            os.close(reader)
+            os.close(writer)
+        LOG.info('supervisor stopped')
+        return 0
+
+    def _on_stop(self, signum: int, frame: Any) -> None:  # pylint: disable=unused-argument  # noqa
+        """Handles SIGTERM and SIGINT."""
+        self._stopping = True
+
+    def _on_signal(self, signum: int, frame: Any) -> None:  # pylint: disable=unused-argument  # noqa
+        """Handles SIGHUP and SIGUSR1 in the loop."""
+        self._signals.add(signum)
+
+    def _on_child(self, signum: int, frame: Any) -> None:
+        """Handles SIGCHLD. The wakeup fd makes the loop reap workers."""
+
+    def _spawn(self, worker: _K2hr3Worker) -> None:
+        """Fork a worker process."""
+        reader, writer = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # the worker never returns to the caller.
+            code = 1
+            try:
+                os.close(reader)
+                code = self._run_worker(writer)
+            finally:
+                os._exit(code)
+        os.close(writer)
+        os.set_blocking(reader, False)
+        worker.pid = pid
+        worker.reader = reader
+        worker.buffer = b''
+        worker.started = time.monotonic()
+        self._selector.register(reader, selectors.EVENT_READ, worker)
+        LOG.info('worker %s started, pid %s', worker.slot, pid)
+
+    def _run_worker(self, writer: int) -> int:
+        """Run the target in a worker process.
+
+        :returns: exit code of the worker
+        :rtype: int
+        """
+        for worker in self._workers:
+            if worker.reader is not None:
+                os.close(worker.reader)
+        signal.set_wakeup_fd(-1)
+        if self._wakeup is not None:
+            os.close(self._wakeup[0])
+            os.close(self._wakeup[1])
+            self._wakeup = None
+        self._selector = selectors.DefaultSelector()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # KeyboardInterrupt stops the listener.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+        parent = os.getppid()
+        thread = threading.Thread(target=self._report,
+                                  args=(writer, parent),
+                                  name='k2hr3-worker-stats')
+        thread.daemon = True
+        thread.start()
+        code = 1
+        try:
+            code = self._target()
+        except KeyboardInterrupt:
+            code = 0
+        except Exception:  # pylint: disable=broad-exception-caught
+            LOG.exception('worker failed.')
+        logging.shutdown()
+        return code
+
+    def _report(self, writer: int, parent: int) -> None:
+        """Send stats to the supervisor. Runs in a worker process."""
+        while True:
+            if os.getppid() != parent:
+                LOG.error('supervisor exited, stopping the worker')
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            report = _worker_usage()
+            try:
+                report.update(self._stats())
+                os.write(writer, json.dumps(report).encode('utf-8') + b'\n')
+            except OSError:
+                return
+            except Exception:  # pylint: disable=broad-exception-caught
+                LOG.exception('failed to collect stats.')
+            time.sleep(self._stats_interval)
+
+    def _poll(self, timeout: float) -> None:
+        """Read reports from workers."""
+        for key, _ in self._selector.select(max(timeout, 0)):
+            worker = key.data
+            if worker is None:  # woken up by a signal.
+                try:
+                    while os.read(key.fd, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            try:
+                data = os.read(key.fd, 65536)
+            except BlockingIOError:
+                continue
+            if not data:  # the worker exited.
+                self._close(worker)
+                continue
+            worker.buffer += data
+            *lines, worker.buffer = worker.buffer.split(b'\n')
+            if lines:
+                try:
+                    worker.report = json.loads(lines[-1])
+                except ValueError as error:
+                    LOG.warning('invalid report from worker %s, %s',
+                                worker.slot, error)
+
+    def _close(self, worker: _K2hr3Worker) -> None:
+        """Close the pipe of the worker."""
+        if worker.reader is not None:
+            self._selector.unregister(worker.reader)
+            os.close(worker.reader)
+            worker.reader = None
+
+    def _reap(self) -> None:
+        """Collect exited workers and schedule restarts."""
+        for worker in self._workers:
+            if worker.pid is None:
+                continue
+            try:
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+            except ChildProcessError:  # reaped by someone else.
+                pid, status = worker.pid, 0
+            if pid == 0:
+                continue
+            self._close(worker)
+            now = time.monotonic()
+            worker.exitcode = os.waitstatus_to_exitcode(status)
+            worker.pid = None
+            if self._stopping:
+                continue
+            if now - worker.started >= _STABLE_SECONDS:
+                worker.failures = 0
+            worker.failures += 1
+            worker.restarts += 1
+            delay = min(self._restart_max_interval,
+                        self._restart_interval * 2**(worker.failures - 1))
+            worker.next_start = now + delay
+            LOG.error('worker %s pid %s exited with %s, restarting in %.1fs',
+                      worker.slot, pid, worker.exitcode, delay)
+
+    def _kill(self, signum: int) -> None:
+        """Send a signal to the running workers."""
+        for worker in self._workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def _shutdown(self) -> None:
+        """Stop the workers. Kill them if they do not exit in time."""
+        self._kill(signal.SIGTERM)
+        deadline = time.monotonic() + self._shutdown_timeout
+        while any(w.pid is not None for w in self._workers):
+            if time.monotonic() >= deadline:
+                LOG.error('workers did not stop in %ss, killing them',
+                          self._shutdown_timeout)
+                self._kill(signal.SIGKILL)
+                deadline = math.inf
+            self._poll(0.1)
+            self._reap()
+        for worker in self._workers:
+            self._close(worker)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
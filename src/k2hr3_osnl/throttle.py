@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Limit the rate and the concurrency of requests to the k2hr3 api."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import logging
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.metrics import _THROTTLE_SECONDS
+
+LOG = logging.getLogger(__name__)
+
+
+class _K2hr3Throttle:
+    """A token bucket and a cap of requests in flight.
+
+    A caller blocks until a token is available and then until the number
+    of requests in flight is below the cap. Blocking the threads of the
+    listener slows down the consumption of messages instead of piling up
+    requests. A caller reserves its tokens in advance, so that callers are
+    served in order without polling.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.throttle import _K2hr3Throttle
+    >>> throttle = _K2hr3Throttle(rate=10, burst=5, max_inflight=2)
+    >>> waited = throttle.acquire()
+    >>> throttle.inflight
+    1
+    >>> throttle.release()
+    """
+
+    def __init__(self, rate: float, burst: int, max_inflight: int) -> None:
+        """Initialize attributes.
+
+        :param rate: tokens added per second. 0 disables the rate limit.
+        :type rate: float
+        :param burst: max number of tokens
+        :type burst: int
+        :param max_inflight: max number of requests in flight. 0 disables
+                             the cap.
+        :type max_inflight: int
+        """
+        self._rate = rate
+        self._burst = burst
+        self._max_inflight = max_inflight
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._inflight = 0
+        self._cond = threading.Condition()
+
+    @property
+    def max_inflight(self) -> int:
+        """Returns the max number of requests in flight.
+
+        :returns: max number of requests. 0 if no cap.
+        :rtype: int
+        """
+        return self._max_inflight
+
+    @property
+    def inflight(self) -> int:
+        """Returns the number of requests in flight.
+
+        :returns: number of requests
+        :rtype: int
+        """
+        return self._inflight
+
+    def update(self, rate: float, burst: int, max_inflight: int) -> None:
+        """Apply new limits.
+
+        :param rate: tokens added per second. 0 disables the rate limit.
+        :type rate: float
+        :param burst: max number of tokens
+        :type burst: int
+        :param max_inflight: max number of requests in flight. 0 disables
+                             the cap.
+        :type max_inflight: int
+        """
+        with self._cond:
+            self._refill(time.monotonic())
+            self._rate = rate
+            self._burst = burst
+            self._tokens = min(self._tokens, float(burst))
+            self._max_inflight = max_inflight
+            self._cond.notify_all()
+
+    def _refill(self, now: float) -> None:
+        """Add tokens for the time elapsed. The caller must hold the lock."""
+        if self._rate > 0:
+            self._tokens = min(
+                float(self._burst),
+                self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def acquire(self, count: int = 1) -> float:
+        """Wait until count requests can be sent.
+
+        count over max_inflight, e.g. after a reload lowered the cap, waits
+        until no request is in flight and is sent alone.
+
+        :param count: number of requests
+        :type count: int
+        :returns: seconds waited
+        :rtype: float
+        """
+        started = time.monotonic()
+        delay = 0.0
+        with self._cond:
+            if self._rate > 0:
+                self._refill(started)
+                self._tokens -= count  # reserves the tokens.
+                if self._tokens < 0:
+                    delay = -self._tokens / self._rate
+        if delay > 0:
+            time.sleep(delay)
+        with self._cond:
+            while 0 < self._max_inflight < self._inflight + count and \
+                    self._inflight > 0:
+                self._cond.wait()
+            self._inflight += count
+        waited = time.monotonic() - started
+        _THROTTLE_SECONDS.observe(waited)
+        return waited
+
+    def release(self, count: int = 1) -> None:
+        """Tell the requests have finished.
+
+        :param count: number of requests
+        :type count: int
+        """
+        with self._cond:
+            self._inflight -= count
+            self._cond.notify_all()
+
+
+_THROTTLE = None  # type: Optional[_K2hr3Throttle]
+_THROTTLE_LOCK = threading.Lock()
+
+
+def _get_throttle(conf: K2hr3Conf) -> _K2hr3Throttle | None:
+    """Return the process wide throttle.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: the throttle or None if neither rate_limit nor
+              max_inflight_requests is set
+    :rtype: _K2hr3Throttle
+    """
+    global _THROTTLE  # pylint: disable=global-statement
+    rate = conf.k2hr3.rate_limit
+    max_inflight = conf.k2hr3.max_inflight_requests
+    if rate <= 0 and max_inflight <= 0:
+        return None
+    with _THROTTLE_LOCK:
+        if _THROTTLE is None:
+            _THROTTLE = _K2hr3Throttle(rate, conf.k2hr3.rate_limit_burst,
+                                       max_inflight)
+        return _THROTTLE
+
+
+def _update_throttle(conf: K2hr3Conf) -> None:
+    """Apply the limits of the configuration to the throttle.
+
+    Requests waiting or in flight keep their slots.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    """
+    with _THROTTLE_LOCK:
+        throttle = _THROTTLE
+    if throttle is not None:
+        throttle.update(conf.k2hr3.rate_limit, conf.k2hr3.rate_limit_burst,
+                        conf.k2hr3.max_inflight_requests)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
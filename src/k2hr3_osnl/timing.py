@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Measure the time each stage of a notification message takes."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+from datetime import datetime, timezone
+import json
+import logging
+import threading
+import time
+
+from typing import List, Set, Dict, Tuple, Optional, Any  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.metrics import _MESSAGE_SECONDS, _STAGE_SECONDS
+
+LOG = logging.getLogger(__name__)
+
+# the trace of the message the current thread handles.
+_LOCAL = threading.local()
+
+
+class _K2hr3Trace:
+    """Monotonic timestamps of the stages of a message.
+
+    A stage is the time from the previous mark to the mark of the stage.
+    Marks of the same stage, for instance of a reconnection, are added up.
+
+    Simple usage:
+
+    >>> from k2hr3_osnl.timing import _K2hr3Trace
+    >>> trace = _K2hr3Trace()
+    >>> trace.mark('parse')
+    >>> list(trace.stages)
+    ['parse']
+    """
+
+    __slots__ = ('started', 'stages', 'fields', '_last')
+
+    def __init__(self) -> None:
+        """Initialize attributes."""
+        self.started = self._last = time.monotonic()
+        self.stages = {}  # type: Dict[str, float]
+        self.fields = {}  # type: Dict[str, Any]
+
+    def mark(self, stage: str) -> None:
+        """Close the stage at now.
+
+        :param stage: name of the stage
+        :type stage: str
+        """
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    @property
+    def total(self) -> float:
+        """Returns seconds from the start to the last mark.
+
+        :returns: seconds
+        :rtype: float
+        """
+        return self._last - self.started
+
+
+def _start_trace() -> _K2hr3Trace:
+    """Start a trace in the current thread.
+
+    :returns: the new trace
+    :rtype: _K2hr3Trace
+    """
+    trace = _K2hr3Trace()
+    _LOCAL.trace = trace
+    return trace
+
+
+def _current_trace() -> _K2hr3Trace | None:
+    """Returns the trace of the current thread.
+
+    :returns: the trace or None
+    :rtype: _K2hr3Trace
+    """
+    return getattr(_LOCAL, 'trace', None)
+
+
+def _set_trace(trace: _K2hr3Trace | None) -> _K2hr3Trace | None:
+    """Make the trace current, for instance in a thread of a shard.
+
+    :param trace: the trace or None
+    :type trace: _K2hr3Trace
+    :returns: the previous trace
+    :rtype: _K2hr3Trace
+    """
+    previous = getattr(_LOCAL, 'trace', None)
+    _LOCAL.trace = trace
+    return previous
+
+
+def _mark(stage: str) -> None:
+    """Close the stage of the current trace if any.
+
+    :param stage: name of the stage
+    :type stage: str
+    """
+    trace = getattr(_LOCAL, 'trace', None)
+    if trace is not None:
+        trace.mark(stage)
+
+
+def _annotate(**fields: Any) -> None:
+    """Add fields to the slow message log of the current trace if any.
+
+    :param fields: names and values
+    :type fields: dict
+    """
+    trace = getattr(_LOCAL, 'trace', None)
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+def _broker_seconds(metadata: Any) -> float | None:
+    """Returns seconds since the notifier sent the message.
+
+    oslo.messaging puts the UTC time of the notification in the metadata.
+    The clocks of the hosts must be synchronized.
+
+    :param metadata: metadata of a notification
+    :type metadata: dict
+    :returns: seconds or None if no timestamp
+    :rtype: float
+    """
+    try:
+        sent = datetime.fromisoformat(str(metadata['timestamp']))
+    except (KeyError, TypeError, ValueError):
+        return None
+    if sent.tzinfo is None:
+        sent = sent.replace(tzinfo=timezone.utc)
+    return max(0.0, time.time() - sent.timestamp())
+
+
+def _finish_trace(trace: _K2hr3Trace, slow_seconds: float,
+                  broker: float | None = None) -> None:
+    """Observe the stages and log a slow message.
+
+    :param trace: the trace of a message
+    :type trace: _K2hr3Trace
+    :param slow_seconds: logs the stages if the message took longer. 0
+                         disables the log.
+    :type slow_seconds: float
+    :param broker: seconds the message waited in the message queue server
+    :type broker: float
+    """
+    if getattr(_LOCAL, 'trace', None) is trace:
+        _LOCAL.trace = None
+    for stage, seconds in trace.stages.items():
+        _STAGE_SECONDS.observe(seconds, stage)
+    total = trace.total
+    _MESSAGE_SECONDS.observe(total)
+    if broker is not None:
+        _STAGE_SECONDS.observe(broker, 'broker')
+        total += broker
+    if 0 < slow_seconds < total:
+        record = dict(trace.fields)
+        record['total'] = round(total, 6)
+        if broker is not None:
+            record['broker'] = round(broker, 6)
+        record['stages'] = {
+            stage: round(seconds, 6)
+            for stage, seconds in trace.stages.items()
+        }
+        LOG.warning('slow message %s', json.dumps(record, default=str))
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
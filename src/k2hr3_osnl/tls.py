@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Build the TLS context to the k2hr3 api."""
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
+
+import logging
+import ssl
+import threading
+
+from typing import List, Set, Dict, Tuple, Optional  # noqa: pylint: disable=unused-import
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.exceptions import _K2hr3UserAgentError
+
+LOG = logging.getLogger(__name__)
+
+# (allow_self_signed_cert, ca_file, cert_file, key_file) => context
+_CONTEXTS = {}  # type: Dict[Tuple[bool, str, str, str], ssl.SSLContext]
+_CONTEXTS_LOCK = threading.Lock()
+
+
+def _build_ssl_context(allow_self_signed_cert: bool, ca_file: str,
+                       cert_file: str, key_file: str) -> ssl.SSLContext:
+    """Build a new TLS context.
+
+    :raises _K2hr3UserAgentError: if failed to load certificates.
+    """
+    try:
+        # https://docs.python.jp/3/library/ssl.html#ssl.create_default_context
+        ctx = ssl.create_default_context(cafile=ca_file or None)
+        if allow_self_signed_cert:
+            # https://github.com/python/cpython/blob/master/Lib/ssl.py#L567
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+        if cert_file:
+            ctx.load_cert_chain(cert_file, keyfile=key_file or None)
+    except (OSError, ssl.SSLError) as error:
+        raise _K2hr3UserAgentError(
+            f'invalid tls settings, ca_file={ca_file} cert_file={cert_file}'
+            f' key_file={key_file} {error}') from error
+    LOG.debug('tls context built. ca_file=%s cert_file=%s', ca_file,
+              cert_file)
+    return ctx
+
+
+def _get_ssl_context(
+        conf: K2hr3Conf,
+        allow_self_signed_cert: bool | None = None) -> ssl.SSLContext:
+    """Return the process wide TLS context for the configuration.
+
+    A context is built once and shared by all connections, so that the CA
+    bundle is loaded only once and the TLS sessions can be resumed. A new
+    context is built only when the TLS settings change.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param allow_self_signed_cert: overrides the configuration if not None
+    :type allow_self_signed_cert: bool
+    :returns: a TLS context
+    :rtype: ssl.SSLContext
+    :raises _K2hr3UserAgentError: if failed to load certificates.
+    """
+    if allow_self_signed_cert is None:
+        allow_self_signed_cert = conf.k2hr3.allow_self_signed_cert
+    key = (bool(allow_self_signed_cert), conf.k2hr3.ca_file or '',
+           conf.k2hr3.cert_file or '', conf.k2hr3.key_file or '')
+    with _CONTEXTS_LOCK:
+        ctx = _CONTEXTS.get(key, None)
+        if ctx is None:
+            ctx = _build_ssl_context(*key)
+            _CONTEXTS[key] = ctx
+        return ctx
+
+
+def _reset_ssl_contexts() -> None:
+    """Forget all TLS contexts, for instance after certificates renewed."""
+    with _CONTEXTS_LOCK:
+        _CONTEXTS.clear()
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
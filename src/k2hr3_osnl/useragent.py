@@ -18,28 +18,41 @@
 # REVISION:
 #
 """Send HTTP requests to the k2hr3 api."""
-from __future__ import (absolute_import, division, print_function,
-                        unicode_literals)
+from __future__ import (absolute_import, annotations, division,
+                        print_function, unicode_literals)
 
+from collections.abc import Mapping
 from enum import Enum
-import json
+import functools
+import http.client
 import logging
 import re
 import socket
 import ssl
 import sys
+import threading
 import time
+import types
 import urllib
 import urllib.parse
-import urllib.request
-from urllib.error import HTTPError, URLError
 import uuid
 
-from typing import List, Set, Dict, Tuple, Optional, Union  # noqa: pylint: disable=unused-import
+from typing import List, Set, Dict, Tuple, Optional, Union, Any  # noqa: pylint: disable=unused-import
 
+from k2hr3_osnl.breaker import _get_circuit_breaker
 from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.codec import _dumpb, _dumps, _loads
+from k2hr3_osnl.connection import _K2hr3ConnectionPool, _get_connection_pool
+from k2hr3_osnl.engine import _K2hr3EnginePool, _get_delivery_engine
 from k2hr3_osnl.exceptions import _K2hr3UserAgentError
 from k2hr3_osnl.httpresponse import _K2hr3HttpResponse
+from k2hr3_osnl.lazylog import _LazyCall, _decode_body
+from k2hr3_osnl.resolver import _get_resolver
+from k2hr3_osnl.retry import _backoff_delay, _get_retry_scheduler
+from k2hr3_osnl.spool import _get_spool
+from k2hr3_osnl.throttle import _get_throttle
+from k2hr3_osnl.timing import _mark
+from k2hr3_osnl.tls import _get_ssl_context
 
 LOG = logging.getLogger(__name__)
 
@@ -48,11 +61,35 @@ class _AgentError(Enum):
     NONE = 1
     TEMP = 2
     FATAL = 3
+    OPEN = 4  # not sent because the circuit is open.
+
+
+# The response header to an OPTIONS request advertising the bulk removal.
+_BULK_HEADER = 'X-K2hr3-Bulk-Delete'
+_BULK_PROBE_INTERVAL_SECONDS = 300
+# Redirects followed as urllib did. 307 and 308 keep the method, so they are
+# followed for any method.
+_REDIRECT_CODES = frozenset((301, 302, 303, 307, 308))
+_MAX_REDIRECTS = 10  # same as urllib
+# api_url => (max number of members in a bulk request, probed time)
+_BULK_SUPPORT = {}  # type: Dict[str, Tuple[int, float]]
+_BULK_SUPPORT_LOCK = threading.Lock()
+# The request headers shared by all agents. Nobody modifies them.
+_HEADERS = types.MappingProxyType({
+    'User-Agent':
+    f'Python-k2hr3_ua/{sys.version_info[0]}.{sys.version_info[1]}'
+})
+# the agent of the current thread reused by _get_agent.
+_LOCAL = threading.local()
 
 
 class _K2hr3UserAgent:
     """Send a http/https request to the K2hr3 WebAPI."""
 
+    __slots__ = ('_conf', '_url', '_allow_self_signed_cert', '_ips',
+                 '_instance_id', '_method', '_params', '_headers',
+                 '_response', '_deferred', '_validated')
+
     def __init__(self, conf: K2hr3Conf) -> None:
         """Initialize attributes.
 
@@ -60,40 +97,60 @@ class _K2hr3UserAgent:
         :type K2hr3Cof: K2hr3Conf
         :raises K2hr3UserAgentError: api_url validation error.
         """
+        self._params = {}  # type: Dict[str, str]
+        self._headers = _HEADERS
+        self._response = _K2hr3HttpResponse()
+        self._validated = None  # type: Optional[Tuple[K2hr3Conf, str]]
+        self.reset(conf)
+        LOG.debug('useragent initialized.')
+
+    def reset(self, conf: K2hr3Conf) -> None:  # public.
+        """Reset attributes to send a new request.
+
+        The params and the response are cleared in place to reuse the agent
+        for another message. The api_url is validated only if the conf or
+        the api_url changed since the last reset.
+
+        :param conf: K2hr3Conf object.
+        :type conf: K2hr3Conf
+        :raises _K2hr3UserAgentError: api_url validation error.
+        """
         # api_url validated for myself.
         if isinstance(conf, K2hr3Conf) is False:
             raise _K2hr3UserAgentError(
                 f'conf is a K2hr3Conf instance, not {type(conf)}')
-        try:
-            _K2hr3UserAgent.validate_url(conf.k2hr3.api_url)
-        except _K2hr3UserAgentError as error:
-            raise _K2hr3UserAgentError(
-                f'a valid url is expected, not {conf.k2hr3.api_url}'
-            ) from error
+        # an option of the conf costs microseconds. reads each one once.
+        group = conf.k2hr3
+        api_url = group.api_url
+        if self._validated is None or self._validated[0] is not conf or \
+                self._validated[1] != api_url:
+            try:
+                _K2hr3UserAgent.validate_url(api_url)
+            except _K2hr3UserAgentError as error:
+                raise _K2hr3UserAgentError(
+                    f'a valid url is expected, not {api_url}') from error
+            self._validated = (conf, api_url)
+        _mark('resolve')
 
         self._conf = conf
-        self._url = conf.k2hr3.api_url
+        self._url = api_url
         # other params validated in oslo_config.
-        self._retries = conf.k2hr3.max_retries
-        self._allow_self_signed_cert = conf.k2hr3.allow_self_signed_cert
+        self._allow_self_signed_cert = group.allow_self_signed_cert
         # init the others.
         self._ips = []  # type: List[str]
         self._instance_id = ''
         self._method = 'DELETE'
-        self._params = {'extra': 'openstack-auto-v1'}
-        self._headers = {
-            'User-Agent':
-            f'Python-k2hr3_ua/{sys.version_info[0]}.{sys.version_info[1]}'
-        }
-        self._response = _K2hr3HttpResponse()
-        LOG.debug('useragent initialized.')
+        self._params.clear()
+        self._params['extra'] = 'openstack-auto-v1'
+        self._response.reset()
+        self._deferred = False
 
     @property
-    def headers(self) -> dict[str, str]:
+    def headers(self) -> Mapping[str, str]:
         """Returns the headers.
 
         :returns: Request headers
-        :rtype: dict
+        :rtype: mappingproxy
         """
         return self._headers
 
@@ -166,13 +223,17 @@ class _K2hr3UserAgent:
             self._url = value
 
     @staticmethod
-    def validate_url(value):
-        """Return True if given string is a url.
+    @functools.lru_cache(maxsize=32)
+    def parse_url(value):
+        """Split a url into the scheme, domain, port and path.
+
+        The result is cached because the api url rarely changes.
 
         :param value: a url like string
         :type value: str
-        :returns: True if given string is a url.
-        :rtype: bool
+        :returns: scheme, domain, port and path
+        :rtype: tuple
+        :raises _K2hr3UserAgentError: if given string is not a url.
         """
         # scheme
         try:
@@ -184,8 +245,6 @@ class _K2hr3UserAgent:
             raise _K2hr3UserAgentError(
                 f'scheme should be http or http, not {scheme}')
 
-        LOG.debug('scheme is %s', scheme)
-
         matches = re.match(
             r'(?P<domain>[\w|\.]+)?(?P<port>:\d{2,5})?(?P<path>[\w|/]*)?',
             url_string)
@@ -193,27 +252,39 @@ class _K2hr3UserAgent:
             raise _K2hr3UserAgentError(
                 f'the argument seems not to be a url string, {value}')
 
-        # domain must be resolved.
         domain = matches.group('domain')
         if domain is None:
             raise _K2hr3UserAgentError(f'url contains no domain, {value}')
-        try:
-            # https://github.com/python/cpython/blob/master/Modules/socketmodule.c#L5729
-            ipaddress = socket.gethostbyname(domain)
-        except OSError as e:  # resolve failed
-            raise _K2hr3UserAgentError(
-                f'unresolved domain, {domain} {e}') from e  # noqa
-
-        LOG.debug('%s resolved %s', domain, ipaddress)
-
         # path(optional)
         if matches.group('path') is None:
             raise _K2hr3UserAgentError(f'url contains no path, {value}')
         path = matches.group('path')
         # port(optional)
         port = matches.group('port')
-        LOG.debug('url=%s domain=%s port=%s path=%s', value, domain, port,
-                  path)
+        LOG.debug('url=%s scheme=%s domain=%s port=%s path=%s', value, scheme,
+                  domain, port, path)
+        return scheme, domain, port, path
+
+    @staticmethod
+    def validate_url(value):
+        """Return True if given string is a url.
+
+        :param value: a url like string
+        :type value: str
+        :returns: True if given string is a url.
+        :rtype: bool
+        """
+        _, domain, _, _ = _K2hr3UserAgent.parse_url(value)
+
+        # domain must be resolved.
+        try:
+            # The resolver answers from its cache after the first lookup.
+            ipaddress = _get_resolver().resolve(domain)
+        except OSError as e:  # resolve failed
+            raise _K2hr3UserAgentError(
+                f'unresolved domain, {domain} {e}') from e  # noqa
+
+        LOG.debug('%s resolved %s', domain, ipaddress)
         return True
 
     @property
@@ -245,12 +316,10 @@ class _K2hr3UserAgent:
             try:
                 # https://github.com/python/cpython/blob/master/Modules/socketmodule.c#L6172
                 socket.inet_pton(socket.AF_INET, ipaddress)
-                self._ips += [ipaddress]
             except OSError:
                 LOG.debug('not ip version4 string %s', ipaddress)
                 try:
                     socket.inet_pton(socket.AF_INET6, ipaddress)
-                    self._ips += [ipaddress]
                 except OSError as e:
                     LOG.error('neither ip version4 nor version6 string %s %s',
                               ipaddress, e)
@@ -261,7 +330,7 @@ class _K2hr3UserAgent:
         LOG.debug('ips=%s', ips)
         # Note:
         # parameter name is 'host' when calling r3api.
-        self._params['host'] = json.dumps(self._ips)
+        self._params['host'] = _dumps(self._ips)
 
     @property
     def instance_id(self) -> str:  # public.
@@ -292,6 +361,16 @@ class _K2hr3UserAgent:
         # parameter name is 'cuk' when calling r3api.
         self._params['cuk'] = self._instance_id
 
+    @property
+    def deferred(self) -> bool:  # public.
+        """Gets the flag of the last request handed over to retries.
+
+        :returns: True if the last request failed temporarily and a retry
+                  has been scheduled.
+        :rtype: bool
+        """
+        return self._deferred
+
     @property
     def allow_self_signed_cert(self) -> bool:  # public.
         """Gets the flag of self signed certificate or not.
@@ -313,75 +392,273 @@ class _K2hr3UserAgent:
         else:
             raise _K2hr3UserAgentError(f'Boolean value expected, not {value}')
 
+    def _get_pool(
+            self, url: str
+    ) -> _K2hr3ConnectionPool | _K2hr3EnginePool:  # non-public.
+        """Return the connection pool to the url.
+
+        Connections are kept alive in the process wide pool and the TLS
+        context is built once and shared by all agents. If delivery_engine
+        is asyncio, the requests are sent in the event loop thread.
+
+        :raises _K2hr3UserAgentError: if failed to load certificates.
+        """
+        ctx = None
+        if url.startswith('https://'):
+            ctx = _get_ssl_context(self._conf, self._allow_self_signed_cert)
+            _mark('tls')
+        if self._conf.k2hr3.delivery_engine == 'asyncio':
+            return _K2hr3EnginePool(_get_delivery_engine(self._conf), url,
+                                    ctx)
+        return _get_connection_pool(url, self._conf, ctx)
+
+    def _request_path(self, url: str,
+                      params: dict[str, str]) -> str | None:  # non-public.
+        """Return the path and query string of a request.
+
+        :returns: path and query string, or None if the url is invalid.
+        :rtype: str
+        """
+        qstring = urllib.parse.urlencode(
+            params, quote_via=urllib.parse.quote)  # type: ignore
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            self._response.error = f'http or https, not {parts.scheme}'
+            LOG.error(self._response)
+            return None
+        if parts.query:  # keeps the query string of the url.
+            qstring = '&'.join([parts.query, qstring]) if qstring else \
+                parts.query
+        return '?'.join([parts.path or '/', qstring])
+
+    @staticmethod
+    def _url_path(url: str) -> str:  # non-public.
+        """Return the path and the query string of the url if any.
+
+        :param url: url string
+        :type url: str
+        :returns: path and query string
+        :rtype: str
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.query:
+            return '?'.join([parts.path or '/', parts.query])
+        return parts.path or '/'
+
+    def _follow_redirects(self, url: str, method: str,
+                          headers: Mapping[str, str],
+                          outcome: Any) -> Any:  # non-public.
+        """Follow the redirects of the outcome as urllib did.
+
+        301, 302 and 303 are followed for GET and HEAD, 307 and 308 for any
+        method. The new url replaces the whole request url.
+
+        :param url: request url
+        :type url: str
+        :param method: http request method
+        :type method: str
+        :param headers: request headers
+        :type headers: Mapping
+        :param outcome: the response and body, or the exception raised
+        :type outcome: object
+        :returns: the outcome of the last request
+        :rtype: object
+        """
+        for _ in range(_MAX_REDIRECTS):
+            if isinstance(outcome, BaseException):
+                return outcome
+            res, _ = outcome
+            if res.status not in _REDIRECT_CODES or (
+                    res.status < 307 and method not in ('GET', 'HEAD')):
+                return outcome
+            location = res.getheader('Location', None)
+            if not location:
+                return outcome
+            url = urllib.parse.urljoin(url, location)
+            if urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+                return outcome
+            LOG.info('redirected to %s. code %s', url, res.status)
+            try:
+                outcome = self._get_pool(url).request(
+                    method, self._url_path(url), headers,
+                    self._conf.k2hr3.timeout_seconds)
+            except (OSError, http.client.HTTPException) as error:
+                outcome = error
+        return outcome
+
+    def _check_outcome(self, url: str, outcome: Any) -> _AgentError:  # non-public.  # noqa
+        """Classify the outcome of a request.
+
+        :param url: request url
+        :type url: str
+        :param outcome: the response and body, or the exception raised
+        :type outcome: object
+        Timeouts, connection errors like a refused connection and server
+        errors are temporary because the api may recover. TLS errors, broken
+        responses and client errors are not.
+
+        :returns: _AgentError.NONE if success, _AgentError.TEMP if a
+                  temporary error occurred, otherwise _AgentError.FATAL.
+        :rtype: _AgentError
+        :raises BaseException: if an unexpected exception is given.
+        """
+        self._record_outcome(url, outcome)
+        if isinstance(outcome, socket.timeout):  # temporary error
+            LOG.error('error(socket) %s', outcome)
+            return _AgentError.TEMP
+        if isinstance(outcome, ssl.SSLError):
+            LOG.error('Could not connect the server. reason %s', outcome)
+            return _AgentError.FATAL
+        if isinstance(outcome, OSError):  # temporary error
+            LOG.error('Could not connect the server. reason %s', outcome)
+            return _AgentError.TEMP
+        if isinstance(outcome, http.client.HTTPException):
+            LOG.error('Could not read the server. reason %s', outcome)
+            return _AgentError.FATAL
+        if isinstance(outcome, BaseException):
+            raise outcome
+        res, body = outcome
+        self._response.code = res.status
+        if 200 <= res.status < 300:
+            LOG.debug('code=[%s]\nurl=[%s]\nbody=[%s]\ninfo=[%s]\n',
+                      res.status, url, _LazyCall(_decode_body, body), res.msg)
+            return _AgentError.NONE
+        LOG.error(
+            'Could not complete the request. code %s reason %s headers %s',
+            res.status, res.reason, res.msg)
+        if res.status >= 500:  # temporary error
+            return _AgentError.TEMP
+        return _AgentError.FATAL
+
+    def _circuit_closed(self, url: str) -> bool:  # non-public.
+        """Returns True if a request can be sent to the url.
+
+        :param url: request url
+        :type url: str
+        :returns: False if the circuit of the url is open
+        :rtype: bool
+        """
+        breaker = _get_circuit_breaker(self._conf, url)
+        if breaker is None or breaker.allow():
+            return True
+        self._response.error = 'circuit open.'
+        return False
+
+    def _record_outcome(self, url: str, outcome: Any) -> None:  # non-public.
+        """Tell the circuit breaker of the url the outcome of a request.
+
+        :param url: request url
+        :type url: str
+        :param outcome: the response and body, or the exception raised
+        :type outcome: object
+        """
+        breaker = _get_circuit_breaker(self._conf, url)
+        if breaker is None:
+            return
+        if isinstance(outcome, BaseException):
+            breaker.record(False, isinstance(outcome, socket.timeout))
+        else:
+            breaker.record(outcome[0].status < 500)
+
+    def _send_once(self, url: str, params: dict[str, str],
+                   headers: Mapping[str, str],
+                   method: str) -> _AgentError:  # non-public.
+        """Send a http request once.
+
+        :returns: _AgentError.NONE if success, _AgentError.TEMP if a
+                  temporary error occurred, _AgentError.OPEN if the circuit
+                  is open, otherwise _AgentError.FATAL.
+        :rtype: _AgentError
+        """
+        path = self._request_path(url, params)
+        if path is None:
+            return _AgentError.FATAL
+        if not self._circuit_closed(url):
+            return _AgentError.OPEN
+        throttle = _get_throttle(self._conf)
+        if throttle is not None:
+            throttle.acquire()
+            _mark('throttle')
+        outcome = None  # type: Any
+        try:
+            try:
+                outcome = self._get_pool(url).request(
+                    method, path, headers, self._conf.k2hr3.timeout_seconds)
+            except (OSError, http.client.HTTPException) as error:
+                outcome = error
+            # a redirected request holds the same slot of the throttle.
+            outcome = self._follow_redirects(url, method, headers, outcome)
+        finally:
+            if throttle is not None:
+                throttle.release()
+        _mark('api')
+        return self._check_outcome(url, outcome)
+
+    def _defer(self, url: str, params: dict[str, str],
+               headers: Mapping[str, str], method: str,
+               circuit_open: bool = False) -> _AgentError:  # non-public.
+        """Hand a temporarily failed request over to the retry scheduler.
+
+        The caller returns immediately instead of sleeping until the next
+        retry. If requeue_on_error is True, the message queue server
+        redelivers the message instead. If no retry is left or the retry
+        scheduler is full, the request is spooled if spool_dir is set. If
+        the circuit is open, the request is spooled without retries.
+
+        :returns: _AgentError.NONE if the retry is scheduled or spooled,
+                  otherwise _AgentError.FATAL.
+        :rtype: _AgentError
+        """
+        if self._conf.k2hr3.requeue_on_error is True and \
+                (self._conf.k2hr3.max_retries > 0 or circuit_open):
+            self._response.error = 'temporary error. requeue the message.'
+            LOG.error(self._response.error)
+            return _AgentError.FATAL
+        task = _K2hr3RetryTask(self._conf, self._allow_self_signed_cert, url,
+                               params, headers, method)
+        if circuit_open and task.spool():
+            self._deferred = True
+            return _AgentError.NONE
+        if self._conf.k2hr3.max_retries <= 0:
+            self._response.error = 'reached the max retry count.'
+        else:
+            delay = _backoff_delay(task.attempt, self._conf)
+            if _get_retry_scheduler(self._conf).schedule(delay, task):
+                LOG.warning('retrying in %.1f seconds. remaining retries=%s',
+                            delay,
+                            self._conf.k2hr3.max_retries - task.attempt + 1)
+                self._deferred = True
+                return _AgentError.NONE
+            self._response.error = 'too many retries in flight.'
+        LOG.error(self._response.error)
+        if self._conf.k2hr3.requeue_on_error is not True and task.spool():
+            self._deferred = True
+            return _AgentError.NONE
+        return _AgentError.FATAL
+
     def _send_internal(self, url: str, params: dict[str, str],
-                       headers: dict[str,
-                                     str], method: str) -> bool:  # non-public.
+                       headers: Mapping[str, str],
+                       method: str) -> bool:  # non-public.
         """Send a http request.
 
-        :returns: True if success, otherwise False
+        :returns: True if success or a retry is scheduled, otherwise False
         :rtype: bool
         """
         assert [
             isinstance(url, str),
             isinstance(params, dict),
-            isinstance(headers, dict),
+            isinstance(headers, Mapping),
             isinstance(method, str),
         ]
 
         LOG.debug('_send called by url %s params %s headers %s method %s', url,
                   params, headers, method)
 
-        qstring = urllib.parse.urlencode(
-            params, quote_via=urllib.parse.quote)  # type: ignore
-        req = urllib.request.Request('?'.join([url, qstring]),
-                                     headers=headers,
-                                     method=method)
-        if req.type not in ('http', 'https'):
-            self._response.error = f'http or https, not {req.type}'
-            LOG.error(self._response)
-            return False
-
-        agent_error = _AgentError.NONE
-        try:
-            ctx = None
-            if req.type == 'https':
-                # https://docs.python.jp/3/library/ssl.html#ssl.create_default_context
-                ctx = ssl.create_default_context()
-                if self._allow_self_signed_cert:
-                    # https://github.com/python/cpython/blob/master/Lib/ssl.py#L567
-                    ctx.check_hostname = False
-                    ctx.verify_mode = ssl.CERT_NONE
-            with urllib.request.urlopen(
-                    req, timeout=self._conf.k2hr3.timeout_seconds,
-                    context=ctx) as res:
-                self._response.code = res.getcode()
-                LOG.debug('code=[%s]\nurl=[%s]\nbody=[%s]\ninfo=[%s]\n',
-                          res.getcode(), res.geturl(), res.read(), res.info())
-        except HTTPError as error:
-            LOG.error(
-                'Could not complete the request. code %s reason %s headers %s',
-                error.code, error.reason, error.headers)
-            agent_error = _AgentError.FATAL  # pylint: disable=redefined-variable-type  # noqa
-        except URLError as error:
-            # https://github.com/python/cpython/blob/master/Lib/urllib/error.py#L73
-            LOG.error('Could not read the server. reason %s', error.reason)
-            agent_error = _AgentError.FATAL
-        except (socket.timeout) as error:  # temporary error
-            LOG.error('error(socket) %s', error)
-            agent_error = _AgentError.TEMP
-        finally:
-            if agent_error == _AgentError.TEMP:
-                self._retries -= 1  # decrement the retries value.
-                if self._retries >= 0:
-                    LOG.warning('sleeping for %s. remaining retries=%s',
-                                self._conf.k2hr3.retry_interval_seconds,
-                                self._retries)
-                    time.sleep(self._conf.k2hr3.retry_interval_seconds)
-                    self._send_internal(url, params, headers, method)
-                else:
-                    self._response.error = 'reached the max retry count.'
-                    LOG.error(self._response.error)
-                    agent_error = _AgentError.FATAL
+        self._deferred = False
+        agent_error = self._send_once(url, params, headers, method)
+        if agent_error in (_AgentError.TEMP, _AgentError.OPEN):
+            agent_error = self._defer(url, params, headers, method,
+                                      agent_error == _AgentError.OPEN)
 
         if agent_error == _AgentError.NONE:
             LOG.debug('no problem.')
@@ -408,6 +685,226 @@ class _K2hr3UserAgent:
         return self._send_internal(self._url, self._params, self._headers,
                                    self._method)
 
+    @property
+    def bulk_max_items(self) -> int:  # public.
+        """Returns the max number of members removed in a bulk request.
+
+        The api advertises the bulk removal by the X-K2hr3-Bulk-Delete
+        header with the max number of members in response to an OPTIONS
+        request. The result is cached for a while.
+
+        :returns: max number of members. 0 if the api does not support.
+        :rtype: int
+        """
+        if not self._conf.k2hr3.bulk_delete:
+            return 0
+        now = time.monotonic()
+        with _BULK_SUPPORT_LOCK:
+            cached = _BULK_SUPPORT.get(self._url, None)
+        if cached is not None and \
+                now - cached[1] < _BULK_PROBE_INTERVAL_SECONDS:
+            return cached[0]
+        max_items = self._probe_bulk()
+        with _BULK_SUPPORT_LOCK:
+            _BULK_SUPPORT[self._url] = (max_items, now)
+        return max_items
+
+    def _probe_bulk(self) -> int:  # non-public.
+        """Ask the api whether it supports the bulk removal.
+
+        :returns: max number of members. 0 if the api does not support.
+        :rtype: int
+        """
+        path = self._url_path(self._url)
+        try:
+            res, _ = self._get_pool(self._url).request(
+                'OPTIONS', path, self._headers,
+                self._conf.k2hr3.timeout_seconds)
+        except (OSError, http.client.HTTPException) as error:
+            LOG.warning('bulk removal probe failed. %s', error)
+            return 0
+        value = ''
+        if 200 <= res.status < 300:
+            value = res.getheader(_BULK_HEADER, '')
+        try:
+            max_items = int(value)
+        except ValueError:
+            max_items = 0
+        max_items = max(0, min(max_items, self._conf.k2hr3.bulk_max_items))
+        LOG.info('bulk removal max items %s, %s', max_items, self._url)
+        return max_items
+
+    def _send_bulk_once(
+            self,
+            agents: list['_K2hr3UserAgent']) -> list[int] | None:  # non-public.  # noqa
+        """Remove the members of agents in a request.
+
+        Request:
+            DELETE api_url
+            {"extra": "openstack-auto-v1",
+             "members": [{"cuk": "...", "host": ["..."]}, ...]}
+        Response:
+            {"results": [{"cuk": "...", "code": 204}, ...]}
+
+        :param agents: agents in the same order of members
+        :type agents: list
+        :returns: status codes of members in the same order, or None if
+                  the request failed as a whole.
+        :rtype: list
+        """
+        members = [{'cuk': agent.instance_id, 'host': agent.ips}
+                   for agent in agents]
+        body = _dumpb({
+            'extra': self._params['extra'],
+            'members': members
+        })
+        headers = dict(self._headers)
+        headers['Content-Type'] = 'application/json'
+        path = self._url_path(self._url)
+        if not self._circuit_closed(self._url):
+            return None  # each agent handles the open circuit.
+        throttle = _get_throttle(self._conf)
+        if throttle is not None:
+            throttle.acquire()
+            _mark('throttle')
+        try:
+            res, data = self._get_pool(self._url).request(
+                self._method, path, headers,
+                self._conf.k2hr3.timeout_seconds, body)
+        except (OSError, http.client.HTTPException) as error:
+            self._record_outcome(self._url, error)
+            LOG.warning('bulk removal failed. reason %s', error)
+            return None
+        finally:
+            if throttle is not None:
+                throttle.release()
+            _mark('api')
+        self._record_outcome(self._url, (res, data))
+        if res.status in {404, 405, 501}:
+            LOG.warning('bulk removal not supported. code %s', res.status)
+            with _BULK_SUPPORT_LOCK:
+                _BULK_SUPPORT[self._url] = (0, time.monotonic())
+            return None
+        if not 200 <= res.status < 300:
+            LOG.warning('bulk removal failed. code %s reason %s', res.status,
+                        res.reason)
+            return None
+        try:
+            codes = [int(r['code']) for r in _loads(data)['results']]
+        except (ValueError, KeyError, TypeError) as error:
+            LOG.warning('invalid bulk removal response. %s', error)
+            return None
+        if len(codes) != len(agents):
+            LOG.warning('bulk removal results %s, not %s', len(codes),
+                        len(agents))
+            return None
+        return codes
+
+    @staticmethod
+    def send_bulk(agents: list['_K2hr3UserAgent']) -> list[bool]:  # public.
+        """Remove the members of agents in as few requests as possible.
+
+        Agents must share the same api url. If the api does not support the
+        bulk removal or a bulk request fails as a whole, each agent sends
+        its own request.
+
+        :param agents: agents which have the instance_id and ips
+        :type agents: list
+        :returns: True for each agent if success or a retry is scheduled,
+                  otherwise False.
+        :rtype: list
+        """
+        results = [False] * len(agents)
+        fallbacks = list(range(len(agents)))
+        max_items = agents[0].bulk_max_items if len(agents) > 1 else 0
+        if max_items > 1:
+            fallbacks = []
+            for start in range(0, len(agents), max_items):
+                chunk = agents[start:start + max_items]
+                codes = agents[0]._send_bulk_once(chunk)
+                if codes is None:
+                    fallbacks.extend(range(start, start + len(chunk)))
+                    continue
+                for offset, (agent, code) in enumerate(zip(chunk, codes)):
+                    agent._deferred = False
+                    agent._response.code = code
+                    if 200 <= code < 300:
+                        results[start + offset] = True
+                    else:
+                        agent._response.error = f'bulk removal failed. {code}'
+                        LOG.error('no removed. %s code %s', agent.instance_id,
+                                  code)
+        if len(fallbacks) > 1 and \
+                agents[0]._conf.k2hr3.delivery_engine == 'asyncio':
+            sent = _K2hr3UserAgent._send_concurrently(
+                [agents[index] for index in fallbacks])
+            for index, success in zip(fallbacks, sent):
+                results[index] = success
+            return results
+        for index in fallbacks:
+            agent = agents[index]
+            results[index] = agent._send_internal(agent.url, agent.params,
+                                                  agent.headers, agent.method)
+        return results
+
+    @staticmethod
+    def _send_concurrently(
+            agents: list['_K2hr3UserAgent']) -> list[bool]:  # non-public.
+        """Send the request of each agent concurrently in the engine.
+
+        :param agents: agents which have the instance_id and ips
+        :type agents: list
+        :returns: True for each agent if success or a retry is scheduled,
+                  otherwise False.
+        :rtype: list
+        """
+        results = [False] * len(agents)
+        requests = []  # type: List[Tuple[int, Tuple[Any, ...]]]
+        for index, agent in enumerate(agents):
+            agent._deferred = False
+            path = agent._request_path(agent.url, agent.params)
+            if path is None:
+                continue
+            if not agent._circuit_closed(agent.url):
+                results[index] = agent._defer(
+                    agent.url, agent.params, agent.headers, agent.method,
+                    True) == _AgentError.NONE
+                continue
+            pool = agent._get_pool(agent.url)
+            assert isinstance(pool, _K2hr3EnginePool)
+            requests.append((index,
+                             pool.args(agent.method, path, agent.headers,
+                                       agent._conf.k2hr3.timeout_seconds)))
+        if not requests:
+            return results
+        engine = _get_delivery_engine(agents[0]._conf)
+        throttle = _get_throttle(agents[0]._conf)
+        size = len(requests)
+        if throttle is not None and throttle.max_inflight > 0:
+            size = throttle.max_inflight  # sends in chunks under the cap.
+        outcomes = []  # type: List[Any]
+        for start in range(0, len(requests), size):
+            chunk = [args for _, args in requests[start:start + size]]
+            if throttle is not None:
+                throttle.acquire(len(chunk))
+                _mark('throttle')
+            try:
+                outcomes.extend(engine.request_all(chunk))
+            finally:
+                if throttle is not None:
+                    throttle.release(len(chunk))
+        _mark('api')
+        for (index, _), outcome in zip(requests, outcomes):
+            agent = agents[index]
+            outcome = agent._follow_redirects(agent.url, agent.method,
+                                              agent.headers, outcome)
+            agent_error = agent._check_outcome(agent.url, outcome)
+            if agent_error == _AgentError.TEMP:
+                agent_error = agent._defer(agent.url, agent.params,
+                                           agent.headers, agent.method)
+            results[index] = agent_error == _AgentError.NONE
+        return results
+
     def __repr__(self):
         attrs = []
         for attr in ('_url', '_params', '_headers', '_method'):
@@ -431,6 +928,202 @@ class _K2hr3UserAgent:
         return '<_K2hr3UserAgent ' + values + '>'
 
 
+class _K2hr3RetryTask:
+    """Retries a request in the retry scheduler.
+
+    A task has its own copy of the request, so the agent which failed the
+    first attempt can be discarded.
+    """
+
+    def __init__(self, conf: K2hr3Conf, allow_self_signed_cert: bool,  # pylint: disable=too-many-positional-arguments  # noqa
+                 url: str, params: dict[str, str], headers: Mapping[str, str],
+                 method: str) -> None:
+        """Initialize attributes.
+
+        :param conf: K2hr3Conf object
+        :type conf: K2hr3Conf
+        :param allow_self_signed_cert: True if allow self signed certificate
+        :type allow_self_signed_cert: bool
+        :param url: request url
+        :type url: str
+        :param params: url params
+        :type params: dict
+        :param headers: request headers
+        :type headers: Mapping
+        :param method: request method
+        :type method: str
+        """
+        self._conf = conf
+        self._allow_self_signed_cert = allow_self_signed_cert
+        self._url = url
+        self._params = dict(params)
+        self._headers = dict(headers)
+        self._method = method
+        self._attempt = 1
+
+    @property
+    def attempt(self) -> int:
+        """Returns the retry count starting from 1.
+
+        :returns: retry count
+        :rtype: int
+        """
+        return self._attempt
+
+    @property
+    def params(self) -> dict[str, str]:
+        """Returns the url params.
+
+        :returns: url params
+        :rtype: dict
+        """
+        return self._params
+
+    def to_dict(self) -> dict[str, Any]:
+        """Returns the request to save in a checkpoint.
+
+        :returns: the request and the retry count
+        :rtype: dict
+        """
+        return {
+            'url': self._url,
+            'params': self._params,
+            'headers': self._headers,
+            'method': self._method,
+            'attempt': self._attempt,
+            'allow_self_signed_cert': self._allow_self_signed_cert,
+        }
+
+    @classmethod
+    def from_dict(cls, conf: K2hr3Conf,
+                  data: dict[str, Any]) -> '_K2hr3RetryTask':
+        """Returns a task restored from a checkpoint.
+
+        :param conf: K2hr3Conf object
+        :type conf: K2hr3Conf
+        :param data: a dict returned by to_dict
+        :type data: dict
+        :returns: a task
+        :rtype: _K2hr3RetryTask
+        :raises KeyError: if data lacks a key.
+        """
+        task = cls(conf, bool(data['allow_self_signed_cert']), data['url'],
+                   data['params'], data['headers'], data['method'])
+        task._attempt = int(data['attempt'])
+        return task
+
+    def spool(self) -> bool:
+        """Save the request to replay it after the api recovers.
+
+        :returns: True if spooled, False if spool_dir is empty or failed.
+        :rtype: bool
+        """
+        spool = _get_spool(self._conf)
+        if spool is None or not spool.append(self.to_dict()):
+            return False
+        LOG.warning('spooled %s', self._params.get('cuk', None))
+        return True
+
+    def _send(self) -> tuple[_AgentError, int]:
+        """Send the request once.
+
+        :returns: the result and the response code
+        :rtype: tuple
+        """
+        agent = _get_agent(self._conf)
+        agent.allow_self_signed_cert = self._allow_self_signed_cert
+        agent_error = agent._send_once(
+            self._url, self._params, self._headers, self._method)
+        return agent_error, agent.code
+
+    def __call__(self) -> None:
+        """Send the request again and reschedule or spool it if needed.
+
+        The message has been acknowledged already, so a request which does
+        not succeed is spooled unless it is rescheduled.
+        """
+        cuk = self._params.get('cuk', None)
+        try:
+            agent_error, code = self._send()
+        except _K2hr3UserAgentError as error:  # the api url is not resolved.
+            LOG.warning('retry %s of %s failed, %s', self._attempt, cuk, error)
+            agent_error, code = _AgentError.TEMP, 0
+        if agent_error == _AgentError.NONE:
+            LOG.info('retry %s succeeded. %s code, %s', self._attempt, cuk,
+                     code)
+            return
+        if agent_error == _AgentError.OPEN and self.spool():
+            return
+        if agent_error in (_AgentError.TEMP, _AgentError.OPEN) and \
+                self._attempt < self._conf.k2hr3.max_retries:
+            self._attempt += 1
+            delay = _backoff_delay(self._attempt, self._conf)
+            if _get_retry_scheduler(self._conf).schedule(delay, self):
+                LOG.warning(
+                    'retrying %s in %.1f seconds. remaining retries=%s', cuk,
+                    delay, self._conf.k2hr3.max_retries - self._attempt + 1)
+                return
+        if self.spool():
+            return
+        LOG.error('reached the max retry count. gave up %s. %s code', cuk,
+                  code)
+
+    def __repr__(self):
+        return (f'<_K2hr3RetryTask url={self._url} params={self._params}'
+                f' attempt={self._attempt}>')
+
+
+def _get_agent(conf: K2hr3Conf) -> _K2hr3UserAgent:
+    """Return the agent of the current thread reset for a new request.
+
+    An agent is built once per thread and reused for requests sent one by
+    one. The caller must not keep it after the request, because the next
+    call in the thread resets it.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :returns: the agent of the current thread
+    :rtype: _K2hr3UserAgent
+    :raises K2hr3UserAgentError: api_url validation error.
+    """
+    agent = getattr(_LOCAL, 'agent', None)
+    if agent is None:
+        agent = _LOCAL.agent = _K2hr3UserAgent(conf)
+    else:
+        agent.reset(conf)
+    return agent
+
+
+def _replay_spooled(conf: K2hr3Conf, data: dict[str, Any]) -> bool:
+    """Send a spooled request once in the replayer of the spool.
+
+    :param conf: K2hr3Conf object
+    :type conf: K2hr3Conf
+    :param data: a dict returned by _K2hr3RetryTask.to_dict
+    :type data: dict
+    :returns: False if the request should be sent again later
+    :rtype: bool
+    """
+    try:
+        task = _K2hr3RetryTask.from_dict(conf, data)
+    except (KeyError, TypeError, ValueError) as error:
+        LOG.error('dropped an invalid spooled request %s, %s', data, error)
+        return True
+    cuk = task.params.get('cuk', None)
+    try:
+        agent_error, code = task._send()
+    except _K2hr3UserAgentError as error:  # the api url is not resolved.
+        LOG.warning('failed to replay %s, %s', cuk, error)
+        return False
+    if agent_error in (_AgentError.TEMP, _AgentError.OPEN):
+        return False
+    if agent_error == _AgentError.NONE:
+        LOG.info('replayed %s. %s code', cuk, code)
+    else:
+        LOG.error('gave up the spooled request of %s. %s code', cuk, code)
+    return True
+
+
 #
 # Local variables:
 # tab-width: 4
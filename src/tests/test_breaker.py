@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the circuit breaker of the k2hr3 api."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+from pathlib import Path
+from os import path, sep
+import socket
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from k2hr3_osnl.breaker import (_BREAKERS, _K2hr3CircuitBreaker,
+                                _get_circuit_breaker,
+                                _update_circuit_breakers)
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.retry import _K2hr3RetryScheduler
+from k2hr3_osnl.spool import _get_spool, _stop_spool
+from k2hr3_osnl.useragent import _AgentError, _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+URL = 'http://127.0.0.1/v1/role'
+
+
+class TestK2hr3CircuitBreaker(unittest.TestCase):
+    """Tests the circuit breaker."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        _BREAKERS.clear()
+        self._conf = K2hr3Conf(conf_file_path)
+        self._conf.k2hr3.circuit_breaker = True
+
+    def tearDown(self):
+        """Tears down a test case."""
+        _BREAKERS.clear()
+        _stop_spool()
+
+    def _open(self, url):
+        """Returns an open circuit breaker of the url."""
+        breaker = _get_circuit_breaker(self._conf, url)
+        for _ in range(self._conf.k2hr3.breaker_consecutive_timeouts):
+            breaker.record(False, timeout=True)
+        self.assertEqual(breaker.state, 'open')
+        return breaker
+
+    def test_consecutive_timeouts(self):
+        """Checks if timeouts in a row open the circuit."""
+        breaker = _K2hr3CircuitBreaker(URL, 0, 3, 30)
+        breaker.record(False, timeout=True)
+        breaker.record(False, timeout=True)
+        breaker.record(True)  # resets the timeouts in a row.
+        breaker.record(False, timeout=True)
+        breaker.record(False, timeout=True)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+        breaker.record(False, timeout=True)
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats, {'opened': 1, 'rejected': 1})
+
+    def test_error_ratio(self):
+        """Checks if the error ratio of the window opens the circuit."""
+        breaker = _K2hr3CircuitBreaker(URL, 0.5, 0, 30, window=4)
+        breaker.record(False)
+        breaker.record(False)
+        breaker.record(False)
+        self.assertEqual(breaker.state, 'closed')  # the window is not full.
+        breaker.record(True)
+        self.assertEqual(breaker.state, 'open')
+        breaker = _K2hr3CircuitBreaker(URL, 0.5, 0, 30, window=4)
+        for success in (False, True, True, True, False):
+            breaker.record(success)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open(self):
+        """Checks if a probe closes or opens the circuit."""
+        with patch('k2hr3_osnl.breaker.time.monotonic') as monotonic:
+            monotonic.return_value = 100.0
+            breaker = _K2hr3CircuitBreaker(URL, 0, 1, 30)
+            breaker.record(False, timeout=True)
+            monotonic.return_value = 129.0
+            self.assertFalse(breaker.allow())
+            monotonic.return_value = 130.0
+            self.assertTrue(breaker.allow())  # the probe
+            self.assertEqual(breaker.state, 'half-open')
+            self.assertFalse(breaker.allow())
+            breaker.record(False)
+            self.assertEqual(breaker.state, 'open')
+            self.assertFalse(breaker.allow())
+            monotonic.return_value = 160.0
+            self.assertTrue(breaker.allow())
+            monotonic.return_value = 190.0
+            self.assertTrue(breaker.allow())  # the probe did not report.
+            breaker.record(True)
+        self.assertEqual(breaker.state, 'closed')
+        self.assertEqual(breaker.stats['opened'], 2)
+
+    def test_get_circuit_breaker(self):
+        """Checks if a circuit breaker is shared by the url."""
+        breaker = _get_circuit_breaker(self._conf, URL)
+        self.assertIs(_get_circuit_breaker(self._conf, URL), breaker)
+        self.assertIsNot(_get_circuit_breaker(self._conf, URL + '2'), breaker)
+        self._conf.k2hr3.breaker_open_seconds = 5
+        _update_circuit_breakers(self._conf)
+        self.assertEqual(breaker._open_seconds, 5)
+        self._conf.k2hr3.circuit_breaker = False
+        self.assertIsNone(_get_circuit_breaker(self._conf, URL))
+
+    def test_useragent_records_timeouts(self):
+        """Checks if timeouts of the api open the circuit."""
+        agent = _K2hr3UserAgent(self._conf)
+        for _ in range(self._conf.k2hr3.breaker_consecutive_timeouts):
+            self.assertEqual(
+                agent._check_outcome(agent.url, socket.timeout()),
+                _AgentError.TEMP)
+        breaker = _get_circuit_breaker(self._conf, agent.url)
+        self.assertEqual(breaker.state, 'open')
+        res = MagicMock(status=204)
+        breaker._state = 'closed'
+        agent._check_outcome(agent.url, (res, b''))
+        self.assertEqual(breaker._timeouts, 0)
+
+    def test_useragent_open_spools(self):
+        """Checks if an open circuit spools a request without sending."""
+        agent = _K2hr3UserAgent(self._conf)
+        self._open(agent.url)
+        with tempfile.TemporaryDirectory() as spool_dir:
+            self._conf.k2hr3.spool_dir = spool_dir
+            with patch.object(_K2hr3UserAgent, '_get_pool') as get_pool:
+                self.assertTrue(
+                    agent._send_internal(agent.url, {'cuk': 'x'},
+                                         agent.headers, 'DELETE'))
+            get_pool.assert_not_called()
+            self.assertTrue(agent.deferred)
+            self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+            _stop_spool()
+
+    def test_useragent_open_requeues(self):
+        """Checks if an open circuit requeues a message."""
+        self._conf.k2hr3.requeue_on_error = True
+        self._conf.k2hr3.max_retries = 0
+        agent = _K2hr3UserAgent(self._conf)
+        self._open(agent.url)
+        with patch.object(_K2hr3UserAgent, '_get_pool') as get_pool:
+            self.assertFalse(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+        get_pool.assert_not_called()
+        self.assertFalse(agent.deferred)
+
+    def test_useragent_open_retries_without_spool(self):
+        """Checks if an open circuit schedules a retry without spool_dir."""
+        scheduler = _K2hr3RetryScheduler(max_inflight=10)
+        agent = _K2hr3UserAgent(self._conf)
+        self._open(agent.url)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler):
+            self.assertTrue(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+        self.assertTrue(agent.deferred)
+        self.assertEqual(scheduler.stats['scheduled'], 1)
+        scheduler.stop()
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the bulk removal of role members."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+from pathlib import Path
+from os import path, sep
+import threading
+import unittest
+import urllib.parse
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.connection import _close_connection_pools
+from k2hr3_osnl.useragent import _BULK_SUPPORT, _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """A k2hr3 api stub which supports the bulk removal or not."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body=b''):
+        """Sends a response."""
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_OPTIONS(self):  # noqa: N802 pylint: disable=invalid-name
+        """Advertises the bulk removal."""
+        self.server.probes += 1
+        self.send_response(204)
+        if self.server.bulk:
+            self.send_header('X-K2hr3-Bulk-Delete',
+                             str(self.server.max_items))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_DELETE(self):  # noqa: N802 pylint: disable=invalid-name
+        """Removes members in bulk or one by one."""
+        length = int(self.headers.get('Content-Length', 0))
+        if length:
+            data = json.loads(self.rfile.read(length))
+            if not self.server.bulk:
+                self._reply(405)
+                return
+            self.server.bulk_requests.append(data)
+            results = [{
+                'cuk': member['cuk'],
+                'code': self.server.codes.get(member['cuk'], 204)
+            } for member in data['members']]
+            self._reply(200, json.dumps({'results': results}).encode())
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        cuk = query['cuk'][0]
+        self.server.single_requests.append(cuk)
+        self._reply(self.server.codes.get(cuk, 204))
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Suppresses access logs."""
+
+
+class TestK2hr3BulkRemoval(unittest.TestCase):
+    """Tests the _K2hr3UserAgent.send_bulk method."""
+
+    def setUp(self):
+        """Starts a stub server."""
+        _BULK_SUPPORT.clear()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.bulk = True
+        self._server.max_items = 2
+        self._server.codes = {}
+        self._server.probes = 0
+        self._server.bulk_requests = []
+        self._server.single_requests = []
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self._conf = K2hr3Conf(conf_file_path)
+        self._conf.k2hr3.api_url = 'http://127.0.0.1:{}/v1/role'.format(
+            self._server.server_address[1])
+
+    def tearDown(self):
+        """Stops the stub server."""
+        self._server.shutdown()
+        self._server.server_close()
+        _close_connection_pools()
+        _BULK_SUPPORT.clear()
+
+    def _agents(self, count):
+        """Returns agents with distinct instance ids."""
+        agents = []
+        for n in range(count):
+            agent = _K2hr3UserAgent(self._conf)
+            agent.instance_id = '12345678-1234-5678-1234-{:012d}'.format(n)
+            agent.ips = ['127.0.0.{}'.format(n + 1)]
+            agents.append(agent)
+        return agents
+
+    def test_send_bulk(self):
+        """Checks if members are removed in chunks of max items."""
+        agents = self._agents(3)
+        self._server.codes[agents[1].instance_id] = 403
+        self.assertEqual(_K2hr3UserAgent.send_bulk(agents),
+                         [True, False, True])
+        self.assertEqual(self._server.probes, 1)
+        self.assertEqual(len(self._server.bulk_requests), 2)
+        self.assertEqual(self._server.single_requests, [])
+        first = self._server.bulk_requests[0]
+        self.assertEqual(first['extra'], 'openstack-auto-v1')
+        self.assertEqual(first['members'][0], {
+            'cuk': agents[0].instance_id,
+            'host': ['127.0.0.1']
+        })
+        self.assertEqual(agents[1].code, 403)
+
+    def test_send_bulk_probe_cached(self):
+        """Checks if the server is probed once."""
+        _K2hr3UserAgent.send_bulk(self._agents(2))
+        _K2hr3UserAgent.send_bulk(self._agents(2))
+        self.assertEqual(self._server.probes, 1)
+        self.assertEqual(len(self._server.bulk_requests), 2)
+
+    def test_send_bulk_not_advertised(self):
+        """Checks if members are removed one by one without support."""
+        self._server.bulk = False
+        agents = self._agents(3)
+        self._server.codes[agents[2].instance_id] = 404
+        self.assertEqual(_K2hr3UserAgent.send_bulk(agents),
+                         [True, True, False])
+        self.assertEqual(self._server.bulk_requests, [])
+        self.assertEqual(self._server.single_requests,
+                         [agent.instance_id for agent in agents])
+
+    def test_send_bulk_rejected(self):
+        """Checks if a rejected bulk request falls back and is cached."""
+        self._server.max_items = 10
+        self._conf.k2hr3.bulk_max_items = 2
+        agents = self._agents(2)
+        self.assertEqual(agents[0].bulk_max_items, 2)  # capped by the client.
+        self._server.bulk = False  # downgraded after the probe.
+        self.assertEqual(_K2hr3UserAgent.send_bulk(agents), [True, True])
+        self.assertEqual(len(self._server.single_requests), 2)
+        self.assertEqual(agents[0].bulk_max_items, 0)
+
+    def test_send_bulk_disabled(self):
+        """Checks if bulk_delete = False disables the probe."""
+        self._conf.k2hr3.bulk_delete = False
+        self.assertEqual(_K2hr3UserAgent.send_bulk(self._agents(2)),
+                         [True, True])
+        self.assertEqual(self._server.probes, 0)
+        self.assertEqual(len(self._server.single_requests), 2)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -35,6 +35,8 @@ conf_file_path = Path(sep.join([here,
                                 'k2hr3-osnl.conf'])).resolve()
 broken_conf_file_path = Path(
     sep.join([here, 'k2hr3-osnl.conf_broken'])).resolve()
+subscriptions_conf_file_path = Path(
+    sep.join([here, 'k2hr3-osnl.conf_subscriptions'])).resolve()
 
 LOG = logging.getLogger(__name__)
 
@@ -218,6 +220,35 @@ class TestK2hr3Conf(unittest.TestCase):
         conf = K2hr3Conf(conf_file_path)
         self.assertEqual('warn', conf.libs_debug_level)
 
+    def test_k2hr3_conf_subscriptions_default(self):
+        """Asserts no subscriptions by default."""
+        conf = K2hr3Conf(conf_file_path)
+        self.assertEqual([], conf.oslo_messaging_notifications.subscriptions)
+        with self.assertRaises(K2hr3ConfError):
+            conf.subscription('neutron')
+
+    def test_k2hr3_conf_subscriptions(self):
+        """Asserts options in subscription sections."""
+        conf = K2hr3Conf(subscriptions_conf_file_path)
+        self.assertEqual(['neutron', 'nova', 'nova_versioned'],
+                         conf.oslo_messaging_notifications.subscriptions)
+        nova = conf.subscription('nova_versioned')
+        self.assertEqual('versioned_notifications', nova.topic)
+        self.assertEqual('nova', nova.exchange)
+        self.assertEqual(r'^instance\.delete\.end$', nova.event_type)
+        self.assertEqual([r'^instance\.delete\.end$ json:loads'],
+                         nova.extractors)
+        # inherits the oslo_messaging_notifications group.
+        self.assertIsNone(nova.payload)
+        self.assertEqual([], conf.subscription('neutron').extractors)
+
+    def test_k2hr3_conf_subscriptions_no_section(self):
+        """Asserts a subscription without its section is an error."""
+        with patch.object(K2hr3Conf, 'list_all_sections',
+                          return_value=['oslo_messaging_notifications']):
+            with self.assertRaises(K2hr3ConfError):
+                K2hr3Conf(subscriptions_conf_file_path)
+
 #
 # EOF
 #
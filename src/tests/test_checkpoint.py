@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the checkpoint of pending retries."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import fcntl
+import json
+import logging
+import os
+from pathlib import Path
+from os import path, sep
+import signal
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, call, patch
+
+import k2hr3_osnl
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.checkpoint import _checkpoint_retries, _replay_retries
+from k2hr3_osnl.endpoint import (K2hr3BatchNotificationEndpoint,
+                                 K2hr3NotificationEndpoint)
+from k2hr3_osnl.retry import _get_retry_scheduler
+from k2hr3_osnl.shard import _stop_shard_dispatcher
+from k2hr3_osnl.useragent import _K2hr3RetryTask
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+CUK = '12345678-1234-5678-1234-567812345678'
+
+
+class TestK2hr3Checkpoint(unittest.TestCase):
+    """Tests the checkpoint functions."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._conf = K2hr3Conf(conf_file_path)
+        self._conf.k2hr3.retry_checkpoint_file = os.path.join(
+            self._tmpdir.name, 'retries.json')
+        _get_retry_scheduler(self._conf).stop()
+
+    def tearDown(self):
+        """Tears down a test case."""
+        _get_retry_scheduler(self._conf).stop()
+        self._tmpdir.cleanup()
+
+    def _task(self, attempt=1):
+        """Returns a retry task."""
+        task = _K2hr3RetryTask(self._conf, False, 'https://localhost/v1/role',
+                               {'cuk': CUK, 'extra': 'openstack-auto-v1'},
+                               {'User-Agent': 'test'}, 'DELETE')
+        task._attempt = attempt
+        return task
+
+    def test_checkpoint_and_replay(self):
+        """Checks if saved retries are scheduled on start."""
+        path = f'{self._conf.k2hr3.retry_checkpoint_file}.{os.getpid()}'
+        self.assertEqual(
+            _checkpoint_retries(self._conf,
+                                [self._task(2), lambda: None]), 1)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(json.load(f)[0]['attempt'], 2)
+        scheduler = _get_retry_scheduler(self._conf)
+        with patch.object(scheduler, 'schedule',
+                          return_value=True) as mock_method:
+            self.assertEqual(_replay_retries(self._conf), 1)
+        task = mock_method.call_args[0][1]
+        self.assertEqual(task.attempt, 2)
+        self.assertEqual(task.params['cuk'], CUK)
+        self.assertFalse(os.path.exists(path))
+
+    def test_checkpoint_disabled(self):
+        """Checks if nothing is saved without retry_checkpoint_file."""
+        self._conf.k2hr3.retry_checkpoint_file = ''
+        self.assertEqual(_checkpoint_retries(self._conf, [self._task()]), 0)
+        self.assertEqual(_replay_retries(self._conf), 0)
+
+    def test_replay_broken_file(self):
+        """Checks if a broken file is left as it is."""
+        path = self._conf.k2hr3.retry_checkpoint_file
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('[{"url": ')
+        self.assertEqual(_replay_retries(self._conf), 0)
+        self.assertTrue(os.path.exists(path))
+
+    def test_checkpoint_workers(self):
+        """Checks if each worker saves its retries and they run once."""
+        pids = []
+        for attempt in (1, 2, 3):
+            pid = os.fork()
+            if pid == 0:  # a worker saves a retry on shutdown.
+                code = 1
+                try:
+                    _checkpoint_retries(self._conf, [self._task(attempt)])
+                    code = 0
+                finally:
+                    os._exit(code)  # pylint: disable=protected-access
+            pids.append(pid)
+        for pid in pids:
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        path = self._conf.k2hr3.retry_checkpoint_file
+        self.assertEqual(
+            sorted(os.listdir(self._tmpdir.name)),
+            sorted(f'{os.path.basename(path)}.{pid}' for pid in pids))
+        # the workers starting together replay each file once.
+        scheduler = _get_retry_scheduler(self._conf)
+        counts = []
+        with patch.object(scheduler, 'schedule',
+                          return_value=True) as mock_method:
+            threads = [
+                threading.Thread(
+                    target=lambda: counts.append(_replay_retries(self._conf)))
+                for _ in range(3)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sum(counts), 3)
+        self.assertEqual(
+            sorted(c[0][1].attempt for c in mock_method.call_args_list),
+            [1, 2, 3])
+        self.assertEqual(os.listdir(self._tmpdir.name), [])
+
+    def test_replay_locked_file(self):
+        """Checks if a file taken by another worker is skipped."""
+        _checkpoint_retries(self._conf, [self._task()])
+        path = f'{self._conf.k2hr3.retry_checkpoint_file}.{os.getpid()}'
+        with open(path, encoding='utf-8') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self.assertEqual(_replay_retries(self._conf), 0)
+        self.assertTrue(os.path.exists(path))
+
+    def test_listen_drains_on_sigterm(self):
+        """Checks if listen stops the listener and saves retries."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        listener = MagicMock()
+        # a retry waiting when SIGTERM arrives.
+        _get_retry_scheduler(self._conf).schedule(600, self._task())
+        timer = threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGTERM))
+        timer.start()
+        with patch('oslo_messaging.get_notification_listener',
+                   return_value=listener):
+            self.assertEqual(k2hr3_osnl.listen([endpoint]), 0)
+        timer.join()
+        listener.start.assert_called_once_with()
+        listener.stop.assert_called_once_with()
+        listener.wait.assert_called_once_with()
+        self.assertEqual(_get_retry_scheduler(self._conf).inflight, 0)
+        with open(f'{self._conf.k2hr3.retry_checkpoint_file}.{os.getpid()}',
+                  encoding='utf-8') as f:
+            self.assertEqual(len(json.load(f)), 1)
+        # the handler is restored.
+        self.assertIs(signal.getsignal(signal.SIGTERM), signal.SIG_DFL)
+
+    def test_drain_timeout(self):
+        """Checks if a stuck listener does not block the shutdown."""
+        self._conf.k2hr3.drain_timeout_seconds = 0
+        event = threading.Event()
+        listener = MagicMock()
+        listener.wait.side_effect = event.wait
+        stops = MagicMock()
+        try:
+            with patch('k2hr3_osnl._stop_shard_dispatcher',
+                       stops.shards), \
+                    patch('k2hr3_osnl._stop_delivery_engine', stops.engine), \
+                    patch('k2hr3_osnl._stop_spool', stops.spool):
+                k2hr3_osnl._drain(listener, self._conf)
+            listener.stop.assert_called_once_with()
+        finally:
+            event.set()
+        # threads are stopped without waiting, and the spool is the last.
+        self.assertEqual(stops.mock_calls, [
+            call.shards(wait=False),
+            call.engine(wait=False),
+            call.spool()
+        ])
+
+    def _drain_in_flight(self, endpoint, deliver):
+        """Drains while a delivery runs and another one waits in a shard.
+
+        :returns: the results of deliver for the two messages
+        """
+        self._conf.k2hr3.drain_timeout_seconds = 0
+        release = threading.Event()
+        started = threading.Event()
+
+        def call_r3api(params):
+            started.set()
+            release.wait(5)
+            return 'handled'
+
+        listener = MagicMock()
+        listener.wait.side_effect = release.wait
+        results = []
+        with patch.object(K2hr3NotificationEndpoint,
+                          '_K2hr3NotificationEndpoint__call_r3api',
+                          side_effect=call_r3api):
+            thread = threading.Thread(
+                target=lambda: results.append(deliver(endpoint)))
+            thread.start()
+            started.wait(5)
+            while endpoint.shards.stats['submitted'] < 2:
+                time.sleep(0.01)
+            try:
+                k2hr3_osnl._drain(listener, self._conf)
+            finally:
+                release.set()
+                thread.join(5)
+                _stop_shard_dispatcher()
+        return results[0]
+
+    def test_drain_timeout_requeues_cancelled(self):
+        """Checks if a delivery cancelled by the drain is requeued."""
+        self._conf.k2hr3.shards = 1
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+
+        def deliver(endpoint):
+            results = [None, None]
+
+            def info(index, cuk):
+                results[index] = endpoint.info(
+                    {}, 'compute.localhost', 'compute.instance.delete.end',
+                    {'instance_id': cuk}, {})
+
+            threads = [
+                threading.Thread(target=info, args=(index, cuk))
+                for index, cuk in enumerate((CUK, CUK.replace('1', 'f')))
+            ]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.1)  # the first one runs in the shard.
+            for thread in threads:
+                thread.join(5)
+            return results
+
+        self.assertEqual(self._drain_in_flight(endpoint, deliver),
+                         ['handled', 'requeue'])
+
+    def test_drain_timeout_requeues_cancelled_batch(self):
+        """Checks if a batch delivery cancelled by the drain is requeued."""
+        self._conf.k2hr3.shards = 1
+        self._conf.k2hr3.bulk_delete = False
+        endpoint = K2hr3BatchNotificationEndpoint(self._conf)
+        messages = [{
+            'ctxt': {},
+            'publisher_id': 'compute.localhost',
+            'event_type': 'compute.instance.delete.end',
+            'payload': {'instance_id': cuk},
+            'metadata': {},
+        } for cuk in (CUK, CUK.replace('1', 'f'))]
+        self.assertEqual(
+            self._drain_in_flight(endpoint,
+                                  lambda endpoint: endpoint.info(messages)),
+            ['handled', 'requeue'])
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
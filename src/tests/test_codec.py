@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the json codecs."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+import unittest
+from unittest.mock import patch
+
+from k2hr3_osnl import codec
+from k2hr3_osnl.codec import (_CODECS, _K2hr3JsonCodec, _dumpb, _dumps,
+                              _dumps_pretty, _get_codec, _loads)
+
+LOG = logging.getLogger(__name__)
+
+PAYLOAD = {
+    'instance_id': '12345678-1234-5678-1234-567812345678',
+    'fixed_ips': [{'address': '127.0.0.1', 'version': 4},
+                  {'address': '::1', 'version': 6}],
+    'metadata': {},
+    'tags': [],
+    'state_description': 'deleting\nnow',
+    'image_ref_url': 'http://127.0.0.1:9292/images/abc',
+    'deleted': True,
+    'progress': None,
+    'memory_mb': 512,
+    'load': 0.5,
+}
+
+
+class TestK2hr3JsonCodec(unittest.TestCase):
+    """Tests the json codecs."""
+
+    def test_codecs_available(self):
+        """Checks if the stdlib codec is always available and the last."""
+        self.assertEqual(list(_CODECS)[-1], 'json')
+        self.assertIs(_get_codec(), next(iter(_CODECS.values())))
+
+    def test_dumps(self):
+        """Checks if every codec serializes into a compact json."""
+        for name, the_codec in _CODECS.items():
+            with self.subTest(codec=name):
+                self.assertEqual(the_codec.dumps(['127.0.0.1', '::1']),
+                                 '["127.0.0.1","::1"]')
+                self.assertEqual(json.loads(the_codec.dumps(PAYLOAD)),
+                                 PAYLOAD)
+                self.assertEqual(json.loads(the_codec.dumpb(PAYLOAD)),
+                                 PAYLOAD)
+
+    def test_dumps_pretty(self):
+        """Checks if every codec indents like the stdlib one."""
+        nested = {'a': {'b': [[[1, {}]], []]}, 'c': PAYLOAD}
+        for name, the_codec in _CODECS.items():
+            with self.subTest(codec=name):
+                for obj in (PAYLOAD, nested, [], 'a'):
+                    self.assertEqual(the_codec.dumps_pretty(obj),
+                                     json.dumps(obj, indent=4,
+                                                sort_keys=True))
+
+    def test_dumps_fallback(self):
+        """Checks if objects a library can not serialize fall back."""
+        for name, the_codec in _CODECS.items():
+            with self.subTest(codec=name):
+                self.assertEqual(the_codec.dumps({1: 2**70}),
+                                 '{"1":1180591620717411303424}')
+                self.assertEqual(the_codec.dumpb({1: 'a'}), b'{"1":"a"}')
+                self.assertEqual(the_codec.dumps_pretty({1: 'a'}),
+                                 '{\n    "1": "a"\n}')
+                with self.assertRaises(TypeError):
+                    the_codec.dumps(object())
+
+    def test_loads(self):
+        """Checks if every codec deserializes str and bytes."""
+        data = json.dumps(PAYLOAD)
+        for name, the_codec in _CODECS.items():
+            with self.subTest(codec=name):
+                self.assertEqual(the_codec.loads(data), PAYLOAD)
+                self.assertEqual(the_codec.loads(data.encode('utf-8')),
+                                 PAYLOAD)
+
+    def test_loads_invalid(self):
+        """Checks if every codec raises a ValueError on an invalid json."""
+        for name, the_codec in _CODECS.items():
+            with self.subTest(codec=name):
+                with self.assertRaises(ValueError):
+                    the_codec.loads(b'{"results": [')
+
+    def test_functions_use_selected_codec(self):
+        """Checks if the module functions delegate to the stdlib codec."""
+        with patch.object(codec, '_CODEC', _K2hr3JsonCodec()):
+            self.assertEqual(_get_codec().name, 'json')
+            self.assertEqual(_dumps({'a': [1]}), '{"a":[1]}')
+            self.assertEqual(_dumpb({'a': [1]}), b'{"a":[1]}')
+            self.assertEqual(_dumps_pretty({'a': 1}), '{\n    "a": 1\n}')
+            self.assertEqual(_loads(b'{"a":[1]}'), {'a': [1]})
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
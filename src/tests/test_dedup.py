@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the cache of the recently removed members."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+from pathlib import Path
+from os import path, sep
+import unittest
+from unittest.mock import PropertyMock, patch
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.dedup import _K2hr3DedupCache
+from k2hr3_osnl.endpoint import (K2hr3BatchNotificationEndpoint,
+                                 K2hr3NotificationEndpoint)
+from k2hr3_osnl.useragent import _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+HANDLED = 'handled'
+REQUEUE = 'requeue'
+CUK = '12345678-1234-5678-1234-567812345678'
+
+
+def _message(payload):
+    """Returns a message passed by the batch dispatcher."""
+    return {
+        'ctxt': {},
+        'publisher_id': 'network.localhost',
+        'event_type': 'compute.instance.delete.end',
+        'payload': payload,
+        'metadata': {},
+    }
+
+
+class TestK2hr3DedupCache(unittest.TestCase):
+    """Tests the _K2hr3DedupCache class."""
+
+    def test_seen_after_add(self):
+        """Checks if added params are seen."""
+        cache = _K2hr3DedupCache(window=60, max_entries=10)
+        params = {'cuk': CUK, 'ips': ['127.0.0.1', '127.0.0.2']}
+        self.assertFalse(cache.seen(params))
+        cache.add(params)
+        # the order of ips does not matter.
+        self.assertTrue(cache.seen({'cuk': CUK,
+                                    'ips': ['127.0.0.2', '127.0.0.1']}))
+        self.assertFalse(cache.seen({'cuk': CUK, 'ips': ['127.0.0.1']}))
+        self.assertFalse(cache.seen({'cuk': CUK}))
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertEqual(cache.stats['misses'], 3)
+        self.assertEqual(cache.stats['entries'], 1)
+
+    def test_window_expired(self):
+        """Checks if params are forgotten after the window."""
+        cache = _K2hr3DedupCache(window=60, max_entries=10)
+        with patch('time.monotonic', return_value=1000.0):
+            cache.add({'cuk': CUK})
+        with patch('time.monotonic', return_value=1059.0):
+            self.assertTrue(cache.seen({'cuk': CUK}))
+            # a duplicate does not extend the window.
+            cache.add({'cuk': CUK})
+        with patch('time.monotonic', return_value=1060.0):
+            self.assertFalse(cache.seen({'cuk': CUK}))
+        self.assertEqual(len(cache), 0)
+
+    def test_max_entries(self):
+        """Checks if the least recently used params are evicted."""
+        cache = _K2hr3DedupCache(window=60, max_entries=2)
+        cache.add({'cuk': 'cuk-1'})
+        cache.add({'cuk': 'cuk-2'})
+        self.assertTrue(cache.seen({'cuk': 'cuk-1'}))
+        cache.add({'cuk': 'cuk-3'})
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(cache.seen({'cuk': 'cuk-1'}))
+        self.assertFalse(cache.seen({'cuk': 'cuk-2'}))
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_window_zero(self):
+        """Checks if window 0 disables the cache."""
+        cache = _K2hr3DedupCache(window=0, max_entries=10)
+        cache.add({'cuk': CUK})
+        self.assertFalse(cache.seen({'cuk': CUK}))
+        self.assertEqual(len(cache), 0)
+
+
+class TestK2hr3EndpointDedup(unittest.TestCase):
+    """Tests the endpoints skip duplicates."""
+
+    def test_endpoint_skips_duplicate(self):
+        """Checks if a duplicate notification is not sent again."""
+        endpoint = K2hr3NotificationEndpoint(K2hr3Conf(conf_file_path))
+        with patch.object(_K2hr3UserAgent, 'send',
+                          return_value=True) as mock_method:
+            for _ in range(3):
+                self.assertEqual(
+                    endpoint.info({}, 'compute.localhost',
+                                  'compute.instance.delete.end',
+                                  {'instance_id': CUK}, {}), HANDLED)
+        mock_method.assert_called_once_with()
+        self.assertEqual(endpoint.dedup.stats['hits'], 2)
+
+    def test_endpoint_failure_not_remembered(self):
+        """Checks if a failed notification is sent again."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.requeue_on_error = True
+        endpoint = K2hr3NotificationEndpoint(conf)
+        with patch.object(_K2hr3UserAgent, 'send',
+                          return_value=False) as mock_method:
+            for _ in range(2):
+                self.assertEqual(
+                    endpoint.info({}, 'compute.localhost',
+                                  'compute.instance.delete.end',
+                                  {'instance_id': CUK}, {}), REQUEUE)
+        self.assertEqual(mock_method.call_count, 2)
+
+    def test_endpoint_deferred_not_remembered(self):
+        """Checks if a notification deferred to a retry is sent again."""
+        endpoint = K2hr3NotificationEndpoint(K2hr3Conf(conf_file_path))
+        with patch.object(_K2hr3UserAgent, 'send',
+                          return_value=True) as mock_method, \
+                patch.object(_K2hr3UserAgent, 'deferred',
+                             new_callable=PropertyMock, return_value=True):
+            for _ in range(2):
+                self.assertEqual(
+                    endpoint.info({}, 'compute.localhost',
+                                  'compute.instance.delete.end',
+                                  {'instance_id': CUK}, {}), HANDLED)
+        self.assertEqual(mock_method.call_count, 2)
+        self.assertEqual(endpoint.dedup.stats['hits'], 0)
+
+    def test_batch_endpoint_deferred_not_remembered(self):
+        """Checks if members deferred in a bulk request are not skipped."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.bulk_delete = True
+        endpoint = K2hr3BatchNotificationEndpoint(conf)
+        messages = [_message({'instance_id': CUK}),
+                    _message({'instance_id': '12345678-1234-5678-1234-'
+                                             '567812345679'})]
+        with patch.object(_K2hr3UserAgent, 'send_bulk',
+                          return_value=[True, True]), \
+                patch.object(_K2hr3UserAgent, 'deferred',
+                             new_callable=PropertyMock, return_value=True):
+            self.assertEqual(endpoint.info(messages), [HANDLED, HANDLED])
+        self.assertFalse(endpoint.dedup.seen({'cuk': CUK}))
+
+    def test_batch_endpoint_merges_duplicates(self):
+        """Checks if duplicates in a batch share the result of the first."""
+        messages = [
+            _message({'instance_id': 'cuk-1'}),
+            _message({'instance_id': 'cuk-2'}),
+            _message({'instance_id': 'cuk-1'}),
+            _message({'instance_id': 'cuk-2'}),
+        ]
+        with patch.object(
+                K2hr3NotificationEndpoint,
+                '_K2hr3NotificationEndpoint__call_r3api',
+                side_effect=[HANDLED, REQUEUE]) as mock_method:
+            conf = K2hr3Conf(conf_file_path)
+            conf.k2hr3.bulk_delete = False
+            endpoint = K2hr3BatchNotificationEndpoint(conf)
+            results = endpoint.info(messages)
+        self.assertEqual(results, [HANDLED, REQUEUE, HANDLED, REQUEUE])
+        self.assertEqual(mock_method.call_count, 2)
+
+    def test_batch_endpoint_skips_recent(self):
+        """Checks if members removed in a previous batch are skipped."""
+        conf = K2hr3Conf(conf_file_path)
+        endpoint = K2hr3BatchNotificationEndpoint(conf)
+        endpoint.dedup.add({'cuk': CUK})
+        with patch.object(
+                K2hr3NotificationEndpoint,
+                '_K2hr3NotificationEndpoint__call_r3api') as mock_method:
+            results = endpoint.info([_message({'instance_id': CUK})])
+        self.assertEqual(results, [HANDLED])
+        mock_method.assert_not_called()
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
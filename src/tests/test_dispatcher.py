@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the batch dispatcher of notification messages."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import unittest
+
+from oslo_messaging import NotificationFilter, NotificationResult  # type: ignore  # noqa
+
+from k2hr3_osnl.dispatcher import _K2hr3BatchNotificationDispatcher
+
+LOG = logging.getLogger(__name__)
+
+
+class _Incoming:  # pylint: disable=too-few-public-methods
+    """A message received from the transport."""
+
+    def __init__(self, event_type, payload, priority='info'):
+        """Initialize attributes."""
+        self.ctxt = {}
+        self.message = {
+            'publisher_id': 'network.localhost',
+            'event_type': event_type,
+            'priority': priority,
+            'payload': payload,
+        }
+
+
+class _Endpoint:  # pylint: disable=too-few-public-methods
+    """A batch endpoint returning the results given."""
+
+    def __init__(self, results):
+        """Initialize attributes."""
+        self.filter_rule = NotificationFilter(
+            event_type=r'^port\.delete\.end$')
+        self.results = results
+        self.messages = []
+
+    def info(self, messages):
+        """Returns the results given."""
+        self.messages.extend(messages)
+        if callable(self.results):
+            return self.results(messages)
+        return self.results
+
+
+class TestK2hr3BatchNotificationDispatcher(unittest.TestCase):
+    """Tests the _K2hr3BatchNotificationDispatcher class."""
+
+    def test_dispatch_requeues_failed_messages_only(self):
+        """Checks if only the messages with REQUEUE are requeued."""
+        incoming = [_Incoming('port.delete.end', {'instance_id': str(n)})
+                    for n in range(3)]
+        endpoint = _Endpoint(lambda messages: [
+            NotificationResult.REQUEUE
+            if m['payload']['instance_id'] == '1' else
+            NotificationResult.HANDLED for m in messages])
+        dispatcher = _K2hr3BatchNotificationDispatcher([endpoint], None)
+        self.assertEqual(dispatcher.dispatch(incoming), {incoming[1]})
+        self.assertEqual(len(endpoint.messages), 3)
+
+    def test_dispatch_filtered_messages(self):
+        """Checks if results map to messages matching the filter."""
+        incoming = [
+            _Incoming('port.create.end', {'instance_id': '0'}),
+            _Incoming('port.delete.end', {'instance_id': '1'}),
+            _Incoming('port.delete.end', {'instance_id': '2'}),
+        ]
+        endpoint = _Endpoint(
+            [NotificationResult.HANDLED, NotificationResult.REQUEUE])
+        dispatcher = _K2hr3BatchNotificationDispatcher([endpoint], None)
+        self.assertEqual(dispatcher.dispatch(incoming), {incoming[2]})
+        self.assertEqual([m['payload']['instance_id']
+                          for m in endpoint.messages], ['1', '2'])
+
+    def test_dispatch_whole_batch_result(self):
+        """Checks if a single REQUEUE requeues all matched messages."""
+        incoming = [_Incoming('port.delete.end', {'instance_id': str(n)})
+                    for n in range(2)]
+        endpoint = _Endpoint(NotificationResult.REQUEUE)
+        dispatcher = _K2hr3BatchNotificationDispatcher([endpoint], None)
+        self.assertEqual(dispatcher.dispatch(incoming), set(incoming))
+
+    def test_dispatch_exception(self):
+        """Checks if an exception in the endpoint requeues the batch."""
+        incoming = [_Incoming('port.delete.end', {'instance_id': '0'})]
+        endpoint = _Endpoint(None)
+        endpoint.info = lambda messages: 1 / 0
+        dispatcher = _K2hr3BatchNotificationDispatcher([endpoint], None)
+        self.assertEqual(dispatcher.dispatch(incoming), set(incoming))
+
+    def test_dispatch_unknown_priority(self):
+        """Checks if messages in an unknown priority are acknowledged."""
+        incoming = [_Incoming('port.delete.end', {}, priority='unknown')]
+        endpoint = _Endpoint(NotificationResult.REQUEUE)
+        dispatcher = _K2hr3BatchNotificationDispatcher([endpoint], None)
+        self.assertEqual(dispatcher.dispatch(incoming), set())
+        self.assertEqual(endpoint.messages, [])
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
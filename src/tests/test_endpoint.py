@@ -53,7 +53,7 @@ import unittest
 from unittest.mock import MagicMock, patch
 
 from k2hr3_osnl.cfg import K2hr3Conf
-from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.endpoint import K2hr3BatchNotificationEndpoint, K2hr3NotificationEndpoint
 from k2hr3_osnl.exceptions import K2hr3NotificationEndpointError, _K2hr3UserAgentError
 from k2hr3_osnl.useragent import _K2hr3UserAgent
 
@@ -62,6 +62,8 @@ conf_file_path = Path(sep.join([here,
                                 'k2hr3-osnl.conf'])).resolve()
 broken_conf_file_path = Path(
     sep.join([here, 'k2hr3-osnl.conf_broken'])).resolve()
+subscriptions_conf_file_path = Path(
+    sep.join([here, 'k2hr3-osnl.conf_subscriptions'])).resolve()
 notification_conf_file_path = Path(
     sep.join([here, '../../',
     '/tools/data/notifications_neutron.json'])).resolve()
@@ -100,6 +102,24 @@ class TestNotificationEndpoint(unittest.TestCase):
             the_exception.msg, 'conf is a K2hr3Conf instance, not {}'.format(
                 type(conf)))
 
+    def test_notification_endpoint_construct_invalid_api_url(self):
+        """Checks if the api_url is validated when constructed."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.api_url = 'localhost/v1/role'
+        with self.assertRaises(K2hr3NotificationEndpointError) as cm:
+            K2hr3NotificationEndpoint(conf)
+        the_exception = cm.exception
+        self.assertEqual(
+            the_exception.msg,
+            'a valid url is expected, not {}'.format(conf.k2hr3.api_url))
+
+    def test_notification_endpoint_construct_unresolved_api_url(self):
+        """Checks if an unresolved host does not fail the construction."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.api_url = 'https://unresolved.example.comm/v1/role'
+        endpoint = K2hr3NotificationEndpoint(conf)
+        self.assertIsInstance(endpoint, K2hr3NotificationEndpoint)
+
     def test_notification_endpoint_conf(self):
         """Checks if conf is readable."""
         conf = K2hr3Conf(conf_file_path)
@@ -115,6 +135,36 @@ class TestNotificationEndpoint(unittest.TestCase):
             new_conf = K2hr3Conf(conf_file_path)
             endpoint.conf = new_conf
 
+    def test_notification_endpoint_subscription(self):
+        """Checks if the filter and the target of a subscription."""
+        conf = K2hr3Conf(subscriptions_conf_file_path)
+        endpoint = K2hr3NotificationEndpoint(conf, 'nova_versioned')
+        self.assertEqual(endpoint.subscription, 'nova_versioned')
+        self.assertEqual(endpoint.target.topic, 'versioned_notifications')
+        self.assertEqual(endpoint.target.exchange, 'nova')
+        self.assertTrue(
+            endpoint.filter_rule.match({}, 'nova-compute:host1',
+                                       'instance.delete.end', {}, {}))
+        self.assertFalse(
+            endpoint.filter_rule.match({}, 'network.host1',
+                                       'port.delete.end', {}, {}))
+        self.assertIs(endpoint._extractors.lookup('instance.delete.end'),
+                      json.loads)
+
+    def test_notification_endpoint_unknown_subscription(self):
+        """Checks if an unknown subscription raises an error."""
+        conf = K2hr3Conf(subscriptions_conf_file_path)
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            K2hr3NotificationEndpoint(conf, 'glance')
+
+    def test_notification_endpoint_target(self):
+        """Checks if the target without subscriptions."""
+        conf = K2hr3Conf(conf_file_path)
+        endpoint = K2hr3NotificationEndpoint(conf)
+        self.assertIsNone(endpoint.subscription)
+        self.assertEqual(endpoint.target.topic, 'notifications')
+        self.assertEqual(endpoint.target.exchange, 'neutron')
+
     def test_neutron_payload_to_params(self):
         """Checks if _payload_to_params() works correctly.
 
@@ -414,6 +464,77 @@ class TestNotificationEndpoint(unittest.TestCase):
         # Ensucre the result of info is HANDLED.
         self.assertEqual(result, HANDLED)
 
+
+class TestBatchNotificationEndpoint(unittest.TestCase):
+    """Tests the BatchNotificationEndpoint class."""
+
+    @staticmethod
+    def _message(payload):
+        """Returns a message passed by the batch dispatcher."""
+        return {
+            'ctxt': {},
+            'publisher_id': 'network.localhost',
+            'event_type': 'port.delete.end',
+            'payload': payload,
+            'metadata': {},
+        }
+
+    def test_batch_endpoint_info_results_per_message(self):
+        """Checks if info returns a result for each message in order."""
+        messages = [
+            self._message({'instance_id': 'cuk-1'}),
+            self._message({'no_instance_id': 'x'}),  # invalid payload.
+            self._message({'instance_id': 'cuk-3'}),
+        ]
+        with patch.object(
+                K2hr3NotificationEndpoint,
+                '_K2hr3NotificationEndpoint__call_r3api',
+                side_effect=[HANDLED, REQUEUE]) as mock_method:
+            conf = K2hr3Conf(conf_file_path)
+            conf.k2hr3.bulk_delete = False
+            endpoint = K2hr3BatchNotificationEndpoint(conf)
+            results = endpoint.info(messages)
+        self.assertEqual(results, [HANDLED, HANDLED, REQUEUE])
+        self.assertEqual(mock_method.call_count, 2)
+        self.assertEqual(mock_method.call_args_list[1][0][0]['cuk'], 'cuk-3')
+
+    def test_batch_endpoint_info_call_r3api_exception(self):
+        """Checks if an exception in a message does not fail the others."""
+        messages = [
+            self._message({'instance_id': 'cuk-1'}),
+            self._message({'instance_id': 'cuk-2'}),
+        ]
+        with patch.object(
+                K2hr3NotificationEndpoint,
+                '_K2hr3NotificationEndpoint__call_r3api',
+                side_effect=[Exception('__call_r3api error'), REQUEUE]):
+            conf = K2hr3Conf(conf_file_path)
+            conf.k2hr3.bulk_delete = False
+            endpoint = K2hr3BatchNotificationEndpoint(conf)
+            results = endpoint.info(messages)
+        self.assertEqual(results, [HANDLED, REQUEUE])
+
+    def test_batch_endpoint_info_bulk(self):
+        """Checks if results of a bulk request map to messages."""
+        messages = [
+            self._message({'instance_id': '12345678-1234-5678-1234-567812345678'}),  # noqa
+            self._message({'instance_id': 'invalid-uuid'}),
+            self._message({'instance_id': '12345678-1234-5678-1234-567812345679'}),  # noqa
+        ]
+        with patch.object(_K2hr3UserAgent, 'send_bulk',
+                          return_value=[True, False]) as mock_method:
+            conf = K2hr3Conf(conf_file_path)
+            conf.k2hr3.requeue_on_error = True
+            endpoint = K2hr3BatchNotificationEndpoint(conf)
+            results = endpoint.info(messages)
+        self.assertEqual(results, [HANDLED, REQUEUE, REQUEUE])
+        agents = mock_method.call_args[0][0]
+        self.assertEqual([agent.instance_id for agent in agents], [
+            '12345678-1234-5678-1234-567812345678',
+            '12345678-1234-5678-1234-567812345679'
+        ])
+
+
 #
 # EOF
 #
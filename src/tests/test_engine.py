@@ -0,0 +1,411 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the asyncio delivery engine to the k2hr3 api."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import asyncio
+import concurrent.futures
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+from os import path, sep
+import socket
+import ssl
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.engine import (_K2hr3AsyncConnectionPool,
+                               _K2hr3DeliveryEngine, _get_delivery_engine,
+                               _read_response, _stop_delivery_engine)
+from k2hr3_osnl.useragent import _BULK_SUPPORT, _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+cert_file_path = Path(sep.join([here, 'k2hr3-osnl.crt'])).resolve()
+key_file_path = Path(sep.join([here, 'k2hr3-osnl.key'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """A keep-alive k2hr3 api stub which records client ports."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_DELETE(self):  # noqa: N802 pylint: disable=invalid-name
+        """Handles a DELETE request."""
+        with self.server.lock:
+            self.server.peers.append(self.client_address)
+            self.server.paths.append(self.path)
+            self.server.hosts.append(self.headers['Host'])
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        if self.path.startswith('/old/'):
+            self.send_response(307)
+            self.send_header('Location', self.path[len('/old'):])
+        else:
+            self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        if self.server.close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Suppresses access logs."""
+
+
+def _parse(data, method='DELETE'):
+    """Parses a response in a new event loop."""
+
+    async def parse():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await _read_response(reader, method)
+
+    return asyncio.run(parse())
+
+
+class TestK2hr3ReadResponse(unittest.TestCase):
+    """Tests the http response parser."""
+
+    def test_read_response_content_length(self):
+        """Checks if the body is read by the Content-Length."""
+        res, body = _parse(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n'
+                           b'X-K2hr3-Bulk-Delete: 10\r\n\r\nokNEXT')
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.reason, 'OK')
+        self.assertEqual(res.getheader('X-K2hr3-Bulk-Delete'), '10')
+        self.assertFalse(res.will_close)
+        self.assertEqual(body, b'ok')
+
+    def test_read_response_chunked(self):
+        """Checks if a chunked body is read."""
+        res, body = _parse(b'HTTP/1.1 200 OK\r\n'
+                           b'Transfer-Encoding: chunked\r\n\r\n'
+                           b'2\r\nok\r\n3;ext=1\r\n!!!\r\n0\r\n\r\n')
+        self.assertEqual(res.status, 200)
+        self.assertEqual(body, b'ok!!!')
+
+    def test_read_response_until_close(self):
+        """Checks if a body without the length ends with the connection."""
+        res, body = _parse(b'HTTP/1.0 200 OK\r\n\r\nuntil the end')
+        self.assertTrue(res.will_close)
+        self.assertEqual(body, b'until the end')
+
+    def test_read_response_no_content(self):
+        """Checks if a 204 response has no body."""
+        res, body = _parse(b'HTTP/1.1 204 No Content\r\n'
+                           b'Connection: close\r\n\r\n')
+        self.assertEqual(res.status, 204)
+        self.assertTrue(res.will_close)
+        self.assertEqual(body, b'')
+
+    def test_read_response_bad_status_line(self):
+        """Checks if a malformed status line raises an error."""
+        with self.assertRaises(http.client.BadStatusLine):
+            _parse(b'garbage\r\n\r\n')
+        with self.assertRaises(http.client.RemoteDisconnected):
+            _parse(b'')
+
+    def test_read_response_bad_chunk_size(self):
+        """Checks if a malformed chunk size raises an error."""
+        for chunks in (b'zz\r\nok\r\n0\r\n\r\n', b'-2\r\nok\r\n0\r\n\r\n',
+                       b'5\r\nok\r\n'):
+            with self.subTest(chunks=chunks):
+                with self.assertRaises(http.client.IncompleteRead):
+                    _parse(b'HTTP/1.1 200 OK\r\n'
+                           b'Transfer-Encoding: chunked\r\n\r\n' + chunks)
+
+    def test_read_response_invalid_content_length(self):
+        """Checks if an invalid or short Content-Length raises an error."""
+        for length in (b'x', b'-1', b'2, 2'):
+            with self.subTest(length=length):
+                with self.assertRaises(http.client.HTTPException):
+                    _parse(b'HTTP/1.1 200 OK\r\nContent-Length: ' + length +
+                           b'\r\n\r\nok')
+        with self.assertRaises(http.client.IncompleteRead):
+            _parse(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nok')
+
+    def test_read_response_keepalive_without_length(self):
+        """Checks if a keep-alive body without the length closes."""
+        res, body = _parse(b'HTTP/1.1 200 OK\r\n'
+                           b'Connection: keep-alive\r\n\r\nuntil the end')
+        self.assertTrue(res.will_close)
+        self.assertEqual(body, b'until the end')
+
+    def test_read_response_without_body(self):
+        """Checks if no body is read for HEAD, 204 and 304."""
+        for method, status in (('HEAD', b'200 OK'), ('DELETE', b'204 OK'),
+                               ('DELETE', b'304 Not Modified')):
+            with self.subTest(method=method, status=status):
+                res, body = _parse(b'HTTP/1.1 ' + status +
+                                   b'\r\nContent-Length: 4\r\n\r\n',
+                                   method)
+                self.assertEqual(body, b'')
+                self.assertFalse(res.will_close)
+
+    def test_read_response_too_long(self):
+        """Checks if too long or too many headers raise an error."""
+        with self.assertRaises(http.client.HTTPException):
+            _parse(b'HTTP/1.1 200 OK\r\n' + b'X-A: 1\r\n' * 101 + b'\r\n')
+        with self.assertRaises(http.client.HTTPException):
+            _parse(b'HTTP/1.1 200 OK\r\nX-A: ' + b'a' * 70000 + b'\r\n\r\n')
+
+
+class TestK2hr3DeliveryEngine(unittest.TestCase):
+    """Tests the _K2hr3DeliveryEngine class."""
+
+    def setUp(self):
+        """Starts a stub server."""
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        self._server.daemon_threads = True
+        self._server.lock = threading.Lock()
+        self._server.peers = []
+        self._server.paths = []
+        self._server.hosts = []
+        self._server.status = 204
+        self._server.delay = 0
+        self._server.close = False
+        self._port = self._server.server_address[1]
+        self._url = 'http://127.0.0.1:{}/v1/role'.format(self._port)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self._engine = _K2hr3DeliveryEngine(maxsize=2)
+
+    def tearDown(self):
+        """Stops the stub server."""
+        self._engine.stop()
+        self._server.shutdown()
+        self._server.server_close()
+        _stop_delivery_engine()
+        _BULK_SUPPORT.clear()
+
+    def test_engine_keepalive(self):
+        """Checks if requests share one connection."""
+        for _ in range(3):
+            res, body = self._engine.request(self._url, 'DELETE',
+                                             '/v1/role?cuk=x', {}, 5)
+            self.assertEqual(res.status, 204)
+            self.assertEqual(body, b'')
+        self.assertEqual(len(set(self._server.peers)), 1)
+        self.assertTrue(self._engine.running)
+
+    def test_engine_host_header(self):
+        """Checks if the Host header has a non-default port."""
+        self._engine.request(self._url, 'DELETE', '/v1/role', {}, 5)
+        self.assertEqual(self._server.hosts, [f'127.0.0.1:{self._port}'])
+        self.assertEqual(
+            _K2hr3AsyncConnectionPool('http', 'localhost', 80)._netloc,
+            'localhost')
+        self.assertEqual(
+            _K2hr3AsyncConnectionPool('https', '::1', 8443)._netloc,
+            '[::1]:8443')
+
+    def test_engine_connects_resolved_address(self):
+        """Checks if a connection is made to the resolved address."""
+        with patch('k2hr3_osnl.resolver._K2hr3Resolver.resolve',
+                   return_value='127.0.0.1') as resolve:
+            self._engine.request(f'http://k2hr3.invalid:{self._port}',
+                                 'DELETE', '/v1/role', {}, 5)
+        resolve.assert_called_once_with('k2hr3.invalid')
+        self.assertEqual(self._server.hosts, [f'k2hr3.invalid:{self._port}'])
+
+    def test_pool_context_replaced(self):
+        """Checks if borrowed connections are closed after a replacement."""
+        old_ctx = ssl.create_default_context()
+        new_ctx = ssl.create_default_context()
+
+        async def replace():
+            pool = _K2hr3AsyncConnectionPool('http', '127.0.0.1', self._port,
+                                             context=old_ctx)
+            reader, writer, _ = await pool._acquire()
+            pool._release(reader, writer, old_ctx)
+            self.assertEqual(pool.idle, 1)
+            reader, writer, reused = await pool._acquire()
+            self.assertTrue(reused)
+            pool.context = new_ctx
+            pool._release(reader, writer, old_ctx)
+            self.assertEqual((pool.idle, pool.size), (0, 0))
+            reader, writer, _ = await pool._acquire()
+            pool.close()
+            pool._release(reader, writer, new_ctx)
+            self.assertEqual((pool.idle, pool.size), (0, 0))
+
+        asyncio.run(replace())
+
+    def test_engine_pool_context_replaced(self):
+        """Checks if the engine replaces the context of a pool in place."""
+        ctx = ssl.create_default_context()
+        self._engine.request(self._url, 'DELETE', '/v1/role', {}, 5, None, ctx)
+        pool = next(iter(self._engine._pools.values()))
+        new_ctx = ssl.create_default_context()
+        self._engine.request(self._url, 'DELETE', '/v1/role', {}, 5, None,
+                             new_ctx)
+        self.assertIs(next(iter(self._engine._pools.values())), pool)
+        self.assertIs(pool.context, new_ctx)
+
+    def test_engine_reconnect(self):
+        """Checks if a new connection is made after Connection: close."""
+        self._server.close = True
+        for _ in range(2):
+            res, _ = self._engine.request(self._url, 'DELETE', '/v1/role', {},
+                                          5)
+            self.assertEqual(res.status, 204)
+        self.assertEqual(len(set(self._server.peers)), 2)
+
+    def test_engine_request_all_multiplexed(self):
+        """Checks if many requests share maxsize connections."""
+        self._server.delay = 0.01
+        requests = [(self._url, 'DELETE', '/v1/role?cuk={}'.format(n), {}, 5)
+                    for n in range(20)]
+        outcomes = self._engine.request_all(requests)
+        self.assertEqual([res.status for res, _ in outcomes], [204] * 20)
+        self.assertLessEqual(len(set(self._server.peers)), 2)
+        self.assertEqual(len(self._server.paths), 20)
+
+    def test_engine_timeout(self):
+        """Checks if a slow response raises socket.timeout."""
+        self._server.delay = 1
+        with self.assertRaises(socket.timeout):
+            self._engine.request(self._url, 'DELETE', '/v1/role', {}, 0.1)
+
+    def test_engine_stop_without_wait(self):
+        """Checks if stop cancels requests in flight."""
+        self._server.delay = 5
+        outcomes = []
+
+        def request():
+            try:
+                self._engine.request(self._url, 'DELETE', '/v1/role', {}, 10)
+            except concurrent.futures.CancelledError as error:
+                outcomes.append(error)
+
+        thread = threading.Thread(target=request)
+        thread.start()
+        while not self._server.paths:
+            time.sleep(0.01)
+        started = time.monotonic()
+        self._engine.stop(wait=False)
+        thread.join(5)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(len(outcomes), 1)
+        self.assertFalse(self._engine.running)
+
+    def test_engine_connection_refused(self):
+        """Checks if a connection error is raised to the caller."""
+        self._server.server_close()
+        outcomes = self._engine.request_all([(self._url, 'DELETE', '/', {}, 5)
+                                             ])
+        self.assertIsInstance(outcomes[0], OSError)
+
+    def test_engine_https(self):
+        """Checks if requests are sent over TLS."""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        server.daemon_threads = True
+        server.lock = threading.Lock()
+        server.peers, server.paths, server.hosts = [], [], []
+        server.status, server.delay, server.close = 204, 0, False
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(str(cert_file_path), str(key_file_path))
+        server.socket = server_ctx.wrap_socket(server.socket,
+                                               server_side=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            ctx = ssl.create_default_context(cafile=str(cert_file_path))
+            url = 'https://localhost:{}/v1/role'.format(
+                server.server_address[1])
+            for _ in range(2):
+                res, _ = self._engine.request(url, 'DELETE', '/v1/role', {}, 5,
+                                              None, ctx)
+                self.assertEqual(res.status, 204)
+            self.assertEqual(len(set(server.peers)), 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_useragent_asyncio_engine(self):
+        """Checks if _K2hr3UserAgent sends requests in the engine."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.delivery_engine = 'asyncio'
+        agent = _K2hr3UserAgent(conf)
+        params = {'extra': 'openstack-auto-v1', 'cuk': 'x'}
+        self.assertTrue(
+            agent._send_internal(self._url, params, agent.headers, 'DELETE'))
+        self.assertEqual(agent.code, 204)
+        self.assertTrue(_get_delivery_engine(conf).running)
+        self._server.status = 404
+        self.assertFalse(
+            agent._send_internal(self._url, params, agent.headers, 'DELETE'))
+        self.assertEqual(agent.code, 404)
+
+    def test_useragent_send_bulk_concurrently(self):
+        """Checks if a batch is sent concurrently without bulk support."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.api_url = self._url
+        conf.k2hr3.delivery_engine = 'asyncio'
+        conf.k2hr3.bulk_delete = False
+        agents = []
+        for n in range(5):
+            agent = _K2hr3UserAgent(conf)
+            agent.instance_id = '12345678-1234-5678-1234-{:012d}'.format(n)
+            agent.ips = ['127.0.0.1']
+            agents.append(agent)
+        self.assertEqual(_K2hr3UserAgent.send_bulk(agents), [True] * 5)
+        self.assertEqual(len(self._server.paths), 5)
+        self.assertEqual([agent.code for agent in agents], [204] * 5)
+
+    def test_useragent_send_bulk_concurrently_redirect(self):
+        """Checks if a redirect is followed in a concurrent batch."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.api_url = f'http://127.0.0.1:{self._port}/old/v1/role'
+        conf.k2hr3.delivery_engine = 'asyncio'
+        conf.k2hr3.bulk_delete = False
+        agents = []
+        for n in range(2):
+            agent = _K2hr3UserAgent(conf)
+            agent.instance_id = '12345678-1234-5678-1234-{:012d}'.format(n)
+            agents.append(agent)
+        self.assertEqual(_K2hr3UserAgent.send_bulk(agents), [True] * 2)
+        self.assertEqual(
+            sorted(path.split('?')[0] for path in self._server.paths),
+            ['/old/v1/role'] * 2 + ['/v1/role'] * 2)
+        self.assertEqual([agent.code for agent in agents], [204] * 2)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
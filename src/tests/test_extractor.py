@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the payload extractors."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+from pathlib import Path
+from os import path, sep
+import unittest
+from unittest.mock import MagicMock, patch
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.exceptions import K2hr3NotificationEndpointError
+from k2hr3_osnl.extractor import (_K2hr3ExtractorRegistry,
+                                  _extract_neutron_port, _load_extractor)
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+data_path = Path(sep.join([here, '..', '..', 'tools', 'data'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+def _extract_octavia(payload):
+    """An extractor for the tests."""
+    return {'cuk': payload['loadbalancer']['vip_port_id']}
+
+
+_extract_octavia.event_type = r'^loadbalancer\.'
+
+
+def _load(name):
+    """Returns a notification in the tools/data directory."""
+    with open(data_path / name, encoding='utf-8') as data:
+        return json.load(data)
+
+
+class TestK2hr3ExtractorRegistry(unittest.TestCase):
+    """Tests the _K2hr3ExtractorRegistry class."""
+
+    def test_builtin_extractors(self):
+        """Checks if the builtin extractors handle the sample messages."""
+        registry = _K2hr3ExtractorRegistry()
+        for name, expected in [
+            ('notifications_neutron.json', {
+                'cuk': '12345678-1234-5678-1234-567812345678',
+                'ips': ['172.16.0.1', '2001:db8::6']
+            }),
+            ('notifications_nova.json', {
+                'cuk': '12345678-1234-5678-1234-567812345678'
+            }),
+            ('versioned_notifications_nova.json', {
+                'cuk': '12345678-1234-5678-1234-567812345678'
+            }),
+        ]:
+            message = _load(name)
+            extractor = registry.lookup(message['event_type'])
+            self.assertIsNotNone(extractor, name)
+            self.assertEqual(extractor(message['payload']), expected, name)
+
+    def test_lookup_unknown_event_type(self):
+        """Checks if an unknown event type has no extractor."""
+        registry = _K2hr3ExtractorRegistry()
+        self.assertIsNone(registry.lookup('image.delete'))
+        self.assertIsNone(registry.lookup(''))
+
+    def test_register_has_priority(self):
+        """Checks if a registered extractor is chosen before builtins."""
+        registry = _K2hr3ExtractorRegistry()
+        self.assertIs(registry.lookup('port.delete.end'),
+                      _extract_neutron_port)
+        extractor = MagicMock()
+        registry.register(r'^port\.delete\.end$', extractor)
+        self.assertIs(registry.lookup('port.delete.end'), extractor)
+        self.assertIs(registry.lookup('port.create.end'),
+                      _extract_neutron_port)
+
+    def test_register_publisher_id(self):
+        """Checks if an extractor is chosen by the publisher id."""
+        registry = _K2hr3ExtractorRegistry()
+        extractor = MagicMock()
+        registry.register(r'^port\.', extractor, r'^network\.')
+        self.assertIs(registry.lookup('port.delete.end', 'network.host1'),
+                      extractor)
+        # cached per the event type and the publisher id.
+        self.assertIs(registry.lookup('port.delete.end', 'compute.host1'),
+                      _extract_neutron_port)
+        self.assertIs(registry.lookup('port.delete.end'),
+                      _extract_neutron_port)
+        self.assertIs(registry.lookup('port.delete.end', 'network.host1'),
+                      extractor)
+
+    def test_register_invalid_pattern(self):
+        """Checks if an invalid regular expression is rejected."""
+        registry = _K2hr3ExtractorRegistry()
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            registry.register('[', _extract_octavia)
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            registry.register('^a', 'not callable')
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            registry.register('^a', _extract_octavia, '[')
+
+    def test_load_extractor(self):
+        """Checks if an extractor is imported by the path."""
+        self.assertIs(_load_extractor('json:dumps'), json.dumps)
+        self.assertIs(_load_extractor('json.dumps'), json.dumps)
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            _load_extractor('nonexistent.module:func')
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            _load_extractor('json:__doc__')
+
+    def test_from_conf(self):
+        """Checks if extractors in the conf are registered."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.extractors = [
+            r'^loadbalancer\.delete\.end$ ' + __name__ + ':_extract_octavia'
+        ]
+        registry = _K2hr3ExtractorRegistry.from_conf(conf)
+        self.assertIs(registry.lookup('loadbalancer.delete.end'),
+                      _extract_octavia)
+
+    def test_from_conf_publisher_id(self):
+        """Checks if extractors in the conf may have a publisher id."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.extractors = [
+            r'^loadbalancer\. ^octavia\. ' + __name__ + ':_extract_octavia'
+        ]
+        registry = _K2hr3ExtractorRegistry.from_conf(conf)
+        self.assertIs(registry.lookup('loadbalancer.delete.end',
+                                      'octavia.host1'), _extract_octavia)
+        self.assertIsNone(registry.lookup('loadbalancer.delete.end',
+                                          'neutron.host1'))
+
+    def test_from_conf_invalid(self):
+        """Checks if a malformed extractors option is rejected."""
+        conf = K2hr3Conf(conf_file_path)
+        for value in ('no_path', '^a ^b ^c json:loads'):
+            conf.k2hr3.extractors = [value]
+            with self.assertRaises(K2hr3NotificationEndpointError):
+                _K2hr3ExtractorRegistry.from_conf(conf)
+
+    def test_entry_points(self):
+        """Checks if extractors installed as entry points are registered."""
+        entry_point = MagicMock()
+        entry_point.load.return_value = _extract_octavia
+        broken = MagicMock()
+        broken.load.side_effect = ImportError('broken')
+        with patch('k2hr3_osnl.extractor._iter_entry_points',
+                   return_value=[broken, entry_point]):
+            registry = _K2hr3ExtractorRegistry.from_conf(
+                K2hr3Conf(conf_file_path))
+        self.assertIs(registry.lookup('loadbalancer.delete.end'),
+                      _extract_octavia)
+
+    def test_entry_points_publisher_id(self):
+        """Checks if an entry point may have the publisher_id attribute."""
+        extractor = MagicMock(event_type=r'^port\.',
+                              publisher_id=r'^network\.')
+        entry_point = MagicMock()
+        entry_point.load.return_value = extractor
+        with patch('k2hr3_osnl.extractor._iter_entry_points',
+                   return_value=[entry_point]):
+            registry = _K2hr3ExtractorRegistry.from_conf(
+                K2hr3Conf(conf_file_path))
+        self.assertIs(registry.lookup('port.delete.end', 'network.host1'),
+                      extractor)
+        self.assertIs(registry.lookup('port.delete.end', 'compute.host1'),
+                      _extract_neutron_port)
+
+
+class TestK2hr3EndpointExtractor(unittest.TestCase):
+    """Tests the extractors in the endpoint."""
+
+    def setUp(self):
+        """Mocks the r3api."""
+        patcher = patch.object(K2hr3NotificationEndpoint,
+                               '_K2hr3NotificationEndpoint__call_r3api',
+                               return_value='handled')
+        self.mock_method = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_endpoint_uses_extractor(self):
+        """Checks if the extractor for the event type is called."""
+        conf = K2hr3Conf(conf_file_path)
+        endpoint = K2hr3NotificationEndpoint(conf)
+        with patch.object(K2hr3NotificationEndpoint,
+                          '_payload_to_params') as probe:
+            message = _load('notifications_neutron.json')
+            endpoint.info(message['ctxt'], message['publisher_id'],
+                          message['event_type'], message['payload'],
+                          message['metadata'])
+        probe.assert_not_called()
+        self.mock_method.assert_called_once_with({
+            'cuk': '12345678-1234-5678-1234-567812345678',
+            'ips': ['172.16.0.1', '2001:db8::6']
+        })
+
+    def test_endpoint_passes_publisher_id(self):
+        """Checks if the extractor for the publisher id is called."""
+        conf = K2hr3Conf(conf_file_path)
+        endpoint = K2hr3NotificationEndpoint(conf)
+        extractor = MagicMock(return_value={'cuk': 'network'})
+        endpoint._extractors.register(r'^port\.', extractor, r'^network\.')
+        endpoint.info({}, 'network.localhost', 'port.delete.end',
+                      {'port': {}}, {})
+        extractor.assert_called_once_with({'port': {}})
+        self.mock_method.assert_called_once_with({'cuk': 'network'})
+
+    def test_endpoint_falls_back_to_probe(self):
+        """Checks if an unexpected payload is probed."""
+        conf = K2hr3Conf(conf_file_path)
+        endpoint = K2hr3NotificationEndpoint(conf)
+        # a port.delete.end without the port.
+        endpoint.info({}, 'network.localhost', 'port.delete.end',
+                      {'instance_id': '12345678-1234-5678-1234-567812345678'},
+                      {})
+        self.mock_method.assert_called_once_with(
+            {'cuk': '12345678-1234-5678-1234-567812345678'})
+
+    def test_endpoint_derived_payload_to_params(self):
+        """Checks if an overridden _payload_to_params is respected."""
+
+        class _Endpoint(K2hr3NotificationEndpoint):
+
+            def _payload_to_params(self, payload):
+                return {'cuk': 'derived'}
+
+        endpoint = _Endpoint(K2hr3Conf(conf_file_path))
+        message = _load('notifications_neutron.json')
+        endpoint.info(message['ctxt'], message['publisher_id'],
+                      message['event_type'], message['payload'],
+                      message['metadata'])
+        self.mock_method.assert_called_once_with({'cuk': 'derived'})
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -25,17 +25,19 @@ import sys
 import unittest
 from pathlib import Path
 from os import path, sep
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 import oslo_messaging  # type: ignore
 
 import k2hr3_osnl
 from k2hr3_osnl.cfg import K2hr3Conf
-from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.endpoint import K2hr3BatchNotificationEndpoint, K2hr3NotificationEndpoint
 from k2hr3_osnl.exceptions import K2hr3Error
 
 here = path.abspath(path.dirname(__file__))
 conf_file_path = Path(sep.join([here,
                                 'k2hr3-osnl.conf'])).resolve()
+subscriptions_conf_file_path = Path(
+    sep.join([here, 'k2hr3-osnl.conf_subscriptions'])).resolve()
 
 class TestK2hr3Init(unittest.TestCase):
     """Tests the k2hr3_osnl init functions."""
@@ -195,6 +197,109 @@ class TestK2hr3Init(unittest.TestCase):
                 with self.assertRaises(Exception):
                     k2hr3_osnl.listen(endpoint)
 
+    def test_k2hr3_osnl_listen_batch_requires_batch_endpoint(self):
+        """Checks if the batch mode rejects a per-message endpoint."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.oslo_messaging_notifications.batch_size = 10
+        endpoint = K2hr3NotificationEndpoint(conf)
+        self.assertEqual(k2hr3_osnl.listen([endpoint]), 1)
+
+    def test_k2hr3_osnl_listen_batch(self):
+        """Checks if the batch mode builds a batch listener."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.oslo_messaging_notifications.batch_size = 10
+        conf.oslo_messaging_notifications.batch_timeout = 2
+        endpoint = K2hr3BatchNotificationEndpoint(conf)
+        with patch('k2hr3_osnl._get_batch_notification_listener') as cm1:
+            cm1.return_value.start.side_effect = Exception('skip listening')
+            with self.assertRaises(Exception):
+                k2hr3_osnl.listen([endpoint])
+        self.assertEqual(cm1.call_args[1]['batch_size'], 10)
+        self.assertEqual(cm1.call_args[1]['batch_timeout'], 2)
+
+    def test_k2hr3_osnl_listen_subscriptions(self):
+        """Checks if a listener serves the endpoints of its target only."""
+        conf = K2hr3Conf(subscriptions_conf_file_path)
+        endpoints = [
+            K2hr3NotificationEndpoint(conf, name)
+            for name in conf.oslo_messaging_notifications.subscriptions
+        ]
+        with patch('oslo_messaging.get_notification_listener') as cm1:
+            cm1.return_value.start.side_effect = Exception('skip listening')
+            with self.assertRaises(Exception):
+                k2hr3_osnl.listen(endpoints)
+        self.assertEqual(cm1.call_count, 3)
+        targets = [call_args[0][1] for call_args in cm1.call_args_list]
+        self.assertEqual([[(t.topic, t.exchange) for t in target]
+                          for target in targets],
+                         [[('notifications', 'neutron')],
+                          [('notifications', 'nova')],
+                          [('versioned_notifications', 'nova')]])
+        self.assertEqual([call_args[0][2] for call_args in cm1.call_args_list],
+                         [[endpoint] for endpoint in endpoints])
+        # the listeners share a transport.
+        self.assertEqual(len({id(call_args[0][0])
+                              for call_args in cm1.call_args_list}), 1)
+
+    def test_k2hr3_osnl_get_listener_topics(self):
+        """Checks if subscriptions on different topics have listeners."""
+        conf = K2hr3Conf(subscriptions_conf_file_path)
+        neutron = K2hr3NotificationEndpoint(conf, 'neutron')
+        versioned = K2hr3NotificationEndpoint(conf, 'nova_versioned')
+        listeners = [MagicMock(), MagicMock()]
+        with patch('oslo_messaging.get_notification_listener',
+                   side_effect=listeners) as cm1:
+            listener = k2hr3_osnl._get_listener([neutron, versioned], conf)
+        self.assertEqual([call_args[0][1][0].topic
+                          for call_args in cm1.call_args_list],
+                         ['notifications', 'versioned_notifications'])
+        self.assertEqual([call_args[0][2] for call_args in cm1.call_args_list],
+                         [[neutron], [versioned]])
+        # a listener failed to start stops the others.
+        listeners[1].start.side_effect = Exception('skip listening')
+        with self.assertRaises(Exception):
+            listener.start()
+        listeners[0].stop.assert_called_once_with()
+        listeners[0].wait.assert_called_once_with()
+        listeners[1].start.side_effect = None
+        listener.start()
+        listener.stop()
+        listener.wait()
+        for each in listeners:
+            each.stop.assert_called_with()
+            each.wait.assert_called_with()
+
+    def test_k2hr3_osnl_main_subscriptions(self):
+        """Checks if main builds an endpoint per subscription."""
+        my_args = ['dummy_main', '-c',
+                   str(subscriptions_conf_file_path.absolute())]
+        with patch.object(sys, 'argv', my_args):
+            with patch('k2hr3_osnl.listen', return_value=0) as cm1:
+                with self.assertRaises(SystemExit):
+                    k2hr3_osnl.main()
+        endpoints = cm1.call_args[0][0]
+        self.assertEqual([e.subscription for e in endpoints],
+                         ['neutron', 'nova', 'nova_versioned'])
+
+    def test_k2hr3_osnl_main_workers(self):
+        """Checks if main runs listeners in worker processes."""
+        my_args = ['dummy_main', '-c', str(conf_file_path.absolute()),
+                   '--workers', '3']
+        with patch.object(sys, 'argv', my_args):
+            with patch('k2hr3_osnl._K2hr3Supervisor') as cm1:
+                cm1.return_value.run.return_value = 0
+                with patch('k2hr3_osnl.listen', return_value=0) as cm2:
+                    with self.assertRaises(SystemExit):
+                        k2hr3_osnl.main()
+                    # listen is called in workers only.
+                    cm2.assert_not_called()
+                    self.assertEqual(cm1.call_args[0][0], 3)
+                    self.assertEqual(cm1.call_args[0][1](), 0)
+                    cm2.assert_called_once()
+                    stats = cm1.call_args[1]['stats']()
+        self.assertIn('dedup', stats)
+        self.assertIn('retry', stats)
+
 
 #
 # Local variables:
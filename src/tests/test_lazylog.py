@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the lazy formatting of log arguments."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import unittest
+from unittest.mock import MagicMock
+
+from k2hr3_osnl.lazylog import _LazyCall, _LazyJson, _decode_body
+
+LOG = logging.getLogger(__name__)
+
+
+class TestK2hr3LazyLog(unittest.TestCase):
+    """Tests the lazy log arguments."""
+
+    def test_lazy_call_skipped_if_disabled(self):
+        """Checks if the function is not called below the level."""
+        logger = logging.getLogger('k2hr3_osnl.test_lazylog')
+        logger.setLevel(logging.INFO)
+        func = MagicMock(return_value='formatted')
+        logger.debug('value %s', _LazyCall(func, 1, key=2))
+        func.assert_not_called()
+
+    def test_lazy_call_called_if_emitted(self):
+        """Checks if the function is called when the record is emitted."""
+        logger = logging.getLogger('k2hr3_osnl.test_lazylog')
+        logger.setLevel(logging.DEBUG)
+        func = MagicMock(return_value='formatted')
+        with self.assertLogs(logger, level=logging.DEBUG) as cm:
+            logger.debug('value %s', _LazyCall(func, 1, key=2))
+        func.assert_called_once_with(1, key=2)
+        self.assertEqual(cm.records[0].getMessage(), 'value formatted')
+
+    def test_lazy_json(self):
+        """Checks if an object is serialized like the eager code."""
+        self.assertEqual(str(_LazyJson({'b': 1, 'a': [1]})),
+                         '{\n    "a": [\n        1\n    ],\n    "b": 1\n}')
+
+    def test_decode_body(self):
+        """Checks if a long body is truncated."""
+        self.assertEqual(_decode_body(b'ok'), 'ok')
+        self.assertEqual(_decode_body(b'x' * 10, limit=4), 'xxxx...(10 bytes)')
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
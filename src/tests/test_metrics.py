@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the metrics and the metrics server."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+from os import path, sep
+import socket
+import threading
+import unittest
+from unittest.mock import patch
+import urllib.request
+
+from oslo_messaging import NotificationFilter  # type: ignore
+
+import k2hr3_osnl
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.connection import _K2hr3ConnectionPool
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.endpoint import _K2hr3NotificationFilter
+from k2hr3_osnl.metrics import (_API_REQUEST_SECONDS, _FILTERED, _HANDLED,
+                                _RECEIVED, _K2hr3Metrics, _get_metrics,
+                                _merge_families, _start_metrics_server,
+                                _stop_metrics_server)
+from k2hr3_osnl.resolver import _get_resolver
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """A k2hr3 api stub."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_DELETE(self):  # noqa: N802 pylint: disable=invalid-name
+        """Handles a DELETE request."""
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        """Suppresses access logs."""
+
+
+def _free_port():
+    """Returns a port nobody listens to."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestK2hr3Metrics(unittest.TestCase):
+    """Tests the metrics classes."""
+
+    def test_counter_threads(self):
+        """Checks if increments of threads are summed up."""
+        metrics = _K2hr3Metrics()
+        counter = metrics.counter('messages_total', 'messages',
+                                  ('event_type', ))
+
+        def run():
+            for _ in range(1000):
+                counter.inc('port.delete.end')
+
+        threads = [threading.Thread(target=run) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('instance.delete.end')
+        self.assertEqual(counter.value('port.delete.end'), 4000)
+        self.assertIn('messages_total{event_type="port.delete.end"} 4000',
+                      metrics.render())
+        # the same name returns the same counter.
+        self.assertIs(metrics.counter('messages_total', 'messages'), counter)
+
+    def test_histogram(self):
+        """Checks if the buckets are cumulative."""
+        metrics = _K2hr3Metrics()
+        histogram = metrics.histogram('seconds', 'latency', ('code', ),
+                                      buckets=(0.1, 1.0))
+        histogram.observe(0.05, '204')
+        histogram.observe(0.5, '204')
+        histogram.observe(5, '204')
+        text = metrics.render()
+        self.assertIn('seconds_bucket{code="204",le="0.1"} 1\n', text)
+        self.assertIn('seconds_bucket{code="204",le="1.0"} 2\n', text)
+        self.assertIn('seconds_bucket{code="204",le="+Inf"} 3\n', text)
+        self.assertIn('seconds_sum{code="204"} 5.55\n', text)
+        self.assertIn('seconds_count{code="204"} 3\n', text)
+        self.assertIn('# TYPE seconds histogram\n', text)
+
+    def test_collector_and_escape(self):
+        """Checks if a callback is read and labels are escaped."""
+        metrics = _K2hr3Metrics()
+        metrics.collector('depth', 'gauge', 'depth',
+                          lambda: {('a"b\\c\n', ): 2}, ('shard', ))
+        self.assertIn('depth{shard="a\\"b\\\\c\\n"} 2\n', metrics.render())
+
+    def test_collector_failure(self):
+        """Checks if a failing callback does not break the others."""
+        metrics = _K2hr3Metrics()
+        metrics.collector('broken', 'gauge', 'broken', lambda: 1 / 0)
+        metrics.counter('ok_total', 'ok').inc()
+        self.assertEqual(metrics.render(),
+                         '# HELP ok_total ok\n# TYPE ok_total counter\n'
+                         'ok_total 1\n')
+
+    def test_merge_families(self):
+        """Checks if the worker label is added to the samples."""
+        metrics = _K2hr3Metrics()
+        metrics.counter('ok_total', 'ok').inc()
+        families = metrics.collect()
+        text = metrics.render(_merge_families({0: families, 1: families}))
+        self.assertEqual(text.count('# TYPE ok_total counter'), 1)
+        self.assertIn('ok_total{worker="0"} 1\n', text)
+        self.assertIn('ok_total{worker="1"} 1\n', text)
+
+    def test_resolver_lookups(self):
+        """Checks if the lookups of the resolver are exported."""
+        endpoint = K2hr3NotificationEndpoint(K2hr3Conf(conf_file_path))
+        k2hr3_osnl._register_metrics([endpoint])
+        resolver = _get_resolver()
+        resolver.clear()
+        resolver.resolve('localhost')
+        resolver.resolve('localhost')
+        stats = resolver.stats
+        text = _get_metrics().render()
+        self.assertIn('# TYPE k2hr3_osnl_resolver_lookups_total counter\n',
+                      text)
+        for outcome in ('hits', 'misses', 'failures', 'refreshes'):
+            self.assertIn(
+                f'k2hr3_osnl_resolver_lookups_total{{outcome="{outcome}"}}'
+                f' {stats[outcome]}\n', text)
+        self.assertGreaterEqual(stats['hits'], 1)
+
+    def test_filter_counts(self):
+        """Checks if the filter counts received and dropped messages."""
+        rule = _K2hr3NotificationFilter(
+            NotificationFilter(event_type=r'^port\.delete\.end$'))
+        received = _RECEIVED.value('port.update.end')
+        filtered = _FILTERED.value('port.update.end')
+        self.assertFalse(
+            rule.match({}, 'network.host1', 'port.update.end', {}, {}))
+        self.assertEqual(_RECEIVED.value('port.update.end'), received + 1)
+        self.assertEqual(_FILTERED.value('port.update.end'), filtered + 1)
+
+    def test_endpoint_counts_handled(self):
+        """Checks if the endpoint counts handled messages."""
+        endpoint = K2hr3NotificationEndpoint(K2hr3Conf(conf_file_path))
+        handled = _HANDLED.value('port.delete.end')
+        with patch.object(K2hr3NotificationEndpoint,
+                          '_K2hr3NotificationEndpoint__call_r3api',
+                          return_value='handled'):
+            endpoint.info({}, 'network.host1', 'port.delete.end', {
+                'port': {
+                    'device_id': '12345678-1234-5678-1234-567812345678'
+                }
+            }, {})
+        self.assertEqual(_HANDLED.value('port.delete.end'), handled + 1)
+
+    def test_api_request_latency(self):
+        """Checks if the latency of an api request is observed."""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            pool = _K2hr3ConnectionPool('http', '127.0.0.1',
+                                        server.server_address[1])
+            before = _API_REQUEST_SECONDS.collect()
+            pool.request('DELETE', '/v1/role', {}, 5)
+            pool.close()
+            after = _API_REQUEST_SECONDS.collect()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        def count(family):
+            return sum(value for name, labels, value in family['samples']
+                       if name.endswith('_count') and labels == {
+                           'method': 'DELETE',
+                           'code': '204'
+                       })
+
+        self.assertEqual(count(after), count(before) + 1)
+
+    def test_metrics_server(self):
+        """Checks if the server serves the metrics at /metrics."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.metrics_port = _free_port()
+        server = _start_metrics_server(conf)
+        self.addCleanup(_stop_metrics_server)
+        self.assertIs(_start_metrics_server(conf), server)
+        url = f'http://127.0.0.1:{conf.k2hr3.metrics_port}/metrics'
+        with urllib.request.urlopen(url, timeout=5) as res:  # nosec
+            self.assertEqual(res.status, 200)
+            self.assertTrue(
+                res.headers['Content-Type'].startswith('text/plain'))
+            text = res.read().decode('utf-8')
+        self.assertIn('# TYPE k2hr3_osnl_messages_received_total counter',
+                      text)
+        self.assertIn('process_resident_memory_bytes ', text)
+
+    def test_metrics_server_disabled(self):
+        """Checks if metrics_port 0 disables the server."""
+        self.assertIsNone(_start_metrics_server(K2hr3Conf(conf_file_path)))
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the prefilter of serialized notifications."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import logging
+from pathlib import Path
+from os import path, sep
+import re
+import types
+import unittest
+from unittest.mock import MagicMock, patch
+
+from oslo_messaging import NotificationResult  # type: ignore
+from oslo_messaging._drivers import common as driver_common  # type: ignore
+from oslo_messaging._drivers import impl_rabbit  # type: ignore
+from oslo_messaging._drivers.impl_rabbit import RabbitMessage  # type: ignore
+from oslo_messaging.notify.dispatcher import NotificationDispatcher  # type: ignore  # noqa
+
+import k2hr3_osnl.prefilter
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.prefilter import (_deserialize_msg, _get_prefilter,
+                                  _hook_reached, _K2hr3Prefilter,
+                                  _update_prefilter)
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+data_file_path = Path(
+    sep.join([here, '..', '..', 'tools', 'data',
+              'notifications_neutron.json'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+def _envelope(event_type='port.delete.end', **fields):
+    """Returns a neutron notification serialized like the rabbit driver."""
+    with open(data_file_path, encoding='utf-8') as f:
+        data = json.load(f)
+    message = {
+        'message_id': 'ffffffff-ffff-ffff-ffff-ffffffffffff',
+        'publisher_id': data['publisher_id'],
+        'event_type': event_type,
+        'priority': 'INFO',
+        'payload': data['payload'],
+        'timestamp': '2018-09-11 00:00:00.000000',
+    }
+    message.update(('_context_' + key, value)
+                   for key, value in data['ctxt'].items())
+    message['_unique_id'] = 'eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee'
+    message.update(fields)
+    return driver_common.serialize_msg(message)
+
+
+class TestK2hr3Prefilter(unittest.TestCase):
+    """Tests the prefilter."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        self._conf = K2hr3Conf(conf_file_path)
+        self._endpoint = K2hr3NotificationEndpoint(self._conf)
+        self._prefilter = _K2hr3Prefilter([self._endpoint.prefilter_rule])
+
+    def tearDown(self):
+        """Tears down a test case."""
+        k2hr3_osnl.prefilter._PREFILTER = None
+        driver_common.deserialize_msg = k2hr3_osnl.prefilter._DESERIALIZE_MSG
+
+    def test_screen_matched(self):
+        """Checks if a message matching a filter is decoded."""
+        self.assertIsNone(self._prefilter.screen(_envelope()))
+        self.assertEqual(self._prefilter.stats, {'skipped': 0, 'decoded': 1})
+
+    def test_screen_skipped(self):
+        """Checks if the body of an irrelevant message is not decoded."""
+        message = self._prefilter.screen(_envelope('port.update.end'))
+        self.assertEqual(
+            message, {
+                'publisher_id': 'network.node1.example.com',
+                'event_type': 'port.update.end',
+                'priority': 'INFO',
+                '_unique_id': 'eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee',
+                'payload': {},
+            })
+        self.assertEqual(self._prefilter.stats, {'skipped': 1, 'decoded': 0})
+
+    def test_screen_escaped_value(self):
+        """Checks if an escaped value is decoded before matched."""
+        envelope = _envelope()
+        envelope['oslo.message'] = envelope['oslo.message'].replace(
+            '"port.delete.end"', '"port.\\u0064elete.end"')
+        self.assertIsNone(self._prefilter.screen(envelope))
+        envelope['oslo.message'] = envelope['oslo.message'].replace(
+            '"port.\\u0064elete.end"', '"port.\\u0075pdate.end"')
+        self.assertEqual(
+            self._prefilter.screen(envelope)['event_type'],
+            'port.update.end')
+
+    def test_screen_ambiguous_key(self):
+        """Checks if a body having a key twice is decoded."""
+        envelope = _envelope('port.update.end')
+        message = json.loads(envelope['oslo.message'])
+        message['payload']['event_type'] = 'port.delete.end'
+        envelope['oslo.message'] = json.dumps(message)
+        self.assertIsNone(self._prefilter.screen(envelope))
+
+    def test_screen_missing_key(self):
+        """Checks if a body without the priority is decoded."""
+        envelope = _envelope('port.update.end')
+        message = json.loads(envelope['oslo.message'])
+        del message['priority']
+        envelope['oslo.message'] = json.dumps(message)
+        self.assertIsNone(self._prefilter.screen(envelope))
+
+    def test_screen_not_envelope(self):
+        """Checks if messages of other formats are passed through."""
+        envelope = _envelope('port.update.end')
+        self.assertIsNone(self._prefilter.screen(
+            dict(envelope, **{'oslo.version': '1.0'})))
+        self.assertIsNone(self._prefilter.screen(
+            json.loads(envelope['oslo.message'])))
+        self.assertIsNone(self._prefilter.screen('port.update.end'))
+
+    def test_screen_match_all(self):
+        """Checks if the body is not scanned if a rule matches all."""
+        prefilter = _K2hr3Prefilter([(None, re.compile('^.*$'))])
+        with patch('k2hr3_osnl.prefilter._scan_message') as scan:
+            self.assertIsNone(prefilter.screen(_envelope('port.update.end')))
+            scan.assert_not_called()
+        self.assertEqual(prefilter.stats, {'skipped': 0, 'decoded': 1})
+        prefilter.update([self._endpoint.prefilter_rule])
+        self.assertIsNotNone(prefilter.screen(_envelope('port.update.end')))
+
+    def test_hook_reached(self):
+        """Checks if the rabbit driver decodes messages by the hook."""
+        self.assertFalse(_hook_reached())
+        driver_common.deserialize_msg = _deserialize_msg
+        self.assertTrue(_hook_reached())
+
+    def test_update_prefilter_hook_not_reached(self):
+        """Checks if the prefilter is disabled if the driver skips it."""
+        self._conf.oslo_messaging_notifications.prefilter = True
+        # a driver which bound the function at import time.
+        bound = types.SimpleNamespace(
+            deserialize_msg=driver_common.deserialize_msg)
+        with patch.object(impl_rabbit, 'rpc_common', bound), \
+                self.assertLogs('k2hr3_osnl.prefilter', 'ERROR'):
+            self.assertIsNone(_update_prefilter(
+                self._conf, [self._endpoint.prefilter_rule]))
+        self.assertIsNone(_get_prefilter())
+        self.assertIs(driver_common.deserialize_msg,
+                      k2hr3_osnl.prefilter._DESERIALIZE_MSG)
+
+    def test_update_prefilter(self):
+        """Checks if the driver calls the prefilter only if enabled."""
+        rules = [self._endpoint.prefilter_rule]
+        self.assertIsNone(_update_prefilter(self._conf, rules))
+        self._conf.oslo_messaging_notifications.prefilter = True
+        prefilter = _update_prefilter(self._conf, rules)
+        self.assertIs(prefilter, _get_prefilter())
+        self.assertIs(driver_common.deserialize_msg, _deserialize_msg)
+        self.assertEqual(_deserialize_msg(_envelope('port.update.end')),
+                         prefilter.screen(_envelope('port.update.end')))
+        self._conf.oslo_messaging_notifications.transport_url = 'kafka://'
+        self.assertIsNone(_update_prefilter(self._conf, rules))
+        envelope = _envelope('port.update.end')
+        self.assertEqual(_deserialize_msg(envelope),
+                         json.loads(envelope['oslo.message']))
+
+    def test_skipped_message_acknowledged(self):
+        """Checks if a skipped message is filtered out by the dispatcher."""
+        self._conf.oslo_messaging_notifications.prefilter = True
+        _update_prefilter(self._conf, [self._endpoint.prefilter_rule])
+        dispatcher = NotificationDispatcher([self._endpoint], None)
+        with patch.object(K2hr3NotificationEndpoint, '_handle',
+                          return_value=NotificationResult.HANDLED) as handle:
+            for event_type, called in (('port.update.end', False),
+                                       ('port.delete.end', True)):
+                message = RabbitMessage(
+                    MagicMock(payload=_envelope(event_type)))
+                self.assertEqual(message['payload'] != {}, called)
+                incoming = MagicMock(ctxt={}, message=dict(message))
+                self.assertEqual(dispatcher.dispatch(incoming),
+                                 NotificationResult.HANDLED)
+                self.assertEqual(handle.called, called)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
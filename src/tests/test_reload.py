@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the configuration reload on SIGHUP."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import os
+from pathlib import Path
+from os import path, sep
+import shutil
+import signal
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import k2hr3_osnl
+from k2hr3_osnl import _reload
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.exceptions import K2hr3NotificationEndpointError
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+class TestK2hr3Reload(unittest.TestCase):
+    """Tests the reload of the configuration."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._path = Path(self._tmpdir.name) / 'k2hr3-osnl.conf'
+        shutil.copyfile(conf_file_path, self._path)
+        self._conf = K2hr3Conf(self._path)
+
+    def tearDown(self):
+        """Tears down a test case."""
+        self._tmpdir.cleanup()
+
+    def _rewrite(self, old, new):
+        """Replaces a line of the configuration file."""
+        text = self._path.read_text(encoding='utf-8')
+        self.assertIn(old, text)
+        self._path.write_text(text.replace(old, new), encoding='utf-8')
+
+    def test_conf_path(self):
+        """Checks if the path of the configuration file is kept."""
+        self.assertEqual(self._conf.path, self._path)
+
+    def test_endpoint_reload(self):
+        """Checks if the filter rule is replaced in place."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        rule = endpoint.filter_rule
+        self.assertTrue(
+            rule.match({}, 'network.host1', 'port.delete.end', {}, {}))
+        self._rewrite(r'event_type = ^port\.delete\.end$',
+                      r'event_type = ^port\.update\.end$')
+        conf = K2hr3Conf(self._path)
+        endpoint.reload(conf)
+        self.assertIs(endpoint.filter_rule, rule)
+        self.assertIs(endpoint.conf, conf)
+        self.assertFalse(
+            rule.match({}, 'network.host1', 'port.delete.end', {}, {}))
+        self.assertTrue(
+            rule.match({}, 'network.host1', 'port.update.end', {}, {}))
+
+    def test_endpoint_reload_invalid(self):
+        """Checks if an invalid configuration leaves the endpoint as is."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        self._rewrite('api_url = https://localhost/v1/role',
+                      'api_url = localhost')
+        with self.assertRaises(K2hr3NotificationEndpointError):
+            endpoint.reload(K2hr3Conf(self._path))
+        self.assertIs(endpoint.conf, self._conf)
+
+    def test_reload_runtime_settings(self):
+        """Checks if runtime settings are applied without a new listener."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        listener = MagicMock()
+        self._rewrite('api_url = https://localhost/v1/role',
+                      'api_url = https://127.0.0.1/v1/role\n'
+                      'timeout_seconds = 5')
+        with patch('k2hr3_osnl._get_listener') as mock_method:
+            new_listener, conf = _reload([endpoint], listener, self._conf)
+        mock_method.assert_not_called()
+        self.assertIs(new_listener, listener)
+        self.assertIs(endpoint.conf, conf)
+        self.assertEqual(conf.k2hr3.api_url, 'https://127.0.0.1/v1/role')
+        self.assertEqual(conf.k2hr3.timeout_seconds, 5)
+        listener.stop.assert_not_called()
+
+    def test_reload_transport_settings(self):
+        """Checks if the listener is rebuilt if the topic changed."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        listener = MagicMock()
+        self._rewrite('topic = notifications', 'topic = versioned')
+        with patch('k2hr3_osnl._get_listener') as mock_method:
+            new_listener, conf = _reload([endpoint], listener, self._conf)
+        mock_method.assert_called_once_with([endpoint], conf)
+        self.assertIs(new_listener, mock_method.return_value)
+        new_listener.start.assert_called_once_with()
+        listener.stop.assert_called_once_with()
+        listener.wait.assert_called_once_with()
+        self.assertEqual(endpoint.target.topic, 'versioned')
+
+    def test_reload_broken_file(self):
+        """Checks if a broken file keeps the current configuration."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        listener = MagicMock()
+        self._rewrite('[k2hr3]', '[k2hr3]\ntimeout_seconds = abc')
+        new_listener, conf = _reload([endpoint], listener, self._conf)
+        self.assertIs(new_listener, listener)
+        self.assertIs(conf, self._conf)
+        self.assertIs(endpoint.conf, self._conf)
+
+    def test_reload_batch_mode_rejected(self):
+        """Checks if enabling batch_size requires a restart."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        listener = MagicMock()
+        self._rewrite('exchange = neutron', 'exchange = neutron\n'
+                      'batch_size = 10')
+        new_listener, conf = _reload([endpoint], listener, self._conf)
+        self.assertIs(new_listener, listener)
+        self.assertIs(conf, self._conf)
+        self.assertIs(endpoint.conf, self._conf)
+
+    def test_reload_rolls_back_endpoints(self):
+        """Checks if endpoints reloaded already are restored on an error."""
+        endpoints = [
+            K2hr3NotificationEndpoint(self._conf),
+            K2hr3NotificationEndpoint(self._conf)
+        ]
+        self._rewrite('topic = notifications', 'topic = versioned')
+        with patch.object(endpoints[1], 'reload',
+                          side_effect=K2hr3NotificationEndpointError('error')):
+            _, conf = _reload(endpoints, MagicMock(), self._conf)
+        self.assertIs(conf, self._conf)
+        self.assertIs(endpoints[0].conf, self._conf)
+        self.assertEqual(endpoints[0].target.topic, 'notifications')
+
+    def test_listen_reloads_on_sighup(self):
+        """Checks if listen reloads on SIGHUP and keeps listening."""
+        endpoint = K2hr3NotificationEndpoint(self._conf)
+        listener = MagicMock()
+        self._rewrite('[k2hr3]', '[k2hr3]\ntimeout_seconds = 5')
+
+        def start():
+            # handlers are set before the listener starts.
+            os.kill(os.getpid(), signal.SIGHUP)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+        listener.start.side_effect = start
+        with patch('k2hr3_osnl._get_listener', return_value=listener), \
+                patch('k2hr3_osnl._drain') as mock_drain:
+            self.assertEqual(k2hr3_osnl.listen([endpoint]), 0)
+        listener.start.assert_called_once_with()
+        self.assertEqual(endpoint.conf.k2hr3.timeout_seconds, 5)
+        mock_drain.assert_called_once_with(listener, endpoint.conf)
+        self.assertIs(signal.getsignal(signal.SIGHUP), signal.SIG_DFL)
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
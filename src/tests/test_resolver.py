@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the resolver cache of the k2hr3 api host."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import socket
+import time
+import unittest
+from unittest.mock import patch
+
+from k2hr3_osnl.resolver import _K2hr3Resolver, _get_resolver
+
+LOG = logging.getLogger(__name__)
+
+
+class TestK2hr3Resolver(unittest.TestCase):
+    """Tests the _K2hr3Resolver class."""
+
+    def test_resolver_cache_hit(self):
+        """Checks if the second lookup is served from the cache."""
+        resolver = _K2hr3Resolver(ttl=300)
+        with patch('socket.gethostbyname',
+                   return_value='127.0.0.1') as mock_method:
+            self.assertEqual(resolver.resolve('api.example.com'), '127.0.0.1')
+            self.assertEqual(resolver.resolve('api.example.com'), '127.0.0.1')
+        mock_method.assert_called_once_with('api.example.com')
+        self.assertEqual(resolver.stats['hits'], 1)
+        self.assertEqual(resolver.stats['misses'], 1)
+
+    def test_resolver_ip_address(self):
+        """Checks if an ip address is resolved without a lookup."""
+        resolver = _K2hr3Resolver(ttl=300)
+        with patch('socket.gethostbyname') as mock_method:
+            self.assertEqual(resolver.resolve('127.0.0.1'), '127.0.0.1')
+            self.assertEqual(resolver.resolve('::1'), '::1')
+        mock_method.assert_not_called()
+
+    def test_resolver_ttl_zero(self):
+        """Checks if ttl 0 disables the cache."""
+        resolver = _K2hr3Resolver(ttl=0)
+        with patch('socket.gethostbyname',
+                   return_value='127.0.0.1') as mock_method:
+            resolver.resolve('api.example.com')
+            resolver.resolve('api.example.com')
+        self.assertEqual(mock_method.call_count, 2)
+
+    def test_resolver_failure_cached(self):
+        """Checks if a failure is counted and not retried on every call."""
+        resolver = _K2hr3Resolver(ttl=300)
+        with patch('socket.gethostbyname',
+                   side_effect=socket.gaierror(-2, 'Name or service not known')
+                   ) as mock_method:
+            for _ in range(2):
+                with self.assertRaises(OSError):
+                    resolver.resolve('api.example.com')
+        mock_method.assert_called_once_with('api.example.com')
+        self.assertEqual(resolver.stats['failures'], 1)
+
+    def test_resolver_refresh_in_background(self):
+        """Checks if an expired entry is answered and refreshed."""
+        resolver = _K2hr3Resolver(ttl=300)
+        with patch('socket.gethostbyname', return_value='127.0.0.1'):
+            resolver.resolve('api.example.com')
+        # expires the entry.
+        resolver._cache['api.example.com'] = ('127.0.0.1', None, 0)
+        with patch('socket.gethostbyname', return_value='127.0.0.2'):
+            self.assertEqual(resolver.resolve('api.example.com'), '127.0.0.1')
+            for _ in range(100):
+                if not resolver._refreshing:
+                    break
+                time.sleep(0.01)
+        self.assertEqual(resolver.resolve('api.example.com'), '127.0.0.2')
+        self.assertEqual(resolver.stats['refreshes'], 1)
+
+    def test_resolver_keeps_stale_address_on_failure(self):
+        """Checks if the last known address survives a failed refresh."""
+        resolver = _K2hr3Resolver(ttl=300)
+        with patch('socket.gethostbyname', return_value='127.0.0.1'):
+            resolver.resolve('api.example.com')
+        with patch('socket.gethostbyname', side_effect=socket.gaierror()):
+            resolver._refresh('api.example.com')
+        self.assertEqual(resolver.resolve('api.example.com'), '127.0.0.1')
+        self.assertEqual(resolver.stats['failures'], 1)
+
+    def test_get_resolver(self):
+        """Checks if the resolver is shared in a process."""
+        self.assertIs(_get_resolver(), _get_resolver())
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the retry scheduler of requests to the k2hr3 api."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+from pathlib import Path
+from os import path, sep
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.retry import (_backoff_delay, _get_retry_scheduler,
+                              _K2hr3RetryScheduler)
+from k2hr3_osnl.useragent import _AgentError, _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+def _wait_until(predicate, timeout=5.0):
+    """Waits until the predicate returns True."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestK2hr3Retry(unittest.TestCase):
+    """Tests the retry scheduler."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        self._conf = K2hr3Conf(conf_file_path)
+        self._conf.k2hr3.retry_interval_seconds = 2
+        self._conf.k2hr3.retry_max_interval_seconds = 10
+        self._conf.k2hr3.retry_jitter = False
+
+    def test_backoff_delay_exponential(self):
+        """Checks if the interval doubles up to the max interval."""
+        delays = [_backoff_delay(n, self._conf) for n in range(1, 6)]
+        self.assertEqual(delays, [2, 4, 8, 10, 10])
+
+    def test_backoff_delay_jitter(self):
+        """Checks if the jitter keeps the interval in its upper half."""
+        self._conf.k2hr3.retry_jitter = True
+        for _ in range(100):
+            delay = _backoff_delay(3, self._conf)
+            self.assertTrue(4 <= delay <= 8)
+
+    def test_scheduler_runs_task_later(self):
+        """Checks if a task runs after its delay without blocking."""
+        scheduler = _K2hr3RetryScheduler(max_inflight=10, workers=2)
+        done = threading.Event()
+        start = time.monotonic()
+        self.assertTrue(scheduler.schedule(0.1, done.set))
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(scheduler.inflight, 1)
+        self.assertTrue(done.wait(5))
+        self.assertTrue(_wait_until(lambda: scheduler.inflight == 0))
+        self.assertEqual(scheduler.stats['executed'], 1)
+        self.assertEqual(scheduler.stop(), [])
+
+    def test_scheduler_order(self):
+        """Checks if tasks run in the order they are due."""
+        scheduler = _K2hr3RetryScheduler(max_inflight=10, workers=1)
+        order = []
+        scheduler.schedule(0.2, lambda: order.append(2))
+        scheduler.schedule(0.1, lambda: order.append(1))
+        self.assertTrue(_wait_until(lambda: len(order) == 2))
+        self.assertEqual(order, [1, 2])
+        scheduler.stop()
+
+    def test_scheduler_max_inflight(self):
+        """Checks if a task is rejected when too many are in flight."""
+        scheduler = _K2hr3RetryScheduler(max_inflight=2)
+        self.assertTrue(scheduler.schedule(60, lambda: None))
+        self.assertTrue(scheduler.schedule(60, lambda: None))
+        self.assertFalse(scheduler.schedule(60, lambda: None))
+        self.assertEqual(scheduler.stats['rejected'], 1)
+        self.assertEqual(len(scheduler.stop()), 2)
+        self.assertEqual(scheduler.inflight, 0)
+
+    def test_get_retry_scheduler(self):
+        """Checks if the scheduler is shared in a process."""
+        scheduler = _get_retry_scheduler(self._conf)
+        self.assertIs(scheduler, _get_retry_scheduler(self._conf))
+        self.assertEqual(scheduler.max_inflight,
+                         self._conf.k2hr3.max_inflight_retries)
+
+    def test_useragent_deferred_on_temporary_error(self):
+        """Checks if a temporary error schedules a retry and returns."""
+        self._conf.k2hr3.retry_interval_seconds = 0
+        scheduler = _K2hr3RetryScheduler(max_inflight=10)
+        agent = _K2hr3UserAgent(self._conf)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch.object(_K2hr3UserAgent, '_send_once',
+                             side_effect=[_AgentError.TEMP, _AgentError.TEMP,
+                                          _AgentError.NONE]) as mock_method:
+            self.assertTrue(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+            self.assertTrue(agent.deferred)
+            self.assertTrue(
+                _wait_until(lambda: scheduler.stats['executed'] == 2))
+        self.assertEqual(mock_method.call_count, 3)
+        self.assertEqual(scheduler.stop(), [])
+
+    def test_useragent_logs_remaining_retries(self):
+        """Checks if the remaining retries are logged."""
+        self._conf.k2hr3.max_retries = 3
+        scheduler = _K2hr3RetryScheduler(max_inflight=10)
+        agent = _K2hr3UserAgent(self._conf)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch.object(_K2hr3UserAgent, '_send_once',
+                             return_value=_AgentError.TEMP), \
+                self.assertLogs('k2hr3_osnl.useragent',
+                                level=logging.WARNING) as logs:
+            agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                 'DELETE')
+        self.assertIn('remaining retries=3', logs.output[-1])
+        self.assertEqual(len(scheduler.stop()), 1)
+
+    def test_useragent_gives_up_after_max_retries(self):
+        """Checks if retries stop at max_retries."""
+        self._conf.k2hr3.retry_interval_seconds = 0
+        self._conf.k2hr3.max_retries = 2
+        scheduler = _K2hr3RetryScheduler(max_inflight=10)
+        agent = _K2hr3UserAgent(self._conf)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch.object(_K2hr3UserAgent, '_send_once',
+                             return_value=_AgentError.TEMP) as mock_method:
+            self.assertTrue(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+            self.assertTrue(
+                _wait_until(lambda: scheduler.stats['executed'] == 2))
+            time.sleep(0.1)
+        self.assertEqual(mock_method.call_count, 3)
+        self.assertEqual(scheduler.inflight, 0)
+        scheduler.stop()
+
+    def test_useragent_requeue_on_error(self):
+        """Checks if no retry is scheduled when the broker requeues."""
+        self._conf.k2hr3.requeue_on_error = True
+        scheduler = _K2hr3RetryScheduler(max_inflight=10)
+        agent = _K2hr3UserAgent(self._conf)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch.object(_K2hr3UserAgent, '_send_once',
+                             return_value=_AgentError.TEMP):
+            self.assertFalse(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+        self.assertFalse(agent.deferred)
+        self.assertEqual(scheduler.stats['scheduled'], 0)
+
+    def test_useragent_too_many_retries(self):
+        """Checks if the request fails when the scheduler is full."""
+        scheduler = _K2hr3RetryScheduler(max_inflight=1)
+        scheduler.schedule(60, lambda: None)
+        agent = _K2hr3UserAgent(self._conf)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch.object(_K2hr3UserAgent, '_send_once',
+                             return_value=_AgentError.TEMP):
+            self.assertFalse(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+        self.assertEqual(agent.error, 'too many retries in flight.')
+        scheduler.stop()
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
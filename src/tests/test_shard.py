@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the shards serializing deliveries of an instance."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+from pathlib import Path
+from os import path, sep
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.endpoint import (K2hr3BatchNotificationEndpoint,
+                                 K2hr3NotificationEndpoint)
+from k2hr3_osnl.shard import (_K2hr3ShardDispatcher, _get_shard_dispatcher,
+                              _stop_shard_dispatcher)
+from k2hr3_osnl.useragent import _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+HANDLED = 'handled'
+REQUEUE = 'requeue'
+CUK = '12345678-1234-5678-1234-567812345678'
+
+
+class TestK2hr3ShardDispatcher(unittest.TestCase):
+    """Tests the _K2hr3ShardDispatcher class."""
+
+    def test_shard_stable_and_balanced(self):
+        """Checks if keys are spread over shards by a stable hash."""
+        shards = _K2hr3ShardDispatcher(4)
+        another = _K2hr3ShardDispatcher(4)
+        counts = [0] * 4
+        for key in (f'instance-{i}' for i in range(4000)):
+            shard = shards.shard(key)
+            self.assertEqual(shard, another.shard(key))
+            counts[shard] += 1
+        for count in counts:
+            self.assertGreater(count, 600)
+
+    def test_shard_consistent(self):
+        """Checks if adding a shard moves only a part of keys."""
+        four = _K2hr3ShardDispatcher(4)
+        five = _K2hr3ShardDispatcher(5)
+        keys = [f'instance-{i}' for i in range(4000)]
+        moved = [key for key in keys if four.shard(key) != five.shard(key)]
+        self.assertLess(len(moved), 4000 * 0.35)
+        for key in moved:
+            self.assertEqual(five.shard(key), 4)
+
+    def test_same_key_serialized(self):
+        """Checks if tasks of a key run one by one in the order."""
+        shards = _K2hr3ShardDispatcher(4)
+        running = []
+        order = []
+
+        def task(i):
+            running.append(i)
+            self.assertEqual(len(running), 1)
+            time.sleep(0.01)
+            order.append(i)
+            running.remove(i)
+            return i
+
+        futures = [shards.submit(CUK, lambda i=i: task(i)) for i in range(5)]
+        self.assertEqual([f.result(timeout=5) for f in futures],
+                         list(range(5)))
+        self.assertEqual(order, list(range(5)))
+        shards.stop()
+
+    def test_different_shards_parallel(self):
+        """Checks if tasks of different shards run in parallel."""
+        shards = _K2hr3ShardDispatcher(4)
+        keys = {}
+        i = 0
+        while len(keys) < 2:
+            keys.setdefault(shards.shard(f'instance-{i}'), f'instance-{i}')
+            i += 1
+        barrier = threading.Barrier(2, timeout=5)
+        futures = [shards.submit(key, barrier.wait) for key in keys.values()]
+        for future in futures:
+            future.result(timeout=5)
+        shards.stop()
+
+    def test_depths(self):
+        """Checks if the depth of a shard counts waiting tasks."""
+        shards = _K2hr3ShardDispatcher(2)
+        event = threading.Event()
+        futures = [shards.submit(CUK, event.wait) for _ in range(3)]
+        depths = shards.depths
+        self.assertEqual(depths[shards.shard(CUK)], 3)
+        self.assertEqual(sum(depths), 3)
+        event.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(shards.depths, [0, 0])
+        self.assertEqual(shards.stats['completed'], 3)
+        shards.stop()
+
+    def test_stop_without_wait(self):
+        """Checks if stop cancels waiting tasks without waiting."""
+        shards = _K2hr3ShardDispatcher(2)
+        event = threading.Event()
+        running = shards.submit(CUK, event.wait)
+        waiting = shards.submit(CUK, event.wait)
+        shards.stop(wait=False)
+        self.assertTrue(waiting.cancelled())
+        self.assertFalse(running.done())
+        event.set()
+        self.assertTrue(running.result(timeout=5))
+
+    def test_run_raises(self):
+        """Checks if run raises the exception of the task."""
+        shards = _K2hr3ShardDispatcher(2)
+        with self.assertRaises(ZeroDivisionError):
+            shards.run(CUK, lambda: 1 / 0)
+        self.assertEqual(sum(shards.depths), 0)
+        shards.stop()
+
+    def test_get_shard_dispatcher(self):
+        """Checks if the dispatcher is shared and disabled by 0."""
+        conf = K2hr3Conf(conf_file_path)
+        self.assertIsNone(_get_shard_dispatcher(conf))
+        conf.k2hr3.shards = 2
+        shards = _get_shard_dispatcher(conf)
+        self.assertIs(shards, _get_shard_dispatcher(conf))
+        self.assertEqual(shards.shards, 2)
+        _stop_shard_dispatcher()
+
+    def test_get_shard_dispatcher_resized(self):
+        """Checks if the old dispatcher is stopped without the lock."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.shards = 2
+        old = _get_shard_dispatcher(conf)
+        event = threading.Event()
+        future = old.submit(CUK, event.wait)
+        conf.k2hr3.shards = 3
+        resized = threading.Thread(target=_get_shard_dispatcher, args=(conf,))
+        resized.start()
+        time.sleep(0.1)
+        # the other threads get the new one while the old one drains.
+        got = []
+        getter = threading.Thread(
+            target=lambda: got.append(_get_shard_dispatcher(conf)))
+        getter.start()
+        getter.join(1)
+        try:
+            self.assertEqual([shards.shards for shards in got], [3])
+            self.assertTrue(resized.is_alive())
+        finally:
+            event.set()
+        resized.join(5)
+        self.assertTrue(future.result(timeout=5))
+        _stop_shard_dispatcher()
+
+
+class TestK2hr3EndpointShards(unittest.TestCase):
+    """Tests the endpoints deliver in shards."""
+
+    def tearDown(self):
+        """Stops the shards."""
+        _stop_shard_dispatcher()
+
+    def test_endpoint_duplicate_waits_and_skipped(self):
+        """Checks if a duplicate waiting for the first one is skipped."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.shards = 2
+        endpoint = K2hr3NotificationEndpoint(conf)
+
+        def send():
+            time.sleep(0.2)
+            return True
+
+        with patch.object(_K2hr3UserAgent, 'send',
+                          side_effect=send) as mock_method:
+            threads = [
+                threading.Thread(target=endpoint.info,
+                                 args=({}, 'compute.localhost',
+                                       'compute.instance.delete.end',
+                                       {'instance_id': CUK}, {}))
+                for _ in range(2)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        mock_method.assert_called_once_with()
+        self.assertEqual(endpoint.shards.stats['completed'], 2)
+
+    def test_batch_endpoint_shards(self):
+        """Checks if a batch is delivered in shards."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.shards = 2
+        conf.k2hr3.bulk_delete = False
+        endpoint = K2hr3BatchNotificationEndpoint(conf)
+        messages = [{
+            'ctxt': {},
+            'publisher_id': 'compute.localhost',
+            'event_type': 'compute.instance.delete.end',
+            'payload': {'instance_id': f'cuk-{i}'},
+            'metadata': {},
+        } for i in range(4)]
+        with patch.object(
+                K2hr3NotificationEndpoint,
+                '_K2hr3NotificationEndpoint__call_r3api',
+                side_effect=lambda params: (REQUEUE if params['cuk'] == 'cuk-2'
+                                            else HANDLED)):
+            results = endpoint.info(messages)
+        self.assertEqual(results, [HANDLED, HANDLED, REQUEUE, HANDLED])
+        self.assertEqual(endpoint.shards.stats['completed'], 4)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
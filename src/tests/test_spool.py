@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the spool of failed requests."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+from pathlib import Path
+from os import path, sep
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.exceptions import _K2hr3UserAgentError
+from k2hr3_osnl.retry import _K2hr3RetryScheduler
+from k2hr3_osnl.spool import (_K2hr3Spool, _get_spool, _read_records,
+                              _stop_spool)
+from k2hr3_osnl.useragent import (_AgentError, _K2hr3RetryTask,
+                                  _K2hr3UserAgent, _replay_spooled)
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+CUK = '12345678-1234-5678-1234-567812345678'
+
+
+class _ErrorHandler(BaseHTTPRequestHandler):
+    """A k2hr3 api stub which replies the status code of the server."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_DELETE(self):  # noqa: N802 pylint: disable=invalid-name
+        """Handles a DELETE request."""
+        self.send_response(self.server.code)  # type: ignore
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Suppresses access logs."""
+
+
+class TestK2hr3Spool(unittest.TestCase):
+    """Tests the spool and the replayer."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        _stop_spool()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._conf = K2hr3Conf(conf_file_path)
+        self._conf.k2hr3.spool_dir = self._tmpdir.name
+
+    def tearDown(self):
+        """Tears down a test case."""
+        _stop_spool()
+        self._tmpdir.cleanup()
+
+    def _segments(self):
+        """Returns segment paths."""
+        return sorted(
+            os.path.join(self._tmpdir.name, name)
+            for name in os.listdir(self._tmpdir.name))
+
+    def _replay(self, spool, replay, count):
+        """Runs the replayer until count records are replayed."""
+        spool.start(replay)
+        deadline = time.monotonic() + 10
+        while spool.stats['replayed'] < count and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        spool.stop()
+
+    def test_append_and_read(self):
+        """Checks if records are read back from a segment."""
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        self.assertTrue(spool.append({'cuk': 'a'}))
+        self.assertTrue(spool.append({'cuk': 'b'}))
+        spool.stop()
+        segments = self._segments()
+        self.assertEqual(len(segments), 1)
+        with open(segments[0], 'rb') as f:
+            data = f.read()
+        self.assertEqual(spool.size, len(data))
+        self.assertEqual([r['cuk'] for r in _read_records(data, 'seg')],
+                         ['a', 'b'])
+
+    def test_read_torn_and_broken(self):
+        """Checks if a torn or broken record ends the segment."""
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        spool.append({'cuk': 'a'})
+        spool.append({'cuk': 'b'})
+        spool.stop()
+        with open(self._segments()[0], 'rb') as f:
+            data = f.read()
+        with self.assertLogs('k2hr3_osnl.spool', 'WARNING'):
+            records = list(_read_records(data[:-3], 'seg'))
+        self.assertEqual([r['cuk'] for r in records], ['a'])
+        broken = bytearray(data)
+        broken[-2] ^= 0xff
+        with self.assertLogs('k2hr3_osnl.spool', 'ERROR'):
+            records = list(_read_records(bytes(broken), 'seg'))
+        self.assertEqual([r['cuk'] for r in records], ['a'])
+
+    def test_replay_quarantines_broken_segment(self):
+        """Checks if a segment broken in the middle is kept for recovery."""
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        for cuk in ('a', 'b', 'c'):
+            spool.append({'cuk': cuk})
+        spool.stop()
+        path = self._segments()[0]
+        with open(path, 'rb') as f:
+            data = f.read()
+        # breaks the payload of b.
+        offset = len(data) // 2
+        broken = bytearray(data)
+        broken[offset] ^= 0xff
+        with open(path, 'wb') as f:
+            f.write(broken)
+        sent = []
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        with self.assertLogs('k2hr3_osnl.spool', 'ERROR') as cm:
+            self._replay(spool,
+                         lambda conf, record: sent.append(record) or True, 1)
+        self.assertEqual(sent, [{'cuk': 'a'}])
+        self.assertIn(f'quarantined {path}', '\n'.join(cm.output))
+        self.assertEqual(self._segments(), [path + '.corrupt'])
+        with open(path + '.corrupt', 'rb') as f:
+            self.assertEqual(f.read(), bytes(broken))
+        self.assertEqual(spool.size, 0)
+
+    def test_concurrent_appends(self):
+        """Checks if records of threads share fsync calls."""
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        real_fsync = os.fsync
+
+        def slow_fsync(fd):
+            time.sleep(0.01)
+            real_fsync(fd)
+
+        with patch('k2hr3_osnl.spool.os.fsync',
+                   side_effect=slow_fsync) as fsync:
+            threads = [
+                threading.Thread(target=spool.append, args=({'cuk': i}, ))
+                for i in range(20)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertLess(fsync.call_count, 20)
+        spool.stop()
+        with open(self._segments()[0], 'rb') as f:
+            records = list(_read_records(f.read(), 'seg'))
+        self.assertEqual(sorted(r['cuk'] for r in records), list(range(20)))
+
+    def test_replay_with_backoff(self):
+        """Checks if a failed record is sent again before the next one."""
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        spool.append({'cuk': 'a'})
+        spool.append({'cuk': 'b'})
+        sent = []
+
+        def replay(_, record):
+            sent.append(record['cuk'])
+            return len(sent) > 1  # fails the first time.
+
+        with patch('k2hr3_osnl.spool._backoff_delay', return_value=0.01):
+            self._replay(spool, replay, 2)
+        self.assertEqual(sent, ['a', 'a', 'b'])
+        self.assertEqual(spool.stats['replayed'], 2)
+        self.assertEqual(self._segments(), [])
+
+    def test_replay_skips_locked_segment(self):
+        """Checks if a segment another spool writes to is not replayed."""
+        writer = _K2hr3Spool(self._tmpdir.name, self._conf)
+        writer.append({'cuk': 'a'})
+        spool = _K2hr3Spool(self._tmpdir.name, self._conf)
+        sent = []
+        spool.start(lambda conf, record: sent.append(record) or True)
+        time.sleep(0.1)
+        self.assertEqual(sent, [])
+        writer.stop()  # closes the segment.
+        deadline = time.monotonic() + 10
+        while not sent and time.monotonic() < deadline:
+            time.sleep(0.01)
+        spool.stop()
+        self.assertEqual(sent, [{'cuk': 'a'}])
+
+    def test_get_spool(self):
+        """Checks if the spool is disabled by an empty spool_dir."""
+        spool = _get_spool(self._conf)
+        self.assertIs(_get_spool(self._conf), spool)
+        self.assertEqual(spool.path, self._tmpdir.name)
+        _stop_spool()
+        self._conf.k2hr3.spool_dir = ''
+        self.assertIsNone(_get_spool(self._conf))
+
+    def test_useragent_spools_without_retries(self):
+        """Checks if a temporary failure is spooled without retries."""
+        self._conf.k2hr3.max_retries = 0
+        agent = _K2hr3UserAgent(self._conf)
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.TEMP):
+            self.assertTrue(
+                agent._send_internal(agent.url, {'cuk': CUK}, agent.headers,
+                                     'DELETE'))
+        self.assertTrue(agent.deferred)
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+
+    def _send(self, url):
+        """Sends a request to the url without retries."""
+        self._conf.k2hr3.api_url = url
+        self._conf.k2hr3.max_retries = 0
+        self._conf.k2hr3.requeue_on_error = False
+        agent = _K2hr3UserAgent(self._conf)
+        agent.instance_id = CUK
+        agent.ips = ['127.0.0.1']
+        return agent._send_internal(agent.url, agent.params, agent.headers,
+                                    agent.method), agent
+
+    def test_useragent_spools_connection_refused(self):
+        """Checks if a request to a stopped api is spooled."""
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        success, agent = self._send(f'http://127.0.0.1:{port}/v1/role')
+        self.assertTrue(success)
+        self.assertTrue(agent.deferred)
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+
+    def _send_to_stub(self, code):
+        """Sends a request to an api stub replying the status code."""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _ErrorHandler)
+        server.code = code  # type: ignore
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            return self._send(
+                f'http://127.0.0.1:{server.server_address[1]}/v1/role')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_useragent_spools_server_error(self):
+        """Checks if a request failed by a server error is spooled."""
+        success, agent = self._send_to_stub(503)
+        self.assertTrue(success)
+        self.assertTrue(agent.deferred)
+        self.assertEqual(agent.code, 503)
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+
+    def test_useragent_no_spool_on_client_error(self):
+        """Checks if a request rejected by the api is not spooled."""
+        success, agent = self._send_to_stub(404)
+        self.assertFalse(success)
+        self.assertEqual(agent.code, 404)
+        self.assertFalse(agent.deferred)
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 0)
+
+    def test_useragent_spools_when_scheduler_full(self):
+        """Checks if a request is spooled when the scheduler is full."""
+        scheduler = _K2hr3RetryScheduler(max_inflight=0)
+        agent = _K2hr3UserAgent(self._conf)
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch.object(_K2hr3UserAgent, '_send_once',
+                             return_value=_AgentError.TEMP):
+            self.assertTrue(
+                agent._send_internal(agent.url, {'cuk': CUK}, agent.headers,
+                                     'DELETE'))
+        self.assertEqual(agent.error, 'too many retries in flight.')
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+
+    def test_useragent_no_spool_on_requeue(self):
+        """Checks if nothing is spooled when the broker requeues."""
+        self._conf.k2hr3.max_retries = 0
+        self._conf.k2hr3.requeue_on_error = True
+        agent = _K2hr3UserAgent(self._conf)
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.TEMP):
+            self.assertFalse(
+                agent._send_internal(agent.url, {'cuk': CUK}, agent.headers,
+                                     'DELETE'))
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 0)
+
+    def test_retry_task_spools_on_give_up(self):
+        """Checks if the last failed retry is spooled and replayed."""
+        self._conf.k2hr3.max_retries = 1
+        task = _K2hr3RetryTask(self._conf, False, 'https://localhost/v1/role',
+                               {'cuk': CUK, 'extra': 'openstack-auto-v1'},
+                               {'User-Agent': 'test'}, 'DELETE')
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.TEMP):
+            task()
+        spool = _get_spool(self._conf)
+        self.assertEqual(spool.stats['spooled'], 1)
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.NONE) as send_once:
+            self._replay(spool, _replay_spooled, 1)
+        send_once.assert_called_once_with('https://localhost/v1/role', {
+            'cuk': CUK,
+            'extra': 'openstack-auto-v1'
+        }, {'User-Agent': 'test'}, 'DELETE')
+        self.assertEqual(self._segments(), [])
+
+    def test_retry_task_agent_error(self):
+        """Checks if a task failed to build an agent is retried and spooled."""
+        self._conf.k2hr3.max_retries = 2
+        scheduler = _K2hr3RetryScheduler(max_inflight=10)
+        task = _K2hr3RetryTask(self._conf, False, 'https://localhost/v1/role',
+                               {'cuk': CUK}, {}, 'DELETE')
+        with patch('k2hr3_osnl.useragent._get_retry_scheduler',
+                   return_value=scheduler), \
+                patch('k2hr3_osnl.useragent._get_agent',
+                      side_effect=_K2hr3UserAgentError('unresolved')):
+            task()
+            self.assertEqual(scheduler.stop(), [task])
+            self.assertEqual(task.attempt, 2)
+            task()
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+
+    def test_retry_task_spools_fatal(self):
+        """Checks if a retry failed by a fatal error is spooled."""
+        self._conf.k2hr3.max_retries = 3
+        task = _K2hr3RetryTask(self._conf, False, 'https://localhost/v1/role',
+                               {'cuk': CUK}, {}, 'DELETE')
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.FATAL):
+            task()
+        self.assertEqual(task.attempt, 1)
+        self.assertEqual(_get_spool(self._conf).stats['spooled'], 1)
+
+    def test_replay_spooled(self):
+        """Checks if only a temporary failure is sent again."""
+        data = _K2hr3RetryTask(self._conf, False, 'https://localhost/v1/role',
+                               {'cuk': CUK}, {}, 'DELETE').to_dict()
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.TEMP):
+            self.assertFalse(_replay_spooled(self._conf, data))
+        with patch.object(_K2hr3UserAgent, '_send_once',
+                          return_value=_AgentError.FATAL):
+            self.assertTrue(_replay_spooled(self._conf, data))
+        self.assertTrue(_replay_spooled(self._conf, {'url': 'x'}))
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
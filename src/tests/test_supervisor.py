@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the supervisor of worker processes."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+from k2hr3_osnl.supervisor import _K2hr3Supervisor
+
+LOG = logging.getLogger(__name__)
+
+
+def _sleep():
+    """A worker which runs until a signal arrives."""
+    while True:
+        time.sleep(0.01)
+
+
+def _fail():
+    """A worker which fails soon."""
+    return 1
+
+
+class TestK2hr3Supervisor(unittest.TestCase):
+    """Tests the _K2hr3Supervisor class."""
+
+    def _run(self, supervisor, seconds, action=None):
+        """Runs the supervisor for seconds."""
+        def stop():
+            time.sleep(seconds / 2)
+            if action is not None:
+                action()
+            time.sleep(seconds / 2)
+            supervisor.stop()
+        thread = threading.Thread(target=stop)
+        thread.start()
+        try:
+            return supervisor.run()
+        finally:
+            thread.join()
+
+    def test_workers_started_and_stopped(self):
+        """Checks if workers run until the supervisor stops."""
+        supervisor = _K2hr3Supervisor(2, _sleep, stats_interval=0.05)
+        self.assertEqual(self._run(supervisor, 1.0), 0)
+        stats = supervisor.stats
+        self.assertEqual(sorted(stats.keys()), [0, 1])
+        pids = set()
+        for worker in stats.values():
+            self.assertIsNone(worker['pid'])
+            self.assertEqual(worker['restarts'], 0)
+            # KeyboardInterrupt by SIGTERM stops the worker normally.
+            self.assertEqual(worker['exitcode'], 0)
+            pids.add(worker['report']['pid'])
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_worker_restarted_with_backoff(self):
+        """Checks if a failed worker is restarted with a backoff."""
+        supervisor = _K2hr3Supervisor(1, _fail, restart_interval=0.1,
+                                      restart_max_interval=0.2)
+        self._run(supervisor, 1.2)
+        worker = supervisor.stats[0]
+        self.assertEqual(worker['exitcode'], 1)
+        # 0.1, 0.2, 0.2, ... seconds between restarts.
+        self.assertGreaterEqual(worker['restarts'], 3)
+        self.assertLessEqual(worker['restarts'], 8)
+
+    def test_worker_stats(self):
+        """Checks if the stats of workers are gathered."""
+        supervisor = _K2hr3Supervisor(1, _sleep,
+                                      stats=lambda: {'handled': 10},
+                                      stats_interval=0.05)
+        self._run(supervisor, 0.6)
+        report = supervisor.stats[0]['report']
+        self.assertEqual(report['handled'], 10)
+        self.assertIn('maxrss', report)
+
+    def test_sighup_forwarded(self):
+        """Checks if SIGHUP is forwarded to the workers."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            marker = os.path.join(tmpdir, 'hangup')
+
+            def target():
+                def on_hangup(signum, frame):
+                    with open(marker, 'a', encoding='utf-8') as f:
+                        f.write(f'{os.getpid()}\n')
+                signal.signal(signal.SIGHUP, on_hangup)
+                _sleep()
+
+            supervisor = _K2hr3Supervisor(2, target)
+            self._run(supervisor, 1.0,
+                      lambda: os.kill(os.getpid(), signal.SIGHUP))
+            with open(marker, encoding='utf-8') as f:
+                self.assertEqual(len(f.read().split()), 2)
+        self.assertEqual(signal.getsignal(signal.SIGHUP), signal.SIG_DFL)
+
+    def test_worker_killed_after_timeout(self):
+        """Checks if a worker ignoring SIGTERM is killed."""
+        def target():
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            _sleep()
+
+        supervisor = _K2hr3Supervisor(1, target, shutdown_timeout=0.2)
+        self._run(supervisor, 0.6)
+        self.assertEqual(supervisor.stats[0]['exitcode'], -signal.SIGKILL)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
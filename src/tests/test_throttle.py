@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the rate limit and the in-flight cap of requests."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+from pathlib import Path
+from os import path, sep
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import k2hr3_osnl.throttle
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.metrics import _THROTTLE_SECONDS
+from k2hr3_osnl.throttle import (_K2hr3Throttle, _get_throttle,
+                                 _update_throttle)
+from k2hr3_osnl.useragent import _K2hr3UserAgent
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+def _count():
+    """Returns the number of observed waits."""
+    for name, _, value in _THROTTLE_SECONDS.collect()['samples']:
+        if name.endswith('_count'):
+            return value
+    return 0
+
+
+class TestK2hr3Throttle(unittest.TestCase):
+    """Tests the throttle."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        k2hr3_osnl.throttle._THROTTLE = None
+        self._conf = K2hr3Conf(conf_file_path)
+
+    def tearDown(self):
+        """Tears down a test case."""
+        k2hr3_osnl.throttle._THROTTLE = None
+
+    def test_rate_limit(self):
+        """Checks if callers wait for their reserved tokens."""
+        with patch('k2hr3_osnl.throttle.time.monotonic',
+                   return_value=100.0), \
+                patch('k2hr3_osnl.throttle.time.sleep') as sleep:
+            throttle = _K2hr3Throttle(rate=10, burst=2, max_inflight=0)
+            for _ in range(4):
+                throttle.acquire()
+                throttle.release()
+        delays = [call.args[0] for call in sleep.call_args_list]
+        self.assertEqual(len(delays), 2)
+        self.assertAlmostEqual(delays[0], 0.1)
+        self.assertAlmostEqual(delays[1], 0.2)
+
+    def test_rate_limit_refill(self):
+        """Checks if tokens are added for the time elapsed."""
+        with patch('k2hr3_osnl.throttle.time.monotonic') as monotonic:
+            monotonic.return_value = 100.0
+            throttle = _K2hr3Throttle(rate=10, burst=2, max_inflight=0)
+            with patch('k2hr3_osnl.throttle.time.sleep') as sleep:
+                throttle.acquire(2)
+                monotonic.return_value = 100.2
+                throttle.acquire(2)
+                monotonic.return_value = 100.25
+                throttle.acquire()
+        sleep.assert_called_once()
+        self.assertAlmostEqual(sleep.call_args.args[0], 0.05)
+
+    def test_max_inflight(self):
+        """Checks if a caller waits for a request in flight."""
+        throttle = _K2hr3Throttle(rate=0, burst=1, max_inflight=1)
+        observed = _count()
+        throttle.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            throttle.acquire()
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        throttle.release()
+        self.assertTrue(acquired.wait(10))
+        thread.join()
+        self.assertEqual(throttle.inflight, 1)
+        self.assertEqual(_count(), observed + 2)
+
+    def test_update_wakes_waiters(self):
+        """Checks if raising the cap lets a waiting caller through."""
+        throttle = _K2hr3Throttle(rate=0, burst=1, max_inflight=1)
+        throttle.acquire()
+        thread = threading.Thread(target=throttle.acquire)
+        thread.start()
+        time.sleep(0.05)
+        throttle.update(rate=0, burst=1, max_inflight=2)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(throttle.inflight, 2)
+
+    def test_update_lowers_cap_under_batch(self):
+        """Checks if a batch over a lowered cap is sent once others end."""
+        throttle = _K2hr3Throttle(rate=0, burst=1, max_inflight=4)
+        throttle.acquire(2)
+        thread = threading.Thread(target=throttle.acquire, args=(3, ))
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+        throttle.update(rate=0, burst=1, max_inflight=2)
+        throttle.release(2)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(throttle.inflight, 3)
+        # the others wait for the batch.
+        thread = threading.Thread(target=throttle.acquire)
+        thread.start()
+        time.sleep(0.05)
+        self.assertTrue(thread.is_alive())
+        throttle.release(3)
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(throttle.inflight, 1)
+
+    def test_get_throttle(self):
+        """Checks if the throttle is disabled without limits."""
+        self.assertIsNone(_get_throttle(self._conf))
+        self._conf.k2hr3.max_inflight_requests = 3
+        throttle = _get_throttle(self._conf)
+        self.assertIs(_get_throttle(self._conf), throttle)
+        self.assertEqual(throttle.max_inflight, 3)
+        self._conf.k2hr3.max_inflight_requests = 5
+        _update_throttle(self._conf)
+        self.assertEqual(throttle.max_inflight, 5)
+
+    def test_useragent_holds_a_slot(self):
+        """Checks if a request holds a slot while in flight."""
+        self._conf.k2hr3.max_inflight_requests = 1
+        throttle = _get_throttle(self._conf)
+        agent = _K2hr3UserAgent(self._conf)
+        inflight = []
+
+        def request(*_):
+            inflight.append(throttle.inflight)
+            return MagicMock(status=204), b''
+
+        with patch.object(_K2hr3UserAgent, '_get_pool') as get_pool:
+            get_pool.return_value.request.side_effect = request
+            self.assertTrue(
+                agent._send_internal(agent.url, {'cuk': 'x'}, agent.headers,
+                                     'DELETE'))
+        self.assertEqual(inflight, [1])
+        self.assertEqual(throttle.inflight, 0)
+
+    def test_useragent_concurrent_chunks(self):
+        """Checks if concurrent requests are sent in chunks under the cap."""
+        self._conf.k2hr3.delivery_engine = 'asyncio'
+        self._conf.k2hr3.bulk_delete = False
+        self._conf.k2hr3.max_inflight_requests = 2
+        agents = []
+        for n in range(5):
+            agent = _K2hr3UserAgent(self._conf)
+            agent.instance_id = f'12345678-1234-5678-1234-{n:012d}'
+            agent.ips = ['127.0.0.1']
+            agents.append(agent)
+        engine = MagicMock()
+        engine.request_all.side_effect = lambda requests: [
+            (MagicMock(status=204), b'') for _ in requests
+        ]
+        with patch('k2hr3_osnl.useragent._get_delivery_engine',
+                   return_value=engine):
+            self.assertEqual(_K2hr3UserAgent.send_bulk(agents), [True] * 5)
+        self.assertEqual(
+            [len(call.args[0]) for call in engine.request_all.call_args_list],
+            [2, 2, 1])
+        self.assertEqual(_get_throttle(self._conf).inflight, 0)
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the per-stage timing of notification messages."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+from pathlib import Path
+from os import path, sep
+import threading
+import unittest
+from unittest.mock import patch
+
+from oslo_messaging import NotificationFilter  # type: ignore
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint
+from k2hr3_osnl.endpoint import _K2hr3NotificationFilter
+from k2hr3_osnl.metrics import _MESSAGE_SECONDS, _STAGE_SECONDS
+from k2hr3_osnl.timing import (_K2hr3Trace, _annotate, _broker_seconds,
+                               _current_trace, _finish_trace, _mark,
+                               _set_trace, _start_trace)
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+LOG = logging.getLogger(__name__)
+
+_PAYLOAD = {'port': {'device_id': '12345678-1234-5678-1234-567812345678'}}
+
+
+def _count(histogram, **labels):
+    """Returns the number of observations of the labels."""
+    for name, sample_labels, value in histogram.collect()['samples']:
+        if name.endswith('_count') and sample_labels == labels:
+            return value
+    return 0
+
+
+class TestK2hr3Timing(unittest.TestCase):
+    """Tests the timing functions."""
+
+    def tearDown(self):
+        """Tears down a test case."""
+        _set_trace(None)
+
+    def test_trace_mark(self):
+        """Checks if marks of the same stage are added up."""
+        with patch('k2hr3_osnl.timing.time.monotonic',
+                   side_effect=[10.0, 10.5, 11.0, 12.0]):
+            trace = _K2hr3Trace()
+            trace.mark('connect')
+            trace.mark('api')
+            trace.mark('connect')
+        self.assertEqual(trace.stages, {'connect': 1.5, 'api': 0.5})
+        self.assertEqual(trace.total, 2.0)
+
+    def test_mark_without_trace(self):
+        """Checks if _mark and _annotate do nothing without a trace."""
+        self.assertIsNone(_current_trace())
+        _mark('api')
+        _annotate(cuk='abc')
+        trace = _start_trace()
+        _mark('api')
+        _annotate(cuk='abc')
+        self.assertIs(_current_trace(), trace)
+        self.assertIn('api', trace.stages)
+        self.assertEqual(trace.fields, {'cuk': 'abc'})
+
+    def test_trace_per_thread(self):
+        """Checks if a trace is local to the thread."""
+        _start_trace()
+        traces = []
+        thread = threading.Thread(
+            target=lambda: traces.append(_current_trace()))
+        thread.start()
+        thread.join()
+        self.assertEqual(traces, [None])
+
+    def test_broker_seconds(self):
+        """Checks if the time in the message queue server is computed."""
+        sent = datetime.now(timezone.utc) - timedelta(seconds=5)
+        naive = sent.replace(tzinfo=None).isoformat(sep=' ')
+        self.assertAlmostEqual(_broker_seconds({'timestamp': naive}), 5,
+                               delta=1)
+        self.assertIsNone(_broker_seconds({}))
+        self.assertIsNone(_broker_seconds({'timestamp': 'abc'}))
+        self.assertIsNone(_broker_seconds(None))
+
+    def test_finish_trace_slow(self):
+        """Checks if a slow message is logged in JSON."""
+        trace = _start_trace()
+        _annotate(cuk='abc')
+        trace.mark('api')
+        with self.assertLogs('k2hr3_osnl.timing', 'WARNING') as logs:
+            _finish_trace(trace, 0.5, broker=1.0)
+        self.assertIsNone(_current_trace())
+        record = json.loads(logs.output[0].split('slow message ', 1)[1])
+        self.assertEqual(record['cuk'], 'abc')
+        self.assertEqual(record['broker'], 1.0)
+        self.assertIn('api', record['stages'])
+
+    def test_finish_trace_fast(self):
+        """Checks if nothing is logged unless slow_message_seconds is set."""
+        trace = _start_trace()
+        trace.mark('api')
+        with patch('k2hr3_osnl.timing.LOG') as log:
+            _finish_trace(trace, 0, broker=100.0)
+            _finish_trace(trace, 1000)
+        log.warning.assert_not_called()
+
+    def test_endpoint_observes_stages(self):
+        """Checks if the stages of a message are observed."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.slow_message_seconds = 1e-9
+        endpoint = K2hr3NotificationEndpoint(conf)
+        rule = _K2hr3NotificationFilter(
+            NotificationFilter(event_type=r'^port\.delete\.end$'))
+        before = {
+            stage: _count(_STAGE_SECONDS, stage=stage)
+            for stage in ('filter', 'parse', 'queue', 'result')
+        }
+        messages = _count(_MESSAGE_SECONDS)
+        self.assertTrue(
+            rule.match({}, 'network.host1', 'port.delete.end', {}, _PAYLOAD))
+        with patch.object(K2hr3NotificationEndpoint,
+                          '_K2hr3NotificationEndpoint__call_r3api',
+                          return_value='handled'):
+            with self.assertLogs('k2hr3_osnl.timing', 'WARNING') as logs:
+                endpoint.info({}, 'network.host1', 'port.delete.end',
+                              _PAYLOAD, {})
+        for stage, count in before.items():
+            self.assertEqual(_count(_STAGE_SECONDS, stage=stage), count + 1,
+                             stage)
+        self.assertEqual(_count(_MESSAGE_SECONDS), messages + 1)
+        record = json.loads(logs.output[0].split('slow message ', 1)[1])
+        self.assertEqual(record['event_type'], 'port.delete.end')
+        self.assertEqual(record['result'], 'handled')
+        self.assertEqual(record['cuk'], _PAYLOAD['port']['device_id'])
+        self.assertIsNone(_current_trace())
+
+    def test_filter_drops_trace(self):
+        """Checks if the trace of a filtered message is dropped."""
+        rule = _K2hr3NotificationFilter(
+            NotificationFilter(event_type=r'^port\.delete\.end$'))
+        self.assertFalse(
+            rule.match({}, 'network.host1', 'port.update.end', {}, {}))
+        self.assertIsNone(_current_trace())
+
+    def test_trace_follows_shard(self):
+        """Checks if the trace is current in the thread of a shard."""
+        conf = K2hr3Conf(conf_file_path)
+        conf.k2hr3.shards = 2
+        endpoint = K2hr3NotificationEndpoint(conf)
+        traces = []
+
+        def call_r3api(*_):
+            traces.append(_current_trace())
+            return 'handled'
+
+        trace = _start_trace()
+        with patch.object(K2hr3NotificationEndpoint,
+                          '_K2hr3NotificationEndpoint__call_r3api',
+                          autospec=True, side_effect=call_r3api):
+            endpoint.info({}, 'network.host1', 'port.delete.end', _PAYLOAD,
+                          {})
+        self.assertEqual(traces, [trace])
+        self.assertIn('queue', trace.stages)
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Tests the TLS context to the k2hr3 api."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from pathlib import Path
+from os import path, sep
+import ssl
+import threading
+import unittest
+
+from k2hr3_osnl.cfg import K2hr3Conf
+from k2hr3_osnl.connection import _K2hr3ConnectionPool
+from k2hr3_osnl.exceptions import _K2hr3UserAgentError
+from k2hr3_osnl.tls import _get_ssl_context, _reset_ssl_contexts
+
+here = path.abspath(path.dirname(__file__))
+conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
+cert_file_path = Path(sep.join([here, 'k2hr3-osnl.crt'])).resolve()
+key_file_path = Path(sep.join([here, 'k2hr3-osnl.key'])).resolve()
+LOG = logging.getLogger(__name__)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """A keep-alive k2hr3 api stub."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_DELETE(self):  # noqa: N802 pylint: disable=invalid-name
+        """Handles a DELETE request."""
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        # closes every connection to make the client reconnect.
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Suppresses access logs."""
+
+
+class TestK2hr3Tls(unittest.TestCase):
+    """Tests the TLS context functions."""
+
+    def setUp(self):
+        """Sets up a test case."""
+        _reset_ssl_contexts()
+        self._conf = K2hr3Conf(conf_file_path)
+
+    def tearDown(self):
+        """Tears down a test case."""
+        _reset_ssl_contexts()
+
+    def test_get_ssl_context_shared(self):
+        """Checks if a context is built once."""
+        ctx1 = _get_ssl_context(self._conf)
+        ctx2 = _get_ssl_context(self._conf)
+        self.assertIs(ctx1, ctx2)
+        self.assertEqual(ctx1.verify_mode, ssl.CERT_REQUIRED)
+
+    def test_get_ssl_context_allow_self_signed_cert(self):
+        """Checks if allow_self_signed_cert disables the verification."""
+        ctx = _get_ssl_context(self._conf, allow_self_signed_cert=True)
+        self.assertIsNot(ctx, _get_ssl_context(self._conf))
+        self.assertFalse(ctx.check_hostname)
+        self.assertEqual(ctx.verify_mode, ssl.CERT_NONE)
+
+    def test_get_ssl_context_rebuilt_on_change(self):
+        """Checks if a new context is built when the settings change."""
+        ctx1 = _get_ssl_context(self._conf)
+        self._conf.k2hr3.ca_file = str(cert_file_path)
+        ctx2 = _get_ssl_context(self._conf)
+        self.assertIsNot(ctx1, ctx2)
+
+    def test_get_ssl_context_invalid_ca_file(self):
+        """Checks if an invalid ca_file raises an error."""
+        self._conf.k2hr3.ca_file = '/nonexistent/ca.pem'
+        with self.assertRaises(_K2hr3UserAgentError):
+            _get_ssl_context(self._conf)
+
+    def test_get_ssl_context_client_cert(self):
+        """Checks if the client certificate is loaded."""
+        self._conf.k2hr3.cert_file = str(cert_file_path)
+        self._conf.k2hr3.key_file = str(key_file_path)
+        ctx = _get_ssl_context(self._conf)
+        self.assertIsInstance(ctx, ssl.SSLContext)
+
+    def test_connection_pool_session_resumption(self):
+        """Checks if the TLS session is resumed on a new connection."""
+        server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+        server.daemon_threads = True
+        server_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_ctx.load_cert_chain(str(cert_file_path), str(key_file_path))
+        server.socket = server_ctx.wrap_socket(server.socket,
+                                               server_side=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            self._conf.k2hr3.ca_file = str(cert_file_path)
+            ctx = _get_ssl_context(self._conf)
+            pool = _K2hr3ConnectionPool('https', '127.0.0.1',
+                                        server.server_address[1],
+                                        context=ctx)
+            res, _ = pool.request('DELETE', '/v1/role', {}, 5)
+            self.assertEqual(res.status, 204)
+            self.assertIsNotNone(pool._session)
+            conn = pool._new_connection(5)
+            conn.connect()
+            self.assertTrue(conn.sock.session_reused)
+            conn.close()
+            pool.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_connection_pool_context_replaced(self):
+        """Checks if idle connections are closed when the context changes."""
+        pool = _K2hr3ConnectionPool('https', '127.0.0.1', 443,
+                                    context=_get_ssl_context(self._conf))
+        conn = pool._new_connection(5)
+        pool._created += 1
+        pool._release(conn, pool.context)
+        self.assertEqual(pool.idle, 1)
+        pool.context = _get_ssl_context(self._conf,
+                                        allow_self_signed_cert=True)
+        self.assertEqual(pool.idle, 0)
+        self.assertEqual(pool.size, 0)
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -50,12 +50,13 @@ from pathlib import Path
 from os import path, sep
 import os
 import sys
+import threading
 import unittest
 from unittest.mock import patch
 
 from k2hr3_osnl.cfg import K2hr3Conf
 from k2hr3_osnl.exceptions import _K2hr3UserAgentError
-from k2hr3_osnl.useragent import _K2hr3UserAgent
+from k2hr3_osnl.useragent import _K2hr3UserAgent, _get_agent
 
 here = path.abspath(path.dirname(__file__))
 conf_file_path = Path(sep.join([here, 'k2hr3-osnl.conf'])).resolve()
@@ -383,6 +384,68 @@ class TestK2hr3UserAgent(unittest.TestCase):
         # Ensure values are as expected at runtime.
         mock_send_method.assert_called_once_with(url, params, headers, method)
 
+    def test_k2hr3useragent_slots(self):
+        """Checks if an agent has no instance dict."""
+        agent = _K2hr3UserAgent(self._conf)
+        with self.assertRaises(AttributeError):
+            agent.unknown = 1
+
+    def test_k2hr3useragent_headers_immutable(self):
+        """Checks if the shared headers can not be modified."""
+        agent = _K2hr3UserAgent(self._conf)
+        with self.assertRaises(TypeError):
+            agent.headers['User-Agent'] = 'broken'
+        self.assertIs(agent.headers, _K2hr3UserAgent(self._conf).headers)
+
+    def test_k2hr3useragent_reset(self):
+        """Checks if reset clears the request and the response."""
+        agent = _K2hr3UserAgent(self._conf)
+        params = agent.params
+        agent.instance_id = '12345678-1234-5678-1234-567812345678'
+        agent.ips = ['127.0.0.1']
+        agent.method = 'GET'
+        agent._response.code = 503
+        agent._response.error = 'broken'
+        agent.reset(self._conf)
+        self.assertIs(agent.params, params)
+        self.assertEqual(agent.params, {'extra': 'openstack-auto-v1'})
+        self.assertEqual(agent.instance_id, '')
+        self.assertEqual(agent.ips, [])
+        self.assertEqual(agent.method, 'DELETE')
+        self.assertEqual(agent.code, -1)
+        self.assertEqual(agent.error, '')
+        self.assertFalse(agent.deferred)
+
+    def test_get_agent_per_thread(self):
+        """Checks if an agent is reused in a thread only."""
+        agent = _get_agent(self._conf)
+        agent.instance_id = '12345678-1234-5678-1234-567812345678'
+        self.assertIs(_get_agent(self._conf), agent)
+        self.assertEqual(agent.instance_id, '')
+        others = []
+        thread = threading.Thread(
+            target=lambda: others.append(_get_agent(self._conf)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(others[0], agent)
+
+    def test_reset_validates_changed_url(self):
+        """Checks if reset validates the api_url only if it changed."""
+        agent = _K2hr3UserAgent(self._conf)
+        with patch.object(_K2hr3UserAgent, 'validate_url',
+                          return_value=True) as validate_url:
+            agent.reset(self._conf)
+            agent.reset(self._conf)
+            validate_url.assert_not_called()
+            self._conf.k2hr3.api_url = 'http://localhost/v1/role'
+            agent.reset(self._conf)
+            validate_url.assert_called_once_with('http://localhost/v1/role')
+            conf = K2hr3Conf(conf_file_path)
+            agent.reset(conf)
+            self.assertEqual(validate_url.call_count, 2)
+        self.assertIs(agent._conf, conf)
+        self.assertEqual(agent.url, conf.k2hr3.api_url)
+
 #
 # Local variables:
 # tab-width: 4
@@ -99,6 +99,15 @@ class TestK2hr3UserAgentResponse(unittest.TestCase):
         self.assertEqual('error should be str, not {}'.format(111000111),
                          '{}'.format(the_exception))
 
+    def test_k2hr3httpresponse_reset(self):
+        """Checks if reset clears the code and the error."""
+        response = _K2hr3HttpResponse()
+        response.code = 503
+        response.error = 'OSO'
+        response.reset()
+        self.assertEqual(response.code, -1)
+        self.assertEqual(response.error, '')
+
 #
 # EOF
 #
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""Micro benchmarks of the per-message work of the listener.
+
+Measures the CPU time to handle a notification message in the endpoint
+without calling the k2hr3 api. Each case runs at the INFO and the DEBUG
+level. The "eager" case serializes the payload like the old code did.
+
+The hot functions of the per-message path are measured one by one at the
+INFO level too: parsing each payload family, building a user agent with
+the url validation, the ips and instance_id setters and building the
+query string of a request. They are reported in ns/op, and in memory
+blocks and peak bytes per op traced by tracemalloc. Each case is run -r
+times and the fastest run is reported to reduce the noise.
+
+The prefilter cases compare decoding a message serialized like the rabbit
+driver with screening it by the prefilter. "skipped" is a message of an
+irrelevant event type, "matched" is a relevant one which is screened and
+decoded, and "traffic" cycles the sample messages of which 19 of 20 are
+irrelevant.
+
+The codec cases compare the json libraries installed on the sample
+payloads: the compact serialization used for the request params and the
+spool, the indented one used for the debug logs, and the deserialization
+of the whole message. The stdlib json is always measured as the baseline.
+
+Simple usage:
+
+$ python3 tools/micro_benchmark.py -n 2000
+$ python3 tools/micro_benchmark.py -n 10000 -r 5 -k agent
+$ python3 tools/micro_benchmark.py -k codec/
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+import re
+import sys
+import time
+import tracemalloc
+from unittest.mock import patch
+
+from oslo_messaging._drivers import common as driver_common  # type: ignore
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent / 'src'))
+
+from k2hr3_osnl.cfg import K2hr3Conf  # noqa
+from k2hr3_osnl.codec import _CODECS  # noqa
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint  # noqa
+from k2hr3_osnl.prefilter import _K2hr3Prefilter  # noqa
+from k2hr3_osnl.useragent import _K2hr3UserAgent, _get_agent  # noqa
+
+DATA = {
+    'neutron': HERE / 'data' / 'notifications_neutron.json',
+    'nova': HERE / 'data' / 'notifications_nova.json',
+    'nova_versioned': HERE / 'data' / 'versioned_notifications_nova.json',
+}
+LEVELS = {'info': logging.INFO, 'debug': logging.DEBUG}
+IPS = ['172.16.0.1', '2001:db8::1']
+INSTANCE_ID = '12345678-1234-5678-1234-567812345678'
+
+
+def _configure_logger(level):
+    """Emits records of the package to /dev/null at the level."""
+    logger = logging.getLogger('k2hr3_osnl')
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    # pylint: disable=consider-using-with
+    handler = logging.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))
+    handler.setFormatter(
+        logging.Formatter(
+            '%(asctime)-15s %(levelname)s %(name)s:%(lineno)d %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+def bench_endpoint_info(endpoint, message, iterations, eager=False):
+    """Returns CPU seconds per message of K2hr3NotificationEndpoint.info."""
+    started = time.process_time()
+    for _ in range(iterations):
+        if eager:
+            # what the endpoint did before the lazy logging.
+            json.dumps(message['payload'], indent=4, sort_keys=True)
+        endpoint.info(message['ctxt'], message['publisher_id'],
+                      message['event_type'], message['payload'],
+                      message['metadata'])
+    return (time.process_time() - started) / iterations
+
+
+def bench_ns(func, iterations, repeat):
+    """Returns the fastest nanoseconds per call of func in repeat runs."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        for _ in range(iterations):
+            func()
+        elapsed = (time.perf_counter_ns() - started) / iterations
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_allocations(func, iterations):
+    """Returns memory blocks and peak bytes per call of func.
+
+    The results are kept alive until the end, so that the blocks they hold
+    are counted. The peak is the highest memory a call takes, including
+    the temporary objects freed before it returns.
+    """
+    results = []
+    peak = 0
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for _ in range(iterations):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            results.append(func())
+            peak += tracemalloc.get_traced_memory()[1] - current
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks = sum(stat.count_diff for stat in after.filter_traces(
+        filters).compare_to(before.filter_traces(filters), 'filename'))
+    del results
+    return blocks / iterations, peak / iterations
+
+
+def _envelope(message, event_type):
+    """Returns a message serialized like the rabbit driver."""
+    body = {
+        'message_id': 'ffffffff-ffff-ffff-ffff-ffffffffffff',
+        'publisher_id': message['publisher_id'],
+        'event_type': event_type,
+        'priority': 'INFO',
+        'payload': message['payload'],
+        'timestamp': '2018-09-11 00:00:00.000000',
+    }
+    body.update(('_context_' + key, value)
+                for key, value in message['ctxt'].items())
+    body['_unique_id'] = 'eeeeeeeeeeeeeeeeeeeeeeeeeeeeeeee'
+    return driver_common.serialize_msg(body)
+
+
+def prefilter_cases():
+    """Returns decoding and screening the sample messages by names."""
+    messages = {}
+    for name, path in DATA.items():
+        with open(path, encoding='utf-8') as data:
+            messages[name] = json.load(data)
+    prefilter = _K2hr3Prefilter([
+        (re.compile(f'^{re.escape(message["publisher_id"])}$'),
+         re.compile(f'^{re.escape(message["event_type"])}$'))
+        for message in messages.values()
+    ])
+    decode = driver_common.deserialize_msg
+
+    def screen(envelope):
+        return prefilter.screen(envelope) or decode(envelope)
+
+    cases = {}
+    traffic = []
+    for name, message in messages.items():
+        skipped = _envelope(message,
+                            message['event_type'].replace('delete', 'update'))
+        matched = _envelope(message, message['event_type'])
+        cases[f'decode/{name}'] = lambda envelope=skipped: decode(envelope)
+        cases[f'prefilter/{name}/skipped'] = (
+            lambda envelope=skipped: screen(envelope))
+        cases[f'prefilter/{name}/matched'] = (
+            lambda envelope=matched: screen(envelope))
+        traffic.extend([skipped] * 19 + [matched])
+    decoded = itertools.cycle(traffic)
+    screened = itertools.cycle(traffic)
+    cases['decode/traffic'] = lambda: decode(next(decoded))
+    cases['prefilter/traffic'] = lambda: screen(next(screened))
+    return cases
+
+
+def codec_cases():
+    """Returns serializing the sample payloads by every codec by names."""
+    cases = {}
+    for name, path in DATA.items():
+        with open(path, encoding='utf-8') as data:
+            text = data.read()
+        payload = json.loads(text)['payload']
+        for operation, func, arg in (('dumps', 'dumps', payload),
+                                     ('pretty', 'dumps_pretty', payload),
+                                     ('loads', 'loads', text)):
+            for library, codec in _CODECS.items():
+                cases[f'codec/{name}/{operation}/{library}'] = (
+                    lambda func=getattr(codec, func), arg=arg: func(arg))
+    return cases
+
+
+def hot_cases(conf, endpoint):
+    """Returns the hot functions of the per-message path by names."""
+    cases = {}
+    for name, path in DATA.items():
+        with open(path, encoding='utf-8') as data:
+            payload = json.load(data)['payload']
+        cases[f'payload_to_params/{name}'] = (
+            lambda payload=payload: endpoint._payload_to_params(payload))
+    agent = _K2hr3UserAgent(conf)
+    cases['agent/__init__'] = lambda: _K2hr3UserAgent(conf)
+    cases['agent/_get_agent'] = lambda: _get_agent(conf)
+    cases['agent/validate_url'] = (
+        lambda: _K2hr3UserAgent.validate_url(conf.k2hr3.api_url))
+
+    def set_ips():
+        agent.ips = IPS
+
+    def set_instance_id():
+        agent.instance_id = INSTANCE_ID
+
+    cases['agent/ips'] = set_ips
+    cases['agent/instance_id'] = set_instance_id
+    set_ips()
+    set_instance_id()
+    cases['agent/query_string'] = (
+        lambda: agent._request_path(conf.k2hr3.api_url, agent.params))
+    return cases
+
+
+def main():
+    """Runs the benchmarks and prints the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n',
+                        dest='iterations',
+                        type=int,
+                        default=2000,
+                        help='messages per case. default: 2000')
+    parser.add_argument('-c',
+                        dest='config_file',
+                        default=str(HERE.parent / 'etc' / 'k2hr3-osnl.conf'),
+                        help='config file path')
+    parser.add_argument('-r',
+                        dest='repeat',
+                        type=int,
+                        default=3,
+                        help='runs per hot function case. default: 3')
+    parser.add_argument('-k',
+                        dest='keyword',
+                        default='',
+                        help='runs the hot function cases which names'
+                        ' contain the keyword only')
+    args = parser.parse_args()
+
+    conf = K2hr3Conf(Path(args.config_file))
+    with patch.object(K2hr3NotificationEndpoint,
+                      '_K2hr3NotificationEndpoint__call_r3api',
+                      return_value='handled'):
+        endpoint = K2hr3NotificationEndpoint(conf)
+        print(f'{"data":<16}{"level":<8}{"lazy us/msg":>14}'
+              f'{"eager us/msg":>14}')
+        for name, path in DATA.items():
+            with open(path, encoding='utf-8') as data:
+                message = json.load(data)
+            for level_name, level in LEVELS.items():
+                _configure_logger(level)
+                bench_endpoint_info(endpoint, message, 100)  # warm up
+                lazy = bench_endpoint_info(endpoint, message, args.iterations)
+                eager = bench_endpoint_info(endpoint, message,
+                                            args.iterations, eager=True)
+                print(f'{name:<16}{level_name:<8}{lazy * 1e6:>14.1f}'
+                      f'{eager * 1e6:>14.1f}')
+
+        _configure_logger(logging.INFO)
+        print()
+        print(f'{"case":<34}{"ns/op":>12}{"blocks/op":>12}'
+              f'{"peak B/op":>12}')
+        cases = hot_cases(conf, endpoint)
+        cases.update(prefilter_cases())
+        cases.update(codec_cases())
+        for name, func in cases.items():
+            if args.keyword not in name:
+                continue
+            bench_ns(func, 100, 1)  # warm up
+            nanoseconds = bench_ns(func, args.iterations, args.repeat)
+            blocks, peak = bench_allocations(func, args.iterations)
+            print(f'{name:<34}{nanoseconds:>12.0f}{blocks:>12.2f}'
+                  f'{peak:>12.0f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# K2HR3 OpenStack Notification Listener
+#
+# Copyright 2018 Yahoo Japan Corporation
+#
+# K2HR3 is K2hdkc based Resource and Roles and policy Rules, gathers
+# common management information for the cloud.
+# K2HR3 can dynamically manage information as "who", "what", "operate".
+# These are stored as roles, resources, policies in K2hdkc, and the
+# client system can dynamically read and modify these information.
+#
+# For the full copyright and license information, please view
+# the licenses file that was distributed with this source code.
+#
+# AUTHOR:   Hirotaka Wakabayashi
+# CREATE:   Tue Sep 11 2018
+# REVISION:
+#
+"""End-to-end throughput benchmark of the listener.
+
+Runs listen() on the in-memory fake:// transport of oslo.messaging against
+a stub k2hr3 api with a configurable latency and error rate. The messages
+in tools/data are published at a controlled rate, each with its own
+instance id. A message is delivered when the stub api responds 2xx to a
+request with its instance id, so a retried or spooled message is
+delivered late, and a message which never gets 2xx is lost. The
+throughput and the latency from the notifier to the delivery, and the
+number of lost and requeued messages are reported, and can be saved as
+JSON to compare versions.
+
+Simple usage:
+
+$ python3 tools/throughput_benchmark.py -n 5000 --rate 1000 --latency 0.005
+$ python3 tools/throughput_benchmark.py -n 5000 -o k2hr3.shards=4 \\
+      --output after.json --baseline before.json
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import argparse
+import configparser
+import copy
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import uuid
+
+import oslo_messaging  # type: ignore
+from oslo_config import cfg  # type: ignore
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent / 'src'))
+
+import k2hr3_osnl  # noqa
+from k2hr3_osnl.cfg import K2hr3Conf  # noqa
+from k2hr3_osnl.endpoint import K2hr3BatchNotificationEndpoint  # noqa
+from k2hr3_osnl.endpoint import K2hr3NotificationEndpoint  # noqa
+
+DATA = {
+    'neutron': HERE / 'data' / 'notifications_neutron.json',
+    'nova': HERE / 'data' / 'notifications_nova.json',
+    'nova_versioned': HERE / 'data' / 'versioned_notifications_nova.json',
+}
+LEVELS = {'info': logging.INFO, 'debug': logging.DEBUG,
+          'error': logging.ERROR}
+EXCHANGE = 'k2hr3_benchmark'
+TOPIC = 'notifications'
+
+
+def _configure_logger(level):
+    """Emits records of the package to /dev/null at the level."""
+    logger = logging.getLogger('k2hr3_osnl')
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    # pylint: disable=consider-using-with
+    handler = logging.StreamHandler(open(os.devnull, 'w', encoding='utf-8'))
+    handler.setFormatter(
+        logging.Formatter(
+            '%(asctime)-15s %(levelname)s %(name)s:%(lineno)d %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """A keep-alive k2hr3 api stub."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        """Responds after the latency, or an error at the error rate.
+
+        Instance ids of a request responded 2xx are told to the recorder.
+        """
+        length = int(self.headers.get('Content-Length', 0))
+        members = []
+        if length:
+            members = json.loads(self.rfile.read(length)).get('members', [])
+        cuks = urllib.parse.parse_qs(urllib.parse.urlsplit(
+            self.path).query).get('cuk', [])
+        cuks.extend(member['cuk'] for member in members)
+        stats = self.server.stats
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        status = 204
+        if random.random() < self.server.error_rate:  # nosec
+            status = 503
+        with self.server.lock:
+            stats['requests'] += 1
+            stats['errors'] += status >= 500
+        if status < 300:
+            for cuk in cuks:
+                self.server.recorder.delivered(cuk)
+        body = b''
+        if members and status < 300:  # results of a bulk request
+            status = 200
+            body = json.dumps({
+                'results': [{'cuk': member['cuk'], 'code': 204}
+                            for member in members]
+            }).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_DELETE = _respond  # noqa: N815
+    do_OPTIONS = _respond  # noqa: N815
+
+    def log_message(self, *args):
+        """Suppresses access logs."""
+
+
+def _start_stub_api(latency, error_rate, recorder):
+    """Starts the stub api in a thread and returns the server."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.daemon_threads = True
+    server.recorder = recorder
+    server.latency = latency
+    server.error_rate = error_rate
+    server.lock = threading.Lock()
+    server.stats = {'requests': 0, 'errors': 0}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class _Recorder:
+    """Records the time each message is published and delivered."""
+
+    def __init__(self, count):
+        self.sent = [0.0] * count
+        self.done = [0.0] * count
+        self.requeued = 0
+        self._remaining = count
+        self._cond = threading.Condition()
+
+    def delivered(self, cuk):
+        """Records the first 2xx response to a request of the instance."""
+        seq = _seq(cuk)
+        if not 0 <= seq < len(self.done):
+            return
+        now = time.perf_counter()
+        with self._cond:
+            if not self.done[seq]:
+                self.done[seq] = now
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self._cond.notify_all()
+
+    def handled(self, result):
+        """Counts a message the endpoint requeued."""
+        if result == oslo_messaging.NotificationResult.REQUEUE:
+            with self._cond:
+                self.requeued += 1
+
+    def wait(self, timeout):
+        """Waits until all messages are delivered."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._remaining == 0, timeout)
+
+
+def _endpoint_classes(recorder):
+    """Returns endpoint classes which tell the recorder of deliveries."""
+
+    class _Endpoint(K2hr3NotificationEndpoint):
+        """Records deliveries of messages."""
+
+        def info(self, context, publisher_id, event_type, payload,
+                 metadata):
+            result = super().info(context, publisher_id, event_type,
+                                  payload, metadata)
+            recorder.handled(result)
+            return result
+
+    class _BatchEndpoint(K2hr3BatchNotificationEndpoint):
+        """Records deliveries of batches."""
+
+        def info(self, messages):
+            results = super().info(messages)
+            for result in results:
+                recorder.handled(result)
+            return results
+
+    return _Endpoint, _BatchEndpoint
+
+
+def _cuk(seq):
+    """Returns the instance id of the message of the sequence number."""
+    return str(uuid.UUID(int=seq + 1))
+
+
+def _seq(cuk):
+    """Returns the sequence number of the message of the instance id."""
+    try:
+        return uuid.UUID(cuk).int - 1
+    except ValueError:
+        return -1
+
+
+def _with_cuk(payload, cuk):
+    """Returns a copy of the payload with the instance id replaced."""
+    payload = copy.deepcopy(payload)
+    if payload.get('port', None):
+        payload['port']['device_id'] = cuk
+    if payload.get('nova_object.data', None):
+        payload['nova_object.data']['uuid'] = cuk
+    if payload.get('instance_id', None):
+        payload['instance_id'] = cuk
+    return payload
+
+
+def _messages(names, count):
+    """Returns count messages cycling through the data files."""
+    data = []
+    for name in names:
+        with open(DATA[name], encoding='utf-8') as f:
+            data.append(json.load(f))
+    messages = []
+    for seq in range(count):
+        message = data[seq % len(data)]
+        messages.append((message['publisher_id'], message['event_type'],
+                         message['ctxt'],
+                         _with_cuk(message['payload'], _cuk(seq))))
+    return messages
+
+
+def _write_config(path, port, names, overrides):
+    """Writes the config file of the listener."""
+    event_types = set()
+    for name in names:
+        with open(DATA[name], encoding='utf-8') as f:
+            event_types.add(json.load(f)['event_type'])
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read_dict({
+        'DEFAULT': {
+            'debug_level': 'error',
+        },
+        'oslo_messaging_notifications': {
+            'event_type':
+            '^(' + '|'.join(sorted(t.replace('.', r'\.')
+                                   for t in event_types)) + ')$',
+            'publisher_id': '^.*$',
+            'transport_url': 'fake://',
+            'topic': TOPIC,
+            'exchange': EXCHANGE,
+        },
+        'k2hr3': {
+            'api_url': f'http://127.0.0.1:{port}/v1/role',
+        },
+    })
+    for override in overrides:
+        key, _, value = override.partition('=')
+        section, _, option = key.rpartition('.')
+        if not parser.has_section(section) and section != 'DEFAULT':
+            parser.add_section(section)
+        parser.set(section or 'DEFAULT', option, value)
+    with open(path, 'w', encoding='utf-8') as f:
+        parser.write(f)
+
+
+def _publish(messages, recorder, rate):
+    """Publishes messages at the rate. 0 publishes as fast as possible."""
+    oslo_messaging.set_transport_defaults(control_exchange=EXCHANGE)
+    transport = oslo_messaging.get_notification_transport(cfg.CONF,
+                                                          url='fake://')
+    notifiers = {}
+    started = time.perf_counter()
+    for seq, (publisher_id, event_type, ctxt, payload) in enumerate(messages):
+        if rate > 0:
+            delay = started + seq / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        notifier = notifiers.get(publisher_id, None)
+        if notifier is None:
+            notifier = oslo_messaging.Notifier(transport,
+                                               publisher_id=publisher_id,
+                                               driver='messagingv2',
+                                               topics=[TOPIC])
+            notifiers[publisher_id] = notifier
+        recorder.sent[seq] = time.perf_counter()
+        notifier.info(ctxt, event_type, payload)
+
+
+def _percentile(values, percent):
+    """Returns the nearest-rank percentile of sorted values."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1,
+                      int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def _summarize(recorder, warmup):
+    """Returns the throughput and the latency of the delivered messages."""
+    pairs = [(sent, done) for sent, done in zip(recorder.sent, recorder.done)
+             if done]
+    measured = pairs[warmup:] if len(pairs) > warmup else pairs
+    latencies = sorted(done - sent for sent, done in measured)
+    elapsed = 0.0
+    if measured:
+        elapsed = max(done for _, done in measured) - \
+            min(sent for sent, _ in measured)
+    result = {
+        'messages': len(recorder.sent),
+        'delivered': len(pairs),
+        'lost': len(recorder.sent) - len(pairs),
+        'requeued': recorder.requeued,
+        'measured': len(measured),
+        'elapsed_seconds': elapsed,
+        'throughput_per_second': len(measured) / elapsed if elapsed else 0,
+        'latency_seconds': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': _percentile(latencies, 50),
+            'p99': _percentile(latencies, 99),
+            'p999': _percentile(latencies, 99.9),
+            'max': latencies[-1] if latencies else None,
+        },
+    }
+    return result
+
+
+def _print_result(result, baseline=None):
+    """Prints the result and the change from the baseline."""
+    rows = [('throughput/s', result['throughput_per_second'], 1)]
+    for name in ('mean', 'p50', 'p99', 'p999', 'max'):
+        rows.append((f'{name} ms', result['latency_seconds'][name], 1000))
+    print(f'messages {result["delivered"]}/{result["messages"]} delivered,'
+          f' {result["lost"]} lost, {result["requeued"]} requeued,'
+          f' api {result["api"]["requests"]} requests'
+          f' {result["api"]["errors"]} errors')
+    print(f'{"metric":<16}{"value":>12}' +
+          (f'{"baseline":>12}{"change":>10}' if baseline else ''))
+    for name, value, scale in rows:
+        line = f'{name:<16}'
+        line += f'{value * scale:>12.2f}' if value is not None else \
+            f'{"-":>12}'
+        if baseline:
+            if name == 'throughput/s':
+                base = baseline.get('throughput_per_second', None)
+            else:
+                base = baseline.get('latency_seconds',
+                                    {}).get(name.split()[0], None)
+            if base and value is not None:
+                line += f'{base * scale:>12.2f}'
+                line += f'{(value - base) / base * 100:>+9.1f}%'
+        print(line)
+
+
+def main():
+    """Runs the benchmark and prints the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n',
+                        dest='count',
+                        type=int,
+                        default=2000,
+                        help='messages to publish. default: 2000')
+    parser.add_argument('--rate',
+                        type=float,
+                        default=0,
+                        help='messages per second. default: 0 publishes as'
+                        ' fast as possible')
+    parser.add_argument('--data',
+                        nargs='+',
+                        choices=sorted(DATA),
+                        default=sorted(DATA),
+                        help='data files to replay. default: all')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.005,
+                        help='seconds the stub api takes to respond.'
+                        ' default: 0.005')
+    parser.add_argument('--error-rate',
+                        type=float,
+                        default=0,
+                        help='ratio of 503 responses of the stub api.'
+                        ' default: 0')
+    parser.add_argument('--warmup',
+                        type=int,
+                        default=100,
+                        help='first messages excluded from the results.'
+                        ' default: 100')
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=120,
+                        help='seconds to wait for the deliveries after the'
+                        ' last message. default: 120')
+    parser.add_argument('-o',
+                        dest='overrides',
+                        action='append',
+                        default=[],
+                        metavar='SECTION.OPTION=VALUE',
+                        help='overrides the config, for instance'
+                        ' k2hr3.shards=4 or'
+                        ' oslo_messaging_notifications.batch_size=10')
+    parser.add_argument('-l',
+                        dest='log_level',
+                        choices=sorted(LEVELS),
+                        default='error',
+                        help='log level of the package to /dev/null.'
+                        ' default: error')
+    parser.add_argument('--output', help='JSON file to save the results')
+    parser.add_argument('--baseline',
+                        help='JSON file of results to compare with')
+    args = parser.parse_args()
+
+    _configure_logger(LEVELS[args.log_level])
+    recorder = _Recorder(args.count)
+    server = _start_stub_api(args.latency, args.error_rate, recorder)
+    messages = _messages(args.data, args.count)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = Path(tmpdir) / 'k2hr3-osnl.conf'
+        _write_config(config_file, server.server_address[1], args.data,
+                      args.overrides)
+        conf = K2hr3Conf(config_file)
+        endpoint_class, batch_class = _endpoint_classes(recorder)
+        if conf.oslo_messaging_notifications.batch_size > 0:
+            endpoint_class = batch_class
+        endpoint = endpoint_class(conf)
+
+        def run():
+            try:
+                _publish(messages, recorder, args.rate)
+                if not recorder.wait(args.timeout):
+                    print('timed out waiting for deliveries',
+                          file=sys.stderr)
+            finally:
+                # stops listen() in the main thread.
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        # listen() handles the signals in the main thread.
+        publisher = threading.Thread(target=run, name='benchmark-publisher')
+        publisher.daemon = True
+        publisher.start()
+        status = k2hr3_osnl.listen([endpoint])
+        publisher.join()
+    server.shutdown()
+    server.server_close()
+
+    result = _summarize(recorder, args.warmup)
+    result['api'] = dict(server.stats)
+    result['settings'] = {
+        'rate': args.rate,
+        'data': args.data,
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'warmup': args.warmup,
+        'overrides': args.overrides,
+    }
+    result['version'] = k2hr3_osnl.version()
+    result['python'] = platform.python_version()
+    result['created'] = datetime.now(timezone.utc).isoformat()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    _print_result(result, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+    return status or int(result['lost'] > 0)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+#
+# EOF
+#
+
+#
+# Local variables:
+# tab-width: 4
+# c-basic-offset: 4
+# End:
+# vim600: noexpandtab sw=4 ts=4 fdm=marker
+# vim<600: noexpandtab sw=4 ts=4
+#